@@ -1,109 +1,398 @@
-from flask import Flask, request, jsonify
+import os
+from flask import Flask, Request, Response, g, request, jsonify, render_template, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from chatbot import chatbot
+from werkzeug.exceptions import RequestEntityTooLarge
+from chatbot import attachment_pool, audit_log, authenticator, chat_batch, chatbot, conversation_store, decode_attachments, iter_chat_batch, document_extractor, image_processor, model_router, request_coalescer, response_cache, retriever, semantic_cache, shared_state, speech, warmup
+from attachments import InvalidAttachment, process_attachments
+from response_cache import cache_requested
+from uploads import MAX_FILE_BYTES, MAX_REQUEST_BYTES, LimitedSpooledFile, UploadTooLarge, read_upload
+from idempotency import IDEMPOTENCY_HEADER, IdempotencyConflict, chat_fingerprint
+from batch import batch_options, parse_items
+from concurrency import Overloaded
+from token_budget import PromptTooLarge, usage
+from upstream import USER_HEADER, request_user, reset_user, set_user
+from auth import current_principal, reset_principal, set_principal
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, end_request, registry, span, start_request
+from warmup import warm_up_from_env
+from json_codec import dumps, loads
+from speech import SentenceSplitter, reply_audio, sentences
 
-app = Flask(__name__)
-CORS(app)
+class UploadRequest(Request):
+    """Request that spools uploaded files with a per-file size limit enforced while parsing."""
 
-from flask import Flask, request, jsonify, render_template
-from flask_cors import CORS
-from chatbot import chatbot
-import base64
-import mimetypes
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return LimitedSpooledFile(limit=MAX_FILE_BYTES)
+
+class FastJSONProvider(JSONProvider):
+    """``request.get_json()`` and ``jsonify`` through json_codec, which uses orjson when it is installed."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # The encoded bytes become the body as they are, without a round trip through str
+        return self._app.response_class(dumps(self._prepare_response_obj(args, kwargs)), mimetype="application/json")
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.json = FastJSONProvider(app)
+# Bodies of any route are capped; a larger Content-Length is rejected with a JSON 413 before the body is read
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
 CORS(app)
+# WARMUP=blocking warms up here, before the server starts; WARMUP=background starts it alongside
+warm_up_from_env(warmup)
+
+@app.before_request
+def start_trace():
+    g.trace, g.trace_token = start_request(request.url_rule.rule if request.url_rule else "other", request.method)
+    # Model calls are queued fairly per user
+    g.user_token = set_user(request_user(request.headers.get(USER_HEADER), request.remote_addr))
+    # Only a signed token says who the caller is; the user above is anyone's to claim
+    if authenticator is not None:
+        g.principal_token = set_principal(authenticator.principal(request.headers.get("Authorization")))
+
+@app.before_request
+def limit_request_size():
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+        return request_too_large_response(RequestEntityTooLarge())
+    if request.content_length is None and request.is_json:
+        # A JSON body sent without a Content-Length is read here, so going over the limit is a 413 and not a route's 500;
+        # the routes' get_json() then parses the bytes read here. The stream stops at the limit rather than raising.
+        if len(request.get_data(cache=True)) >= MAX_REQUEST_BYTES:
+            return request_too_large_response(RequestEntityTooLarge())
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large_response(error):
+    return jsonify({
+        "error": f"Request exceeds the {MAX_REQUEST_BYTES} byte limit",
+        "response": "Sorry, your request is too large."
+    }), 413
+
+@app.after_request
+def finish_trace(response):
+    # Streamed bodies are still being sent here, so the trace ends when the response is closed
+    trace = g.get("trace")
+    if trace is not None:
+        response.call_on_close(lambda: trace.finish(response.status_code))
+    return response
+
+@app.teardown_request
+def detach_trace(error=None):
+    trace = g.pop("trace", None)
+    if error is not None and trace is not None:
+        trace.finish(500)
+    token = g.pop("trace_token", None)
+    if token is not None:
+        end_request(token)
+    user_token = g.pop("user_token", None)
+    if user_token is not None:
+        reset_user(user_token)
+    principal_token = g.pop("principal_token", None)
+    if principal_token is not None:
+        reset_principal(principal_token)
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
+def sse_event(data, event=None):
+    """Format a Server-Sent Events frame with a JSON payload."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {dumps(data).decode('utf-8')}\n\n"
+
+def overloaded_response(error: Overloaded):
+    return jsonify({
+        "error": f"Server busy: {error.reason}",
+        "response": "Sorry, I'm handling too many requests right now. Please try again shortly."
+    }), 503, {"Retry-After": str(error.retry_after)}
+
+def too_large_response(error: PromptTooLarge):
+    return jsonify({
+        "error": str(error),
+        "response": "Sorry, your message is too long for me to answer. Please shorten it or split it up."
+    }), 413
+
+def invalid_attachment_response(error: InvalidAttachment):
+    return jsonify({
+        "error": str(error),
+        "response": "Sorry, an attachment in this request is malformed."
+    }), 400
+
+def conflict_response(error: IdempotencyConflict):
+    return jsonify({
+        "error": str(error),
+        "response": "Sorry, this request reused the idempotency key of a different message."
+    }), 422
+
 @app.route("/api/chat", methods=["POST"])
 def chat():
     try:
-        data = request.get_json()
+        with span("parse"):
+            # Not cached, so the raw body can be freed once parsed
+            data = request.get_json(cache=False)
         message = data.get("message", "")
-        attachments = data.get("attachments", [])
         
-        # Process attachments if any
-        processed_attachments = []
-        for attachment in attachments:
-            processed_attachment = {
-                'type': attachment.get('type', 'unknown'),
-                'filename': attachment.get('filename', 'unknown'),
-                'content': attachment.get('content', ''),
-                'mime_type': attachment.get('mime_type', ''),
-                'encoding': attachment.get('encoding', 'base64')
-            }
-            
-            # Determine type from mime_type if not specified
-            if processed_attachment['type'] == 'unknown' and processed_attachment['mime_type']:
-                if processed_attachment['mime_type'].startswith('image/'):
-                    processed_attachment['type'] = 'image'
-                elif processed_attachment['mime_type'].startswith('text/'):
-                    processed_attachment['type'] = 'text'
-                elif processed_attachment['mime_type'] in ['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-                    processed_attachment['type'] = 'document'
-            
-            processed_attachments.append(processed_attachment)
+        # Process attachments if any, on the attachment pool rather than this thread
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                attachment_pool.run(decode_attachments, processed_attachments, task="decode")
         
-        # Call chatbot with message and attachments
-        ai_response = chatbot(message, processed_attachments if processed_attachments else None)
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
         
-        return jsonify({
-            "response": ai_response,
-            "attachments_processed": len(processed_attachments)
-        })
+        # Call chatbot with message and attachments; retries and duplicates share one call
+        ai_response = request_coalescer.run(
+            lambda: chatbot(message, processed_attachments if processed_attachments else None, use_cache=use_cache, conversation_id=conversation_id),
+            "/api/chat", chat_fingerprint(message, processed_attachments, conversation_id),
+            idempotency_key=request.headers.get(IDEMPOTENCY_HEADER), coalesce=use_cache
+        )
+        
+        with span("serialize"):
+            return jsonify({
+                "response": ai_response,
+                "attachments_processed": len(processed_attachments),
+                "conversation_id": conversation_id,
+                "usage": usage(g.get("trace")),
+                **reply_audio(speech, ai_response, data.get("speech"))
+            })
+    
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    
+    except IdempotencyConflict as e:
+        return conflict_response(e)
     
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
+    
+    except Exception as e:
+        return jsonify({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your request."
+        }), 500
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Stream the response as Server-Sent Events.
+
+    Each chunk is sent as ``data: {"token": ...}`` as soon as the model
+    produces it, followed by an ``event: done`` frame. Errors after the
+    stream started are reported as an ``event: error`` frame. With
+    ``"speech": true`` each finished sentence is also sent as an
+    ``event: audio`` frame with the URL of its audio.
+    """
+    try:
+        with span("parse"):
+            # Not cached, so the raw body can be freed once parsed
+            data = request.get_json(cache=False)
+        message = data.get("message", "")
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                attachment_pool.run(decode_attachments, processed_attachments, task="decode")
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
+        tokens = chatbot(message, processed_attachments if processed_attachments else None, stream=True, use_cache=use_cache, conversation_id=conversation_id)
+        trace = g.get("trace")
+        splitter = SentenceSplitter() if data.get("speech") and speech is not None else None
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
     except Exception as e:
         return jsonify({
             "error": str(e),
             "response": "Sorry, I encountered an error processing your request."
         }), 500
 
+    def generate():
+        # Werkzeug closes this generator when the client disconnects, and the
+        # finally block closes the upstream model stream with it
+        try:
+            for token in tokens:
+                yield sse_event({"token": token})
+                if splitter is not None:
+                    for sentence in splitter.feed(token):
+                        yield sse_event(speech.clip(sentence), event="audio")
+            if splitter is not None:
+                for sentence in splitter.flush():
+                    yield sse_event(speech.clip(sentence), event="audio")
+            yield sse_event({"attachments_processed": len(processed_attachments), "conversation_id": conversation_id, "usage": usage(trace)}, event="done")
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+        finally:
+            tokens.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def speech_disabled_response():
+    return jsonify({"error": "Server-side speech is off; set TTS_ENGINE to enable it"}), 404
+
+@app.route("/api/chat/speech", methods=["POST"])
+def chat_speech():
+    """
+    Stream the spoken reply as one WAV file.
+
+    Takes the same body as ``/api/chat/stream``. Each sentence is
+    synthesized as soon as the model has written it, so playback can start
+    long before the reply is complete.
+    """
+    if speech is None:
+        return speech_disabled_response()
+    try:
+        with span("parse"):
+            # Not cached, so the raw body can be freed once parsed
+            data = request.get_json(cache=False)
+        message = data.get("message", "")
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                attachment_pool.run(decode_attachments, processed_attachments, task="decode")
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
+        tokens = chatbot(message, processed_attachments if processed_attachments else None, stream=True, use_cache=use_cache, conversation_id=conversation_id)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
+    except Exception as e:
+        return jsonify({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your request."
+        }), 500
+
+    def generate():
+        # A failure after the first bytes can only end the audio early
+        try:
+            yield from speech.stream(sentences(tokens))
+        finally:
+            tokens.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="audio/wav",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/api/audio/<key>", methods=["GET"])
+def sentence_audio(key):
+    """One sentence's WAV audio, waiting for its synthesis; a key always means the same audio, so clients may cache it."""
+    if speech is None:
+        return speech_disabled_response()
+    try:
+        audio = speech.audio(key)
+    except Exception as e:
+        return jsonify({"error": f"Speech synthesis failed: {e}"}), 500
+    if audio is None:
+        return jsonify({"error": "Audio not found"}), 404
+    return Response(audio, mimetype="audio/wav", headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{key}"'})
+
+@app.route("/api/chat/batch", methods=["POST"])
+def chat_batch_route():
+    """
+    Answer a list of ``{message, attachments}`` items concurrently.
+
+    Returns all results in item order, or with ``"stream": true`` one NDJSON
+    line per item as each finishes. A failed item carries an ``error`` and
+    does not abort the batch.
+    """
+    try:
+        with span("parse"):
+            # Not cached, so the raw body can be freed once parsed
+            data = request.get_json(cache=False)
+            items = parse_items(data.get("items"))
+            concurrency, timeout = batch_options(data.get("concurrency"), data.get("timeout"))
+        with span("attachments"):
+            items = [{"message": item.get("message", ""), "attachments": process_attachments(item.get("attachments") or [])} for item in items]
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": str(e), "response": "Sorry, this batch request is malformed."}), 400
+
+    if data.get("stream"):
+        def generate():
+            results = iter_chat_batch(items, concurrency, timeout, use_cache)
+            try:
+                for result in results:
+                    yield dumps(result.to_dict()) + b"\n"
+            finally:
+                # Items not started yet are skipped if the client disconnects
+                results.close()
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+    results = chat_batch(items, concurrency, timeout, use_cache)
+    with span("serialize"):
+        failed = sum(not result.ok for result in results)
+        return jsonify({"results": [result.to_dict() for result in results], "succeeded": len(results) - failed, "failed": failed})
+
 @app.route("/api/chat/upload", methods=["POST"])
 def chat_with_upload():
     try:
         # Handle form data with files
-        message = request.form.get("message", "")
-        files = request.files.getlist("files")
+        with span("parse"):
+            message = request.form.get("message", "")
+            files = request.files.getlist("files")
         
         processed_attachments = []
         
-        for file in files:
-            if file and file.filename:
-                # Read file content
-                file_content = file.read()
-                encoded_content = base64.b64encode(file_content).decode('utf-8')
-                
-                # Determine file type
-                mime_type = file.content_type or mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
-                
-                attachment_type = 'unknown'
-                if mime_type.startswith('image/'):
-                    attachment_type = 'image'
-                elif mime_type.startswith('text/'):
-                    attachment_type = 'text'
-                elif mime_type in ['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-                    attachment_type = 'document'
-                
-                processed_attachment = {
-                    'type': attachment_type,
-                    'filename': file.filename,
-                    'content': encoded_content,
-                    'mime_type': mime_type,
-                    'encoding': 'base64'
-                }
-                
-                processed_attachments.append(processed_attachment)
+        with span("attachments"):
+            for file in files:
+                if file and file.filename:
+                    # Stream the spooled file on the attachment pool, keeping only what the model needs
+                    processed_attachments.append(attachment_pool.run(
+                        read_upload, file.stream, file.filename, file.content_type,
+                        extractor=document_extractor, retriever=retriever, image_processor=image_processor, task="upload"
+                    ))
+        
+        use_cache = cache_requested(request.form.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = request.form.get("conversation_id") or request.headers.get("X-Conversation-Id")
         
-        # Call chatbot with message and attachments
-        ai_response = chatbot(message, processed_attachments if processed_attachments else None)
+        # Call chatbot with message and attachments; retries and duplicates share one call
+        ai_response = request_coalescer.run(
+            lambda: chatbot(message, processed_attachments if processed_attachments else None, use_cache=use_cache, conversation_id=conversation_id),
+            "/api/chat/upload", chat_fingerprint(message, processed_attachments, conversation_id),
+            idempotency_key=request.headers.get(IDEMPOTENCY_HEADER), coalesce=use_cache
+        )
         
+        with span("serialize"):
+            return jsonify({
+                "response": ai_response,
+                "files_processed": len(processed_attachments),
+                "conversation_id": conversation_id,
+                "usage": usage(g.get("trace"))
+            })
+    
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    
+    except IdempotencyConflict as e:
+        return conflict_response(e)
+    
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
         return jsonify({
-            "response": ai_response,
-            "files_processed": len(processed_attachments)
-        })
+            "error": str(e),
+            "response": "Sorry, your upload is too large."
+        }), 413
     
     except Exception as e:
         return jsonify({
@@ -113,7 +402,70 @@ def chat_with_upload():
 
 @app.route("/api/health" , methods = ["GET"])
 def health():
-    return jsonify({"status" : "healthy"})
+    """Readiness probe: 503 while warm-up runs or after it failed."""
+    return jsonify({"status" : "healthy" if warmup.ready else warmup.state, "warmup": warmup.stats(), "upstream": model_router.stats(),
+                    "attachments": attachment_pool.stats(), "audit": audit_log.stats() if audit_log else None,
+                    "worker": os.getpid(), "shared_state": shared_state.stats() if shared_state else None}), 200 if warmup.ready else 503
+
+@app.route("/api/conversations/<conversation_id>", methods=["DELETE"])
+def delete_conversation(conversation_id):
+    if not conversation_store.clear(conversation_id):
+        return jsonify({"error": "Conversation not found"}), 404
+    return jsonify({"status": "deleted", "conversation_id": conversation_id})
+
+def history_unavailable_response():
+    """The response of the history routes when they are disabled or the caller is not authenticated, else None."""
+    if audit_log is None or authenticator is None:
+        return jsonify({"error": "History is not served; set AUDIT_DB and AUTH_SECRET to enable it"}), 404
+    if current_principal() is None:
+        return jsonify({"error": "A valid bearer token is required"}), 401, {"WWW-Authenticate": "Bearer"}
+    return None
+
+@app.route("/api/history", methods=["GET"])
+def history_sessions():
+    """The caller's logged conversations, most recently active first; paged with ``?cursor=`` and ``?limit=``."""
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    try:
+        sessions, next_cursor = audit_log.sessions(request.args.get("cursor"), int(request.args.get("limit", 20)), owner=current_principal())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"sessions": sessions, "next_cursor": next_cursor})
+
+@app.route("/api/history/<session_id>", methods=["GET"])
+def history_turns(session_id):
+    """One of the caller's conversations, newest turn first; paged with ``?cursor=`` and ``?limit=``."""
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    try:
+        turns, next_cursor = audit_log.turns(session_id, request.args.get("cursor"), int(request.args.get("limit", 50)), owner=current_principal())
+    except LookupError:
+        return jsonify({"error": "Conversation not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"session_id": session_id, "turns": turns, "next_cursor": next_cursor})
+
+@app.route("/api/history/<session_id>", methods=["DELETE"])
+def delete_history(session_id):
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    if not audit_log.delete(session_id, owner=current_principal()):
+        return jsonify({"error": "Conversation not found"}), 404
+    return jsonify({"status": "deleted", "session_id": session_id})
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({**response_cache.stats(), "semantic": semantic_cache.stats() if semantic_cache else None, "documents": document_extractor.stats(), "retrieval": retriever.stats(), "images": image_processor.stats(), "dedup": request_coalescer.stats(), "speech": speech.stats() if speech else None})
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics; ``?format=json`` gives estimated p50/p95/p99 per histogram instead."""
+    if request.args.get("format") == "json":
+        return jsonify(registry.snapshot())
+    return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
 
 if __name__ == "__main__":  
     app.run(debug=True, port=4000)
\ No newline at end of file
@@ -0,0 +1,575 @@
+"""
+Async (ASGI) entry point for the chatbot API.
+
+Serves the same routes as ``api.py`` but awaits the model with
+``ainvoke`` / ``astream``, so one worker can hold many concurrent chats.
+Upstream calls are capped by a ``ConcurrencyLimiter``; requests that cannot
+get a slot are shed with 503 and a ``Retry-After`` header.
+
+Configuration (environment variables):
+    LLM_MAX_CONCURRENCY   concurrent upstream calls (default 16)
+    LLM_MAX_QUEUE         requests allowed to wait for a slot (default 64)
+    LLM_QUEUE_TIMEOUT     seconds a request may wait for a slot (default 10)
+
+Run with:
+    uvicorn asgi_api:app --port 4000
+"""
+import os
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse as StarletteJSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Route
+
+from attachments import InvalidAttachment, process_attachments
+from auth import current_principal, reset_principal, set_principal
+from chatbot import achat_batch, achatbot, aiter_chat_batch, attachment_pool, audit_log, authenticator, conversation_store, decode_attachments, document_extractor, image_processor, model_router, request_coalescer, response_cache, retriever, semantic_cache, shared_state, speech, warmup
+from batch import batch_options, parse_items
+from concurrency import ConcurrencyLimiter, Overloaded
+from idempotency import IDEMPOTENCY_HEADER, IdempotencyConflict, chat_fingerprint
+from json_codec import dumps, loads
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, current_trace, end_request, registry, span, start_request
+from response_cache import cache_requested
+from speech import SentenceSplitter, asentences, reply_audio
+from token_budget import PromptTooLarge, usage
+from upstream import USER_HEADER, request_user, reset_user, set_user
+from uploads import MAX_REQUEST_BYTES, UploadTooLarge, read_upload
+from warmup import warm_up_from_env
+
+limiter = ConcurrencyLimiter(
+    max_in_flight=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "10")),
+)
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSON responses through json_codec, which uses orjson when it is installed."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+async def json_body(request: Request):
+    """The parsed JSON body; orjson parses the raw bytes without decoding them to text first."""
+    return loads(await request.body())
+
+
+def overloaded_response(error: Overloaded) -> JSONResponse:
+    return JSONResponse({
+        "error": f"Server busy: {error.reason}",
+        "response": "Sorry, I'm handling too many requests right now. Please try again shortly."
+    }, status_code=503, headers={"Retry-After": str(error.retry_after)})
+
+
+def too_large_response(error: PromptTooLarge) -> JSONResponse:
+    return JSONResponse({
+        "error": str(error),
+        "response": "Sorry, your message is too long for me to answer. Please shorten it or split it up."
+    }, status_code=413)
+
+
+def invalid_attachment_response(error: InvalidAttachment) -> JSONResponse:
+    return JSONResponse({
+        "error": str(error),
+        "response": "Sorry, an attachment in this request is malformed."
+    }, status_code=400)
+
+
+def conflict_response(error: IdempotencyConflict) -> JSONResponse:
+    return JSONResponse({
+        "error": str(error),
+        "response": "Sorry, this request reused the idempotency key of a different message."
+    }, status_code=422)
+
+
+async def limited_chat(message, attachments, use_cache, conversation_id):
+    async with limiter.slot():
+        return await achatbot(message, attachments if attachments else None, use_cache=use_cache, conversation_id=conversation_id)
+
+
+def sse_event(data, event=None) -> str:
+    """Format a Server-Sent Events frame with a JSON payload."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {dumps(data).decode('utf-8')}\n\n"
+
+
+async def chat(request: Request):
+    try:
+        with span("parse"):
+            data = await json_body(request)
+        message = data.get("message", "")
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                await attachment_pool.arun(decode_attachments, processed_attachments, task="decode")
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
+
+        # Retries and duplicates share one call and one limiter slot
+        ai_response = await request_coalescer.arun(
+            lambda: limited_chat(message, processed_attachments, use_cache, conversation_id),
+            "/api/chat", chat_fingerprint(message, processed_attachments, conversation_id),
+            idempotency_key=request.headers.get(IDEMPOTENCY_HEADER), coalesce=use_cache
+        )
+
+        with span("serialize"):
+            return JSONResponse({
+                "response": ai_response,
+                "attachments_processed": len(processed_attachments),
+                "conversation_id": conversation_id,
+                "usage": usage(current_trace()),
+                **await run_in_threadpool(reply_audio, speech, ai_response, data.get("speech"))
+            })
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except IdempotencyConflict as e:
+        return conflict_response(e)
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
+    except Exception as e:
+        return JSONResponse({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your request."
+        }, status_code=500)
+
+
+async def chat_stream(request: Request):
+    try:
+        with span("parse"):
+            data = await json_body(request)
+        message = data.get("message", "")
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                await attachment_pool.arun(decode_attachments, processed_attachments, task="decode")
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
+        splitter = SentenceSplitter() if data.get("speech") and speech is not None else None
+        # The slot is held until the stream finishes, not just until it starts
+        await limiter.acquire()
+        try:
+            # The prompt is built and budgeted here, so an oversized one is a 413 before any headers are sent
+            tokens = await achatbot(message, processed_attachments if processed_attachments else None, stream=True, use_cache=use_cache, conversation_id=conversation_id)
+        except BaseException:
+            limiter.release()
+            raise
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
+    except Exception as e:
+        return JSONResponse({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your request."
+        }, status_code=500)
+
+    async def generate():
+        try:
+            async for token in tokens:
+                yield sse_event({"token": token})
+                if splitter is not None:
+                    for sentence in splitter.feed(token):
+                        yield sse_event(await run_in_threadpool(speech.clip, sentence), event="audio")
+            if splitter is not None:
+                for sentence in splitter.flush():
+                    yield sse_event(await run_in_threadpool(speech.clip, sentence), event="audio")
+            yield sse_event({"attachments_processed": len(processed_attachments), "conversation_id": conversation_id, "usage": usage(current_trace())}, event="done")
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+        finally:
+            # Runs on client disconnect too, cancelling the upstream stream
+            await tokens.aclose()
+            limiter.release()
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def speech_disabled_response():
+    return JSONResponse({"error": "Server-side speech is off; set TTS_ENGINE to enable it"}, status_code=404)
+
+
+async def chat_speech(request: Request):
+    """Same as ``/api/chat/speech`` in ``api.py``: the spoken reply as one WAV stream, sentence by sentence."""
+    if speech is None:
+        return speech_disabled_response()
+    try:
+        with span("parse"):
+            data = await json_body(request)
+        message = data.get("message", "")
+        with span("attachments"):
+            processed_attachments = process_attachments(data.get("attachments", []))
+            if processed_attachments:
+                await attachment_pool.arun(decode_attachments, processed_attachments, task="decode")
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = data.get("conversation_id") or request.headers.get("X-Conversation-Id")
+        await limiter.acquire()
+        try:
+            tokens = await achatbot(message, processed_attachments if processed_attachments else None, stream=True, use_cache=use_cache, conversation_id=conversation_id)
+        except BaseException:
+            limiter.release()
+            raise
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except InvalidAttachment as e:
+        return invalid_attachment_response(e)
+    except Exception as e:
+        return JSONResponse({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your request."
+        }, status_code=500)
+
+    async def generate():
+        # A failure after the first bytes can only end the audio early
+        try:
+            async for chunk in speech.astream(asentences(tokens)):
+                yield chunk
+        finally:
+            await tokens.aclose()
+            limiter.release()
+
+    return StreamingResponse(
+        generate(),
+        media_type="audio/wav",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def sentence_audio(request: Request):
+    """One sentence's WAV audio, waiting for its synthesis; a key always means the same audio, so clients may cache it."""
+    if speech is None:
+        return speech_disabled_response()
+    key = request.path_params["key"]
+    try:
+        audio = await run_in_threadpool(speech.audio, key)
+    except Exception as e:
+        return JSONResponse({"error": f"Speech synthesis failed: {e}"}, status_code=500)
+    if audio is None:
+        return JSONResponse({"error": "Audio not found"}, status_code=404)
+    return Response(audio, media_type="audio/wav", headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{key}"'})
+
+
+async def chat_batch(request: Request):
+    """Same as ``/api/chat/batch`` in ``api.py``; every item call also takes a limiter slot."""
+    try:
+        with span("parse"):
+            data = await json_body(request)
+            items = parse_items(data.get("items"))
+            concurrency, timeout = batch_options(data.get("concurrency"), data.get("timeout"))
+        with span("attachments"):
+            items = [{"message": item.get("message", ""), "attachments": process_attachments(item.get("attachments") or [])} for item in items]
+        use_cache = cache_requested(data.get("cache"), request.headers.get("Cache-Control"))
+    except (ValueError, TypeError, AttributeError) as e:
+        return JSONResponse({"error": str(e), "response": "Sorry, this batch request is malformed."}, status_code=400)
+
+    if data.get("stream"):
+        async def generate():
+            results = aiter_chat_batch(items, concurrency, timeout, use_cache, slot=limiter.slot)
+            try:
+                async for result in results:
+                    yield dumps(result.to_dict()) + b"\n"
+            finally:
+                # Items not started yet are skipped if the client disconnects
+                await results.aclose()
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+    results = await achat_batch(items, concurrency, timeout, use_cache, slot=limiter.slot)
+    with span("serialize"):
+        failed = sum(not result.ok for result in results)
+        return JSONResponse({"results": [result.to_dict() for result in results], "succeeded": len(results) - failed, "failed": failed})
+
+
+async def chat_with_upload(request: Request):
+    try:
+        # Oversized bodies are rejected by BodyLimitMiddleware before this runs
+        # Handle form data with files; Starlette spools them to temporary files
+        with span("parse"):
+            form = await request.form()
+        message = form.get("message", "")
+
+        processed_attachments = []
+        with span("attachments"):
+            for file in form.getlist("files"):
+                if getattr(file, "filename", None):
+                    # Hashing, encoding and extraction are blocking, keep them off the event loop
+                    processed_attachments.append(await attachment_pool.arun(
+                        read_upload, file.file, file.filename, file.content_type,
+                        extractor=document_extractor, retriever=retriever, image_processor=image_processor, task="upload"
+                    ))
+        use_cache = cache_requested(form.get("cache"), request.headers.get("Cache-Control"))
+        conversation_id = form.get("conversation_id") or request.headers.get("X-Conversation-Id")
+
+        ai_response = await request_coalescer.arun(
+            lambda: limited_chat(message, processed_attachments, use_cache, conversation_id),
+            "/api/chat/upload", chat_fingerprint(message, processed_attachments, conversation_id),
+            idempotency_key=request.headers.get(IDEMPOTENCY_HEADER), coalesce=use_cache
+        )
+
+        with span("serialize"):
+            return JSONResponse({
+                "response": ai_response,
+                "files_processed": len(processed_attachments),
+                "conversation_id": conversation_id,
+                "usage": usage(current_trace())
+            })
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except PromptTooLarge as e:
+        return too_large_response(e)
+    except IdempotencyConflict as e:
+        return conflict_response(e)
+    except UploadTooLarge as e:
+        return JSONResponse({
+            "error": str(e),
+            "response": "Sorry, your upload is too large."
+        }, status_code=413)
+    except Exception as e:
+        return JSONResponse({
+            "error": str(e),
+            "response": "Sorry, I encountered an error processing your uploaded files."
+        }, status_code=500)
+
+
+async def health(request: Request):
+    """Readiness probe: 503 while warm-up runs or after it failed."""
+    return JSONResponse({"status": "healthy" if warmup.ready else warmup.state, "warmup": warmup.stats(), "llm": limiter.stats(),
+                         "upstream": model_router.stats(), "attachments": attachment_pool.stats(),
+                         "audit": audit_log.stats() if audit_log else None, "worker": os.getpid(),
+                         "shared_state": shared_state.stats() if shared_state else None}, status_code=200 if warmup.ready else 503)
+
+
+async def delete_conversation(request: Request):
+    conversation_id = request.path_params["conversation_id"]
+    if not await run_in_threadpool(conversation_store.clear, conversation_id):
+        return JSONResponse({"error": "Conversation not found"}, status_code=404)
+    return JSONResponse({"status": "deleted", "conversation_id": conversation_id})
+
+
+def history_unavailable_response():
+    """The response of the history routes when they are disabled or the caller is not authenticated, else None."""
+    if audit_log is None or authenticator is None:
+        return JSONResponse({"error": "History is not served; set AUDIT_DB and AUTH_SECRET to enable it"}, status_code=404)
+    if current_principal() is None:
+        return JSONResponse({"error": "A valid bearer token is required"}, status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    return None
+
+
+async def history_sessions(request: Request):
+    """The caller's logged conversations, most recently active first; paged with ``?cursor=`` and ``?limit=``."""
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    try:
+        sessions, next_cursor = await run_in_threadpool(
+            audit_log.sessions, request.query_params.get("cursor"), int(request.query_params.get("limit", 20)), owner=current_principal())
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse({"sessions": sessions, "next_cursor": next_cursor})
+
+
+async def history_turns(request: Request):
+    """One of the caller's conversations, newest turn first; paged with ``?cursor=`` and ``?limit=``."""
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    session_id = request.path_params["session_id"]
+    try:
+        turns, next_cursor = await run_in_threadpool(
+            audit_log.turns, session_id, request.query_params.get("cursor"), int(request.query_params.get("limit", 50)), owner=current_principal())
+    except LookupError:
+        return JSONResponse({"error": "Conversation not found"}, status_code=404)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse({"session_id": session_id, "turns": turns, "next_cursor": next_cursor})
+
+
+async def delete_history(request: Request):
+    unavailable = history_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    session_id = request.path_params["session_id"]
+    if not await run_in_threadpool(audit_log.delete, session_id, owner=current_principal()):
+        return JSONResponse({"error": "Conversation not found"}, status_code=404)
+    return JSONResponse({"status": "deleted", "session_id": session_id})
+
+
+async def cache_stats(request: Request):
+    return JSONResponse({**response_cache.stats(), "semantic": semantic_cache.stats() if semantic_cache else None, "documents": document_extractor.stats(), "retrieval": retriever.stats(), "images": image_processor.stats(), "dedup": request_coalescer.stats(), "speech": speech.stats() if speech else None})
+
+
+async def metrics(request: Request):
+    """Prometheus metrics; ``?format=json`` gives estimated p50/p95/p99 per histogram instead."""
+    if request.query_params.get("format") == "json":
+        return JSONResponse(registry.snapshot())
+    return Response(registry.render(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+routes = [
+    Route("/api/chat", chat, methods=["POST"]),
+    Route("/api/chat/stream", chat_stream, methods=["POST"]),
+    Route("/api/chat/upload", chat_with_upload, methods=["POST"]),
+    Route("/api/chat/batch", chat_batch, methods=["POST"]),
+    Route("/api/chat/speech", chat_speech, methods=["POST"]),
+    Route("/api/audio/{key}", sentence_audio, methods=["GET"]),
+    Route("/api/health", health, methods=["GET"]),
+    Route("/api/cache/stats", cache_stats, methods=["GET"]),
+    Route("/api/metrics", metrics, methods=["GET"]),
+    Route("/api/conversations/{conversation_id}", delete_conversation, methods=["DELETE"]),
+    Route("/api/history", history_sessions, methods=["GET"]),
+    Route("/api/history/{session_id}", history_turns, methods=["GET"]),
+    Route("/api/history/{session_id}", delete_history, methods=["DELETE"]),
+]
+
+
+def route_name(scope) -> str:
+    """Path template of the matching route, so metrics are not labelled per conversation id."""
+    for route in routes:
+        if route.matches(scope)[0] != Match.NONE:
+            return route.path
+    return "other"
+
+
+class MetricsMiddleware:
+    """Traces each HTTP request until its last body chunk is sent, streamed or not."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace, token = start_request(route_name(scope), scope["method"])
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            trace.finish(status)
+            end_request(token)
+
+
+class BodyLimitMiddleware:
+    """Rejects request bodies over ``UPLOAD_MAX_REQUEST_BYTES`` with a JSON 413, on every route, as api.py does."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    async def too_large(scope, receive, send):
+        response = JSONResponse({
+            "error": f"Request exceeds the {MAX_REQUEST_BYTES} byte limit",
+            "response": "Sorry, your request is too large."
+        }, status_code=413)
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+            await self.too_large(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            # Bodies sent without a Content-Length are counted as they arrive
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > MAX_REQUEST_BYTES:
+                raise UploadTooLarge(f"Request exceeds the {MAX_REQUEST_BYTES} byte limit", MAX_REQUEST_BYTES)
+            return message
+
+        if content_length is None and headers.get(b"content-type", b"").startswith(b"application/json"):
+            # A JSON body is read here, so going over the limit is a 413 and not a route's 500
+            messages = []
+            try:
+                while not messages or messages[-1].get("more_body", False):
+                    messages.append(await limited_receive())
+            except UploadTooLarge:
+                await self.too_large(scope, receive, send)
+                return
+
+            async def replay():
+                return messages.pop(0) if messages else await receive()
+
+            await self.app(scope, replay, send)
+            return
+        await self.app(scope, limited_receive, send)
+
+
+class UserMiddleware:
+    """
+    Makes the request's user current, so its model calls are queued fairly against other users.
+
+    The principal of a valid bearer token is made current as well; the user is anyone's
+    to claim, so only the principal decides whose history a request may see.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        client = scope.get("client")
+        token = set_user(request_user(headers.get(USER_HEADER.lower().encode(), b"").decode("latin-1"), client[0] if client else None))
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        principal_token = set_principal(authenticator.principal(authorization) if authenticator is not None else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            reset_principal(principal_token)
+            reset_user(token)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # WARMUP=blocking finishes before uvicorn accepts requests; WARMUP=background starts it alongside
+    await run_in_threadpool(warm_up_from_env, warmup)
+    yield
+
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(BodyLimitMiddleware),
+        Middleware(UserMiddleware),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, port=4000)
@@ -0,0 +1,189 @@
+"""
+Bounded worker pool for attachment processing.
+
+Hashing, base64, image downscaling, document parsing and indexing of
+attachments run on a few worker threads instead of the request thread, so a
+handful of large uploads cannot take every core from the small chats served
+next to them. Pillow, hashlib and zlib release the GIL and run in parallel
+on the threads; PDF and DOCX parsing is pure Python and can also be sent to
+worker processes (``ATTACHMENT_PROCESSES``), where it no longer holds the
+serving process's GIL. Thread results are handed back as they are, without
+copying; from a process, only the file bytes go in and the extracted text
+comes back.
+
+At most ``ATTACHMENT_MAX_QUEUE`` tasks wait for a worker; more are refused
+with ``Overloaded`` (503 with Retry-After). A request waits at most
+``ATTACHMENT_TIMEOUT`` seconds for its task. A task that times out, still
+queued or already running, is not cancelled: it runs to the end and caches
+its result, so the retry usually finds it ready. It keeps its place in the
+queue bound until then.
+
+Configuration (environment variables):
+    ATTACHMENT_WORKERS     worker threads (default min(4, CPUs)); 0 processes attachments
+                           on the request thread (Flask) or Starlette's thread pool (ASGI)
+    ATTACHMENT_PROCESSES   worker processes for PDF/DOCX parsing (default 0: parse on the threads)
+    ATTACHMENT_MAX_QUEUE   tasks allowed to wait for a worker (default 32)
+    ATTACHMENT_TIMEOUT     seconds a request waits for its task (default 30)
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import copy_context
+from typing import Any, Callable, Dict, Optional
+
+from concurrency import Overloaded
+from metrics import Counter, Histogram, registry
+
+logger = logging.getLogger(__name__)
+
+attachment_tasks = registry.register(Counter(
+    "chatbot_attachment_tasks_total", "Attachment processing tasks by outcome.", ("task", "outcome")))
+attachment_queue_seconds = registry.register(Histogram(
+    "chatbot_attachment_queue_seconds", "Time attachment tasks waited for a worker.", ("task",)))
+attachment_task_seconds = registry.register(Histogram(
+    "chatbot_attachment_task_seconds", "Time attachment tasks ran on a worker.", ("task",)))
+
+
+class AttachmentTimeout(Overloaded):
+    """Raised when a request's attachment task does not finish in time."""
+
+
+class AttachmentPool:
+    """
+    Worker threads (and optionally processes) with a bounded queue.
+
+    Args:
+        workers (int): Worker threads; 0 runs tasks on the calling thread
+        processes (int): Worker processes for ``in_process()``; 0 runs those on the worker thread.
+            They are started on first use.
+        max_queue (int): Tasks allowed to wait for a worker
+        timeout (float): Seconds ``run()`` and ``arun()`` wait for a task
+    """
+
+    def __init__(self, workers: int = 4, processes: int = 0, max_queue: int = 32, timeout: float = 30.0):
+        self.workers = workers
+        self.processes = processes
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._threads = ThreadPoolExecutor(workers, thread_name_prefix="attachment") if workers > 0 else None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def run(self, fn: Callable, *args, task: str = "attachment", **kwargs) -> Any:
+        """Run ``fn(*args, **kwargs)`` on a worker thread and return its result."""
+        if self._threads is None:
+            return self._call(task, time.perf_counter(), fn, args, kwargs)
+        future = self._submit(task, fn, args, kwargs)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise self._timed_out(task, future) from None
+
+    async def arun(self, fn: Callable, *args, task: str = "attachment", **kwargs) -> Any:
+        """Async version of ``run()``: the event loop is free while the task runs."""
+        if self._threads is None:
+            return await asyncio.to_thread(self._call, task, time.perf_counter(), fn, args, kwargs)
+        future = self._submit(task, fn, args, kwargs)
+        try:
+            # Shielded, so the timeout does not cancel a task that is still queued
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(task, future) from None
+
+    def in_process(self, fn: Callable, *args) -> Any:
+        """
+        Run a picklable ``fn(*args)`` in a worker process and wait for it.
+
+        Meant for pure-Python work called from a task that is already on a
+        worker thread; without worker processes it runs right here.
+        """
+        if not self.processes:
+            return fn(*args)
+        with self._lock:
+            if self._processes is None:
+                # Forking a threaded server is unsafe, so workers start from a fresh interpreter
+                self._processes = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            executor = self._processes
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a new pool for the next task
+            with self._lock:
+                if self._processes is executor:
+                    self._processes = None
+            raise
+
+    def _submit(self, task: str, fn: Callable, args: tuple, kwargs: dict) -> Future:
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                attachment_tasks.inc(1, task, "rejected")
+                raise Overloaded("attachment queue full")
+            self.pending += 1
+        submitted = time.perf_counter()
+        future = self._threads.submit(copy_context().run, self._call, task, submitted, fn, args, kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _call(self, task: str, submitted: float, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        start = time.perf_counter()
+        attachment_queue_seconds.observe(start - submitted, task)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            attachment_tasks.inc(1, task, "error")
+            raise
+        finally:
+            attachment_task_seconds.observe(time.perf_counter() - start, task)
+        attachment_tasks.inc(1, task, "ok")
+        return result
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def _timed_out(self, task: str, future: Future) -> AttachmentTimeout:
+        """Count a request that gave up on ``future``; the task itself still runs."""
+        with self._lock:
+            self.timed_out += 1
+        attachment_tasks.inc(1, task, "timeout")
+        logger.warning("Attachment task %s did not finish within %.1fs", task, self.timeout)
+        return AttachmentTimeout("attachment processing timed out", retry_after=max(1, int(self.timeout)))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "processes": self.processes,
+                "max_queue": self.max_queue,
+                "pending": self.pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+def pool_from_env() -> AttachmentPool:
+    """Build the attachment pool from ATTACHMENT_* environment variables."""
+    return AttachmentPool(
+        workers=int(os.getenv("ATTACHMENT_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        processes=int(os.getenv("ATTACHMENT_PROCESSES", "0")),
+        max_queue=int(os.getenv("ATTACHMENT_MAX_QUEUE", "32")),
+        timeout=float(os.getenv("ATTACHMENT_TIMEOUT", "30")),
+    )
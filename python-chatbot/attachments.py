@@ -0,0 +1,163 @@
+"""
+Attachment normalization shared by the Flask and ASGI APIs.
+
+JSON attachments become ``Attachment`` objects: their fields live in
+slots rather than a dictionary per attachment, and the base64 payload is
+decoded at most once (``attachment_bytes``), however many of the cache
+key, the request fingerprint, the image processor or the document
+extractor need it. Attachments read like the dictionaries the upload
+pipeline builds, so ``chatbot()`` takes either.
+"""
+import binascii
+import hashlib
+from typing import Any, Dict, Iterator, List, Optional
+
+DOCUMENT_MIME_TYPES = ['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+
+def classify_attachment(mime_type: str) -> str:
+    """Map a MIME type to the attachment type ``chatbot()`` understands."""
+    if mime_type.startswith('image/'):
+        return 'image'
+    elif mime_type.startswith('text/'):
+        return 'text'
+    elif mime_type in DOCUMENT_MIME_TYPES:
+        return 'document'
+    return 'unknown'
+
+
+class InvalidAttachment(ValueError):
+    """Raised for a JSON attachment that is not an object of string fields."""
+
+
+class Attachment:
+    """
+    One attachment of a JSON request.
+
+    Supports the dictionary operations ``chatbot()`` uses (``get``, ``[]``,
+    ``in``, ``update``, ``dict(attachment)``). Fields that were never set,
+    such as ``image`` before the image is processed, are not ``in`` it.
+
+    Args:
+        type (str): ``text``, ``image``, ``document`` or ``unknown``
+        filename (str): Name shown to the model
+        content (str): Base64 (optionally a ``data:`` URL) or plain text
+        mime_type (str): MIME type declared by the client
+        encoding (str): ``base64`` or ``text``
+    """
+
+    __slots__ = ('type', 'filename', 'content', 'mime_type', 'encoding',
+                 'data', 'digest', 'size', 'image', 'extracted', 'index')
+    _FIELDS = frozenset(__slots__)
+
+    def __init__(self, type: str = 'unknown', filename: str = 'unknown', content: str = '', mime_type: str = '',
+                 encoding: str = 'base64'):
+        self.type = type
+        self.filename = filename
+        self.content = content
+        self.mime_type = mime_type
+        self.encoding = encoding
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default) if key in self._FIELDS else default
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._FIELDS and hasattr(self, key)
+
+    def update(self, **fields: Any) -> None:
+        for key, value in fields.items():
+            self[key] = value
+
+    def keys(self) -> List[str]:
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __repr__(self) -> str:
+        size = len(self.data) if hasattr(self, 'data') else len(self.content)
+        return f"Attachment({self.type!r}, {self.filename!r}, {self.mime_type!r}, {size} bytes)"
+
+
+_STRING_FIELDS = (('type', 'unknown'), ('filename', 'unknown'), ('content', ''), ('mime_type', ''), ('encoding', 'base64'))
+
+def process_attachments(attachments: Optional[List[Dict]]) -> List[Attachment]:
+    """
+    Validate JSON attachments and turn them into ``Attachment`` objects.
+
+    The payload is not copied or decoded here; ``content`` is the string the
+    JSON parser produced.
+
+    Raises:
+        InvalidAttachment: ``attachments`` is not a list of objects with string fields
+    """
+    if attachments is None:
+        return []
+    if not isinstance(attachments, list):
+        raise InvalidAttachment("attachments must be a list")
+    processed_attachments = []
+    for i, attachment in enumerate(attachments, 1):
+        if not isinstance(attachment, dict):
+            raise InvalidAttachment(f"attachment {i} must be an object")
+        fields = {}
+        for name, default in _STRING_FIELDS:
+            value = attachment.get(name)
+            if value is None:
+                value = default
+            elif not isinstance(value, str):
+                raise InvalidAttachment(f"attachment {i}: {name} must be a string")
+            fields[name] = value
+        processed_attachment = Attachment(**fields)
+
+        # Determine type from mime_type if not specified
+        if processed_attachment.type == 'unknown' and processed_attachment.mime_type:
+            processed_attachment.type = classify_attachment(processed_attachment.mime_type)
+
+        processed_attachments.append(processed_attachment)
+    return processed_attachments
+
+
+def data_url_mime_type(content: str, default: str = '') -> str:
+    """The MIME type in a ``data:`` URL's header, or ``default``."""
+    if content.startswith('data:'):
+        return content[5:content.find(',', 0, 256)].split(';')[0] or default
+    return default
+
+
+def attachment_bytes(attachment: Dict) -> bytes:
+    """
+    The decoded payload of an attachment.
+
+    Base64 content, with or without a ``data:`` prefix, is decoded the first
+    time and kept as ``data``, and its SHA-256 is recorded as ``digest``;
+    later calls return the same bytes. Works on ``Attachment`` objects and
+    plain dictionaries alike.
+
+    Raises:
+        ValueError: The content is not valid base64
+    """
+    data = attachment.get('data')
+    if data is not None:
+        return data
+    content = attachment.get('content', '')
+    if attachment.get('encoding', 'base64') == 'base64' and isinstance(content, str):
+        start = content.find(',', 0, 256) + 1 if content.startswith('data:') else 0
+        # One copy to ASCII bytes; the data URL header is skipped through a view rather than a second copy
+        data = binascii.a2b_base64(memoryview(content.encode('ascii'))[start:])
+    else:
+        data = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+    attachment['data'] = data
+    attachment['digest'] = hashlib.sha256(data).hexdigest()
+    return data
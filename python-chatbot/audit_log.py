@@ -0,0 +1,377 @@
+"""
+Append-only log of chat turns, paged by session.
+
+Every answered turn (question, attachment names and digests, model, user,
+stage timings, token estimates and the answer) is appended to a sqlite
+database in WAL mode. Requests never wait for the disk: turns go onto a
+queue and a writer thread commits them in batches of up to
+``AUDIT_BATCH_SIZE``, at least every ``AUDIT_FLUSH_INTERVAL`` seconds, with
+one fsync per batch. A crash loses at most that window. Questions and
+answers longer than ``COMPRESS_CHARS`` are stored zlib-compressed.
+
+Turn ids increase with time, so the ``(session_id, id)`` index orders a
+session's turns by time, and the ``sessions`` table (one row per
+conversation, indexed by last activity) lists conversations without
+scanning the turns. A conversation belongs to the authenticated principal
+(see auth.py) of its first turn, and the history methods take an ``owner``
+to only list, read and delete that principal's conversations. Turns logged
+without a principal, and conversations logged before owners were kept,
+belong to nobody and are never listed to an owner. Pages are fetched with opaque keyset cursors rather
+than offsets, so each page is an O(log n) index seek however long the
+log grows, and turns appended meanwhile do not shift later pages.
+
+Configuration (environment variables):
+    AUDIT_DB               sqlite file for the log (default: unset, no log is kept)
+    AUDIT_BATCH_SIZE       turns written per transaction at most (default 256)
+    AUDIT_FLUSH_INTERVAL   seconds a turn may wait before it is written (default 1)
+    AUDIT_MAX_QUEUE        turns waiting to be written before new ones are dropped (default 10000)
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from metrics import RequestTrace
+
+logger = logging.getLogger(__name__)
+
+# Text longer than this is stored compressed; chat text shrinks to about a third
+COMPRESS_CHARS = 512
+MAX_PAGE_SIZE = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT,
+    created_at REAL NOT NULL,
+    user TEXT,
+    model TEXT,
+    cached INTEGER NOT NULL,
+    message BLOB NOT NULL,
+    response BLOB NOT NULL,
+    attachments TEXT,
+    timings TEXT,
+    prompt_tokens INTEGER,
+    response_tokens INTEGER,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    owner TEXT,
+    title TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    last_active REAL NOT NULL,
+    turns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active, session_id);
+"""
+
+
+def _pack(text: str) -> Any:
+    if len(text) <= COMPRESS_CHARS:
+        return text
+    return zlib.compress(text.encode("utf-8"), 6)
+
+
+def _unpack(value: Any) -> str:
+    return zlib.decompress(value).decode("utf-8") if isinstance(value, bytes) else value
+
+
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    """Values of a cursor from ``encode_cursor``; raises ValueError if it is not one."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor") from None
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("invalid cursor")
+    return values
+
+
+def describe_attachments(attachments: Optional[List[Dict]]) -> List[Dict]:
+    """What the log keeps of attachments: name, type, size and content digest, never the content."""
+    described = []
+    for attachment in attachments or []:
+        digest = attachment.get('digest')
+        if not digest:
+            content = attachment.get('content', '')
+            digest = hashlib.sha256(content.encode('utf-8') if isinstance(content, str) else content).hexdigest()
+        described.append({
+            "filename": attachment.get('filename', 'Unknown file'),
+            "type": attachment.get('type'),
+            "mime_type": attachment.get('mime_type'),
+            "size": attachment.get('size'),
+            "digest": digest,
+        })
+    return described
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[None]:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _title(message: str) -> str:
+    message = " ".join(message.split())
+    return message if len(message) <= 50 else message[:50] + "..."
+
+
+class AuditLog:
+    """
+    Append-only sqlite log of chat turns with a background batch writer.
+
+    Args:
+        path (str): Database file, created if missing
+        batch_size (int): Turns written per transaction at most
+        flush_interval (float): Seconds a turn may wait in the queue before it is written
+        max_queue (int): Turns waiting to be written before new ones are dropped
+    """
+
+    def __init__(self, path: str, batch_size: int = 256, flush_interval: float = 1.0, max_queue: int = 10_000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue" = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._write_loop, name="audit-log", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Every commit fsyncs the WAL, which batching turns into one fsync per batch of turns
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def _migrate(self) -> None:
+        """Add the owner columns to a log written before they existed; its conversations are left without an owner."""
+        with _transaction(self._conn):
+            for table in ("turns", "sessions"):
+                if "owner" not in [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN owner TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_owner ON sessions (owner, last_active, session_id)")
+
+    def record(self, session_id: Optional[str], message: str, response: str, model: Optional[str] = None,
+               attachments: Optional[List[Dict]] = None, trace: Optional[RequestTrace] = None,
+               user: Optional[str] = None, cached: bool = False, owner: Optional[str] = None) -> None:
+        """
+        Queue a completed turn for writing; never blocks.
+
+        Args:
+            session_id (str, optional): Conversation the turn belongs to; turns without
+                one are logged but not listed in any session's history
+            message (str): The user's question
+            response (str): The answer
+            model (str, optional): Model that was asked
+            attachments (List[Dict], optional): Processed attachments; only their
+                names, types, sizes and digests are kept
+            trace (RequestTrace, optional): The request's trace, for stage timings and tokens
+            user (str, optional): Who asked, as the rate limiter saw it
+            cached (bool): Whether the answer came from the response cache
+            owner (str, optional): Authenticated principal that asked; the first
+                turn's owner owns the session
+        """
+        timings = None
+        prompt_tokens = response_tokens = None
+        if trace is not None:
+            timings = {stage: round(seconds * 1000, 1) for stage, seconds in trace.spans.items()}
+            timings["total"] = round((time.perf_counter() - trace.start) * 1000, 1)
+            prompt_tokens, response_tokens = trace.prompt_tokens, trace.response_tokens
+        row = (
+            session_id, time.time(), user, model, int(cached), _pack(message), _pack(response),
+            json.dumps(describe_attachments(attachments), separators=(",", ":")) if attachments else None,
+            json.dumps(timings, separators=(",", ":")) if timings else None,
+            prompt_tokens, response_tokens, owner,
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Audit log queue full, dropped a turn of session %s", session_id)
+
+    def _write_loop(self) -> None:
+        writer = self._connect()
+        while True:
+            item = self._queue.get()
+            batch, flushes = [], []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    flushes.append(item)
+                elif item is not None:
+                    batch.append(item)
+                if item is None or flushes or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write(writer, batch)
+                except sqlite3.Error:
+                    logger.exception("Could not write %d turns to the audit log", len(batch))
+            for event in flushes:
+                event.set()
+            if item is None:
+                writer.close()
+                return
+
+    def _write(self, writer: sqlite3.Connection, batch: List[Tuple]) -> None:
+        with _transaction(writer):
+            writer.executemany(
+                "INSERT INTO turns (session_id, created_at, user, model, cached, message, response, attachments, timings,"
+                " prompt_tokens, response_tokens, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch
+            )
+            writer.executemany(
+                "INSERT INTO sessions (session_id, owner, title, started_at, last_active, turns) VALUES (?, ?, ?, ?, ?, 1)"
+                " ON CONFLICT (session_id) DO UPDATE SET last_active = excluded.last_active, turns = turns + 1",
+                [(row[0], row[11], _title(_unpack(row[5])), row[1], row[1]) for row in batch if row[0]]
+            )
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every turn queued so far is written. Returns False on timeout."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """Write what is queued and stop the writer."""
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+
+    def _owned(self, session_id: str, owner: Optional[str]) -> bool:
+        """Whether ``owner`` may see the session; any session may be seen without an owner. Call with the lock held."""
+        if owner is None:
+            return True
+        return self._conn.execute("SELECT 1 FROM sessions WHERE session_id = ? AND owner = ?", (session_id, owner)).fetchone() is not None
+
+    def turns(self, session_id: str, cursor: Optional[str] = None, limit: int = 50,
+              owner: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of a session's turns, newest first.
+
+        Args:
+            session_id (str): Conversation id
+            cursor (str, optional): ``next_cursor`` of the previous page
+            limit (int): Turns per page, at most ``MAX_PAGE_SIZE``
+            owner (str, optional): Only read the session if this principal owns it
+
+        Returns:
+            Tuple[List[Dict], Optional[str]]: The turns, and the cursor of the next
+            page or None if this is the last one
+
+        Raises:
+            ValueError: If ``cursor`` is not a cursor of this log
+            LookupError: If ``owner`` is given and the session is not theirs or does not exist
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        before = decode_cursor(cursor, 1)[0] if cursor else None
+        with self._lock:
+            if not self._owned(session_id, owner):
+                raise LookupError(f"no conversation {session_id!r} for this owner")
+            rows = self._conn.execute(
+                "SELECT id, created_at, user, model, cached, message, response, attachments, timings, prompt_tokens,"
+                " response_tokens FROM turns WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before if before is not None else 1 << 62, limit + 1)
+            ).fetchall()
+        turns = [{
+            "id": row[0],
+            "created_at": row[1],
+            "user": row[2],
+            "model": row[3],
+            "cached": bool(row[4]),
+            "message": _unpack(row[5]),
+            "response": _unpack(row[6]),
+            "attachments": json.loads(row[7]) if row[7] else [],
+            "timings_ms": json.loads(row[8]) if row[8] else None,
+            "prompt_tokens": row[9],
+            "response_tokens": row[10],
+        } for row in rows[:limit]]
+        return turns, encode_cursor(turns[-1]["id"]) if len(rows) > limit else None
+
+    def sessions(self, cursor: Optional[str] = None, limit: int = 20, owner: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """One page of conversations (only ``owner``'s if given), most recently active first; see ``turns()``."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where, params = ("WHERE owner = ?", [owner]) if owner is not None else ("", [])
+        if cursor:
+            where += (" AND" if where else "WHERE") + " (last_active, session_id) < (?, ?)"
+            params += decode_cursor(cursor, 2)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT session_id, title, started_at, last_active, turns FROM sessions {where}"
+                " ORDER BY last_active DESC, session_id DESC LIMIT ?", (*params, limit + 1)
+            ).fetchall()
+        sessions = [
+            {"session_id": row[0], "title": row[1], "started_at": row[2], "last_active": row[3], "turns": row[4]}
+            for row in rows[:limit]
+        ]
+        last = sessions[-1] if sessions else None
+        return sessions, encode_cursor(last["last_active"], last["session_id"]) if len(rows) > limit else None
+
+    def delete(self, session_id: str, owner: Optional[str] = None) -> bool:
+        """
+        Remove a conversation's turns, e.g. at the user's request.
+
+        Returns False if it had none, or if ``owner`` is given and the conversation is not theirs.
+        """
+        self.flush()
+        with self._lock, _transaction(self._conn):
+            if not self._owned(session_id, owner):
+                return False
+            deleted = self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,)).rowcount
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return deleted > 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "path": self.path,
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "batches": self.batches,
+                "dropped": self.dropped,
+            }
+
+
+def audit_log_from_env() -> Optional[AuditLog]:
+    """Build the audit log from AUDIT_* environment variables; None if ``AUDIT_DB`` is not set."""
+    path = os.getenv("AUDIT_DB")
+    if not path:
+        return None
+    return AuditLog(
+        path,
+        batch_size=int(os.getenv("AUDIT_BATCH_SIZE", "256")),
+        flush_interval=float(os.getenv("AUDIT_FLUSH_INTERVAL", "1")),
+        max_queue=int(os.getenv("AUDIT_MAX_QUEUE", "10000")),
+    )
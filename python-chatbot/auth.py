@@ -0,0 +1,121 @@
+"""
+Signed bearer tokens that say who is calling.
+
+The ``X-User-Id`` header and the client address are good enough to queue
+model calls fairly, but they cannot decide who may read a conversation:
+any client can send any header, and callers behind one proxy or NAT share
+an address. Routes that return a user's own data (``/api/history``)
+instead require ``Authorization: Bearer <token>``, where the token was
+issued with ``AUTH_SECRET``. A token names its principal and when it
+expires, and is signed with HMAC-SHA256, so the server keeps no session
+state and every worker accepts tokens any other one issued.
+
+Tokens are issued by whatever already authenticates your users, or from
+the command line:
+
+    AUTH_SECRET=... python auth.py alice
+
+Configuration (environment variables):
+    AUTH_SECRET      key tokens are signed with, at least 16 characters
+                     (default: unset, nobody is authenticated and /api/history is disabled)
+    AUTH_TOKEN_TTL   seconds an issued token is valid (default 86400)
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from contextvars import ContextVar, Token
+from typing import Optional
+
+MIN_SECRET_CHARS = 16
+
+_principal: ContextVar[Optional[str]] = ContextVar("auth_principal", default=None)
+
+
+def set_principal(principal: Optional[str]) -> Token:
+    """Make ``principal`` the authenticated caller of the current request; pass the token to ``reset_principal``."""
+    return _principal.set(principal)
+
+
+def reset_principal(token: Token) -> None:
+    _principal.reset(token)
+
+
+def current_principal() -> Optional[str]:
+    """The authenticated caller of the current request, None if it presented no valid token."""
+    return _principal.get()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class TokenAuthenticator:
+    """
+    Issues and checks HMAC-signed bearer tokens.
+
+    Args:
+        secret (str): Signing key, shared by every worker
+        ttl (float): Seconds an issued token is valid
+    """
+
+    def __init__(self, secret: str, ttl: float = 86400):
+        if len(secret) < MIN_SECRET_CHARS:
+            raise ValueError(f"AUTH_SECRET must be at least {MIN_SECRET_CHARS} characters")
+        self._key = secret.encode("utf-8")
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, principal: str, ttl: Optional[float] = None) -> str:
+        """A token for ``principal``, valid for ``ttl`` seconds (default: the authenticator's)."""
+        if not principal:
+            raise ValueError("a token needs a principal")
+        expires = int(time.time() + (self.ttl if ttl is None else ttl))
+        payload = _b64encode(json.dumps({"sub": principal, "exp": expires}, separators=(",", ":")).encode("utf-8"))
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str) -> Optional[str]:
+        """The principal of ``token``, None if it is malformed, forged or expired."""
+        payload, _, signature = token.partition(".")
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get("sub"), str) or not isinstance(claims.get("exp"), int):
+            return None
+        return claims["sub"] if claims["exp"] > time.time() and claims["sub"] else None
+
+    def principal(self, authorization: Optional[str]) -> Optional[str]:
+        """The principal of an ``Authorization: Bearer <token>`` header value, None without a valid one."""
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not token.strip():
+            return None
+        return self.verify(token.strip())
+
+
+def authenticator_from_env() -> Optional[TokenAuthenticator]:
+    """Build the authenticator from AUTH_* environment variables; None if ``AUTH_SECRET`` is not set."""
+    secret = os.getenv("AUTH_SECRET")
+    if not secret:
+        return None
+    return TokenAuthenticator(secret, ttl=float(os.getenv("AUTH_TOKEN_TTL", "86400")))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: AUTH_SECRET=... python auth.py <principal>")
+    authenticator = authenticator_from_env()
+    if authenticator is None:
+        sys.exit("AUTH_SECRET is not set")
+    print(authenticator.issue(sys.argv[1]))
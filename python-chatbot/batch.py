@@ -0,0 +1,170 @@
+"""
+Concurrent batch execution of many chat requests.
+
+Nightly jobs send thousands of questions; sending them one HTTP call at a
+time leaves the model idle between calls. A batch is prepared item by item
+(cache lookups and prompt building are cheap), then every item that needs
+the model goes through LangChain's ``batch_as_completed`` /
+``abatch_as_completed`` with ``max_concurrency`` as the cap. Each item gets
+its own timeout, and a failed or timed-out item is reported in its result
+instead of aborting the batch.
+
+Once the consumer stops reading (e.g. the HTTP client disconnects), items
+that have not started yet are skipped; at most ``max_concurrency`` calls
+are still running, and each ends by its timeout.
+
+A sync call cannot be interrupted, so a timed-out item keeps its slot
+until its call really returns. The cap therefore bounds the live model
+calls, abandoned ones included, and not just the items being waited on.
+
+Configuration (environment variables):
+    BATCH_MAX_ITEMS         items accepted per batch (default 1000)
+    BATCH_MAX_CONCURRENCY   upper bound on concurrent model calls per batch (default 8)
+    BATCH_TIMEOUT           default per-item timeout in seconds (default 60)
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from contextvars import copy_context
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from langchain_core.runnables import Runnable, RunnableLambda
+
+MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+DEFAULT_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", "60"))
+
+# A prepared model call: the runnable and its input
+Call = Tuple[Runnable, Any]
+
+
+class BatchCancelled(Exception):
+    """Raised for items that had not started when the batch was abandoned."""
+
+
+class BatchResult:
+    """Outcome of one batch item; exactly one of ``response`` and ``error`` is set."""
+
+    __slots__ = ("index", "response", "error", "cached")
+
+    def __init__(self, index: int, response: Optional[str] = None, error: Optional[str] = None, cached: bool = False):
+        self.index = index
+        self.response = response
+        self.error = error
+        self.cached = cached
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict:
+        result = {"index": self.index, "response": self.response, "cached": self.cached}
+        if self.error is not None:
+            result["error"] = self.error
+        return result
+
+
+def describe_error(error: BaseException, timeout: Optional[float]) -> str:
+    """Short message for a failed item."""
+    if isinstance(error, TimeoutError):
+        return f"timed out after {timeout:g}s"
+    return str(error) or type(error).__name__
+
+
+def batch_options(concurrency: Any = None, timeout: Any = None) -> Tuple[int, float]:
+    """Clamp a client's requested concurrency and per-item timeout to the configured limits."""
+    concurrency = MAX_CONCURRENCY if concurrency in (None, "") else int(concurrency)
+    timeout = DEFAULT_TIMEOUT if timeout in (None, "") else float(timeout)
+    if concurrency < 1 or timeout <= 0:
+        raise ValueError("concurrency and timeout must be positive")
+    return min(concurrency, MAX_CONCURRENCY), timeout
+
+
+def parse_items(items: Any) -> List[Dict]:
+    """
+    Validate the ``items`` of a batch request.
+
+    Raises:
+        ValueError: If ``items`` is not a non-empty list of ``{message, attachments}``
+            objects within ``BATCH_MAX_ITEMS``
+    """
+    if not isinstance(items, list) or not items:
+        raise ValueError("'items' must be a non-empty list")
+    if len(items) > MAX_ITEMS:
+        raise ValueError(f"a batch may contain at most {MAX_ITEMS} items")
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get("message", ""), str):
+            raise ValueError(f"item {i} must be an object with a string 'message'")
+        if not isinstance(item.get("attachments") or [], list):
+            raise ValueError(f"item {i}: 'attachments' must be a list")
+    return items
+
+
+def run_as_completed(calls: Sequence[Call], max_concurrency: int = MAX_CONCURRENCY,
+                     timeout: Optional[float] = DEFAULT_TIMEOUT) -> Iterator[Tuple[int, Union[str, Exception]]]:
+    """
+    Invoke ``calls`` on worker threads, yielding ``(position, result or exception)`` as each finishes.
+
+    A timed-out call is reported when its timeout expires; its thread is left
+    to finish in the background, holding its slot, and the result discarded.
+    """
+    stopped = threading.Event()
+    # Held for as long as a model call runs, also after its item timed out
+    slots = threading.BoundedSemaphore(max_concurrency)
+    pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch-item")
+
+    def call_model(runnable: Runnable, request_input: Any):
+        try:
+            return runnable.invoke(request_input)
+        finally:
+            slots.release()
+
+    def invoke(call: Call):
+        # Waits for a slot while abandoned calls still hold them, unless the batch is abandoned meanwhile
+        while not slots.acquire(timeout=0.5):
+            if stopped.is_set():
+                raise BatchCancelled("batch was abandoned before this item started")
+        if stopped.is_set():
+            slots.release()
+            raise BatchCancelled("batch was abandoned before this item started")
+        runnable, request_input = call
+        if timeout is None:
+            return call_model(runnable, request_input)
+        # The call keeps the request's context, e.g. the user it is rate limited as
+        return pool.submit(copy_context().run, call_model, runnable, request_input).result(timeout)
+
+    try:
+        yield from RunnableLambda(invoke).batch_as_completed(
+            list(calls), config={"max_concurrency": max_concurrency}, return_exceptions=True)
+    finally:
+        stopped.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def arun_as_completed(calls: Sequence[Call], max_concurrency: int = MAX_CONCURRENCY,
+                            timeout: Optional[float] = DEFAULT_TIMEOUT,
+                            slot: Optional[Callable[[], AsyncContextManager]] = None) -> AsyncIterator[Tuple[int, Union[str, Exception]]]:
+    """
+    Async counterpart of ``run_as_completed()``; timed-out calls are cancelled.
+
+    Args:
+        slot: Optional factory of an ``async with`` guard taken around each model call,
+            e.g. a server-wide ``ConcurrencyLimiter.slot``; its errors fail only that item
+    """
+    stopped = False
+
+    async def ainvoke(call: Call):
+        if stopped:
+            raise BatchCancelled("batch was abandoned before this item started")
+        runnable, request_input = call
+        async with (slot() if slot else nullcontext()):
+            return await asyncio.wait_for(runnable.ainvoke(request_input), timeout)
+
+    try:
+        async for position, result in RunnableLambda(ainvoke).abatch_as_completed(
+                list(calls), config={"max_concurrency": max_concurrency}, return_exceptions=True):
+            yield position, result
+    finally:
+        stopped = True
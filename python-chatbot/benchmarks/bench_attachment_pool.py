@@ -0,0 +1,120 @@
+"""
+Small-chat latency next to heavy uploads, with and without the attachment pool.
+
+Starts the API with the fake LLM (``serve_fake.py``) once per mode:
+
+    inline     ATTACHMENT_WORKERS=0: uploads are processed on the request thread
+    threads    ATTACHMENT_WORKERS=2
+    processes  ATTACHMENT_WORKERS=2, ATTACHMENT_PROCESSES=2: PDFs parsed in worker processes
+
+and measures ``/api/chat`` latency of small text-only questions, first on an
+idle server, then while ``--uploaders`` clients keep uploading large PDFs
+and photos to ``/api/chat/upload``. The files are generated up front and
+the extraction caches hold a single entry, so every upload is processed.
+
+Usage:
+    python benchmarks/bench_attachment_pool.py [--server flask] [--modes inline threads processes]
+        [--uploaders 4] [--requests 200] [--latency 0.05]
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from load_test import multipart, percentile, post_chat, start_server, wait_until_ready
+from sample_documents import make_pdf
+from sample_images import make_photo
+
+MODES = {
+    "inline": {"ATTACHMENT_WORKERS": "0"},
+    "threads": {"ATTACHMENT_WORKERS": "2"},
+    "processes": {"ATTACHMENT_WORKERS": "2", "ATTACHMENT_PROCESSES": "2"},
+}
+PORT = 4120
+
+
+def sample_files(count: int) -> List[Tuple[str, bytes, str]]:
+    """Distinct PDFs and photos, so no upload is answered from a cache."""
+    files = []
+    for i in range(count):
+        pages = [f"Report {i} page {page}: " + "quarterly revenue grew in every region " * 8 for page in range(150)]
+        files.append((f"report-{i}.pdf", make_pdf(pages), "application/pdf"))
+        files.append((f"photo-{i}.jpg", make_photo(seed=i), "image/jpeg"))
+    return files
+
+
+def upload_loop(port: int, bodies: List[Tuple[bytes, str]], stop: threading.Event, offset: int, counts: Dict[str, int]) -> None:
+    i = offset
+    while not stop.is_set():
+        body, content_type = bodies[i % len(bodies)]
+        i += 1
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        try:
+            conn.request("POST", "/api/chat/upload", body=body, headers={"Content-Type": content_type})
+            status = conn.getresponse()
+            status.read()
+            counts[str(status.status)] = counts.get(str(status.status), 0) + 1
+        except OSError:
+            counts["0"] = counts.get("0", 0) + 1
+        finally:
+            conn.close()
+
+
+def chat_latencies(port: int, requests: int, concurrency: int) -> Dict:
+    body = json.dumps({"message": "What is the capital of France?", "cache": False}).encode()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: post_chat("127.0.0.1", port, body), range(requests)))
+    latencies = [latency * 1000 for status, latency in results if status == 200]
+    return {
+        "ok": len(latencies),
+        **{f"p{q}_ms": round(percentile(latencies, q), 1) if latencies else None for q in (50, 95, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="flask", choices=["flask", "asgi"])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--uploaders", type=int, default=4, help="clients uploading files in a loop")
+    parser.add_argument("--requests", type=int, default=200, help="small chats per measurement")
+    parser.add_argument("--concurrency", type=int, default=4, help="small chats in flight")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake LLM latency in seconds")
+    args = parser.parse_args()
+
+    print("Generating sample files...")
+    bodies = [multipart({"message": "Summarize this file", "cache": "false"}, [f]) for f in sample_files(4)]
+
+    results = {}
+    for mode in args.modes:
+        env = {**MODES[mode], "DOCUMENT_CACHE_SIZE": "1", "IMAGE_CACHE_SIZE": "1"}
+        process = start_server(args.server, PORT, args.latency, env)
+        try:
+            wait_until_ready("127.0.0.1", PORT)
+            idle = chat_latencies(PORT, args.requests, args.concurrency)
+
+            stop, counts = threading.Event(), {}
+            uploaders = [threading.Thread(target=upload_loop, args=(PORT, bodies, stop, i, counts)) for i in range(args.uploaders)]
+            for thread in uploaders:
+                thread.start()
+            time.sleep(1)
+            loaded = chat_latencies(PORT, args.requests, args.concurrency)
+            stop.set()
+            for thread in uploaders:
+                thread.join()
+            results[mode] = {"idle": idle, "under_uploads": loaded, "upload_statuses": counts}
+        finally:
+            process.terminate()
+            process.wait()
+        print(mode, json.dumps(results[mode]))
+
+    print(f"\n{'mode':<10} {'idle p50':>9} {'idle p99':>9} {'load p50':>9} {'load p95':>9} {'load p99':>9}")
+    for mode, result in results.items():
+        idle, loaded = result["idle"], result["under_uploads"]
+        print(f"{mode:<10} {idle['p50_ms']:9} {idle['p99_ms']:9} {loaded['p50_ms']:9} {loaded['p95_ms']:9} {loaded['p99_ms']:9}")
+
+
+if __name__ == "__main__":
+    main()
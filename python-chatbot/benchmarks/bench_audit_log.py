@@ -0,0 +1,77 @@
+"""
+Append throughput and page latency of the audit log.
+
+Appends ``--turns`` turns with each ``--batch-sizes`` value (1 is a commit,
+and an fsync, per turn) and reports turns per second and the database
+size per turn. Then grows one log to each ``--rows`` size, spread over
+1000 sessions, and times fetching the first and a deep page of a
+session's history and of the session list, which should stay flat as the
+log grows.
+
+Usage:
+    python benchmarks/bench_audit_log.py [--turns 5000] [--batch-sizes 1 64 256] [--rows 10000 100000 1000000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audit_log import AuditLog
+
+QUESTION = "What does the attached report say about revenue in the northern region last quarter?"
+ANSWER = "Revenue in the northern region grew by 12% last quarter, driven mostly by new enterprise contracts. " * 8
+
+
+def timed(fn, repeat: int = 50) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64, 256])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'batch':>6} {'turns/s':>9} {'bytes/turn':>11}")
+        for batch_size in args.batch_sizes:
+            path = os.path.join(directory, f"batch-{batch_size}.db")
+            log = AuditLog(path, batch_size=batch_size, flush_interval=0.05, max_queue=args.turns + 1)
+            start = time.perf_counter()
+            for i in range(args.turns):
+                log.record(f"session-{i % 100}", QUESTION, ANSWER, "gemini-2.5-flash")
+            log.flush()
+            elapsed = time.perf_counter() - start
+            log.close()
+            size = sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+            print(f"{batch_size:6d} {args.turns / elapsed:9.0f} {size / args.turns:11.0f}")
+
+        print(f"\n{'rows':>9} {'turns p1 ms':>12} {'turns p20 ms':>13} {'sessions ms':>12}")
+        log = AuditLog(os.path.join(directory, "grow.db"), batch_size=1000, max_queue=100_000)
+        written = 0
+        for rows in sorted(args.rows):
+            while written < rows:
+                log.record(f"session-{written % 1000}", QUESTION, ANSWER, "gemini-2.5-flash")
+                written += 1
+                if written % 50_000 == 0:
+                    log.flush()
+            log.flush()
+            cursor = None
+            for _ in range(19):
+                _, cursor = log.turns("session-7", cursor, limit=10)
+            first = timed(lambda: log.turns("session-7", limit=10))
+            deep = timed(lambda: log.turns("session-7", cursor, limit=10))
+            sessions = timed(lambda: log.sessions(limit=20))
+            print(f"{rows:9d} {first:12.3f} {deep:13.3f} {sessions:12.3f}")
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
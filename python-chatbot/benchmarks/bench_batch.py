@@ -0,0 +1,61 @@
+"""
+Throughput of batch chats against the fake LLM.
+
+Sends ``--items`` distinct questions through ``chat_batch()`` (threads) and
+``achat_batch()`` (asyncio) at each ``--concurrency`` level and reports
+items per second, next to one-at-a-time ``chatbot()`` calls as the baseline.
+The response cache is bypassed so every item reaches the model.
+
+Usage:
+    python benchmarks/bench_batch.py [--items 256] [--latency 0.2] [--concurrency 1 8 64]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The real client is never called, but it still needs a key to be constructed
+os.environ.setdefault("GOOGLE_API_KEY", "fake-key")
+
+import chatbot
+from fake_llm import FakeChatModel
+
+
+def report(label: str, items: int, elapsed: float, failed: int = 0) -> None:
+    print(f"{label:<22} {items:6d} {elapsed:9.2f} {items / elapsed:10.1f} {failed:7d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM latency in seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--sequential-items", type=int, default=20, help="items for the one-at-a-time baseline")
+    args = parser.parse_args()
+
+    fake = FakeChatModel(latency=args.latency)
+    chatbot.model_router.use_clients(lambda model_name: fake)
+    items = [{"message": f"Question number {i}?", "attachments": []} for i in range(args.items)]
+
+    print(f"{'mode':<22} {'items':>6} {'seconds':>9} {'items/s':>10} {'failed':>7}")
+    start = time.perf_counter()
+    for item in items[:args.sequential_items]:
+        chatbot.chatbot(item["message"], use_cache=False)
+    report("sequential chatbot()", args.sequential_items, time.perf_counter() - start)
+
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        results = chatbot.chat_batch(items, max_concurrency=concurrency, use_cache=False)
+        report(f"chat_batch c={concurrency}", len(results), time.perf_counter() - start, sum(not r.ok for r in results))
+
+        start = time.perf_counter()
+        results = asyncio.run(chatbot.achat_batch(items, max_concurrency=concurrency, use_cache=False))
+        report(f"achat_batch c={concurrency}", len(results), time.perf_counter() - start, sum(not r.ok for r in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark for the image preprocessing stage.
+
+Generates a corpus of sample images (phone photos at several sizes, a
+screenshot and a small icon) and reports, per image, the bytes that would
+have been sent before (base64 of the original) and after processing, the
+processing time, and the time of a cached repeat.
+
+Usage:
+    python benchmarks/bench_image_processing.py [--max-dimension 1536] [--quality 85]
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_processing import ImageProcessor
+from sample_images import make_icon, make_photo, make_screenshot
+
+CORPUS = [
+    ("photo_12mp.jpg", "image/jpeg", lambda: make_photo(4032, 3024, seed=0)),
+    ("photo_48mp.jpg", "image/jpeg", lambda: make_photo(8000, 6000, quality=90, seed=1)),
+    ("photo_2mp.jpg", "image/jpeg", lambda: make_photo(1600, 1200, seed=2)),
+    ("screenshot.png", "image/png", make_screenshot),
+    ("icon.png", "image/png", make_icon),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-dimension", type=int, default=1536)
+    parser.add_argument("--quality", type=int, default=85)
+    args = parser.parse_args()
+    processor = ImageProcessor(max_dimension=args.max_dimension, quality=args.quality)
+
+    print(f"{'image':<16} {'original':>10} {'sent before':>12} {'sent after':>11} {'saved':>7} {'size':>11} "
+          f"{'ms':>7} {'cached ms':>10}")
+    total_before = total_after = 0
+    for name, mime_type, make in CORPUS:
+        data = make()
+        image = processor.process(data, mime_type)
+        before = len(base64.b64encode(data))
+        after = len(image.data_url)
+
+        start = time.perf_counter()
+        processor.process(data, mime_type)
+        cached = (time.perf_counter() - start) * 1000
+
+        total_before += before
+        total_after += after
+        print(f"{name:<16} {len(data):10d} {before:12d} {after:11d} {1 - after / before:7.1%} "
+              f"{image.width:>5}x{image.height:<5} {image.ms:7.1f} {cached:10.2f}")
+    print(f"{'total':<16} {'':>10} {total_before:12d} {total_after:11d} {1 - total_after / total_before:7.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Start-up cost of the serving process: import time and warm-up time.
+
+Imports each of ``--modules`` in a fresh interpreter under
+``python -X importtime``, ``--repeat`` times, and reports the median wall
+time of the import and the slowest modules it imports directly. Then
+times ``warmup.run()`` in a fresh process, which is what the first
+request pays when ``WARMUP`` is off.
+
+Usage:
+    python benchmarks/bench_import_time.py [--modules chatbot api asgi_api] [--repeat 5] [--top 8]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV = {**os.environ, "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", "benchmark-key"), "WARMUP": "off"}
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+WARMUP_CODE = """
+import json, time
+start = time.perf_counter()
+from chatbot import warmup
+imported = time.perf_counter()
+warmup.run()
+print(json.dumps({"import_ms": (imported - start) * 1000, "warmup_ms": (time.perf_counter() - imported) * 1000,
+                  "state": warmup.state, "error": warmup.error, "steps": warmup.step_ms}))
+"""
+
+
+def import_once(module: str):
+    """Import ``module`` in a fresh interpreter; returns the wall time in ms and the cumulative µs of each module it imports directly."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, env=ENV, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    # importtime lists a module's imports before the module itself, one indent level deeper
+    children, direct = {}, {}
+    for match in LINE.finditer(result.stderr):
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 3:
+            children[name] = cumulative
+        elif indent == 1:
+            if name == module:
+                direct = children
+            children = {}
+    return elapsed, direct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=["chatbot", "api", "asgi_api"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="slowest direct imports to list")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        walls, cumulative = [], defaultdict(list)
+        for _ in range(args.repeat):
+            wall, direct = import_once(module)
+            walls.append(wall)
+            for name, us in direct.items():
+                cumulative[name].append(us)
+        print(f"import {module}: median {statistics.median(walls):.0f} ms (min {min(walls):.0f}, max {max(walls):.0f})")
+        slowest = sorted(cumulative.items(), key=lambda item: -statistics.median(item[1]))[:args.top]
+        for name, values in slowest:
+            print(f"    {statistics.median(values) / 1000:8.1f} ms  {name}")
+
+    runs = []
+    for _ in range(args.repeat):
+        result = subprocess.run([sys.executable, "-c", WARMUP_CODE], cwd=ROOT, env=ENV, capture_output=True, text=True)
+        if result.returncode != 0:
+            sys.exit(f"warm-up failed:\n{result.stderr[-2000:]}")
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    print(f"\nwarm-up: median {statistics.median(r['warmup_ms'] for r in runs):.0f} ms, state {runs[-1]['state']}"
+          + (f" ({runs[-1]['error']})" if runs[-1]["error"] else ""))
+    for name in runs[-1]["steps"]:
+        print(f"    {statistics.median(r['steps'][name] for r in runs if name in r['steps']):8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
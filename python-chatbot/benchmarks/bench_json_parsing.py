@@ -0,0 +1,112 @@
+"""
+Parse and validate time of JSON chat requests with large attachments.
+
+Builds a chat body with one base64 attachment per ``--sizes`` value (in
+MB of JSON) and times, per body, the median of ``--repeat`` runs of:
+
+- ``get_json``: Flask's ``request.get_json()`` with its default JSON
+  provider and with the json_codec one the API installs;
+- ``attachments``: turning the attachments into what ``chatbot()`` takes,
+  then decoding the payload and computing the request fingerprint's and
+  cache key's digests. The old path copied each attachment into a dict,
+  hashed the base64 text twice and decoded it separately. The new path
+  builds ``Attachment`` structs and decodes and hashes once.
+
+Usage:
+    python benchmarks/bench_json_parsing.py [--sizes 1 10 50] [--repeat 5]
+"""
+import argparse
+import base64
+import hashlib
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The largest body is just over the API's default 50 MB request limit
+os.environ.setdefault("UPLOAD_MAX_REQUEST_BYTES", str(256 * 1024 * 1024))
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark-key")
+
+from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
+
+from attachments import attachment_bytes, process_attachments
+from json_codec import BACKEND, dumps
+from response_cache import attachment_digest
+
+
+def old_process_attachments(attachments):
+    """The dict-copying normalization the APIs used before Attachment structs."""
+    return [{
+        'type': attachment.get('type', 'unknown'),
+        'filename': attachment.get('filename', 'unknown'),
+        'content': attachment.get('content', ''),
+        'mime_type': attachment.get('mime_type', ''),
+        'encoding': attachment.get('encoding', 'base64'),
+    } for attachment in attachments]
+
+
+def old_attachments(data):
+    attachments = old_process_attachments(data["attachments"])
+    for attachment in attachments:
+        content = attachment['content']
+        # Fingerprint and cache key each hashed the base64 text; decoding was separate again
+        for _ in range(2):
+            hashlib.sha256(content.encode('utf-8')).hexdigest()
+        base64.b64decode(content.split(',', 1)[-1])
+    return attachments
+
+
+def new_attachments(data):
+    attachments = process_attachments(data["attachments"])
+    for attachment in attachments:
+        attachment_bytes(attachment)
+        for _ in range(2):
+            attachment_digest(attachment)
+    return attachments
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50], help="body sizes in MB")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    default_app = Flask("default")
+    default_app.json = DefaultJSONProvider(default_app)
+    import api
+    fast_app = api.app
+
+    def get_json(app, body):
+        with app.test_request_context("/api/chat", method="POST", data=body, content_type="application/json"):
+            return request.get_json()
+
+    print(f"json_codec backend: {BACKEND}\n")
+    print(f"{'MB':>5} {'get_json stdlib ms':>19} {'json_codec ms':>14} {'attachments old ms':>19} {'new ms':>7} {'total old ms':>13} {'new ms':>7}")
+    for size in args.sizes:
+        raw = os.urandom(int(size * 1024 * 1024 * 3 / 4))
+        body = dumps({"message": "What is in this photo?", "attachments": [{
+            "filename": "photo.jpg", "mime_type": "image/jpeg",
+            "content": "data:image/jpeg;base64," + base64.b64encode(raw).decode("ascii"),
+        }]})
+        data = get_json(fast_app, body)
+        parse_old = timed(lambda: get_json(default_app, body), args.repeat)
+        parse_new = timed(lambda: get_json(fast_app, body), args.repeat)
+        attach_old = timed(lambda: old_attachments(data), args.repeat)
+        attach_new = timed(lambda: new_attachments(data), args.repeat)
+        print(f"{len(body) / 1e6:5.0f} {parse_old:19.1f} {parse_new:14.1f} {attach_old:19.1f} {attach_new:7.1f} "
+              f"{parse_old + attach_old:13.1f} {parse_new + attach_new:7.1f}")
+
+
+if __name__ == "__main__":
+    main()
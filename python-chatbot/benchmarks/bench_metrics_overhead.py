@@ -0,0 +1,54 @@
+"""
+Per-request cost of the metrics instrumentation.
+
+Runs the same calls a chat request makes (start a trace, six spans, token
+counts, finish) in a loop and reports the time per request, with and
+without a Prometheus scrape rendering the resulting series.
+
+Usage:
+    python benchmarks/bench_metrics_overhead.py [--requests 100000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import current_trace, end_request, record_tokens, registry, span, start_request
+
+STAGES = ("parse", "attachments", "prompt_build", "llm_total", "serialize")
+
+
+def one_request(route: str) -> None:
+    trace, token = start_request(route, "POST")
+    for stage in STAGES:
+        with span(stage):
+            pass
+    current_trace().since_start("llm_first_token")
+    record_tokens(prompt=120, response=300)
+    trace.finish(200)
+    end_request(token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100_000)
+    args = parser.parse_args()
+
+    routes = ["/api/chat", "/api/chat/stream", "/api/chat/upload"]
+    start = time.perf_counter()
+    for i in range(args.requests):
+        one_request(routes[i % len(routes)])
+    per_request = (time.perf_counter() - start) / args.requests
+
+    start = time.perf_counter()
+    body = registry.render()
+    render = time.perf_counter() - start
+
+    print(f"instrumentation per request: {per_request * 1e6:.1f} us")
+    print(f"scrape render: {render * 1000:.2f} ms for {len(body.splitlines())} lines")
+
+
+if __name__ == "__main__":
+    main()
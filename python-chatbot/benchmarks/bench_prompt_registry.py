@@ -0,0 +1,76 @@
+"""
+Micro-benchmark for per-request prompt overhead.
+
+Compares the old text-only path (load prompt.poml, build the chain and run
+it on every request) with the shared chain from the prompt registry. A stub
+LLM is used so only prompt handling is measured; no API key is needed.
+
+Usage:
+    python benchmarks/bench_prompt_registry.py [--baseline-runs 5] [--registry-runs 2000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from poml.integration.langchain import LangchainPomlTemplate
+
+from prompt_registry import PromptRegistry
+
+PROMPT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prompt.poml")
+QUESTION = "What's new in Python 3.13?\n\nAttachments provided:\n1. notes.txt (text)\n   Content: hello\n"
+
+stub_llm = RunnableLambda(lambda prompt_value: AIMessage(content="ok"))
+
+
+def time_calls(fn, runs: int):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def baseline_request():
+    prompt = LangchainPomlTemplate.from_file(PROMPT_FILE)
+    chain = prompt | stub_llm | StrOutputParser()
+    chain.invoke({"question": QUESTION})
+
+
+def report(name: str, samples):
+    print(f"{name:<10} runs={len(samples):<6} mean={statistics.mean(samples):9.3f} ms  "
+          f"p50={statistics.median(samples):9.3f} ms  max={max(samples):9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline-runs", type=int, default=5)
+    parser.add_argument("--registry-runs", type=int, default=2000)
+    args = parser.parse_args()
+
+    registry = PromptRegistry()
+    start = time.perf_counter()
+    registry.preload([PROMPT_FILE])
+    print(f"startup compile: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def registry_request():
+        registry.chain(PROMPT_FILE, stub_llm).invoke({"question": QUESTION})
+
+    baseline = time_calls(baseline_request, args.baseline_runs)
+    cached = time_calls(registry_request, args.registry_runs)
+
+    report("baseline", baseline)
+    report("registry", cached)
+    print(f"speedup (p50): {statistics.median(baseline) / statistics.median(cached):.0f}x")
+    print(f"registry stats: {registry.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Latency benchmark for retrieval over long text attachments.
+
+Generates a synthetic log file and a synthetic source file of the given
+size and measures, per file:
+
+    build    cold index build (chunking + BM25 arrays), paid once per content
+    cached   index lookup for content that was indexed before (hash + LRU hit)
+    query    selecting the top chunks for a question, averaged over many runs
+
+and checks that the planted needle line is among the selected chunks.
+
+Usage:
+    python benchmarks/bench_retrieval.py [--size-mb 10] [--queries 200]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import Retriever
+
+NEEDLE_LOG = "2024-01-01 12:34:56 ERROR payment-service: connection refused by ledger-db replica-3\n"
+NEEDLE_CODE = "def reconcile_ledger_balance(account, ledger_entries):\n    return sum(entry.amount for entry in ledger_entries)\n"
+
+
+def make_log(size: int) -> str:
+    rng = random.Random(0)
+    services = ["api", "auth", "search", "billing", "worker"]
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2024-01-01 12:{rng.randrange(60):02d}:{rng.randrange(60):02d} INFO {rng.choice(services)}: "
+                f"request {rng.randrange(10**6)} handled in {rng.randrange(1, 500)} ms\n")
+        lines.append(line)
+        total += len(line)
+    lines.insert(len(lines) * 2 // 3, NEEDLE_LOG)
+    return "".join(lines)
+
+
+def make_code(size: int) -> str:
+    rng = random.Random(1)
+    blocks = []
+    total = 0
+    while total < size:
+        n = rng.randrange(10**6)
+        block = (f"def handler_{n}(request, context):\n"
+                 f"    value_{n} = context.get('key_{n % 997}')\n"
+                 f"    return render(request, value_{n}, status={200 + n % 5})\n\n")
+        blocks.append(block)
+        total += len(block)
+    blocks.insert(len(blocks) // 3, NEEDLE_CODE)
+    return "".join(blocks)
+
+
+def bench(name: str, text: str, question: str, needle: str, queries: int):
+    retriever = Retriever()
+
+    start = time.perf_counter()
+    index = retriever.index(text)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    retriever.index(text)
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        selected = retriever.select(index, question)
+    query = (time.perf_counter() - start) / queries
+
+    found = any(needle.splitlines()[0] in chunk.text for chunk in selected)
+    print(f"{name:<6} {len(text) / 2**20:8.1f} {len(index):8d} {build * 1000:10.0f} {cached * 1000:10.1f} "
+          f"{query * 1000:9.3f} {'yes' if found else 'NO':>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    print(f"{'file':<6} {'size MB':>8} {'chunks':>8} {'build ms':>10} {'cached ms':>10} {'query ms':>9} {'found':>6}")
+    bench("log", make_log(size), "why did the payment service get connection refused from the ledger db?", NEEDLE_LOG, args.queries)
+    bench("code", make_code(size), "where do we reconcile the ledger balance?", NEEDLE_CODE, args.queries)
+
+
+if __name__ == "__main__":
+    main()
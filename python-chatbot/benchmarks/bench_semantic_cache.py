@@ -0,0 +1,136 @@
+"""
+Lookup latency, recall and answer quality of the semantic cache.
+
+Embeds a set of hand-written question pairs: paraphrases, different
+questions that share most of their words, and look-alikes that differ in
+a negation, a number, the tense or the direction. It reports how many
+would be answered from cache at ``--threshold``, after the check that
+both questions have the same negations, numbers, tense and direction. Then fills a cache with
+``--sizes`` synthetic questions, saves and reloads it, and times lookups
+of slightly reworded copies with the brute-force index and with the
+clustered one. Recall is how often the clustered index finds the same
+nearest entry as the brute force.
+
+Usage:
+    python benchmarks/bench_semantic_cache.py [--sizes 1000 10000 100000 300000] [--queries 500] [--threshold 0.82] [--nprobe 16]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_test import percentile
+from semantic_cache import SemanticCache, embed, same_markers
+
+SCOPE = "gemini-2.5-flash:template"
+
+PARAPHRASES = [
+    ("how do I reset my password", "password reset steps"),
+    ("What is the refund policy?", "what's your refund policy"),
+    ("How can I cancel my subscription?", "cancel subscription"),
+    ("how do i change my email address", "changing my email address"),
+    ("What are your opening hours?", "opening hours?"),
+    ("How do I export my data to CSV?", "export data as csv"),
+    ("Where can I download the invoice?", "download invoice"),
+    ("How to delete my account", "how do I delete my account permanently"),
+    ("what is the capital of france", "capital of France?"),
+    ("Explain how photosynthesis works", "how does photosynthesis work"),
+]
+DIFFERENT = [
+    ("how do I reset my password", "how do I change my password"),
+    ("What is the refund policy?", "what is the privacy policy"),
+    ("How can I cancel my subscription?", "How can I upgrade my subscription?"),
+    ("how do i change my email address", "how do i change my postal address"),
+    ("What are your opening hours?", "what are your closing hours?"),
+    ("How do I export my data to CSV?", "How do I import my data from CSV?"),
+    ("Where can I download the invoice?", "where can I download the app"),
+    ("How to delete my account", "how to delete my photos"),
+    ("what is the capital of france", "what is the capital of germany"),
+    ("reset password for admin", "reset password for user"),
+    ("How do I enable 2FA?", "How do I disable 2FA?"),
+    ("Convert 100 USD to EUR", "Convert 100 EUR to USD"),
+    ("Who is the CEO of Twitter?", "Who was the CEO of Twitter?"),
+    ("Why does my password reset?", "Why does my password not reset?"),
+    ("Is it safe to mix bleach and ammonia?", "Is it safe to mix bleach and vinegar?"),
+    ("How many days are in 2023?", "How many days are in 2024?"),
+]
+
+
+def synthetic_questions(count: int, rng: random.Random):
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+    return [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(5, 9))) for _ in range(count)]
+
+
+def reworded(question: str, rng: random.Random) -> str:
+    words = question.split()
+    del words[rng.randrange(len(words))]
+    return " ".join(words)
+
+
+def time_lookups(cache: SemanticCache, queries):
+    latencies, answers = [], []
+    for query in queries:
+        start = time.perf_counter()
+        answers.append(cache.lookup(query, SCOPE))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10_000, 100_000, 300_000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threshold", type=float, default=0.82)
+    parser.add_argument("--nprobe", type=int, default=16, help="clusters the clustered index scans per lookup")
+    args = parser.parse_args()
+
+    print("similarity of paraphrases:", " ".join(f"{float(embed(a) @ embed(b)):.2f}" for a, b in PARAPHRASES))
+    print("similarity of different questions:", " ".join(f"{float(embed(a) @ embed(b)):.2f}" for a, b in DIFFERENT))
+    hits = sum(float(embed(a) @ embed(b)) >= args.threshold and same_markers(a, b) for a, b in PARAPHRASES)
+    false_hits = sum(float(embed(a) @ embed(b)) >= args.threshold and same_markers(a, b) for a, b in DIFFERENT)
+    print(f"at threshold {args.threshold}: {hits}/{len(PARAPHRASES)} paraphrases hit, "
+          f"{false_hits}/{len(DIFFERENT)} different questions wrongly hit")
+
+    rng = random.Random(0)
+    questions = synthetic_questions(max(args.sizes), rng)
+    start = time.perf_counter()
+    for question in questions[:10_000]:
+        embed(question)
+    print(f"embedding: {(time.perf_counter() - start) / min(10_000, len(questions)) * 1e6:.0f} us per question\n")
+
+    print(f"{'entries':>8} {'add us':>7} {'save ms':>8} {'load ms':>8} {'exact p50':>10} {'p95':>6} "
+          f"{'ann p50':>8} {'p95':>6} {'recall':>7} {'MB':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            path = os.path.join(directory, f"semantic-{size}.npz")
+            # Clustered from the start, so that filling a large cache does not scan it on every add
+            cache = SemanticCache(max_entries=size, threshold=0.0, ttl=0, path=path, ann_min_entries=1000)
+            start = time.perf_counter()
+            for i, question in enumerate(questions[:size]):
+                cache.add(question, SCOPE, f"answer {i}")
+            add_us = (time.perf_counter() - start) / size * 1e6
+            start = time.perf_counter()
+            cache.save()
+            save_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            exact = SemanticCache(max_entries=size, threshold=0.0, ttl=0, path=path, ann_min_entries=size + 1)
+            load_ms = (time.perf_counter() - start) * 1000
+            clustered = SemanticCache(max_entries=size, threshold=0.0, ttl=0, path=path, ann_min_entries=min(size, 100_000),
+                                     nprobe=args.nprobe)
+
+            targets = [rng.randrange(size) for _ in range(args.queries)]
+            queries = [reworded(questions[i], rng) for i in targets]
+            exact_ms, exact_answers = time_lookups(exact, queries)
+            ann_ms, ann_answers = time_lookups(clustered, queries)
+            recall = sum(a == b for a, b in zip(exact_answers, ann_answers)) / len(queries)
+            print(f"{size:8d} {add_us:7.0f} {save_ms:8.0f} {load_ms:8.0f} {percentile(exact_ms, 50):10.3f} {percentile(exact_ms, 95):6.3f} "
+                  f"{percentile(ann_ms, 50):8.3f} {percentile(ann_ms, 95):6.3f} {recall:7.3f} {os.path.getsize(path) / 1e6:6.1f}")
+
+
+if __name__ == "__main__":
+    main()
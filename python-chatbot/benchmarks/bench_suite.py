@@ -0,0 +1,274 @@
+"""
+End-to-end benchmark of the API under a realistic request mix, fully offline.
+
+For each of ``--servers``, starts the API with ``FakeChatModel`` in place of
+every model client (``serve_fake.py``) and sends ``--requests`` requests from
+``--concurrency`` clients, drawn from a weighted ``--mix`` of:
+
+    chat       short JSON question
+    text       JSON question with a base64 text attachment (a log of ``--text-kb`` KB)
+    image      multipart upload of a phone photo
+    document   multipart upload of a ``--pdf-pages`` page PDF
+    stream     question to /api/chat/stream, read to the last event
+
+The fake's latency can follow a lognormal distribution (``--latency-sigma``),
+stream at ``--tokens-per-second`` and fail ``--error-rate`` of calls. The
+request sequence, the files and the fake's latencies all come from
+``--seed``. The response cache is bypassed, and the attachment caches hold
+one entry, so every request reaches the model and every file is processed.
+
+Each run records throughput, latency percentiles overall and per kind (and
+time to first byte for streams), status counts, the server's peak RSS and
+its own per-stage percentiles. The result is written as JSON to
+``--output``. With ``--baseline`` it is compared to an earlier result file,
+and the exit status is 1 if throughput dropped, or p95 latency or peak RSS
+grew, by more than ``--tolerance``.
+
+Usage:
+    python benchmarks/bench_suite.py --output baseline.json
+    python benchmarks/bench_suite.py --baseline baseline.json --output current.json
+    python benchmarks/bench_suite.py --servers asgi --mix chat=1 document=1 --latency-sigma 0.5 --error-rate 0.02
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from load_test import PORTS, multipart, percentile, server_stages, start_server, wait_until_ready
+from sample_documents import make_pdf
+from sample_images import make_photo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ("chat", "text", "image", "document", "stream")
+DEFAULT_MIX = ["chat=50", "text=20", "image=15", "document=10", "stream=5"]
+# Regressions checked against the baseline: (metric path, whether higher is better)
+CHECKS = ((("throughput_rps",), True), (("latency_ms", "p95"), False), (("peak_rss_mb",), False))
+
+# (kind, route, body, content type)
+Request = Tuple[str, str, bytes, str]
+
+
+def parse_mix(pairs: List[str]) -> Dict[str, float]:
+    mix = {}
+    for pair in pairs:
+        kind, _, weight = pair.partition("=")
+        if kind not in KINDS:
+            raise SystemExit(f"unknown request kind {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def payloads(args, rng: random.Random) -> Dict[str, List[Request]]:
+    """``--variants`` distinct requests of each kind in the mix."""
+    questions = ["What is the capital of France?", "Summarize the main points.", "How do I reset my password?",
+                 "Explain the difference between a list and a tuple.", "What happened in the last quarter?"]
+    line = "2024-05-01 12:00:{:02d} INFO worker-{} handled request {} in {} ms\n"
+    variants: Dict[str, List[Request]] = {kind: [] for kind in args.mix}
+    for i in range(args.variants):
+        question = f"{rng.choice(questions)} ({i})"
+        if "chat" in variants:
+            variants["chat"].append(("chat", "/api/chat", json.dumps({"message": question, "cache": False}).encode(), "application/json"))
+        if "stream" in variants:
+            variants["stream"].append(("stream", "/api/chat/stream", json.dumps({"message": question, "cache": False}).encode(), "application/json"))
+        if "text" in variants:
+            log = "".join(line.format(n % 60, rng.randrange(8), n, rng.randrange(500)) for n in range(args.text_kb * 16))
+            attachment = {"type": "text", "filename": f"server-{i}.log", "mime_type": "text/plain", "encoding": "base64",
+                          "content": base64.b64encode(log.encode()).decode()}
+            body = json.dumps({"message": "Which worker was slowest?", "attachments": [attachment], "cache": False}).encode()
+            variants["text"].append(("text", "/api/chat", body, "application/json"))
+        if "image" in variants:
+            body, content_type = multipart({"message": "What is in this photo?", "cache": "false"},
+                                           [(f"photo-{i}.jpg", make_photo(2016, 1512, seed=args.seed + i), "image/jpeg")])
+            variants["image"].append(("image", "/api/chat/upload", body, content_type))
+        if "document" in variants:
+            pages = [f"Report {i}, page {page}: " + "revenue grew in every region this quarter " * 6 for page in range(args.pdf_pages)]
+            body, content_type = multipart({"message": "Summarize this report", "cache": "false"},
+                                           [(f"report-{i}.pdf", make_pdf(pages), "application/pdf")])
+            variants["document"].append(("document", "/api/chat/upload", body, content_type))
+    return variants
+
+
+def send(port: int, request: Request) -> Tuple[str, int, float, float]:
+    """Send one request; returns (kind, status or 0 on a connection error, seconds to first byte, seconds in total)."""
+    kind, route, body, content_type = request
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        conn.request("POST", route, body=body, headers={"Content-Type": content_type})
+        response = conn.getresponse()
+        response.read(1)
+        first_byte = time.perf_counter() - start
+        response.read()
+        return kind, response.status, first_byte, time.perf_counter() - start
+    except OSError:
+        elapsed = time.perf_counter() - start
+        return kind, 0, elapsed, elapsed
+    finally:
+        conn.close()
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Peak resident set size of a running process, where ``/proc`` has it."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ms = [sample * 1000 for sample in samples]
+    return {
+        **{f"p{q}": round(percentile(ms, q), 1) for q in (50, 95, 99)},
+        "mean": round(sum(ms) / len(ms), 1),
+        "max": round(max(ms), 1),
+    }
+
+
+def run(port: int, requests: List[Request], concurrency: int) -> Dict:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda request: send(port, request), requests))
+    elapsed = time.perf_counter() - start
+
+    statuses: Dict[str, int] = {}
+    for _, status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [result for result in results if result[1] == 200]
+    kinds = {}
+    for kind in sorted({result[0] for result in results}):
+        of_kind = [result for result in ok if result[0] == kind]
+        kinds[kind] = {
+            "requests": sum(result[0] == kind for result in results),
+            "ok": len(of_kind),
+            "latency_ms": summarize([result[3] for result in of_kind]),
+        }
+        if kind == "stream":
+            kinds[kind]["first_byte_ms"] = summarize([result[2] for result in of_kind])
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 1),
+        "latency_ms": summarize([result[3] for result in ok]),
+        "kinds": kinds,
+        "statuses": statuses,
+    }
+
+
+def metadata(args) -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+    }
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Lines describing each checked metric that got worse by more than ``tolerance``."""
+    regressions = []
+    for server, current in result["servers"].items():
+        before = baseline.get("servers", {}).get(server)
+        if before is None:
+            continue
+        for path, higher_is_better in CHECKS:
+            new, old = current, before
+            for key in path:
+                new, old = (new or {}).get(key), (old or {}).get(key)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            marker = ""
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                marker = "  REGRESSION"
+                regressions.append(f"{server} {'.'.join(path)}: {old} -> {new} ({change:+.1%})")
+            print(f"{server:<6} {'.'.join(path):<16} {old:>10} {new:>10} {change:+8.1%}{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", default=["flask", "asgi"], choices=["flask", "asgi"])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--mix", nargs="+", default=DEFAULT_MIX, help="kind=weight pairs")
+    parser.add_argument("--variants", type=int, default=8, help="distinct requests generated per kind")
+    parser.add_argument("--text-kb", type=int, default=200)
+    parser.add_argument("--pdf-pages", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.2, help="median fake LLM latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="lognormal spread of the latency, 0 for fixed")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="fake streaming speed")
+    parser.add_argument("--response-words", type=int, default=80, help="length of the fake answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls failing with a 503")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_suite.json", help="where to write the result")
+    parser.add_argument("--baseline", help="earlier result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    args = parser.parse_args()
+    args.mix = parse_mix(args.mix)
+
+    rng = random.Random(args.seed)
+    print("Generating payloads...")
+    variants = payloads(args, rng)
+    kinds = list(args.mix)
+    sequence = [rng.choice(variants[kind]) for kind in rng.choices(kinds, [args.mix[kind] for kind in kinds], k=args.warmup + args.requests)]
+
+    fake_args = ["--latency-sigma", str(args.latency_sigma), "--tokens-per-second", str(args.tokens_per_second),
+                 "--response-words", str(args.response_words), "--error-rate", str(args.error_rate), "--seed", str(args.seed)]
+    env = {"DOCUMENT_CACHE_SIZE": "1", "IMAGE_CACHE_SIZE": "1", "RETRIEVAL_CACHE_SIZE": "1"}
+    result = {"meta": metadata(args), "servers": {}}
+    for server in args.servers:
+        port = PORTS[server]
+        process = start_server(server, port, args.latency, env, fake_args)
+        try:
+            wait_until_ready("127.0.0.1", port)
+            run(port, sequence[:args.warmup], args.concurrency)
+            result["servers"][server] = run(port, sequence[args.warmup:], args.concurrency)
+            result["servers"][server]["peak_rss_mb"] = peak_rss_mb(process.pid)
+            result["servers"][server]["server_ms"] = {route: server_stages("127.0.0.1", port, route)
+                                                      for route in ("/api/chat", "/api/chat/upload", "/api/chat/stream")}
+        finally:
+            process.terminate()
+            process.wait()
+        summary = result["servers"][server]
+        print(f"{server:<6} {summary['throughput_rps']} req/s, p50/p95/p99 {summary['latency_ms']['p50']}/"
+              f"{summary['latency_ms']['p95']}/{summary['latency_ms']['p99']} ms, peak RSS {summary['peak_rss_mb']} MB, "
+              f"statuses {summary['statuses']}")
+
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\n{'server':<6} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Speed and accuracy of the local token estimator.
+
+Times ``estimate_tokens`` on prose (README.md), Python source, JSON and
+base64 text cut to each ``--sizes`` KB, and reports microseconds per KB.
+If ``tiktoken`` is installed, each sample is also counted with its
+``o200k_base`` tokenizer and the estimate's error is shown next to it;
+otherwise that column is left out.
+
+Usage:
+    python benchmarks/bench_tokens.py [--sizes 1 16 1024] [--repeat 20]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from token_budget import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+def samples() -> dict:
+    def read(name):
+        with open(os.path.join(ROOT, name), encoding="utf-8") as f:
+            return f.read()
+
+    records = [{"index": i, "response": f"Answer number {i}", "error": None, "cached": i % 3 == 0} for i in range(20000)]
+    return {
+        "prose": read("README.md"),
+        "python": "\n".join(read(name) for name in sorted(os.listdir(ROOT)) if name.endswith(".py")),
+        "json": json.dumps(records),
+        "base64": base64.b64encode(os.urandom(800_000)).decode("ascii"),
+    }
+
+
+def repeated(text: str, size: int) -> str:
+    """``text`` repeated or cut to ``size`` characters."""
+    return (text * (size // len(text) + 1))[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 16, 1024], help="sample sizes in KB")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    encoding = tiktoken.get_encoding("o200k_base") if tiktoken else None
+    print(f"{'sample':<8} {'KB':>6} {'estimate':>9} {'us/KB':>8}" + (f" {'o200k':>8} {'error':>7}" if encoding else ""))
+    for name, text in samples().items():
+        for size in args.sizes:
+            sample = repeated(text, size * 1024)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                tokens = estimate_tokens(sample)
+            per_kb = (time.perf_counter() - start) / args.repeat / size * 1e6
+            line = f"{name:<8} {size:6d} {tokens:9d} {per_kb:8.1f}"
+            if encoding:
+                reference = len(encoding.encode(sample, disallowed_special=()))
+                line += f" {reference:8d} {(tokens - reference) / reference:+7.1%}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Time to first audio of server-side speech, streamed per sentence or not.
+
+Streams a canned answer at ``--tokens-per-second`` and measures, for each
+strategy, when the first audio byte is ready and when the last one is:
+
+- ``whole``: wait for the whole answer, then synthesize it in one call,
+  as the browser did;
+- ``sentences``: ``Speech.stream``, with each sentence synthesized as soon
+  as the model has written it;
+- ``cached``: the same answer again, with every sentence cached.
+
+``--engine espeak`` or ``piper`` uses the real engine (see speech.py for
+the TTS_* settings). The default ``simulated`` engine sleeps
+``--seconds-per-char`` per character and returns silence. That is
+roughly espeak's speed on one core, so the benchmark also runs where no
+engine is installed.
+
+Usage:
+    python benchmarks/bench_tts.py [--engine simulated|espeak|piper] [--tokens-per-second 40] [--sentences 8] [--repeat 3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from speech import Speech, engine_from_env, sentences, wav_bytes
+
+SENTENCE = "This is sentence number {} of the answer, and it is about as long as a typical one."
+
+
+class SimulatedEngine:
+    """Takes a fixed time per character and returns silence at 16 kHz, about 15 characters per spoken second."""
+
+    name = "simulated"
+
+    def __init__(self, seconds_per_char: float):
+        self.seconds_per_char = seconds_per_char
+
+    @property
+    def settings(self):
+        return {"engine": self.name, "seconds_per_char": self.seconds_per_char}
+
+    def synthesize(self, text: str) -> bytes:
+        time.sleep(len(text) * self.seconds_per_char)
+        return wav_bytes(bytes(2 * 16000 * len(text) // 15), 16000)
+
+
+def model_stream(answer: str, tokens_per_second: float):
+    # About four characters per token, as for Gemini
+    for i in range(0, len(answer), 4):
+        time.sleep(1 / tokens_per_second)
+        yield answer[i:i + 4]
+
+
+def first_and_last(chunks) -> tuple:
+    start = time.perf_counter()
+    first = None
+    for _ in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+    return first * 1000, (time.perf_counter() - start) * 1000
+
+
+def whole(speech: Speech, answer: str, tokens_per_second: float):
+    text = "".join(model_stream(answer, tokens_per_second))
+    yield speech.engine.synthesize(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["simulated", "espeak", "piper"], default="simulated")
+    parser.add_argument("--seconds-per-char", type=float, default=0.0005, help="speed of the simulated engine")
+    parser.add_argument("--tokens-per-second", type=float, default=40)
+    parser.add_argument("--sentences", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.engine == "simulated":
+        engine = SimulatedEngine(args.seconds_per_char)
+    else:
+        os.environ["TTS_ENGINE"] = args.engine
+        engine = engine_from_env()
+    answer = " ".join(SENTENCE.format(i + 1) for i in range(args.sentences))
+    print(f"engine: {engine.settings}; {len(answer)} characters at {args.tokens_per_second:g} tokens/s\n")
+
+    print(f"{'strategy':>10} {'first audio ms':>15} {'last audio ms':>14}")
+    results = {"whole": [], "sentences": [], "cached": []}
+    for run in range(args.repeat):
+        # A fresh cache per run, and a different answer, so only "cached" reuses audio
+        speech = Speech(engine)
+        run_answer = answer.replace("answer", f"answer {run}")
+        results["whole"].append(first_and_last(whole(speech, run_answer, args.tokens_per_second)))
+        results["sentences"].append(first_and_last(speech.stream(sentences(model_stream(run_answer, args.tokens_per_second)))))
+        results["cached"].append(first_and_last(speech.stream(sentences(model_stream(run_answer, args.tokens_per_second)))))
+    for strategy, samples in results.items():
+        print(f"{strategy:>10} {statistics.median(s[0] for s in samples):15.0f} {statistics.median(s[1] for s in samples):14.0f}")
+
+    speech = Speech(engine)
+    sentence = SENTENCE.format(0)
+    start = time.perf_counter()
+    speech.synthesize(sentence)
+    miss_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for _ in range(1000):
+        speech.synthesize(sentence)
+    hit_us = (time.perf_counter() - start) * 1000
+    print(f"\none sentence: {miss_ms:.1f} ms to synthesize, {hit_us:.1f} us from cache")
+
+
+if __name__ == "__main__":
+    main()
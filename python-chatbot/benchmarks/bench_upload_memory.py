@@ -0,0 +1,86 @@
+"""
+Memory benchmark for the upload pipeline.
+
+Writes 50 MB text, image and PDF files to temporary storage (where the
+multipart parser spools uploads) and measures peak Python heap allocation
+with tracemalloc for:
+
+    buffered   the old path: file.read() + base64 of the whole file, then
+               chatbot() decoding text attachments again or wrapping images
+               in a data URL
+    streaming  uploads.read_upload()
+
+Usage:
+    python benchmarks/bench_upload_memory.py [--size-mb 50]
+"""
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uploads import read_upload
+
+SAMPLES = {
+    "notes.txt": (b"", b"2024-01-01 12:00:00 INFO request handled in 12 ms\n", "text/plain"),
+    "photo.png": (b"\x89PNG\r\n\x1a\n", None, "image/png"),
+    "handbook.pdf": (b"%PDF-1.7\n", None, "application/pdf"),
+}
+
+
+def make_file(size: int, header: bytes, line: bytes):
+    f = tempfile.TemporaryFile()
+    f.write(header)
+    block = (line * (1024 * 1024 // len(line) + 1))[:1024 * 1024] if line else os.urandom(1024 * 1024)
+    while f.tell() < size:
+        f.write(block[:size - f.tell()])
+    f.seek(0)
+    return f
+
+
+def buffered(f, filename: str, mime_type: str):
+    encoded_content = base64.b64encode(f.read()).decode('utf-8')
+    if mime_type.startswith('text/'):
+        content = base64.b64decode(encoded_content).decode('utf-8')
+        return content[:500]
+    if mime_type.startswith('image/'):
+        return f"data:{mime_type};base64,{encoded_content}"
+    return encoded_content
+
+
+def streaming(f, filename: str, mime_type: str):
+    return read_upload(f, filename, mime_type, max_file_bytes=1 << 40)
+
+
+def measure(fn, f, filename: str, mime_type: str):
+    f.seek(0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(f, filename, mime_type)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=50)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    print(f"{'file':<14} {'path':<10} {'peak MB':>9} {'x size':>7} {'time s':>7}")
+    for filename, (header, line, mime_type) in SAMPLES.items():
+        with make_file(size, header, line) as f:
+            for name, fn in (("buffered", buffered), ("streaming", streaming)):
+                peak, elapsed = measure(fn, f, filename, mime_type)
+                print(f"{filename:<14} {name:<10} {peak / 2**20:9.1f} {peak / size:7.2f} {elapsed:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
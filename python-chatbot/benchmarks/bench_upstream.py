@@ -0,0 +1,105 @@
+"""
+The upstream guard against a fake provider that answers 429 above a rate limit.
+
+Scenario 1 sends ``--requests`` calls from ``--concurrency`` threads to a
+fake model accepting ``--provider-rate`` calls per second. It compares the
+bare model, retried immediately up to 3 times the way the frontend retries
+a 500, with the same model behind ``GuardedModel``. It reports successes,
+calls the provider saw, 429s, and the rate the limiter settled on.
+
+Scenario 2 measures fairness: one heavy user keeps ``--concurrency`` calls
+queued while a light user sends a few calls one after another. It reports
+the light user's latency with per-user queuing, and with every call queued
+as the same user (plain FIFO).
+
+Usage:
+    python benchmarks/bench_upstream.py [--requests 200] [--concurrency 32] [--provider-rate 20]
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm import FakeChatModel
+from upstream import AdaptiveRateLimiter, CircuitBreaker, GuardedModel, set_user
+
+
+def unguarded_call(model: FakeChatModel, retries: int = 3) -> bool:
+    for _ in range(retries + 1):
+        try:
+            model.invoke("hi")
+            return True
+        except Exception:
+            continue
+    return False
+
+
+def guarded_call(model: GuardedModel, user: str = "anonymous") -> bool:
+    set_user(user)
+    try:
+        model.invoke("hi")
+        return True
+    except Exception:
+        return False
+
+
+def overload(args) -> None:
+    print(f"{'client':<10} {'ok':>5} {'failed':>7} {'provider calls':>15} {'429s':>6} {'seconds':>8} {'final rate':>11}")
+    for name in ("bare", "guarded"):
+        fake = FakeChatModel(latency=args.latency, rate_limit=args.provider_rate)
+        limiter = AdaptiveRateLimiter(rate=args.provider_rate * 4, burst=args.concurrency, max_wait=120, max_queue=args.requests)
+        guarded = GuardedModel(fake, limiter, CircuitBreaker(failure_threshold=args.requests), attempts=6, backoff_base=0.1)
+        call = (lambda _: unguarded_call(fake)) if name == "bare" else (lambda _: guarded_call(guarded))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(call, range(args.requests)))
+        elapsed = time.perf_counter() - start
+        rate = f"{limiter.rate:.1f}/s" if name == "guarded" else "-"
+        print(f"{name:<10} {sum(results):5d} {results.count(False):7d} {fake.calls:15d} {fake.rejected:6d} {elapsed:8.2f} {rate:>11}")
+
+
+def fairness(args) -> None:
+    print(f"\n{'queuing':<10} {'light user p50 ms':>18} {'max ms':>8}")
+    for name, light_user in (("per-user", "light"), ("fifo", "heavy")):
+        fake = FakeChatModel(latency=args.latency)
+        limiter = AdaptiveRateLimiter(rate=args.provider_rate, burst=1, max_wait=120, max_queue=10_000, increase=0)
+        guarded = GuardedModel(fake, limiter)
+        stop = threading.Event()
+
+        def heavy_user():
+            while not stop.is_set():
+                guarded_call(guarded, "heavy")
+
+        heavy = [threading.Thread(target=heavy_user) for _ in range(args.concurrency)]
+        for thread in heavy:
+            thread.start()
+        time.sleep(0.5)
+        latencies = []
+        for _ in range(5):
+            start = time.perf_counter()
+            guarded_call(guarded, light_user)
+            latencies.append((time.perf_counter() - start) * 1000)
+        stop.set()
+        for thread in heavy:
+            thread.join()
+        print(f"{name:<10} {statistics.median(latencies):18.0f} {max(latencies):8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--provider-rate", type=float, default=20, help="calls per second the fake provider accepts")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake model latency in seconds")
+    args = parser.parse_args()
+    overload(args)
+    fairness(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Throughput of serve.py at 1, 2, 4 and 8 worker processes, backed by the fake LLM.
+
+Each worker count gets a fresh ``serve_fake.py --workers N``. It is hit
+with ``--requests`` POSTs to ``/api/chat`` from ``--concurrency``
+clients, each asking a different question, so every request misses the
+response cache and runs the whole pipeline. Every run uses the sqlite
+shared state (see shared_state.py), which serve.py turns on for more than
+one worker, so only the number of workers differs. The fake model only sleeps, so the difference between the
+worker counts is the Python work per request, which one process runs on
+one core at a time.
+
+Workers only help up to the number of cores, and the load generator runs
+on the same machine and competes with them, so read the results against
+the CPU count printed first.
+
+Usage:
+    python benchmarks/bench_workers.py [--servers flask asgi] [--workers 1 2 4 8] [--requests 2000] [--concurrency 64] [--latency 0.05]
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import percentile, post_chat, start_server, wait_until_ready
+
+HOST = "127.0.0.1"
+PORT = 4110
+
+
+def wait_for_workers(workers: int, timeout: float) -> None:
+    """Wait until ``/api/health`` has answered from ``workers`` different processes, i.e. all of them warmed up."""
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while len(seen) < workers and time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(HOST, PORT, timeout=5)
+            conn.request("GET", "/api/health")
+            response = conn.getresponse()
+            if response.status == 200:
+                seen.add(json.loads(response.read())["worker"])
+            conn.close()
+        except OSError:
+            time.sleep(0.2)
+    if len(seen) < workers:
+        raise RuntimeError(f"only {len(seen)} of {workers} workers became ready")
+
+
+def run_unique(requests: int, concurrency: int, prefix: str) -> Dict:
+    bodies = [json.dumps({"message": f"{prefix} question number {i}: what is the capital of France?"}).encode()
+              for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda body: post_chat(HOST, PORT, body), bodies))
+    elapsed = time.perf_counter() - start
+    latencies = [latency * 1000 for status, latency in results if status == 200]
+    return {
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) if latencies else 0.0,
+        "p99_ms": percentile(latencies, 99) if latencies else 0.0,
+        "errors": requests - len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", default=["flask"], choices=["flask", "asgi"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake LLM latency in seconds")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs; {args.requests} requests at concurrency {args.concurrency}, fake LLM latency {args.latency:g} s\n")
+    print(f"{'server':>6} {'workers':>7} {'req/s':>8} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    # The default queue limits would shed load before the workers are saturated, and a log line per request would be measured too
+    env = {"LLM_MAX_CONCURRENCY": "256", "LLM_MAX_QUEUE": "1024", "LOG_LEVEL": "WARNING", "SHARED_STATE": "sqlite",
+           "SHARED_STATE_PATH": os.path.join(tempfile.gettempdir(), f"bench-workers-{os.getpid()}.db")}
+    for server in args.servers:
+        baseline = None
+        for workers in args.workers:
+            process = start_server(server, PORT, args.latency, env, ["--workers", str(workers)])
+            try:
+                wait_until_ready(HOST, PORT, timeout=60)
+                wait_for_workers(workers, timeout=60 + 15 * workers)
+                result = run_unique(args.requests, args.concurrency, f"{server} {workers}")
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=60)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            baseline = baseline or result["throughput_rps"]
+            print(f"{server:>6} {workers:>7} {result['throughput_rps']:8.1f} {result['throughput_rps'] / baseline:7.2f}x "
+                  f"{result['p50_ms']:8.1f} {result['p99_ms']:8.1f} {result['errors']:7}")
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(env["SHARED_STATE_PATH"] + suffix)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
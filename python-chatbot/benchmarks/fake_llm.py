@@ -0,0 +1,114 @@
+"""
+Deterministic stand-in for the Gemini chat model used by the benchmarks.
+
+``FakeChatModel`` is a real LangChain ``BaseChatModel``, so it can stand in
+for the model clients (``chatbot.model_router.use_clients``) and run through
+the same chains. It sleeps instead of calling the network: ``time.sleep``
+on the sync path and ``asyncio.sleep`` on the async path, which is what
+makes the sync/async comparison fair.
+
+Latency can be fixed or drawn from a lognormal distribution around it
+(``latency_sigma``), which gives the long tail real providers have. Streams
+emit ``tokens_per_second`` after the first token. It can also behave like a
+provider under load: ``rate_limit`` makes it reject calls beyond that many
+per second with a 429 (``ModelRateLimitError``) and ``error_rate`` fails
+that fraction of calls with a 503. With a ``seed``, the latencies and
+injected errors are the same sequence on every run.
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.exceptions import ModelAPIError, ModelRateLimitError
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers with a fixed text after a fixed latency.
+
+    Args:
+        latency (float): Seconds before the first token, the median if ``latency_sigma`` is set
+        latency_sigma (float): Spread of the lognormal latency distribution, 0 for a fixed latency;
+            0.5 puts p99 at about 3x the median
+        response (str): Text returned for every request
+        tokens_per_second (float): Streaming speed after the first token, 0 for instant
+        rate_limit (float): Calls accepted per second, with a burst of one second's worth; 0 for unlimited
+        error_rate (float): Fraction of calls failing with a server error
+        seed (int, optional): Seed for latencies and injected errors
+    """
+
+    latency: float = 0.5
+    latency_sigma: float = 0.0
+    response: str = "Hi, I'm Shauna! This is a canned answer from the fake model."
+    tokens_per_second: float = 0.0
+    rate_limit: float = 0.0
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+    calls: int = 0
+    rejected: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _bucket: List[float] = PrivateAttr(default_factory=list)
+    _random: random.Random = PrivateAttr(default=None)
+
+    def model_post_init(self, context: Any) -> None:
+        self._random = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _tokens(self) -> List[str]:
+        words = self.response.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _admit(self) -> float:
+        """Fail the call the way an overloaded provider would, or let it through and return its latency."""
+        with self._lock:
+            self.calls += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.rejected += 1
+                raise ModelAPIError("503 Service Unavailable (fake)")
+            if self.rate_limit > 0:
+                now = time.monotonic()
+                tokens, updated = self._bucket or (self.rate_limit, now)
+                tokens = min(self.rate_limit, tokens + (now - updated) * self.rate_limit)
+                if tokens < 1:
+                    self._bucket[:] = [tokens, now]
+                    self.rejected += 1
+                    raise ModelRateLimitError("429 Resource has been exhausted (fake)")
+                self._bucket[:] = [tokens - 1, now]
+            if self.latency_sigma:
+                return self.latency * math.exp(self._random.gauss(0.0, self.latency_sigma))
+            return self.latency
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        latency = self._admit()
+        time.sleep(latency + self._token_delay() * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        latency = self._admit()
+        await asyncio.sleep(latency + self._token_delay() * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._admit())
+        for token in self._tokens():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            time.sleep(self._token_delay())
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._admit())
+        for token in self._tokens():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            await asyncio.sleep(self._token_delay())
@@ -0,0 +1,162 @@
+"""
+Load test: Flask dev server vs. the ASGI app, both backed by the fake LLM.
+
+Each server is started in a subprocess via ``serve_fake.py`` and hit with
+``--requests`` POSTs to ``/api/chat`` at ``--concurrency`` parallel clients.
+Client-side latency percentiles are reported alongside the server's own
+per-stage p50/p95/p99 from ``/api/metrics?format=json``.
+
+Usage:
+    python benchmarks/load_test.py --concurrency 100 --requests 1000 --latency 0.5
+    python benchmarks/load_test.py --servers asgi --url-only http://localhost:4000
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORTS = {"flask": 4100, "asgi": 4101}
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def wait_until_ready(host: str, port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=1)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not become ready")
+
+
+def post_chat(host: str, port: int, body: bytes) -> Tuple[int, float]:
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=120)
+    try:
+        conn.request("POST", "/api/chat", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    except OSError:
+        return 0, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def multipart(fields: Dict[str, str], files: Sequence[Tuple[str, bytes, str]]) -> Tuple[bytes, str]:
+    """A multipart/form-data body with the given form ``fields`` and (filename, data, content type) ``files``; returns it and its Content-Type."""
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode() for name, value in fields.items()]
+    for filename, data, content_type in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b"\r\n"
+        )
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def run_load(host: str, port: int, requests: int, concurrency: int) -> Dict:
+    body = json.dumps({"message": "What is the capital of France?", "attachments": []}).encode()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: post_chat(host, port, body), range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000 for status, latency in results if status == 200]
+    statuses: Dict[str, int] = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95), 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 1) if latencies else None,
+        "statuses": statuses,
+    }
+
+
+def server_stages(host: str, port: int, route: str = "/api/chat") -> Dict:
+    """Server-side p50/p95/p99 in ms per stage of ``route``, from the metrics endpoint."""
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        conn.request("GET", "/api/metrics?format=json")
+        snapshot = json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+    series = {"total": snapshot.get("chatbot_request_duration_seconds", {}).get(f"route={route}")}
+    prefix = f"route={route},stage="
+    for labels, values in snapshot.get("chatbot_stage_duration_seconds", {}).items():
+        if labels.startswith(prefix):
+            series[labels[len(prefix):]] = values
+    return {
+        stage: {q: round(values[q] * 1000, 2) for q in ("p50", "p95", "p99")}
+        for stage, values in series.items() if values
+    }
+
+
+def start_server(server: str, port: int, latency: float, env: Dict[str, str], extra_args: Sequence[str] = ()) -> subprocess.Popen:
+    """Start ``serve_fake.py``; ``extra_args`` are passed on to it, e.g. ``["--error-rate", "0.01"]``."""
+    return subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "serve_fake.py"), server, "--port", str(port), "--latency", str(latency), *extra_args],
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", default=["flask", "asgi"], choices=["flask", "asgi"])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency in seconds")
+    parser.add_argument("--max-concurrency", type=int, default=256, help="LLM_MAX_CONCURRENCY for the ASGI app")
+    parser.add_argument("--max-queue", type=int, default=1024, help="LLM_MAX_QUEUE for the ASGI app")
+    parser.add_argument("--url-only", help="benchmark an already running server instead of starting one")
+    args = parser.parse_args()
+
+    if args.url_only:
+        url = urlparse(args.url_only)
+        result = run_load(url.hostname, url.port or 80, args.requests, args.concurrency)
+        result["server_ms"] = server_stages(url.hostname, url.port or 80)
+        print(json.dumps(result, indent=2))
+        return
+
+    env = {"LLM_MAX_CONCURRENCY": str(args.max_concurrency), "LLM_MAX_QUEUE": str(args.max_queue)}
+    results = {}
+    for server in args.servers:
+        process: Optional[subprocess.Popen] = start_server(server, PORTS[server], args.latency, env)
+        try:
+            wait_until_ready("127.0.0.1", PORTS[server])
+            results[server] = run_load("127.0.0.1", PORTS[server], args.requests, args.concurrency)
+            results[server]["server_ms"] = server_stages("127.0.0.1", PORTS[server])
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{server:<6} {json.dumps(results[server])}")
+
+    if "flask" in results and "asgi" in results and results["flask"]["throughput_rps"]:
+        ratio = results["asgi"]["throughput_rps"] / results["flask"]["throughput_rps"]
+        print(f"asgi/flask throughput: {ratio:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Generate sample images for benchmarks and tests (needs Pillow).
+"""
+import io
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def make_photo(width: int = 4032, height: int = 3024, quality: int = 95, seed: int = 0) -> bytes:
+    """A photo-like JPEG: smooth gradients with sensor noise, like a phone camera shot."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed)
+    red = Image.blend(gradient, noise, 0.35)
+    green = Image.blend(gradient.transpose(Image.Transpose.ROTATE_180), noise, 0.25)
+    blue = noise.filter(ImageFilter.GaussianBlur(2))
+    out = io.BytesIO()
+    Image.merge("RGB", (red, green, blue)).save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def make_screenshot(width: int = 2560, height: int = 1440) -> bytes:
+    """A PNG with flat colours and text-like bars, like a desktop screenshot."""
+    image = Image.new("RGB", (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 60), fill=(40, 44, 52))
+    for row in range(100, height - 40, 28):
+        draw.rectangle((80, row, 80 + (row * 37) % (width - 200), row + 12), fill=(90, 90, 110))
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def make_icon(size: int = 64) -> bytes:
+    """A small transparent PNG."""
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse((4, 4, size - 4, size - 4), fill=(220, 60, 60, 255))
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
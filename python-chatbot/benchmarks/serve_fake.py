@@ -0,0 +1,70 @@
+"""
+Run the Flask or ASGI API with every model client replaced by ``FakeChatModel``.
+
+Usage:
+    python benchmarks/serve_fake.py flask --port 4100 --latency 0.5
+    python benchmarks/serve_fake.py asgi --port 4101 --latency 0.5 --latency-sigma 0.5 --error-rate 0.01
+    python benchmarks/serve_fake.py flask --port 4102 --workers 4
+
+With ``--workers`` the app runs under serve.py, and each worker installs the fake after the fork.
+"""
+import argparse
+import logging
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The real client is never called, but it still needs a key to be constructed
+os.environ.setdefault("GOOGLE_API_KEY", "fake-key")
+
+from fake_llm import FakeChatModel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("server", choices=["flask", "asgi"])
+    parser.add_argument("--port", type=int, default=4100)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="lognormal spread of the latency, 0 for fixed")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--response-words", type=int, default=0, help="length of the canned answer, 0 for the default")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls failing with a 503")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=0, help="worker processes under serve.py, 0 for one in-process server")
+    args = parser.parse_args()
+
+    def install_fake():
+        # Importing chatbot builds the singletons, so under serve.py this runs in each worker after the fork
+        import chatbot
+
+        fake = FakeChatModel(latency=args.latency, latency_sigma=args.latency_sigma, tokens_per_second=args.tokens_per_second,
+                             error_rate=args.error_rate, seed=args.seed)
+        if args.response_words:
+            fake.response = " ".join(f"word{i % 100}" for i in range(args.response_words))
+        chatbot.model_router.use_clients(lambda model_name: fake)
+
+    if args.workers:
+        import serve
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        serve.main(worker_init=install_fake, argv=["--server", args.server, "--port", str(args.port), "--workers", str(args.workers)])
+        return
+
+    install_fake()
+    if args.server == "flask":
+        from api import app
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        # Same server as `python api.py`, minus the reloader
+        app.run(port=args.port, threaded=True)
+    else:
+        import uvicorn
+        from asgi_api import app
+
+        uvicorn.run(app, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
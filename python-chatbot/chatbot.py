@@ -1,96 +1,572 @@
 from dotenv import load_dotenv
+import asyncio
 import os
-import base64
-from typing import List, Dict, Optional
-from poml.integration.langchain import LangchainPomlTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
+import time
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Iterator, List, Dict, Optional, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import HumanMessage
+from langchain_core.runnables import Runnable
+from prompt_registry import PromptRegistry
+from response_cache import attachment_digest, cache_from_env, cache_key
+from semantic_cache import semantic_cache_from_env
+from conversation_memory import store_from_env
+from document_extraction import CONTEXT_CHARS as DOCUMENT_CONTEXT_CHARS, PDF_SUPPORT, ExtractedDocument, extractor_from_env
+from token_budget import budget_from_env, estimate_tokens, image_tokens, record_estimate
+from retrieval import retriever_from_env
+from image_processing import ProcessedImage, image_processor_from_env
+from attachments import attachment_bytes, data_url_mime_type
+from metrics import RequestTrace, current_trace, record_tokens, span
+from idempotency import coalescer_from_env
+from upstream import current_user, guard_from_env
+from model_router import router_from_env
+from attachment_pool import pool_from_env
+from warmup import WarmUp
+from audit_log import audit_log_from_env
+from auth import authenticator_from_env, current_principal
+from speech import speech_from_env
+from shared_state import shared_store_from_env
+from batch import BatchResult, arun_as_completed, describe_error, run_as_completed
+from batch import DEFAULT_TIMEOUT as BATCH_TIMEOUT, MAX_CONCURRENCY as BATCH_CONCURRENCY
 
 load_dotenv()
-model = "gemini-2.5-flash-lite"
 google_api_key = os.getenv("GOOGLE_API_KEY")
-llm = ChatGoogleGenerativeAI(model = model, google_api_key = google_api_key)
 
-def chatbot(user_input: str, attachments: Optional[List[Dict]] = None):
+# Prompts are measured and cut to fit before they are sent; see token_budget.py for the TOKEN_* settings
+prompt_budget = budget_from_env()
+
+def _client(model_name: str) -> Runnable:
+    """The shared client for one model, behind its own rate limiter, retries and circuit breaker."""
+    # The Gemini SDK takes over a second to import, so it is loaded with the first client rather than with this module
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    # Retries are left to the upstream guard (1 means no retries in the Google SDK); see upstream.py for the
+    # LLM_RATE_*, LLM_RETRY_* and LLM_BREAKER_* settings. Answers are capped at the tokens the budget reserves for them.
+    return guard_from_env(ChatGoogleGenerativeAI(model = model_name, google_api_key = google_api_key, max_retries = 1,
+                                                 max_output_tokens = prompt_budget.output_tokens))
+
+# Each request goes to a fast or a strong model by cheap local signals; see model_router.py for the MODEL_* and ROUTER_* settings
+model_router = router_from_env(_client)
+
+# The POML prompt is compiled on first use (or at warm-up) and recompiled only when the file changes
+PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt.poml")
+prompt_registry = PromptRegistry()
+
+# Caches and sessions are also written to a store every worker process reads when SHARED_STATE is set;
+# see shared_state.py for the SHARED_STATE_* settings
+shared_state = shared_store_from_env()
+
+# Identical questions are answered from cache; see response_cache.py for the RESPONSE_CACHE_* settings
+response_cache = cache_from_env(shared=shared_state)
+# Paraphrases of earlier text-only questions are answered from cache too when SEMANTIC_CACHE_SIZE is set;
+# see semantic_cache.py for the SEMANTIC_CACHE_* settings
+semantic_cache = semantic_cache_from_env()
+
+# Follow-up questions see earlier turns; see conversation_memory.py for the CONVERSATION_* settings
+conversation_store = store_from_env(shared=shared_state)
+
+# Attachments are processed on a bounded worker pool; see attachment_pool.py for the ATTACHMENT_* settings
+attachment_pool = pool_from_env()
+
+# PDF/DOCX text is extracted once per file content, in a worker process if there are any; see document_extraction.py for the DOCUMENT_* settings
+document_extractor = extractor_from_env(runner=attachment_pool.in_process)
+
+# Long text attachments are searched for the parts relevant to the question; see retrieval.py for the RETRIEVAL_* settings
+retriever = retriever_from_env()
+
+# Images are downscaled and recompressed once per content; see image_processing.py for the IMAGE_* settings
+image_processor = image_processor_from_env()
+
+# Retried and duplicate requests share one model call; see idempotency.py for the IDEMPOTENCY_* settings
+request_coalescer = coalescer_from_env(shared=shared_state)
+
+# Answered turns are appended to a server-side log when AUDIT_DB is set; see audit_log.py for the AUDIT_* settings
+audit_log = audit_log_from_env()
+
+# Callers prove who they are with tokens signed with AUTH_SECRET, which /api/history requires; see auth.py
+authenticator = authenticator_from_env()
+
+# Voice replies are synthesized per sentence on the server when TTS_ENGINE is set; see speech.py for the TTS_* settings
+speech = speech_from_env(shared=shared_state)
+
+def _load_pdf_support() -> None:
+    if PDF_SUPPORT:
+        import pypdf
+
+# What the first request would otherwise wait for; the APIs run it according to WARMUP, see warmup.py
+warmup = WarmUp([
+    ("prompt", partial(prompt_registry.preload, [PROMPT_FILE])),
+    ("model_clients", model_router.build_clients),
+    ("pdf", _load_pdf_support),
+    # Loads the voice, so the first voice reply does not wait for it
+    *([("speech", partial(speech.synthesize, "Hello."))] if speech else []),
+])
+
+def _extract_document(attachment: Dict) -> Optional[ExtractedDocument]:
+    """Extracted text of a document attachment, from the upload pipeline or its base64 content."""
+    if 'extracted' in attachment:
+        return attachment['extracted']
+    document = None
+    if attachment.get('content') and attachment.get('encoding', 'base64') == 'base64':
+        try:
+            data = attachment_bytes(attachment)
+        except Exception as e:
+            print(f"Error decoding document attachment: {e}")
+            return None
+        document = document_extractor.extract(data, attachment.get('mime_type', ''), digest=attachment['digest'])
+    return document
+
+def _text_context(attachment: Dict, content: str, question: str, token_budget: Optional[int] = None) -> str:
+    """The whole text if it fits the token budget (the retrieval budget by default), otherwise the chunks that best match the question."""
+    index = attachment.get('index')
+    token_budget = token_budget or retriever.token_budget
+    if index is None:
+        if estimate_tokens(content) <= token_budget:
+            return f"   Content: {content}\n"
+        index = retriever.index(content)
+    chunks = retriever.select(index, question, token_budget)
+    excerpts = "\n".join(f"[{chunk.label}] {chunk.text.rstrip()}" for chunk in chunks)
+    return f"   Content ({len(chunks)} of {len(index)} sections, selected for relevance to the question):\n{excerpts}\n"
+
+def _document_context(document: ExtractedDocument, question: str, token_budget: Optional[int] = None) -> str:
+    """Page-tagged document text, narrowed to the best matching chunks when it is too long or over ``token_budget``."""
+    if token_budget is None:
+        if len(document.text) <= DOCUMENT_CONTEXT_CHARS:
+            return f"   Content:\n{document.excerpt(DOCUMENT_CONTEXT_CHARS)}\n"
+        token_budget = DOCUMENT_CONTEXT_CHARS // 4
+    index = retriever.index_chunks(document.digest, document.chunks)
+    chunks = retriever.select(index, question, token_budget=token_budget)
+    return "   Content:\n" + "\n".join(f"[page {chunk.page}] {chunk.text}" for chunk in chunks) + "\n"
+
+def _process_image(attachment: Dict) -> ProcessedImage:
+    """Downscaled image of an attachment, from the upload pipeline or its base64 content."""
+    image = attachment.get('image')
+    if image is None:
+        data = attachment_bytes(attachment)
+        mime_type = data_url_mime_type(attachment.get('content', ''), attachment.get('mime_type') or 'image/jpeg')
+        image = image_processor.process(data, mime_type, digest=attachment['digest'])
+    return image
+
+OMITTED = "   Content left out to fit the prompt token budget\n"
+
+def decode_attachments(attachments: List[Dict]) -> List[Dict]:
     """
-    Enhanced chatbot function that accepts user input and optional attachments.
-    
-    Args:
-        user_input (str): The user's text query
-        attachments (List[Dict], optional): List of attachment dictionaries containing:
-            - 'type': 'image', 'text', 'document', etc.
-            - 'content': Base64 encoded content or text content
-            - 'filename': Original filename
-            - 'mime_type': MIME type of the attachment
-    
+    Do the CPU-heavy part of handling JSON attachments ahead of ``chatbot()``.
+
+    Base64 is decoded once, document text extracted, images downscaled and
+    long text indexed, and the results are stored on the attachments the way
+    the upload pipeline stores them. Meant to run on ``attachment_pool``;
+    ``chatbot()`` still does this work itself for attachments that skipped it.
+
     Returns:
-        str: AI response incorporating both query and attachments
+        List[Dict]: The same attachment dictionaries, updated in place
     """
-    
-    # Prepare the question with attachment context
-    formatted_question = user_input
-    
-    if attachments:
-        attachment_context = "\n\nAttachments provided:\n"
-        for i, attachment in enumerate(attachments, 1):
-            attachment_context += f"{i}. {attachment.get('filename', 'Unknown file')} ({attachment.get('type', 'unknown type')})\n"
-            
-            # Handle different attachment types
-            if attachment.get('type') == 'text' or attachment.get('mime_type', '').startswith('text/'):
-                # For text attachments, include the content directly
-                content = attachment.get('content', '')
-                if attachment.get('encoding') == 'base64':
-                    try:
-                        content = base64.b64decode(content).decode('utf-8')
-                    except:
-                        content = "Unable to decode text content"
-                attachment_context += f"   Content: {content[:500]}{'...' if len(content) > 500 else ''}\n"
-            
-            elif attachment.get('type') == 'image':
-                attachment_context += f"   Image file provided for analysis\n"
-            
-            else:
-                attachment_context += f"   File type: {attachment.get('mime_type', 'unknown')}\n"
+    for attachment in attachments:
+        if attachment.get('type') == 'image' and 'image' not in attachment:
+            try:
+                attachment['image'] = _process_image(attachment)
+            except Exception as e:
+                print(f"Error processing image attachment: {e}")
+        elif attachment.get('type') == 'document':
+            attachment['extracted'] = _extract_document(attachment)
+        elif (attachment.get('type') == 'text' or attachment.get('mime_type', '').startswith('text/')) and attachment.get('encoding') == 'base64':
+            try:
+                content = attachment_bytes(attachment).decode('utf-8')
+            except Exception:
+                continue
+            attachment.update(content=content, encoding='text')
+            if 'index' not in attachment and estimate_tokens(content) > retriever.token_budget:
+                attachment['index'] = retriever.index(content, digest=attachment['digest'])
+    return attachments
+
+def _attachment_sections(attachments: List[Dict], question: str) -> List[Tuple[str, str, Optional[Callable[[Optional[int]], str]]]]:
+    """
+    Describe each attachment for the prompt.
+
+    Returns:
+        (filename, header, content) per attachment, where ``content(token_budget)``
+        builds the attachment's text context, at its usual size for ``None``;
+        ``content`` is None for attachments that only get a header
+    """
+    sections = []
+    for i, attachment in enumerate(attachments, 1):
+        filename = attachment.get('filename', 'Unknown file')
+        header = f"{i}. {filename} ({attachment.get('type', 'unknown type')})\n"
+        content = None
         
-        formatted_question = user_input + attachment_context
-    
-    # For image attachments, we need to use a different approach with Gemini
-    if attachments and any(att.get('type') == 'image' for att in attachments):
-        # Handle image attachments with multimodal messages
-        messages = []
+        # Handle different attachment types
+        if attachment.get('type') == 'text' or attachment.get('mime_type', '').startswith('text/'):
+            # For text attachments, include the content, or its most relevant parts if it is long
+            text = attachment.get('content', '')
+            if attachment.get('encoding') == 'base64':
+                try:
+                    text = attachment_bytes(attachment).decode('utf-8')
+                except:
+                    text = "Unable to decode text content"
+            content = partial(_text_context, attachment, text, question)
         
-        # Add text content
-        message_content = [{"type": "text", "text": formatted_question}]
+        elif attachment.get('type') == 'image':
+            header += f"   Image file provided for analysis\n"
+        
+        elif attachment.get('type') == 'document' and (document := _extract_document(attachment)) and document.chunks:
+            # For documents, include the extracted text (or the pages matching the question) tagged with page numbers
+            pages = f"first {document.pages} pages" if document.truncated else f"{document.pages} page(s)"
+            header += f"   File type: {attachment.get('mime_type', 'unknown')}, {pages}\n"
+            content = partial(_document_context, document, question)
         
-        # Add image content
+        else:
+            header += f"   File type: {attachment.get('mime_type', 'unknown')}\n"
+        sections.append((filename, header, content))
+    return sections
+
+def _history_turns(history: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Split history into the units it is trimmed by: the summary, then each question with its answer."""
+    turns = []
+    for message in history:
+        if isinstance(message, AIMessage) and turns:
+            turns[-1].append(message)
+        else:
+            turns.append([message])
+    return turns
+
+def _build_request(user_input: str, attachments: Optional[List[Dict]] = None, history: Optional[List[BaseMessage]] = None,
+                   llm: Optional[Runnable] = None) -> Tuple[Runnable, Any]:
+    """
+    Build the runnable and its input for a chat request.
+
+    Text-only requests go through the compiled POML prompt chain, requests with
+    image attachments are sent to the model as a multimodal message. Earlier
+    conversation turns in ``history`` are placed before the new question.
+    ``llm`` is the routed model; without it the request is routed here. The
+    prompt is cut to the token budget (see ``TokenBudget.fit``) and its
+    estimated size recorded for the request.
+
+    Returns:
+        Tuple[Runnable, Any]: The runnable to invoke or stream and its input
+
+    Raises:
+        PromptTooLarge: If the question alone does not fit the token budget
+    """
+    
+    if llm is None:
+        llm = model_router.runnable(model_router.route(user_input, attachments))
+    
+    # For image attachments, we need to use a different approach with Gemini
+    multimodal = bool(attachments) and any(att.get('type') == 'image' for att in attachments)
+    
+    # Downscale the images first, sending identical images only once, so their size counts towards the budget
+    images = []
+    if multimodal:
+        sent = set()
         for attachment in attachments:
             if attachment.get('type') == 'image':
                 try:
-                    image_data = attachment.get('content', '')
-                    if not image_data.startswith('data:'):
-                        # Add data URL prefix if not present
-                        mime_type = attachment.get('mime_type', 'image/jpeg')
-                        image_data = f"data:{mime_type};base64,{image_data}"
-                    
-                    message_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": image_data}
-                    })
+                    image = _process_image(attachment)
+                    if image.digest in sent:
+                        continue
+                    sent.add(image.digest)
+                    images.append(image)
                 except Exception as e:
                     print(f"Error processing image attachment: {e}")
+    
+    # Prepare the question with attachment context, cut to fit the token budget
+    sections = _attachment_sections(attachments or [], user_input)
+    preamble = user_input + ("\n\nAttachments provided:\n" if attachments else "") + "".join(header for _, header, _ in sections)
+    fixed_tokens = estimate_tokens(preamble) + sum(image_tokens(image.width, image.height) for image in images)
+    if not multimodal:
+        fixed_tokens += prompt_registry.tokens(PROMPT_FILE)
+    turns = _history_turns(history or [])
+    contents, estimate = prompt_budget.fit(
+        fixed_tokens,
+        [sum(estimate_tokens(str(message.content)) for message in turn) for turn in turns],
+        [(filename, content(None) if content else "") for filename, _, content in sections],
+        lambda i, tokens: sections[i][2](tokens) if tokens else OMITTED,
+    )
+    history = [message for turn in turns[estimate.history_dropped:] for message in turn]
+    record_estimate(estimate)
+    
+    formatted_question = user_input
+    if attachments:
+        formatted_question += "\n\nAttachments provided:\n" + "".join(header + content for (_, header, _), content in zip(sections, contents))
+    
+    if multimodal:
+        # Handle image attachments with multimodal messages
+        # Add text content, then the image content
+        message_content = [{"type": "text", "text": formatted_question}]
+        for image in images:
+            message_content.append({
+                "type": "image_url",
+                "image_url": {"url": image.data_url}
+            })
         
         # Create message with multimodal content
         human_message = HumanMessage(content=message_content)
-        ai_response = llm.invoke([human_message])
-        return ai_response.content
+        return llm | StrOutputParser(), [*history, human_message]
     
     else:
-        # Use the original prompt template for text-only queries
-        prompt = LangchainPomlTemplate.from_file("prompt.poml")
-        chain = prompt | llm | StrOutputParser()
-        ai_response = chain.invoke({"question": formatted_question})
-        return ai_response
+        # Use the compiled prompt template for text-only queries
+        chain = prompt_registry.chain(PROMPT_FILE, llm)
+        return chain, {"question": formatted_question, "history": history}
+
+def _response_cache_key(user_input: str, attachments: Optional[List[Dict]], model_name: str) -> str:
+    """Cache key for a request; attachments contribute only their content digests."""
+    digests = [attachment_digest(attachment) for attachment in attachments or []]
+    return cache_key(user_input, model_name, prompt_registry.digest(PROMPT_FILE), digests)
+
+def _semantic_scope(model_name: str) -> str:
+    """What a semantically cached answer depends on besides the question."""
+    return f"{model_name}:{prompt_registry.digest(PROMPT_FILE)}"
+
+def _user_turn(user_input: str, attachments: Optional[List[Dict]] = None) -> str:
+    """What is remembered of the user's side of a turn: the text and attachment names, not their content."""
+    if not attachments:
+        return user_input
+    names = ", ".join(attachment.get('filename', 'Unknown file') for attachment in attachments)
+    return f"{user_input}\n[Attachments: {names}]"
+
+def _prepare(user_input: str, attachments: Optional[List[Dict]], use_cache: bool, conversation_id: Optional[str]):
+    """
+    Resolve a request against the response cache and conversation memory.
+
+    Returns:
+        Tuple of (cached answer or None, cache key or None, model name, runnable, runnable input).
+        Answers that depend on earlier turns are not cached.
+    """
+    history = conversation_store.messages(conversation_id) if conversation_id else []
+    decision = model_router.route(user_input, attachments, sum(estimate_tokens(str(message.content)) for message in history))
+    key = None
+    if not use_cache:
+        response_cache.record_bypass()
+    elif not history:
+        key = _response_cache_key(user_input, attachments, decision.model)
+        cached = response_cache.get(key)
+        if cached is None and semantic_cache is not None and not attachments:
+            cached = semantic_cache.lookup(user_input, _semantic_scope(decision.model))
+            if cached is not None:
+                # The next copy of this exact wording is then an exact hit
+                response_cache.set(key, cached)
+        if cached is not None:
+            return cached, key, decision.model, None, None
+
+    with span("prompt_build"):
+        runnable, request_input = _build_request(user_input, attachments, history, model_router.runnable(decision))
+    return None, key, decision.model, runnable, request_input
+
+def _finish(ai_response: str, key: Optional[str], model: str, user_input: str, attachments: Optional[List[Dict]], conversation_id: Optional[str],
+            cached: bool = False, trace: Optional[RequestTrace] = None, user: Optional[str] = None,
+            owner: Optional[str] = None) -> None:
+    """Store a completed answer in the response cache, the conversation and the audit log."""
+    if not ai_response:
+        return
+    if key and not cached:
+        response_cache.set(key, ai_response)
+        if semantic_cache is not None and not attachments:
+            semantic_cache.add(user_input, _semantic_scope(model), ai_response)
+    if conversation_id:
+        conversation_store.append(conversation_id, _user_turn(user_input, attachments), ai_response)
+    if audit_log is not None:
+        audit_log.record(conversation_id, user_input, ai_response, model, attachments, trace, user or current_user(), cached,
+                         owner or current_principal())
+
+def chatbot(user_input: str, attachments: Optional[List[Dict]] = None, stream: bool = False, use_cache: bool = True, conversation_id: Optional[str] = None):
+    """
+    Enhanced chatbot function that accepts user input and optional attachments.
+    
+    Args:
+        user_input (str): The user's text query
+        attachments (List[Dict], optional): List of attachment dictionaries containing:
+            - 'type': 'image', 'text', 'document', etc.
+            - 'content': Base64 encoded content or text content
+            - 'filename': Original filename
+            - 'mime_type': MIME type of the attachment
+        stream (bool): Return a generator of response text chunks instead of
+            waiting for the whole answer
+        use_cache (bool): Look up and store the answer in the response cache
+        conversation_id (str, optional): Continue a server-side conversation;
+            earlier turns are sent along and this turn is remembered
+    
+    Returns:
+        str: AI response incorporating both query and attachments, or an
+        iterator of text chunks when ``stream`` is True
+    """
+    cached, key, model, runnable, request_input = _prepare(user_input, attachments, use_cache, conversation_id)
+    if cached is not None:
+        _finish(cached, key, model, user_input, attachments, conversation_id, cached=True, trace=current_trace())
+        return _cached_stream(cached) if stream else cached
+
+    if stream:
+        # The stream is consumed after this returns, so the request's trace, user and principal are captured now
+        trace, user, owner = current_trace(), current_user(), current_principal()
+        return _stream_response(runnable, request_input, lambda text: _finish(text, key, model, user_input, attachments, conversation_id, trace=trace, user=user, owner=owner), trace)
+    with span("llm_total"):
+        ai_response = runnable.invoke(request_input)
+    record_tokens(response=estimate_tokens(ai_response))
+    _finish(ai_response, key, model, user_input, attachments, conversation_id, trace=current_trace())
+    return ai_response
+
+def _record_stream(trace: Optional[RequestTrace], start: float, chunks: List[str]) -> None:
+    """Record the model time and response tokens of a finished or abandoned stream."""
+    if trace is not None:
+        trace.add("llm_total", time.perf_counter() - start)
+        if chunks:
+            trace.response_tokens += estimate_tokens("".join(chunks))
+
+def _cached_stream(text: str) -> Iterator[str]:
+    yield text
+
+def _stream_response(runnable: Runnable, request_input: Any, on_complete: Optional[Callable[[str], None]] = None,
+                     trace: Optional[RequestTrace] = None) -> Iterator[str]:
+    """
+    Yield response chunks as the model produces them.
+
+    Closing the generator (e.g. when the HTTP client disconnects) closes the
+    upstream stream as well, so the model call is cancelled. ``on_complete``
+    receives the full text only for streams that run to completion. The
+    request ``trace`` is passed in because the generator runs after the view
+    that created it has returned.
+    """
+    upstream = runnable.stream(request_input)
+    chunks = []
+    start = time.perf_counter()
+    try:
+        for chunk in upstream:
+            if chunk:
+                if trace is not None and not chunks:
+                    trace.since_start("llm_first_token")
+                chunks.append(chunk)
+                yield chunk
+    finally:
+        upstream.close()
+        _record_stream(trace, start, chunks)
+    if on_complete:
+        on_complete("".join(chunks))
+
+async def achatbot(user_input: str, attachments: Optional[List[Dict]] = None, stream: bool = False, use_cache: bool = True, conversation_id: Optional[str] = None):
+    """
+    Async version of ``chatbot()`` built on ``ainvoke`` / ``astream``.
+
+    Takes the same arguments as ``chatbot()``. When ``stream`` is True the
+    result is an async iterator of response text chunks. Preparing the prompt
+    and storing the answer run on a worker thread: with a shared store they
+    are blocking sqlite or Redis calls, which must not hold up the event loop.
+    """
+    cached, key, model, runnable, request_input = await asyncio.to_thread(_prepare, user_input, attachments, use_cache, conversation_id)
+    if cached is not None:
+        await asyncio.to_thread(_finish, cached, key, model, user_input, attachments, conversation_id, cached=True, trace=current_trace())
+        return _acached_stream(cached) if stream else cached
+
+    if stream:
+        # The stream is consumed after this returns, so the request's trace, user and principal are captured now
+        trace, user, owner = current_trace(), current_user(), current_principal()
+        return _astream_response(runnable, request_input, lambda text: _finish(text, key, model, user_input, attachments, conversation_id, trace=trace, user=user, owner=owner), trace)
+    with span("llm_total"):
+        ai_response = await runnable.ainvoke(request_input)
+    record_tokens(response=estimate_tokens(ai_response))
+    await asyncio.to_thread(_finish, ai_response, key, model, user_input, attachments, conversation_id, trace=current_trace())
+    return ai_response
+
+async def _acached_stream(text: str) -> AsyncIterator[str]:
+    yield text
+
+async def _astream_response(runnable: Runnable, request_input: Any, on_complete: Optional[Callable[[str], None]] = None,
+                            trace: Optional[RequestTrace] = None) -> AsyncIterator[str]:
+    """Async counterpart of ``_stream_response()``; ``on_complete`` runs on a worker thread."""
+    upstream = runnable.astream(request_input)
+    chunks = []
+    start = time.perf_counter()
+    try:
+        async for chunk in upstream:
+            if chunk:
+                if trace is not None and not chunks:
+                    trace.since_start("llm_first_token")
+                chunks.append(chunk)
+                yield chunk
+    finally:
+        await upstream.aclose()
+        _record_stream(trace, start, chunks)
+    if on_complete:
+        await asyncio.to_thread(on_complete, "".join(chunks))
+
+def _prepare_batch(items: List[Dict], use_cache: bool) -> Tuple[List[BatchResult], List[Tuple[int, Optional[str], str, Runnable, Any]]]:
+    """
+    Prepare every item of a batch.
+
+    Returns:
+        Results that are already known (cached answers and items that could not
+        be prepared), and (index, cache key, model name, runnable, input) for the rest
+    """
+    done, pending = [], []
+    for index, item in enumerate(items):
+        try:
+            cached, key, model, runnable, request_input = _prepare(item.get('message', ''), item.get('attachments') or None, use_cache, None)
+        except Exception as e:
+            done.append(BatchResult(index, error=describe_error(e, None)))
+            continue
+        if cached is not None:
+            done.append(BatchResult(index, response=cached, cached=True))
+        else:
+            pending.append((index, key, model, runnable, request_input))
+    return done, pending
+
+def _batch_result(item: Dict, index: int, key: Optional[str], model: str, result: Any, timeout: Optional[float]) -> BatchResult:
+    """Record a finished batch call like a single chat, or describe its failure."""
+    if isinstance(result, BaseException):
+        return BatchResult(index, error=describe_error(result, timeout))
+    record_tokens(response=estimate_tokens(result))
+    _finish(result, key, model, item.get('message', ''), item.get('attachments') or None, None)
+    return BatchResult(index, response=result)
+
+def iter_chat_batch(items: List[Dict], max_concurrency: int = BATCH_CONCURRENCY, timeout: Optional[float] = BATCH_TIMEOUT,
+                    use_cache: bool = True) -> Iterator[BatchResult]:
+    """
+    Answer many independent questions concurrently, yielding results as they finish.
+
+    Args:
+        items (List[Dict]): ``{'message': str, 'attachments': [...]}`` dictionaries,
+            attachments as for ``chatbot()``
+        max_concurrency (int): Model calls running at once
+        timeout (float, optional): Seconds allowed per item, None for no limit
+        use_cache (bool): Look up and store answers in the response cache
+
+    Returns:
+        Iterator of ``BatchResult`` in completion order; ``result.index`` is the
+        item's position. A failed item has ``error`` set and does not affect the others.
+    """
+    done, pending = _prepare_batch(items, use_cache)
+    yield from done
+    with span("llm_total"):
+        for position, result in run_as_completed([(runnable, request_input) for _, _, _, runnable, request_input in pending], max_concurrency, timeout):
+            index, key, model, _, _ = pending[position]
+            yield _batch_result(items[index], index, key, model, result, timeout)
+
+def chat_batch(items: List[Dict], max_concurrency: int = BATCH_CONCURRENCY, timeout: Optional[float] = BATCH_TIMEOUT,
+               use_cache: bool = True) -> List[BatchResult]:
+    """Like ``iter_chat_batch()``, but wait for the whole batch and return the results in item order."""
+    return sorted(iter_chat_batch(items, max_concurrency, timeout, use_cache), key=lambda result: result.index)
+
+async def aiter_chat_batch(items: List[Dict], max_concurrency: int = BATCH_CONCURRENCY, timeout: Optional[float] = BATCH_TIMEOUT,
+                           use_cache: bool = True, slot: Optional[Callable] = None) -> AsyncIterator[BatchResult]:
+    """
+    Async version of ``iter_chat_batch()`` built on ``abatch``.
+
+    ``slot`` is an optional ``async with`` guard factory taken around each model
+    call, such as the API's ``ConcurrencyLimiter.slot``. Preparing the items and
+    storing their answers run on worker threads, as in ``achatbot()``.
+    """
+    done, pending = await asyncio.to_thread(_prepare_batch, items, use_cache)
+    for result in done:
+        yield result
+    calls = [(runnable, request_input) for _, _, _, runnable, request_input in pending]
+    with span("llm_total"):
+        async for position, result in arun_as_completed(calls, max_concurrency, timeout, slot):
+            index, key, model, _, _ = pending[position]
+            yield await asyncio.to_thread(_batch_result, items[index], index, key, model, result, timeout)
+
+async def achat_batch(items: List[Dict], max_concurrency: int = BATCH_CONCURRENCY, timeout: Optional[float] = BATCH_TIMEOUT,
+                      use_cache: bool = True, slot: Optional[Callable] = None) -> List[BatchResult]:
+    """Like ``aiter_chat_batch()``, but wait for the whole batch and return the results in item order."""
+    results = [result async for result in aiter_chat_batch(items, max_concurrency, timeout, use_cache, slot)]
+    return sorted(results, key=lambda result: result.index)
 
 if __name__ == "__main__":
     while True:
@@ -0,0 +1,84 @@
+"""
+Bounded concurrency for upstream LLM calls in the async API.
+
+At most ``max_in_flight`` calls run at once. Further requests wait in a
+queue of at most ``max_queue`` entries for up to ``queue_timeout`` seconds;
+anything beyond that is shed with ``Overloaded`` so the API can answer 503
+instead of piling up work it cannot finish.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot get an upstream slot in time."""
+
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """
+    Semaphore with a bounded, time-limited wait queue.
+
+    Args:
+        max_in_flight (int): Maximum concurrent upstream calls
+        max_queue (int): Maximum requests waiting for a slot
+        queue_timeout (float): Seconds a request may wait before being shed
+    """
+
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 64, queue_timeout: float = 10.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    async def acquire(self) -> None:
+        """Wait for an upstream slot, raising ``Overloaded`` if the queue is full or the wait times out."""
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise Overloaded("queue full")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            raise Overloaded("timed out waiting for an upstream slot")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        """Give back a slot taken with ``acquire()``."""
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold an upstream slot for the duration of the ``async with`` block."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
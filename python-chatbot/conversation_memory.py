@@ -0,0 +1,265 @@
+"""
+Server-side conversation memory.
+
+Each conversation id maps to a ``Session`` holding the most recent turns
+that fit in a token budget, plus a running summary of everything older.
+Appending a turn is O(1); turns that no longer fit are popped from the
+front of the deque and folded into the summary once, so the summary is
+never recomputed from scratch. Sessions idle for longer than ``idle_ttl``
+are evicted, and the store never holds more than ``max_sessions``.
+
+With several worker processes, ``SharedConversationStore`` keeps sessions
+in the shared store instead (see shared_state.py), so a follow-up question
+can land on any worker. A session is read and written back once per turn.
+
+Configuration (environment variables):
+    CONVERSATION_TOKEN_BUDGET     tokens of verbatim history per request (default 2000)
+    CONVERSATION_SUMMARY_TOKENS   tokens of running summary kept (default 400)
+    CONVERSATION_IDLE_TTL         seconds before an idle session is evicted (default 1800)
+    CONVERSATION_MAX_SESSIONS     sessions kept in memory (default 10000)
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from json_codec import dumps, loads
+from shared_state import SharedStore
+from token_budget import estimate_tokens
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def first_sentence(text: str, max_chars: int = 160) -> str:
+    """First sentence of ``text`` on one line, cut to ``max_chars``."""
+    text = " ".join(text.split())
+    sentence = _SENTENCE_END.split(text, 1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars - 3].rstrip() + "..."
+
+
+class Turn:
+    """One user question and the assistant's answer."""
+
+    __slots__ = ("user", "assistant", "tokens")
+
+    def __init__(self, user: str, assistant: str):
+        self.user = user
+        self.assistant = assistant
+        self.tokens = estimate_tokens(user) + estimate_tokens(assistant)
+
+
+def extractive_summary(summary_lines: Deque[str], turn: Turn) -> None:
+    """Default summarizer: keep the first sentence of each side of a rolled-off turn."""
+    summary_lines.append(f"User asked: {first_sentence(turn.user)}")
+    summary_lines.append(f"Shauna answered: {first_sentence(turn.assistant)}")
+
+
+class Session:
+    """Recent turns within the token budget plus a running summary of older ones."""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.turns: Deque[Turn] = deque()
+        self.turn_tokens = 0
+        self.summary_lines: Deque[str] = deque()
+        self.summary_tokens = 0
+        self.summarized_turns = 0
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ConversationStore:
+    """
+    In-memory session store keyed by conversation id.
+
+    Args:
+        token_budget (int): Tokens of verbatim turns kept per session
+        summary_tokens (int): Tokens of running summary kept per session
+        idle_ttl (float): Seconds of inactivity before a session is evicted
+        max_sessions (int): Sessions kept before the least recently used is evicted
+        summarizer (Callable, optional): ``summarizer(summary_lines, turn)`` folds a
+            rolled-off turn into the summary; defaults to ``extractive_summary``
+    """
+
+    def __init__(self, token_budget: int = 2000, summary_tokens: int = 400, idle_ttl: float = 1800,
+                 max_sessions: int = 10_000, summarizer: Optional[Callable[[Deque[str], Turn], None]] = None):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.summarizer = summarizer or extractive_summary
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+
+    def _session(self, session_id: str, create: bool) -> Optional[Session]:
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.last_active > self.idle_ttl:
+                # Expired but not evicted yet; its history is gone either way
+                del self._sessions[session_id]
+                self.evicted_idle += 1
+                session = None
+            if session is None and create:
+                session = self._sessions[session_id] = Session(session_id)
+            if session is not None:
+                # Refreshed before evicting, so the session being used is never the one evicted
+                session.last_active = now
+                self._sessions.move_to_end(session_id)
+            self._evict(now)
+            return session
+
+    def _evict(self, now: float) -> None:
+        # Sessions are ordered by last use, so idle ones are always at the front
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_active <= self.idle_ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.evicted_idle += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted_capacity += 1
+
+    def append(self, session_id: str, user: str, assistant: str) -> None:
+        """Record a completed turn, rolling the oldest turns into the summary if over budget."""
+        session = self._session(session_id, create=True)
+        with session.lock:
+            self._add(session, Turn(user, assistant))
+
+    def _add(self, session: Session, turn: Turn) -> None:
+        session.turns.append(turn)
+        session.turn_tokens += turn.tokens
+        while session.turn_tokens > self.token_budget and len(session.turns) > 1:
+            rolled = session.turns.popleft()
+            session.turn_tokens -= rolled.tokens
+            self._fold(session, rolled)
+
+    def _fold(self, session: Session, turn: Turn) -> None:
+        before = len(session.summary_lines)
+        self.summarizer(session.summary_lines, turn)
+        for line in list(session.summary_lines)[before:]:
+            session.summary_tokens += estimate_tokens(line)
+        session.summarized_turns += 1
+        while session.summary_tokens > self.summary_tokens and len(session.summary_lines) > 1:
+            session.summary_tokens -= estimate_tokens(session.summary_lines.popleft())
+
+    def messages(self, session_id: str) -> List[BaseMessage]:
+        """Chat history for the next request: the summary, then the recent turns oldest first."""
+        session = self._session(session_id, create=False)
+        if session is None:
+            return []
+        with session.lock:
+            return self._history(session)
+
+    @staticmethod
+    def _history(session: Session) -> List[BaseMessage]:
+        history: List[BaseMessage] = []
+        if session.summary_lines:
+            history.append(SystemMessage(
+                content="Summary of the earlier conversation:\n" + "\n".join(session.summary_lines)
+            ))
+        for turn in session.turns:
+            history.append(HumanMessage(content=turn.user))
+            history.append(AIMessage(content=turn.assistant))
+        return history
+
+    def clear(self, session_id: str) -> bool:
+        """Forget a conversation. Returns False if it did not exist."""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "token_budget": self.token_budget,
+                "evicted_idle": self.evicted_idle,
+                "evicted_capacity": self.evicted_capacity,
+            }
+
+
+class SharedConversationStore(ConversationStore):
+    """
+    Session store in a ``SharedStore``, so every worker process sees every conversation.
+
+    Sessions expire after ``idle_ttl``. How many are kept is up to the
+    backend, so ``max_sessions`` does not apply. Turns of one conversation
+    arriving at two workers at the same instant may lose one of them; a
+    client waits for each answer before asking the next question.
+
+    Args:
+        shared (SharedStore): Backend
+        Other arguments as for ``ConversationStore``
+    """
+
+    NAMESPACE = "conversations"
+
+    def __init__(self, shared: SharedStore, **kwargs):
+        super().__init__(**kwargs)
+        self.shared = shared
+
+    def _load(self, session_id: str) -> Optional[Session]:
+        stored = self.shared.get(self.NAMESPACE, session_id)
+        if stored is None:
+            return None
+        state = loads(stored)
+        session = Session(session_id)
+        for user, assistant in state["turns"]:
+            turn = Turn(user, assistant)
+            session.turns.append(turn)
+            session.turn_tokens += turn.tokens
+        session.summary_lines.extend(state["summary"])
+        session.summary_tokens = sum(estimate_tokens(line) for line in session.summary_lines)
+        session.summarized_turns = state["summarized_turns"]
+        return session
+
+    def _save(self, session: Session) -> None:
+        state = {
+            "turns": [[turn.user, turn.assistant] for turn in session.turns],
+            "summary": list(session.summary_lines),
+            "summarized_turns": session.summarized_turns,
+        }
+        self.shared.set(self.NAMESPACE, session.id, dumps(state), ttl=self.idle_ttl)
+
+    def append(self, session_id: str, user: str, assistant: str) -> None:
+        turn = Turn(user, assistant)
+        # Serializes this process's writers; other processes are covered by clients asking one question at a time
+        with self._lock:
+            session = self._load(session_id) or Session(session_id)
+            self._add(session, turn)
+            self._save(session)
+
+    def messages(self, session_id: str) -> List[BaseMessage]:
+        session = self._load(session_id)
+        return self._history(session) if session is not None else []
+
+    def clear(self, session_id: str) -> bool:
+        return self.shared.delete(self.NAMESPACE, session_id)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": self.shared.count(self.NAMESPACE),
+            "token_budget": self.token_budget,
+            "shared": self.shared.stats(),
+        }
+
+
+def store_from_env(shared: Optional[SharedStore] = None) -> ConversationStore:
+    """Build the conversation store from CONVERSATION_* environment variables, kept in ``shared`` if given."""
+    settings = dict(
+        token_budget=int(os.getenv("CONVERSATION_TOKEN_BUDGET", "2000")),
+        summary_tokens=int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "400")),
+        idle_ttl=float(os.getenv("CONVERSATION_IDLE_TTL", "1800")),
+        max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000")),
+    )
+    if shared is not None:
+        return SharedConversationStore(shared, **settings)
+    return ConversationStore(**settings)
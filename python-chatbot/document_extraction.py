@@ -0,0 +1,279 @@
+"""
+Text extraction for PDF and Word (.docx) attachments.
+
+Pages are pulled lazily one at a time, so extraction stops as soon as the
+page, character or time cap is reached instead of parsing the whole file.
+The extracted text is split into overlapping chunks and cached by the
+SHA-256 of the file bytes, so the same handbook uploaded a hundred times is
+parsed once.
+
+PDF support needs the optional ``pypdf`` package; without it PDFs are
+described to the model by type only, as before. DOCX files are read with
+the standard library.
+
+Configuration (environment variables):
+    DOCUMENT_MAX_BYTES     largest file that is parsed (default 20 MB)
+    DOCUMENT_MAX_PAGES     pages extracted per document (default 200)
+    DOCUMENT_MAX_CHARS     characters extracted per document (default 500000)
+    DOCUMENT_MAX_SECONDS   extraction time budget per document (default 10)
+    DOCUMENT_CHUNK_CHARS   characters per chunk (default 2000)
+    DOCUMENT_CACHE_SIZE    extracted documents kept in memory (default 256)
+    DOCUMENT_CONTEXT_CHARS characters of document text put in the prompt (default 4000)
+"""
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import threading
+import time
+import zipfile
+from typing import BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Union
+from xml.etree.ElementTree import iterparse
+
+from response_cache import LRUCache
+
+# pypdf is optional and slow to import, so it is only loaded with the first PDF
+PDF_SUPPORT = importlib.util.find_spec("pypdf") is not None
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+MAX_PAGES = int(os.getenv("DOCUMENT_MAX_PAGES", "200"))
+MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", "500000"))
+MAX_SECONDS = float(os.getenv("DOCUMENT_MAX_SECONDS", "10"))
+CHUNK_CHARS = int(os.getenv("DOCUMENT_CHUNK_CHARS", "2000"))
+CHUNK_OVERLAP = CHUNK_CHARS // 10
+CONTEXT_CHARS = int(os.getenv("DOCUMENT_CONTEXT_CHARS", "4000"))
+
+PDF_MIME_TYPE = 'application/pdf'
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# A .docx has no real pages; paragraphs are grouped into pseudo-pages of about this size
+_DOCX_PAGE_CHARS = 3000
+
+
+class Chunk(NamedTuple):
+    page: int
+    text: str
+
+
+class ExtractedDocument:
+    """Chunks extracted from one document plus what it cost to get them."""
+
+    def __init__(self, digest: str, chunks: List[Chunk], pages: int, truncated: bool, timings: Dict[str, float], error: Optional[str] = None):
+        self.digest = digest
+        self.chunks = chunks
+        self.pages = pages
+        self.truncated = truncated
+        self.timings = timings
+        self.error = error
+
+    @property
+    def text(self) -> str:
+        return "\n".join(chunk.text for chunk in self.chunks)
+
+    def excerpt(self, max_chars: int) -> str:
+        """Leading chunks up to ``max_chars``, each tagged with its page number."""
+        parts = []
+        used = 0
+        for chunk in self.chunks:
+            if used >= max_chars:
+                break
+            text = chunk.text[:max_chars - used]
+            parts.append(f"[page {chunk.page}] {text}")
+            used += len(text)
+        return "\n".join(parts)
+
+
+def pdf_pages(stream: BinaryIO) -> Iterator[str]:
+    """Yield the text of each PDF page, parsing pages only as they are requested."""
+    if not PDF_SUPPORT:
+        raise RuntimeError("PDF extraction requires the 'pypdf' package")
+    from pypdf import PdfReader
+
+    reader = PdfReader(stream)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def docx_pages(stream: BinaryIO) -> Iterator[str]:
+    """Yield pseudo-pages of a .docx, streaming word/document.xml paragraph by paragraph."""
+    with zipfile.ZipFile(stream) as archive, archive.open("word/document.xml") as xml:
+        paragraphs: List[str] = []
+        size = 0
+        for _, element in iterparse(xml, events=("end",)):
+            if element.tag != _WORD_NS + "p":
+                continue
+            text = "".join(node.text or "" for node in element.iter(_WORD_NS + "t"))
+            # Free the parsed paragraph, the document can be large
+            element.clear()
+            if text:
+                paragraphs.append(text)
+                size += len(text)
+            if size >= _DOCX_PAGE_CHARS:
+                yield "\n".join(paragraphs)
+                paragraphs, size = [], 0
+        if paragraphs:
+            yield "\n".join(paragraphs)
+
+
+def _hash_stream(stream: BinaryIO) -> str:
+    hasher = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(1024 * 1024), b""):
+        hasher.update(block)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def chunk_pages(pages: List[str], chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[Chunk]:
+    """Split page texts into overlapping chunks that never span pages."""
+    chunks = []
+    step = max(1, chunk_chars - overlap)
+    for number, page in enumerate(pages, 1):
+        page = page.strip()
+        for start in range(0, len(page), step):
+            chunks.append(Chunk(number, page[start:start + chunk_chars]))
+            if start + chunk_chars >= len(page):
+                break
+    return chunks
+
+
+def parse_document(source: Union[bytes, BinaryIO], mime_type: str, digest: str, max_pages: int = MAX_PAGES,
+                   max_chars: int = MAX_CHARS, max_seconds: float = MAX_SECONDS) -> ExtractedDocument:
+    """
+    Extract and chunk the text of a PDF or DOCX file, stopping at the page, character or time cap.
+
+    A module-level function so that it can run in a worker process.
+    """
+    stream = io.BytesIO(source) if isinstance(source, bytes) else source
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    deadline = time.monotonic() + max_seconds
+    pages: List[str] = []
+    chars = 0
+    truncated = False
+    error = None
+    page_iter = pdf_pages(stream) if mime_type == PDF_MIME_TYPE else docx_pages(stream)
+    try:
+        page = next(page_iter, None)
+        timings["open"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        while page is not None:
+            pages.append(page[:max_chars - chars])
+            chars += len(pages[-1])
+            if len(pages) >= max_pages or chars >= max_chars or time.monotonic() > deadline:
+                # Stop without parsing further pages; there may or may not be more
+                truncated = True
+                break
+            page = next(page_iter, None)
+    except Exception as e:
+        error = f"could not extract text: {e}"
+        logger.warning("Document %s: %s", digest[:12], error)
+    finally:
+        page_iter.close()
+    timings.setdefault("open", 0.0)
+    timings["extract"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    chunks = chunk_pages(pages)
+    timings["chunk"] = (time.perf_counter() - start) * 1000
+    return ExtractedDocument(digest, chunks, len(pages), truncated, timings, error)
+
+
+class DocumentExtractor:
+    """
+    Extracts and caches document text by content hash.
+
+    Args:
+        cache_size (int): Extracted documents kept in memory
+        max_bytes (int): Files larger than this are not parsed
+        max_pages (int): Stop after this many pages
+        max_chars (int): Stop after this many characters
+        max_seconds (float): Stop once extraction has taken this long
+        runner (Callable, optional): ``runner(parse_document, data, ...)`` runs the parse
+            elsewhere, e.g. ``AttachmentPool.in_process``; by default it runs in the caller
+    """
+
+    def __init__(self, cache_size: int = 256, max_bytes: int = MAX_BYTES, max_pages: int = MAX_PAGES,
+                 max_chars: int = MAX_CHARS, max_seconds: float = MAX_SECONDS, runner: Optional[Callable] = None):
+        self.cache = LRUCache(max_entries=cache_size, ttl=0)
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+        self.runner = runner
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stage_ms: Dict[str, float] = {"hash": 0.0, "open": 0.0, "extract": 0.0, "chunk": 0.0}
+
+    @staticmethod
+    def supports(mime_type: str) -> bool:
+        return mime_type == DOCX_MIME_TYPE or (mime_type == PDF_MIME_TYPE and PDF_SUPPORT)
+
+    def extract(self, source: Union[bytes, BinaryIO], mime_type: str, digest: Optional[str] = None) -> Optional[ExtractedDocument]:
+        """
+        Return the extracted document for ``source``, parsing it only on a cache miss.
+
+        Args:
+            source: File bytes or a seekable binary stream
+            mime_type (str): PDF or DOCX MIME type
+            digest (str, optional): SHA-256 of the file bytes if already known
+
+        Returns:
+            ExtractedDocument, or None if the type is not supported
+        """
+        if not self.supports(mime_type):
+            return None
+
+        timings: Dict[str, float] = {}
+        if digest is None:
+            start = time.perf_counter()
+            digest = hashlib.sha256(source).hexdigest() if isinstance(source, bytes) else _hash_stream(source)
+            timings["hash"] = (time.perf_counter() - start) * 1000
+
+        document = self.cache.get(digest)
+        if document is not None:
+            with self._lock:
+                self.hits += 1
+            return document
+
+        stream = io.BytesIO(source) if isinstance(source, bytes) else source
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        if size > self.max_bytes:
+            document = ExtractedDocument(digest, [], 0, True, timings, error=f"document larger than {self.max_bytes} bytes")
+        elif self.runner is None:
+            document = parse_document(stream, mime_type, digest, self.max_pages, self.max_chars, self.max_seconds)
+        else:
+            # Only the file bytes go to the runner, and only the extracted text comes back
+            document = self.runner(parse_document, stream.read(), mime_type, digest, self.max_pages, self.max_chars, self.max_seconds)
+        timings.update(document.timings)
+        document.timings = timings
+
+        self.cache.set(digest, document)
+        with self._lock:
+            self.misses += 1
+            for stage, ms in timings.items():
+                self.stage_ms[stage] = self.stage_ms.get(stage, 0.0) + ms
+        logger.info("Extracted %d page(s) from %s in %s", document.pages, digest[:12],
+                    ", ".join(f"{stage}={ms:.1f}ms" for stage, ms in timings.items()))
+        return document
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.cache),
+                "stage_ms_total": {stage: round(ms, 3) for stage, ms in self.stage_ms.items()},
+            }
+
+
+def extractor_from_env(runner: Optional[Callable] = None) -> DocumentExtractor:
+    """Build the document extractor from DOCUMENT_* environment variables."""
+    return DocumentExtractor(cache_size=int(os.getenv("DOCUMENT_CACHE_SIZE", "256")), runner=runner)
@@ -0,0 +1,230 @@
+"""
+Idempotent request de-duplication and single-flight coalescing.
+
+Clients retry chats that time out on their side while the first attempt
+is still running upstream. Rather than paying for every attempt:
+
+* Requests carrying the same ``Idempotency-Key`` share one call. While it
+  runs, retries wait for it; once it has finished, retries within
+  ``IDEMPOTENCY_TTL`` get the stored answer. Reusing a key with a different
+  request body is an error (``IdempotencyConflict``, 422).
+* Identical requests without a key (same route, body and conversation)
+  are coalesced while one of them is in flight, but nothing is stored,
+  so asking again later gets a fresh answer.
+
+Failed calls are never stored: every waiter sees the error and the next
+retry runs again. On the async path the shared call runs as its own task,
+so it finishes (and its result is kept) even if the client that started
+it disconnects.
+
+With several worker processes, keyed answers are kept in the shared store
+(see shared_state.py), so a retry is answered whichever worker it reaches.
+Calls in flight are only shared within one worker.
+
+Configuration (environment variables):
+    IDEMPOTENCY_TTL           seconds a keyed answer is kept (default 300)
+    IDEMPOTENCY_MAX_ENTRIES   keyed answers kept in memory (default 10000)
+"""
+import asyncio
+import hashlib
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from metrics import Counter, registry
+from response_cache import LRUCache, attachment_digest
+from shared_state import SharedMapping, SharedStore
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+upstream_calls_saved = registry.register(Counter(
+    "chatbot_upstream_calls_saved_total",
+    "Chat requests answered from another request's call instead of their own.", ("reason",)))
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different request."""
+
+
+def request_fingerprint(*parts: Optional[str], attachment_digests: Iterable[str] = ()) -> str:
+    """SHA-256 identifying a request body; attachments contribute only their content digests."""
+    hasher = hashlib.sha256()
+    for part in (*parts, *attachment_digests):
+        hasher.update((part or "").encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def chat_fingerprint(message: str, attachments: Iterable[Dict] = (), conversation_id: Optional[str] = None) -> str:
+    """Fingerprint of a chat request: the message, conversation and attachment contents."""
+    return request_fingerprint(message, conversation_id, attachment_digests=[attachment_digest(a) for a in attachments])
+
+
+class _Call:
+    """A call in flight on a worker thread."""
+
+    __slots__ = ("fingerprint", "done", "result", "error")
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class RequestCoalescer:
+    """
+    Shares one execution between duplicate requests.
+
+    Args:
+        ttl (float): Seconds a keyed result is kept after completion
+        max_entries (int): Keyed results kept before the oldest are evicted
+        shared (SharedStore, optional): Keep keyed results here instead of in this process;
+            they must then be JSON-serializable
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 10_000, shared: Optional[SharedStore] = None):
+        if shared is not None:
+            self.completed = SharedMapping(shared, "idempotency", ttl)
+        else:
+            self.completed = LRUCache(max_entries=max_entries, ttl=ttl)
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[str, Tuple[str, asyncio.Task]] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def _key(route: str, fingerprint: str, idempotency_key: Optional[str]) -> str:
+        return f"key:{route}:{idempotency_key}" if idempotency_key else f"body:{route}:{fingerprint}"
+
+    def _check(self, fingerprint: str, expected: str, idempotency_key: Optional[str]) -> None:
+        if fingerprint != expected:
+            with self._lock:
+                self.conflicts += 1
+            raise IdempotencyConflict(f"{IDEMPOTENCY_HEADER} {idempotency_key!r} was already used for a different request")
+
+    def _replay(self, key: str, fingerprint: str, idempotency_key: Optional[str]):
+        """Stored (found, result) for a keyed request that already completed."""
+        if not idempotency_key:
+            return False, None
+        stored = self.completed.get(key)
+        if stored is None:
+            return False, None
+        self._check(fingerprint, stored[0], idempotency_key)
+        self._saved("replayed")
+        return True, stored[1]
+
+    def _saved(self, reason: str) -> None:
+        with self._lock:
+            if reason == "replayed":
+                self.replayed += 1
+            else:
+                self.coalesced += 1
+        upstream_calls_saved.inc(1, reason)
+
+    def run(self, fn: Callable[[], Any], route: str, fingerprint: str, idempotency_key: Optional[str] = None,
+            coalesce: bool = True) -> Any:
+        """
+        Return ``fn()``, or the result of a duplicate request's call.
+
+        Args:
+            fn: Performs the request
+            route (str): Route the request came in on; keys are scoped per route
+            fingerprint (str): ``request_fingerprint()`` of the request body
+            idempotency_key (str, optional): The client's ``Idempotency-Key`` header
+            coalesce (bool): Share calls between identical requests without a key;
+                pass False when the client asked for a fresh answer
+        """
+        if not idempotency_key and not coalesce:
+            return fn()
+        key = self._key(route, fingerprint, idempotency_key)
+        found, result = self._replay(key, fingerprint, idempotency_key)
+        if found:
+            return result
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(fingerprint)
+                self.executed += 1
+
+        if not leader:
+            self._check(fingerprint, call.fingerprint, idempotency_key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            self._saved("coalesced")
+            return call.result
+
+        try:
+            call.result = fn()
+            if idempotency_key:
+                # Stored before the call is unregistered, so there is no window in which a retry runs again
+                self.completed.set(key, (fingerprint, call.result))
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def arun(self, fn: Callable[[], Awaitable[Any]], route: str, fingerprint: str, idempotency_key: Optional[str] = None,
+                   coalesce: bool = True) -> Any:
+        """Async counterpart of ``run()``; ``fn`` returns an awaitable."""
+        if not idempotency_key and not coalesce:
+            return await fn()
+        key = self._key(route, fingerprint, idempotency_key)
+        if idempotency_key:
+            # The shared store is read and written on a worker thread, off the event loop
+            found, result = await asyncio.to_thread(self._replay, key, fingerprint, idempotency_key)
+            if found:
+                return result
+
+        entry = self._tasks.get(key)
+        if entry is not None:
+            self._check(fingerprint, entry[0], idempotency_key)
+            result = await asyncio.shield(entry[1])
+            self._saved("coalesced")
+            return result
+
+        async def call() -> Any:
+            result = await fn()
+            if idempotency_key:
+                # Stored before the call is unregistered, so there is no window in which a retry runs again
+                await asyncio.to_thread(self.completed.set, key, (fingerprint, result))
+            return result
+
+        task = asyncio.ensure_future(call())
+        self._tasks[key] = (fingerprint, task)
+        with self._lock:
+            self.executed += 1
+        task.add_done_callback(lambda task: self._tasks.pop(key, None))
+        # Shielded so a disconnecting client does not cancel the call other requests are waiting on
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "replayed": self.replayed,
+                "conflicts": self.conflicts,
+                "upstream_calls_saved": self.coalesced + self.replayed,
+                "in_flight": len(self._calls) + len(self._tasks),
+                "stored": len(self.completed),
+            }
+
+
+def coalescer_from_env(shared: Optional[SharedStore] = None) -> RequestCoalescer:
+    """Build the request coalescer from IDEMPOTENCY_* environment variables, storing keyed results in ``shared`` if given."""
+    return RequestCoalescer(
+        ttl=float(os.getenv("IDEMPOTENCY_TTL", "300")),
+        max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+        shared=shared,
+    )
@@ -0,0 +1,177 @@
+"""
+Image preprocessing before images are sent to the model.
+
+Phone photos are often 5-10 MB at 12+ megapixels, far more than the model
+needs. Each image is decoded once (large JPEGs straight at a reduced scale),
+rotated upright from its EXIF orientation, downscaled to a maximum
+dimension and re-encoded: photos as JPEG, screenshots and other lossless
+images as PNG so text stays sharp. An image that needed no downscaling is
+re-encoded only if that makes it smaller. Results are cached by the
+SHA-256 of the original bytes, and ``chatbot()`` sends identical images
+in one request only once.
+
+Needs the optional ``Pillow`` package; without it images are sent as they
+were uploaded.
+
+Configuration (environment variables):
+    IMAGE_MAX_DIMENSION   longest side after downscaling, in pixels (default 1536)
+    IMAGE_QUALITY         JPEG/WebP quality (default 85)
+    IMAGE_CACHE_SIZE      processed images kept in memory (default 128)
+"""
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from functools import cached_property
+from typing import BinaryIO, Dict, Optional, Union
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+from response_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# Lossy sources stay lossy; everything else (PNG, GIF, BMP, ...) is re-encoded losslessly
+_OUTPUT_FORMATS = {"JPEG": "JPEG", "MPO": "JPEG", "WEBP": "WEBP"}
+
+
+class ProcessedImage:
+    """An image ready to send, plus what processing it saved and cost."""
+
+    def __init__(self, digest: str, data: bytes, mime_type: str, original_bytes: int, width: int = 0, height: int = 0,
+                 ms: float = 0.0, error: Optional[str] = None):
+        self.digest = digest
+        self.data = data
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.width = width
+        self.height = height
+        self.ms = ms
+        self.error = error
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - len(self.data)
+
+    @cached_property
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+
+class ImageProcessor:
+    """
+    Downscales and recompresses images, caching the result by content hash.
+
+    Args:
+        cache_size (int): Processed images kept in memory
+        max_dimension (int): Longest side of the processed image in pixels
+        quality (int): JPEG/WebP encoder quality
+    """
+
+    def __init__(self, cache_size: int = 128, max_dimension: int = MAX_DIMENSION, quality: int = QUALITY):
+        self.cache = LRUCache(max_entries=cache_size, ttl=0)
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.processing_ms = 0.0
+
+    def process(self, source: Union[bytes, BinaryIO], mime_type: str, digest: Optional[str] = None) -> ProcessedImage:
+        """
+        Return the processed image for ``source``, decoding it only on a cache miss.
+
+        Args:
+            source: Image bytes or a seekable binary stream
+            mime_type (str): MIME type of the original image
+            digest (str, optional): SHA-256 of the image bytes if already known
+
+        Returns:
+            ProcessedImage; if the image cannot be processed it holds the original bytes
+        """
+        if digest is None:
+            if not isinstance(source, bytes):
+                source.seek(0)
+                source = source.read()
+            digest = hashlib.sha256(source).hexdigest()
+
+        image = self.cache.get(digest)
+        if image is not None:
+            with self._lock:
+                self.hits += 1
+            return image
+
+        if not isinstance(source, bytes):
+            # Streams are only read on a cache miss
+            source.seek(0)
+            source = source.read()
+        start = time.perf_counter()
+        try:
+            image = self._convert(source, mime_type, digest)
+        except Exception as e:
+            image = ProcessedImage(digest, source, mime_type, len(source), error=f"could not process image: {e}")
+            logger.warning("Image %s: %s", digest[:12], image.error)
+        image.ms = (time.perf_counter() - start) * 1000
+
+        self.cache.set(digest, image)
+        with self._lock:
+            self.misses += 1
+            self.bytes_in += image.original_bytes
+            self.bytes_out += len(image.data)
+            self.processing_ms += image.ms
+        logger.info("Image %s: %d -> %d bytes (%d saved, %dx%d) in %.1fms", digest[:12], image.original_bytes,
+                    len(image.data), image.bytes_saved, image.width, image.height, image.ms)
+        return image
+
+    def _convert(self, data: bytes, mime_type: str, digest: str) -> ProcessedImage:
+        if Image is None:
+            return ProcessedImage(digest, data, mime_type, len(data), error="image processing requires the 'Pillow' package")
+
+        with Image.open(io.BytesIO(data)) as original:
+            if getattr(original, "n_frames", 1) > 1:
+                # Re-encoding would drop the animation
+                return ProcessedImage(digest, data, mime_type, len(data), *original.size)
+            resized = max(original.size) > self.max_dimension
+            # JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale, which is much faster
+            original.draft("RGB", (self.max_dimension, self.max_dimension))
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((self.max_dimension, self.max_dimension))
+
+            output_format = _OUTPUT_FORMATS.get(original.format, "PNG")
+            if output_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format=output_format, quality=self.quality, optimize=True)
+
+        # An already small, well-compressed image is sent as it was
+        if not resized and output.tell() >= len(data):
+            return ProcessedImage(digest, data, mime_type, len(data), *image.size)
+        return ProcessedImage(digest, output.getvalue(), f"image/{output_format.lower()}", len(data), *image.size)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.cache),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "processing_ms_total": round(self.processing_ms, 3),
+            }
+
+
+def image_processor_from_env() -> ImageProcessor:
+    """Build the image processor from IMAGE_* environment variables."""
+    return ImageProcessor(cache_size=int(os.getenv("IMAGE_CACHE_SIZE", "128")))
@@ -0,0 +1,42 @@
+"""
+JSON encoding and decoding for request and response bodies.
+
+Chat requests can carry tens of megabytes of base64 attachments inside
+their JSON. The standard library decodes such a body to text before
+parsing it and is several times slower than ``orjson``, which parses the
+bytes directly. ``orjson`` is used when it is installed, and otherwise the
+standard library with compact separators. Both APIs route their JSON
+through here: Flask via ``app.json``, Starlette via its ``JSONResponse``.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _default(value: Any) -> Any:
+    # NumPy scalars in stats, e.g. a float64 hit rate
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Parse a JSON document; raises ``ValueError`` if it is not valid JSON."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """Serialize ``value`` to compact UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
@@ -0,0 +1,263 @@
+"""
+Request metrics in Prometheus text format.
+
+Each HTTP request gets a ``RequestTrace`` held in a context variable, so
+code anywhere on the chat path can time a stage with ``span("name")``
+without the trace being passed around; outside a request (CLI, tests)
+spans are no-ops. When the request finishes, its duration, stage timings
+and token counts are folded into histograms and counters that
+``/api/metrics`` renders for Prometheus. Recording is a few
+``perf_counter()`` calls and one locked bucket increment per metric, a
+few microseconds per request.
+
+Stages: ``parse`` (request body), ``attachments``, ``prompt_build``,
+``llm_first_token`` (streams only), ``llm_total`` and ``serialize``.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 6)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram with optional labels.
+
+    Args:
+        name (str): Metric name
+        documentation (str): HELP text
+        labelnames (Sequence[str]): Label names; values are passed positionally to ``observe``
+        buckets (Sequence[float]): Upper bounds, ascending; ``+Inf`` is added
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # labels -> [per-bucket counts (not cumulative), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Estimate a quantile by linear interpolation within buckets, like PromQL ``histogram_quantile``."""
+        with self._lock:
+            series = self._series.get(labels)
+            if not series or not series[2]:
+                return None
+            counts, _, total = list(series[0]), series[1], series[2]
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                upper = self.buckets[i]
+                lower = self.buckets[i - 1] if i else 0.0
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-2]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Count, sum and estimated p50/p95/p99 per label set."""
+        result = {}
+        for labels in list(self._series):
+            series = self._series[labels]
+            key = ",".join(f"{name}={value}" for name, value in zip(self.labelnames, labels)) or "all"
+            result[key] = {
+                "count": series[2],
+                "sum": round(series[1], 6),
+                **{f"p{int(q * 100)}": _round(self.quantile(q, *labels)) for q in (0.5, 0.95, 0.99)},
+            }
+        return result
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                suffix = _format_labels(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+                lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class Registry:
+    """The set of metrics rendered by ``/api/metrics``."""
+
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {metric.name: metric.snapshot() for metric in self.metrics if isinstance(metric, Histogram)}
+
+
+registry = Registry()
+requests_total = registry.register(Counter(
+    "chatbot_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status")))
+request_duration = registry.register(Histogram(
+    "chatbot_request_duration_seconds", "Wall time of HTTP requests, including streamed bodies.", ("route",)))
+stage_duration = registry.register(Histogram(
+    "chatbot_stage_duration_seconds", "Time spent in each stage of a request.", ("route", "stage")))
+tokens_total = registry.register(Counter(
+    "chatbot_tokens_total", "Estimated prompt and response tokens.", ("kind",)))
+request_tokens = registry.register(Histogram(
+    "chatbot_request_tokens", "Estimated prompt and response tokens per request.", ("kind",), buckets=TOKEN_BUCKETS))
+
+
+class RequestTrace:
+    """Stage timings and token counts for one request."""
+
+    __slots__ = ("route", "method", "start", "spans", "prompt_tokens", "response_tokens", "estimate", "finished")
+
+    def __init__(self, route: str, method: str = "GET"):
+        self.route = route
+        self.method = method
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        # The token_budget.PromptEstimate of the request's prompt, if one was built
+        self.estimate = None
+        self.finished = False
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def since_start(self, stage: str) -> None:
+        """Record a stage that runs from the start of the request until now, e.g. time to first token."""
+        self.spans[stage] = time.perf_counter() - self.start
+
+    def finish(self, status: int) -> None:
+        """Fold this request into the metrics; later calls are ignored."""
+        if self.finished:
+            return
+        self.finished = True
+        requests_total.inc(1, self.route, self.method, str(status))
+        request_duration.observe(time.perf_counter() - self.start, self.route)
+        for stage, seconds in self.spans.items():
+            stage_duration.observe(seconds, self.route, stage)
+        for kind, count in (("prompt", self.prompt_tokens), ("response", self.response_tokens)):
+            if count:
+                tokens_total.inc(count, kind)
+                request_tokens.observe(count, kind)
+
+
+_current: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+
+def start_request(route: str, method: str = "GET") -> Tuple[RequestTrace, Token]:
+    """Begin a trace and make it current; pass the token to ``end_request`` to detach it."""
+    trace = RequestTrace(route, method)
+    return trace, _current.set(trace)
+
+
+def end_request(token: Token) -> None:
+    _current.reset(token)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a block as ``stage`` of the current request."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - start)
+
+
+def record_tokens(prompt: int = 0, response: int = 0) -> None:
+    """Add token counts to the current request."""
+    trace = _current.get()
+    if trace is not None:
+        trace.prompt_tokens += prompt
+        trace.response_tokens += response
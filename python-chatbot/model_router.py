@@ -0,0 +1,394 @@
+"""
+Per-request model selection between a fast and a strong model tier.
+
+Most questions are greetings or short factual lookups that the fast model
+answers well. Long prompts, many or heavy attachments, code and questions
+phrased as reviews, debugging or analysis are sent to the strong model.
+The decision uses only cheap local signals (prompt length, attachment
+count and kinds, a keyword classifier). It never calls a model and takes
+about 0.1 ms for a 2 KB prompt.
+
+Each model gets one long-lived client, built on first use and shared by
+every request, so connections are reused. A call that does not finish
+within its tier's timeout, or whose model is unavailable (circuit open,
+retries exhausted), is retried once on the fallback model. The timeout is
+also the call's upstream deadline (``upstream.set_deadline``), so a call
+that timed out stops waiting for the rate limiter and stops retrying
+instead of spending a second request's worth next to the fallback; a
+timed-out stream is closed as soon as its pending chunk arrives. Decisions are
+logged and counted per tier, and every model call is timed per model in
+``chatbot_model_latency_seconds``.
+
+Configuration (environment variables):
+    MODEL_FAST                model for simple requests (default gemini-2.5-flash-lite)
+    MODEL_STRONG              model for hard requests (default gemini-2.5-flash)
+    MODEL_FALLBACK            model used when the routed one times out (default: the other tier)
+    ROUTER_TIMEOUT_FAST       seconds before a fast-tier call falls back (default 40)
+    ROUTER_TIMEOUT_STRONG     seconds before a strong-tier call falls back (default 60)
+    ROUTER_THRESHOLD          score at which requests go to the strong tier (default 3)
+    ROUTER_LONG_PROMPT_TOKENS prompt tokens counted as a long prompt (default 400)
+
+Both timeouts include the rate-limit wait, so they are kept above
+``LLM_RATE_WAIT`` (default 30); a lower one is logged as a warning.
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from metrics import Counter, Histogram, registry
+from token_budget import estimate_tokens
+from upstream import UpstreamUnavailable, set_deadline
+
+logger = logging.getLogger(__name__)
+
+FAST = "fast"
+STRONG = "strong"
+
+route_decisions = registry.register(Counter(
+    "chatbot_route_decisions_total", "Requests routed to each model tier.", ("tier", "model")))
+model_calls = registry.register(Counter(
+    "chatbot_model_calls_total", "Model calls by model and outcome (ok, error, timeout, unavailable).", ("model", "outcome")))
+model_latency = registry.register(Histogram(
+    "chatbot_model_latency_seconds", "Latency of model calls, to the first chunk for streams.", ("model",)))
+
+# Words and phrases that suggest a request needs the strong model; matched on lower-cased text
+_HARD_WORDS = frozenset((
+    "review", "debug", "refactor", "optimize", "optimise", "analyze", "analyse", "analysis", "compare", "comparison",
+    "architecture", "design", "prove", "proof", "derive", "algorithm", "complexity", "tradeoff", "tradeoffs", "traceback",
+    "exception", "bug", "vulnerability", "vulnerabilities", "summarize", "summarise", "translate", "rewrite", "implement",
+    "benchmark",
+))
+_HARD_PHRASES = ("step by step", "step-by-step", "root cause", "stack trace", "trade-off", "explain why", "explain how")
+_WORD = re.compile(r"[a-z]+")
+_SIMPLE = re.compile(
+    r"^\s*(hi|hello|hey|thanks?( you)?|thank you|ok(ay)?|yes|no|good (morning|afternoon|evening)|bye|goodbye|"
+    r"who are you|what can you do)\b[\s!.?]*$", re.IGNORECASE)
+# Separate patterns are several times faster than one alternation over the whole prompt
+_CODE_PATTERNS = (
+    re.compile(r"^[ \t]*(?:def|class|import|from|function|const|let|public|#include) ", re.MULTILINE),
+    re.compile(r"[;{}][ \t]*$", re.MULTILINE),
+)
+_CODE_EXTENSIONS = (".py", ".js", ".ts", ".tsx", ".java", ".go", ".rs", ".c", ".cpp", ".h", ".cs", ".rb", ".php", ".kt", ".swift", ".sql")
+
+
+class RouteDecision:
+    """The model chosen for a request and why."""
+
+    __slots__ = ("tier", "model", "fallback", "score", "reasons")
+
+    def __init__(self, tier: str, model: str, fallback: Optional[str], score: int, reasons: List[str]):
+        self.tier = tier
+        self.model = model
+        self.fallback = fallback
+        self.score = score
+        self.reasons = reasons
+
+    def __repr__(self) -> str:
+        return f"RouteDecision({self.tier}, {self.model}, score={self.score}, reasons={self.reasons})"
+
+
+def score_request(question: str, attachments: Optional[List[Dict]] = None, history_tokens: int = 0,
+                  long_prompt_tokens: int = 400) -> Tuple[int, List[str]]:
+    """
+    Difficulty score of a request from cheap local signals.
+
+    Returns:
+        Tuple of (score, reasons); each reason names a signal that added to or took from the score
+    """
+    score, reasons = 0, []
+    attachments = attachments or []
+    tokens = estimate_tokens(question) + history_tokens
+    if tokens >= long_prompt_tokens:
+        score += 2
+        reasons.append(f"long prompt ({tokens} tokens)")
+    elif not attachments and _SIMPLE.match(question):
+        score -= 2
+        reasons.append("small talk")
+
+    if len(attachments) >= 3:
+        score += 2
+        reasons.append(f"{len(attachments)} attachments")
+    kinds = {attachment.get('type') for attachment in attachments}
+    for kind in ("document", "image"):
+        if kind in kinds:
+            score += 1
+            reasons.append(f"{kind} attachment")
+    if any(attachment.get('filename', '').lower().endswith(_CODE_EXTENSIONS) for attachment in attachments):
+        score += 2
+        reasons.append("code attachment")
+    elif "```" in question or any(pattern.search(question) for pattern in _CODE_PATTERNS):
+        score += 2
+        reasons.append("code in question")
+
+    lowered = question.lower()
+    keywords = set(_HARD_WORDS.intersection(_WORD.findall(lowered)))
+    keywords.update(phrase for phrase in _HARD_PHRASES if phrase in lowered)
+    if keywords:
+        score += min(3, len(keywords) * 2)
+        reasons.append("keywords: " + ", ".join(sorted(keywords)))
+    return score, reasons
+
+
+class ModelPool:
+    """
+    One shared client per model name, built on first use.
+
+    Args:
+        factory: Builds the client (a runnable chat model) for a model name
+    """
+
+    def __init__(self, factory: Callable[[str], Runnable]):
+        self.factory = factory
+        self._clients: Dict[str, Runnable] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Runnable:
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = self.factory(name)
+        return client
+
+    def items(self) -> List[Tuple[str, Runnable]]:
+        with self._lock:
+            return list(self._clients.items())
+
+
+# Sync calls are run here so they can be abandoned when they time out
+_timeout_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="model-call")
+
+
+def _submit_with_deadline(timeout: float, fn: Callable, *args: Any, **kwargs: Any):
+    """Run ``fn`` on the timeout executor in a copy of the caller's context whose upstream deadline is ``timeout``."""
+    context = copy_context()
+    context.run(set_deadline, timeout)
+    return _timeout_executor.submit(context.run, fn, *args, **kwargs)
+
+
+class FallbackModel(Runnable):
+    """
+    Runnable calling the routed model, and the fallback model if it times out or is unavailable.
+
+    Streams fall back only before their first chunk; the timeout applies to that first chunk.
+
+    Args:
+        pool (ModelPool): Where the clients come from
+        model (str): The routed model
+        fallback (str, optional): Model to use instead when ``model`` fails over
+        timeout (float): Seconds ``model`` has before the fallback is tried
+    """
+
+    def __init__(self, pool: ModelPool, model: str, fallback: Optional[str], timeout: float):
+        self.pool = pool
+        self.model = model
+        self.fallback = fallback
+        self.timeout = timeout
+
+    def _record(self, model: str, start: float, outcome: str) -> None:
+        elapsed = time.perf_counter() - start
+        model_calls.inc(1, model, outcome)
+        if outcome == "ok":
+            model_latency.observe(elapsed, model)
+        logger.info("Model %s: %s in %.0fms", model, outcome, elapsed * 1000)
+
+    def _fall_back(self, start: float, error: BaseException) -> bool:
+        """Record a failed primary call; True if the fallback model should be tried."""
+        outcome = "timeout" if isinstance(error, TimeoutError) else "unavailable" if isinstance(error, UpstreamUnavailable) else "error"
+        self._record(self.model, start, outcome)
+        if outcome == "error" or not self.fallback:
+            return False
+        logger.warning("Model %s %s after %.1fs, falling back to %s", self.model, outcome, time.perf_counter() - start, self.fallback)
+        return True
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            future = _submit_with_deadline(self.timeout, self.pool.get(self.model).invoke, input, config, **kwargs)
+            result = future.result(self.timeout)
+        except Exception as e:
+            if not self._fall_back(start, e):
+                raise
+            return self._invoke_fallback(input, config, **kwargs)
+        self._record(self.model, start, "ok")
+        return result
+
+    def _invoke_fallback(self, input: Any, config: Optional[RunnableConfig], **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            result = self.pool.get(self.fallback).invoke(input, config, **kwargs)
+        except Exception:
+            self._record(self.fallback, start, "error")
+            raise
+        self._record(self.fallback, start, "ok")
+        return result
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self.pool.get(self.model).ainvoke(input, config, **kwargs), self.timeout)
+        except Exception as e:
+            if not self._fall_back(start, e):
+                raise
+            start = time.perf_counter()
+            try:
+                result = await self.pool.get(self.fallback).ainvoke(input, config, **kwargs)
+            except Exception:
+                self._record(self.fallback, start, "error")
+                raise
+            self._record(self.fallback, start, "ok")
+            return result
+        self._record(self.model, start, "ok")
+        return result
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        start = time.perf_counter()
+        model = self.model
+        upstream = self.pool.get(model).stream(input, config, **kwargs)
+        pending = _submit_with_deadline(self.timeout, next, upstream, None)
+        try:
+            first = pending.result(self.timeout)
+        except Exception as e:
+            # The generator cannot be closed while its worker thread is inside it, so it is closed when that returns
+            abandoned = upstream
+            pending.add_done_callback(lambda _: abandoned.close())
+            if not self._fall_back(start, e):
+                raise
+            start, model = time.perf_counter(), self.fallback
+            upstream = self.pool.get(model).stream(input, config, **kwargs)
+            first = next(upstream, None)
+        self._record(model, start, "ok")
+        try:
+            if first is not None:
+                yield first
+            yield from upstream
+        finally:
+            upstream.close()
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        start = time.perf_counter()
+        model = self.model
+        upstream = self.pool.get(model).astream(input, config, **kwargs)
+        try:
+            first = await asyncio.wait_for(anext(upstream, None), self.timeout)
+        except Exception as e:
+            await upstream.aclose()
+            if not self._fall_back(start, e):
+                raise
+            start, model = time.perf_counter(), self.fallback
+            upstream = self.pool.get(model).astream(input, config, **kwargs)
+            first = await anext(upstream, None)
+        self._record(model, start, "ok")
+        try:
+            if first is not None:
+                yield first
+            async for chunk in upstream:
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+
+class ModelRouter:
+    """
+    Picks the model tier for each request and hands out the runnable that calls it.
+
+    Args:
+        pool (ModelPool): Shared clients per model
+        fast_model (str): Model for requests scoring below ``threshold``
+        strong_model (str): Model for the rest
+        fallback_model (str, optional): Model used on timeout; defaults to the other tier
+        timeouts (Dict[str, float]): Seconds per tier before falling back
+        threshold (int): Score at which a request goes to the strong tier
+        long_prompt_tokens (int): Prompt tokens counted as a long prompt
+    """
+
+    def __init__(self, pool: ModelPool, fast_model: str = "gemini-2.5-flash-lite", strong_model: str = "gemini-2.5-flash",
+                 fallback_model: Optional[str] = None, timeouts: Optional[Dict[str, float]] = None, threshold: int = 3,
+                 long_prompt_tokens: int = 400):
+        self.pool = pool
+        self.models = {FAST: fast_model, STRONG: strong_model}
+        self.fallback_model = fallback_model
+        self.timeouts = {FAST: 40.0, STRONG: 60.0, **(timeouts or {})}
+        self.threshold = threshold
+        self.long_prompt_tokens = long_prompt_tokens
+        self._runnables: Dict[str, FallbackModel] = {}
+        self._lock = threading.Lock()
+
+    def route(self, question: str, attachments: Optional[List[Dict]] = None, history_tokens: int = 0) -> RouteDecision:
+        """Choose the tier for a request and log why."""
+        score, reasons = score_request(question, attachments, history_tokens, self.long_prompt_tokens)
+        tier = STRONG if score >= self.threshold else FAST
+        model = self.models[tier]
+        fallback = self.fallback_model or self.models[FAST if tier == STRONG else STRONG]
+        decision = RouteDecision(tier, model, fallback if fallback != model else None, score, reasons)
+        route_decisions.inc(1, tier, model)
+        logger.info("Routed to %s (%s), score %d: %s", model, tier, score, "; ".join(reasons) or "no signals")
+        return decision
+
+    def runnable(self, decision: RouteDecision) -> FallbackModel:
+        """The shared runnable for a decision's tier, so chains built on it are reused."""
+        runnable = self._runnables.get(decision.tier)
+        if runnable is None:
+            with self._lock:
+                runnable = self._runnables.get(decision.tier)
+                if runnable is None:
+                    runnable = self._runnables[decision.tier] = FallbackModel(
+                        self.pool, decision.model, decision.fallback, self.timeouts[decision.tier])
+        return runnable
+
+    def build_clients(self) -> None:
+        """Build the client of every configured model now rather than on its first request."""
+        for model in {*self.models.values(), self.fallback_model} - {None}:
+            self.pool.get(model)
+
+    def use_clients(self, factory: Callable[[str], Runnable]) -> None:
+        """Replace every model client, e.g. with a fake in benchmarks."""
+        self.pool = ModelPool(factory)
+        with self._lock:
+            self._runnables.clear()
+
+    def stats(self) -> Dict:
+        """Per-tier decisions and per-model call counts, latency percentiles and client stats."""
+        latency = model_latency.snapshot()
+        result = {
+            "tiers": {tier: {"model": model, "requests": int(route_decisions.value(tier, model))} for tier, model in self.models.items()},
+            "models": {},
+        }
+        for name, client in self.pool.items():
+            entry = {
+                outcome: int(model_calls.value(name, outcome))
+                for outcome in ("ok", "error", "timeout", "unavailable")
+            }
+            entry["latency_s"] = latency.get(f"model={name}")
+            if hasattr(client, "stats"):
+                entry["upstream"] = client.stats()
+            result["models"][name] = entry
+        return result
+
+
+def router_from_env(factory: Callable[[str], Runnable]) -> ModelRouter:
+    """Build the model router from MODEL_* and ROUTER_* environment variables."""
+    timeouts = {FAST: float(os.getenv("ROUTER_TIMEOUT_FAST", "40")), STRONG: float(os.getenv("ROUTER_TIMEOUT_STRONG", "60"))}
+    rate_wait = float(os.getenv("LLM_RATE_WAIT", "30"))
+    for tier, timeout in timeouts.items():
+        if timeout <= rate_wait:
+            logger.warning("The %s tier timeout (%gs) is not above LLM_RATE_WAIT (%gs); calls queued for the rate limiter "
+                           "will fall back before they are sent", tier, timeout, rate_wait)
+    return ModelRouter(
+        ModelPool(factory),
+        fast_model=os.getenv("MODEL_FAST", "gemini-2.5-flash-lite"),
+        strong_model=os.getenv("MODEL_STRONG", "gemini-2.5-flash"),
+        fallback_model=os.getenv("MODEL_FALLBACK") or None,
+        timeouts=timeouts,
+        threshold=int(os.getenv("ROUTER_THRESHOLD", "3")),
+        long_prompt_tokens=int(os.getenv("ROUTER_LONG_PROMPT_TOKENS", "400")),
+    )
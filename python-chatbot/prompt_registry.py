@@ -0,0 +1,216 @@
+"""
+Compiled prompt registry for POML templates.
+
+Rendering a POML file is expensive (the POML renderer runs on every
+``format`` call), so each file is rendered once with placeholder values and
+turned into a plain LangChain ``ChatPromptTemplate``. The compiled template
+and the chains built on it are shared across requests and threads, and a
+file is only recompiled when its mtime and content hash change.
+
+The ``poml`` package takes close to a second to import, so it is only
+loaded when the first file is compiled.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from functools import cached_property
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Matches mustache-style ``{{ name }}`` variables in a POML file
+_VARIABLE_PATTERN = re.compile(r"{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}")
+
+# Variables that hold a list of chat messages rather than text
+MESSAGE_VARIABLES = ("history",)
+
+
+def _sentinel(name: str) -> str:
+    return f"__poml_var_{name}__"
+
+
+def _escape_braces(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+class CompiledPrompt:
+    """A POML file compiled into a reusable LangChain prompt template."""
+
+    def __init__(self, path: str, template: Any, digest: str, mtime_ns: int, size: int, parse_seconds: float):
+        self.path = path
+        self.template = template
+        self.digest = digest
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.parse_seconds = parse_seconds
+        self.checked_at = time.monotonic()
+        # Keyed by id(llm); the llm is kept alive alongside its chain so ids are never reused
+        self._chains: Dict[int, Tuple[Any, Any]] = {}
+        self._chains_lock = threading.Lock()
+
+    def chain(self, llm: Any) -> Any:
+        """Return the ``template | llm | StrOutputParser()`` chain for ``llm``, building it once."""
+        key = id(llm)
+        cached = self._chains.get(key)
+        if cached is None:
+            with self._chains_lock:
+                cached = self._chains.get(key)
+                if cached is None:
+                    cached = (llm, self.template | llm | StrOutputParser())
+                    self._chains[key] = cached
+        return cached[1]
+
+    @cached_property
+    def tokens(self) -> int:
+        """Estimated tokens of the prompt's own text, rendered with empty variables."""
+        messages = self.template.format_prompt(**{name: "" for name in self.template.input_variables}).to_messages()
+        return sum(estimate_tokens(str(message.content)) for message in messages)
+
+
+def compile_poml(path: str, message_variables: Tuple[str, ...] = MESSAGE_VARIABLES) -> Any:
+    """
+    Render a POML file once and convert it into a ``ChatPromptTemplate``.
+
+    Every ``{{ variable }}`` is rendered as a unique sentinel which is then
+    swapped back for a LangChain ``{variable}`` placeholder. Variables named
+    in ``message_variables`` become an optional ``MessagesPlaceholder``,
+    splitting the message they appear in. Templates that render to non-text
+    content fall back to the original POML template.
+
+    Args:
+        path (str): Path to the ``.poml`` file
+        message_variables (Tuple[str, ...]): Variables holding chat message lists
+
+    Returns:
+        A LangChain prompt template accepting the same input variables
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    variables = sorted(set(_VARIABLE_PATTERN.findall(source)))
+    text_variables = [name for name in variables if name not in message_variables]
+    list_variables = [name for name in variables if name in message_variables]
+    list_pattern = re.compile("(" + "|".join(re.escape(_sentinel(name)) for name in list_variables) + ")") if list_variables else None
+
+    from poml.integration.langchain import LangchainPomlTemplate
+
+    poml_template = LangchainPomlTemplate.from_file(path)
+    rendered = poml_template.format_prompt(**{name: _sentinel(name) for name in variables})
+
+    compiled_messages = []
+    for message in rendered.messages:
+        if not isinstance(message.content, str):
+            logger.warning("Prompt %s renders non-text content; using the uncompiled POML template", path)
+            return poml_template
+        # POML merges adjacent messages from the same speaker, so a message list
+        # variable can share a message with text; split around it
+        parts = list_pattern.split(message.content) if list_pattern else [message.content]
+        for part in parts:
+            if list_pattern and list_pattern.fullmatch(part):
+                name = part[len("__poml_var_"):-2]
+                compiled_messages.append(MessagesPlaceholder(name, optional=True))
+                continue
+            part = part.strip()
+            if not part:
+                continue
+            content = _escape_braces(part)
+            for name in text_variables:
+                content = content.replace(_sentinel(name), "{" + name + "}")
+            compiled_messages.append((message.type, content))
+
+    return ChatPromptTemplate.from_messages(compiled_messages)
+
+
+class PromptRegistry:
+    """
+    Thread-safe cache of compiled POML prompts keyed by file path.
+
+    Args:
+        check_interval (float): Minimum seconds between ``stat`` calls on a file.
+            Changes made within this window are picked up on the next check.
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self._entries: Dict[str, CompiledPrompt] = {}
+        self._reloads: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> CompiledPrompt:
+        """Return the compiled prompt for ``path``, recompiling it if the file changed."""
+        path = os.path.abspath(path)
+        entry = self._entries.get(path)
+        if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(path)
+            stat = os.stat(path)
+            if entry is not None:
+                entry.checked_at = time.monotonic()
+                if stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size:
+                    return entry
+                digest = self._hash_file(path)
+                if digest == entry.digest:
+                    # Touched but not edited, no need to recompile
+                    entry.mtime_ns = stat.st_mtime_ns
+                    entry.size = stat.st_size
+                    return entry
+
+            entry = self._compile(path, stat)
+            self._entries[path] = entry
+            return entry
+
+    def chain(self, path: str, llm: Any) -> Any:
+        """Return the shared ``prompt | llm | StrOutputParser()`` chain for ``path``."""
+        return self.get(path).chain(llm)
+
+    def preload(self, paths: List[str]) -> None:
+        """Compile the given prompt files up front, e.g. at process startup."""
+        for path in paths:
+            self.get(path)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Return per-file reload counts, parse time and content hash."""
+        with self._lock:
+            return {
+                path: {
+                    "digest": entry.digest,
+                    "reloads": self._reloads.get(path, 0),
+                    "parse_ms": round(entry.parse_seconds * 1000, 3),
+                }
+                for path, entry in self._entries.items()
+            }
+
+    def digest(self, path: str) -> str:
+        """Return the content hash of the currently compiled version of ``path``."""
+        return self.get(path).digest
+
+    def tokens(self, path: str) -> int:
+        """Return the estimated tokens of ``path``'s own text, without its variables."""
+        return self.get(path).tokens
+
+    def _compile(self, path: str, stat: os.stat_result) -> CompiledPrompt:
+        digest = self._hash_file(path)
+        start = time.perf_counter()
+        template = compile_poml(path)
+        parse_seconds = time.perf_counter() - start
+
+        if path in self._entries:
+            self._reloads[path] = self._reloads.get(path, 0) + 1
+            logger.info("Reloaded prompt %s in %.1f ms", path, parse_seconds * 1000)
+        else:
+            self._reloads.setdefault(path, 0)
+        return CompiledPrompt(path, template, digest, stat.st_mtime_ns, stat.st_size, parse_seconds)
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
@@ -0,0 +1,288 @@
+"""
+Response cache for repeated identical prompts.
+
+Keys are SHA-256 hashes of the normalized question, the model name, the
+prompt template hash and the attachment content digests; attachment
+payloads themselves are never stored. Lookups go to an in-memory LRU tier
+first and then to an optional sqlite tier that survives restarts. With
+several worker processes and no sqlite tier, the second tier is the
+shared store (see shared_state.py), so every worker sees every answer.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from attachments import attachment_bytes
+from shared_state import SharedMapping, SharedStore
+
+
+def normalize_question(question: str) -> str:
+    """Case-fold and collapse whitespace so trivially different copies share a key."""
+    return " ".join(question.split()).casefold()
+
+
+def attachment_digest(attachment: Dict) -> str:
+    """
+    SHA-256 of an attachment's content, plus the metadata that changes how it is sent.
+
+    Base64 content is hashed decoded, like uploads, so the same file sent
+    either way shares cache entries. The digest is recorded on the
+    attachment, so the fingerprint, cache key and audit log hash it once.
+    """
+    digest = attachment.get('digest')
+    if not digest and attachment.get('encoding', 'base64') == 'base64':
+        try:
+            attachment_bytes(attachment)
+            digest = attachment['digest']
+        except ValueError:
+            pass
+    if not digest:
+        # Plain text, or base64 that does not decode: hash the text as it is
+        content = attachment.get('content', '')
+        digest = attachment['digest'] = hashlib.sha256(content.encode('utf-8') if isinstance(content, str) else content).hexdigest()
+    return f"{attachment.get('type', '')}:{attachment.get('mime_type', '')}:{attachment.get('encoding', '')}:{digest}"
+
+
+def cache_key(question: str, model: str, template_digest: str, attachment_digests: Iterable[str] = ()) -> str:
+    """Build the cache key for one request."""
+    hasher = hashlib.sha256()
+    for part in (normalize_question(question), model, template_digest, *attachment_digests):
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with a per-entry TTL.
+
+    Args:
+        max_entries (int): Entries kept before the least recently used is evicted
+        ttl (float): Seconds an entry stays valid, 0 for no expiry
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (stored_at or time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache:
+    """
+    On-disk cache tier backed by sqlite.
+
+    Args:
+        path (str): Database file, created if missing
+        ttl (float): Seconds an entry stays valid, 0 for no expiry
+        max_entries (int): Rows kept before the oldest are pruned
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, max_entries: int = 100_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)")
+        self._writes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self._lock:
+            row = self._conn.execute("SELECT stored_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and time.time() - row[0] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.expirations += 1
+                return None
+            return row
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            self._writes += 1
+            # Prune in batches rather than on every write
+            if self._writes % 100 == 0:
+                self._prune()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _prune(self) -> None:
+        if self.ttl:
+            self.expirations += self._conn.execute(
+                "DELETE FROM responses WHERE stored_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+        excess = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY stored_at LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+
+
+class SharedCacheTier(SharedMapping):
+    """Second tier in a ``SharedStore``; same interface as ``SqliteCache``."""
+
+    def __init__(self, store: SharedStore, ttl: float = 3600):
+        super().__init__(store, "responses", ttl)
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        entry = super().get(key)
+        return tuple(entry) if entry is not None else None
+
+    def set(self, key: str, value: str) -> None:
+        super().set(key, [time.time(), value])
+
+
+class ResponseCache:
+    """
+    Two-tier response cache: an in-memory LRU in front of an optional sqlite or shared tier.
+
+    Args:
+        max_entries (int): In-memory LRU capacity
+        ttl (float): Seconds an entry stays valid in either tier, 0 for no expiry
+        db_path (str, optional): sqlite file for the persistent tier
+        shared (SharedStore, optional): Store for the second tier if there is no ``db_path``
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, db_path: Optional[str] = None,
+                 shared: Optional[SharedStore] = None):
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        if db_path:
+            self.disk = SqliteCache(db_path, ttl=ttl)
+        else:
+            self.disk = SharedCacheTier(shared, ttl=ttl) if shared is not None else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                stored_at, value = row
+                # Promote to memory, keeping the original age so the TTL still applies
+                self.memory.set(key, value, stored_at=stored_at)
+                with self._lock:
+                    self.disk_hits += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory": {
+                "entries": len(self.memory),
+                "max_entries": self.memory.max_entries,
+                "evictions": self.memory.evictions,
+                "expirations": self.memory.expirations,
+            },
+        }
+        if self.disk is not None:
+            stats["disk"] = {
+                "path": self.disk.path,
+                "entries": len(self.disk),
+                "hits": self.disk_hits,
+                "evictions": self.disk.evictions,
+                "expirations": self.disk.expirations,
+            }
+        return stats
+
+
+def cache_requested(flag: Any = None, cache_control: Optional[str] = None) -> bool:
+    """
+    Decide whether a request may use the response cache.
+
+    Args:
+        flag: The request's ``cache`` field; ``False`` or ``"false"`` bypasses the cache
+        cache_control (str, optional): The ``Cache-Control`` header; ``no-cache`` or ``no-store`` bypasses it
+    """
+    if flag is False or (isinstance(flag, str) and flag.strip().lower() in ("false", "0", "no")):
+        return False
+    directives = (cache_control or "").lower()
+    return "no-cache" not in directives and "no-store" not in directives
+
+
+def cache_from_env(shared: Optional[SharedStore] = None) -> ResponseCache:
+    """Build the response cache from RESPONSE_CACHE_* environment variables, backed by ``shared`` if given."""
+    return ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+        db_path=os.getenv("RESPONSE_CACHE_DB") or None,
+        shared=shared,
+    )
@@ -0,0 +1,257 @@
+"""
+Local retrieval over long text attachments.
+
+Instead of cutting a long log or source file to its first few hundred
+characters, the text is split into line-aligned chunks, indexed with BM25
+and only the chunks that best match the question are put in the prompt,
+within a token budget. The index is built with NumPy (no embeddings, no
+network) and cached by the SHA-256 of the text, so follow-up questions
+about the same file only pay for scoring.
+
+Configuration (environment variables):
+    RETRIEVAL_CHUNK_CHARS    characters per chunk (default 1000)
+    RETRIEVAL_TOP_K          chunks put in the prompt per attachment (default 5)
+    RETRIEVAL_TOKEN_BUDGET   tokens of excerpts per attachment (default 1500)
+    RETRIEVAL_MAX_BYTES      bytes of a text file that are indexed (default 20 MB)
+    RETRIEVAL_CACHE_SIZE     indexes kept in memory (default 16)
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+from response_cache import LRUCache
+from token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1000"))
+TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1500"))
+MAX_BYTES = int(os.getenv("RETRIEVAL_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Underscores split words so snake_case identifiers match the words in a question
+_TOKEN = re.compile(r"[^\W_]+")
+
+
+class TextChunk(NamedTuple):
+    first_line: int
+    last_line: int
+    text: str
+
+    @property
+    def label(self) -> str:
+        if self.first_line == self.last_line:
+            return f"line {self.first_line}"
+        return f"lines {self.first_line}-{self.last_line}"
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens; ``read_upload`` gives ``read`` and ``upload``."""
+    return _TOKEN.findall(text.lower())
+
+
+def split_lines(text: str, chunk_chars: int = CHUNK_CHARS) -> List[TextChunk]:
+    """Split text into chunks of about ``chunk_chars``, breaking at line ends where possible."""
+    chunks = []
+    parts: List[str] = []
+    size = 0
+    first = 1
+    for number, line in enumerate(text.splitlines(keepends=True), 1):
+        # Very long lines (minified files, one-line JSON) are cut on their own
+        while len(line) > chunk_chars:
+            if parts:
+                chunks.append(TextChunk(first, number - 1, "".join(parts)))
+                parts, size = [], 0
+            chunks.append(TextChunk(number, number, line[:chunk_chars]))
+            line = line[chunk_chars:]
+            first = number
+        if size + len(line) > chunk_chars and parts:
+            chunks.append(TextChunk(first, number - 1, "".join(parts)))
+            parts, size = [], 0
+        if not parts:
+            first = number
+        parts.append(line)
+        size += len(line)
+    if parts:
+        chunks.append(TextChunk(first, first + len(parts) - 1, "".join(parts)))
+    return [chunk for chunk in chunks if chunk.text.strip()]
+
+
+class ChunkIndex:
+    """
+    BM25 index over a list of chunks, stored as flat NumPy posting arrays.
+
+    Postings are sorted by term, so a query term's postings are one slice
+    and scoring a question is a handful of vectorized additions.
+
+    Args:
+        chunks (Sequence): Objects with a ``text`` attribute, e.g. ``TextChunk``
+        k1 (float): BM25 term-frequency saturation
+        b (float): BM25 length normalization
+    """
+
+    def __init__(self, chunks: Sequence, k1: float = 1.2, b: float = 0.75):
+        self.chunks = list(chunks)
+        count = len(self.chunks)
+        token_lists = [tokenize(chunk.text) for chunk in self.chunks]
+        self.vocabulary: Dict[str, int] = {}
+        vocabulary = self.vocabulary
+        term_ids = np.fromiter(
+            (vocabulary.setdefault(token, len(vocabulary)) for tokens in token_lists for token in tokens),
+            dtype=np.int64,
+        )
+        lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=count)
+        chunk_ids = np.repeat(np.arange(count, dtype=np.int64), lengths)
+
+        # One posting per distinct (term, chunk) pair, with its term frequency
+        pairs, frequencies = np.unique(term_ids * max(count, 1) + chunk_ids, return_counts=True)
+        posting_terms = pairs // max(count, 1)
+        self._posting_chunks = (pairs % max(count, 1)).astype(np.int32)
+        self._offsets = np.searchsorted(posting_terms, np.arange(len(vocabulary) + 1))
+
+        document_frequency = np.diff(self._offsets)
+        idf = np.log1p((count - document_frequency + 0.5) / (document_frequency + 0.5))
+        average_length = lengths.mean() if count else 0.0
+        norm = k1 * (1 - b + b * lengths / average_length) if average_length else np.full(count, k1)
+        # The whole BM25 term weight is precomputed per posting
+        self._weights = (idf[posting_terms] * frequencies * (k1 + 1)
+                         / (frequencies + norm[self._posting_chunks])).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk for ``query``."""
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            # Each chunk appears at most once per term, so plain fancy-index addition is safe
+            scores[self._posting_chunks[start:end]] += self._weights[start:end]
+        return scores
+
+    def search(self, query: str, top_k: int = TOP_K) -> List[int]:
+        """Indices of the best matching chunks, best first; chunks with no matching term are left out."""
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(scores[matched], -top_k)[-top_k:]]
+        return sorted(matched.tolist(), key=lambda i: (-scores[i], i))
+
+    def select(self, query: str, token_budget: int = TOKEN_BUDGET, top_k: int = TOP_K) -> List:
+        """
+        Chunks to put in the prompt for ``query``.
+
+        The best matches are taken until ``token_budget`` is used up and then
+        returned in document order. If nothing matches, the leading chunks are
+        used instead, which is what blind truncation would have sent.
+        """
+        ranked = self.search(query, top_k) or range(min(top_k, len(self.chunks)))
+        selected = []
+        used = 0
+        for i in ranked:
+            tokens = estimate_tokens(self.chunks[i].text)
+            if used + tokens > token_budget and selected:
+                continue
+            selected.append(i)
+            used += tokens
+        return [self.chunks[i] for i in sorted(selected)]
+
+
+class Retriever:
+    """
+    Builds and caches chunk indexes by content hash.
+
+    Args:
+        cache_size (int): Indexes kept in memory
+        chunk_chars (int): Characters per text chunk
+        top_k (int): Chunks selected per attachment
+        token_budget (int): Tokens of excerpts selected per attachment
+        max_bytes (int): Bytes of a text stream that are indexed
+    """
+
+    def __init__(self, cache_size: int = 16, chunk_chars: int = CHUNK_CHARS, top_k: int = TOP_K,
+                 token_budget: int = TOKEN_BUDGET, max_bytes: int = MAX_BYTES):
+        self.cache = LRUCache(max_entries=cache_size, ttl=0)
+        self.chunk_chars = chunk_chars
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.build_ms = 0.0
+        self.search_ms = 0.0
+
+    def index(self, source: Union[str, BinaryIO], digest: Optional[str] = None) -> ChunkIndex:
+        """
+        Return the index for a text, building it only on a cache miss.
+
+        Args:
+            source: The text, or a seekable binary stream of UTF-8 text that is
+                only read on a cache miss
+            digest (str, optional): SHA-256 of the content if already known
+        """
+        if digest is None:
+            if not isinstance(source, str):
+                raise ValueError("digest is required when indexing a stream")
+            digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        return self._cached(f"text:{digest}", lambda: split_lines(self._read(source), self.chunk_chars))
+
+    def index_chunks(self, key: str, chunks: Sequence) -> ChunkIndex:
+        """Return the index for chunks that are already split, e.g. extracted document pages."""
+        return self._cached(f"chunks:{key}", lambda: chunks)
+
+    def _read(self, source: Union[str, BinaryIO]) -> str:
+        if isinstance(source, str):
+            return source
+        source.seek(0)
+        return source.read(self.max_bytes).decode('utf-8', errors='ignore')
+
+    def _cached(self, key: str, load) -> ChunkIndex:
+        index = self.cache.get(key)
+        if index is not None:
+            with self._lock:
+                self.hits += 1
+            return index
+
+        start = time.perf_counter()
+        index = ChunkIndex(load())
+        elapsed = (time.perf_counter() - start) * 1000
+        self.cache.set(key, index)
+        with self._lock:
+            self.misses += 1
+            self.build_ms += elapsed
+        logger.info("Indexed %d chunk(s) for %s in %.1fms", len(index), key[:20], elapsed)
+        return index
+
+    def select(self, index: ChunkIndex, question: str, token_budget: Optional[int] = None) -> List:
+        """Top chunks of ``index`` for ``question`` within the token budget, in document order."""
+        start = time.perf_counter()
+        chunks = index.select(question, token_budget or self.token_budget, self.top_k)
+        with self._lock:
+            self.search_ms += (time.perf_counter() - start) * 1000
+        return chunks
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.cache),
+                "build_ms_total": round(self.build_ms, 3),
+                "search_ms_total": round(self.search_ms, 3),
+            }
+
+
+def retriever_from_env() -> Retriever:
+    """Build the retriever from RETRIEVAL_* environment variables."""
+    return Retriever(cache_size=int(os.getenv("RETRIEVAL_CACHE_SIZE", "16")))
@@ -0,0 +1,449 @@
+"""
+Semantic cache for paraphrased text-only questions.
+
+The response cache only helps when a question is asked again word for
+word (up to case and spacing). Users ask the same thing in many ways, for
+example "how do I reset my password", "reset my password" and "password
+reset steps". Each question is embedded locally: its content words,
+their character trigrams and its word bigrams are hashed into a small
+unit vector, with no model and no network. Words about the form of the
+answer ("steps", "explain") count as stopwords, and bigrams ignore word
+order, except around direction words. Negations, numbers and past or
+future tense words weigh more than other words. The nearest earlier
+question with the same model and prompt template is found by cosine
+similarity. Its answer is reused if the similarity is at least
+``SEMANTIC_CACHE_THRESHOLD`` and both questions have the same negations,
+numbers, tense words and direction ("USD to EUR" is not "EUR to USD").
+Questions that differ only in one of those words are otherwise nearly
+identical vectors, and a wrong cached answer is worse than a model call.
+A hit still needs nearly the same content words. An extra one ("delete
+my account permanently"), another form of one ("changing my email") or a
+synonym usually misses.
+
+Search is a NumPy brute force over all entries, about half a millisecond
+for ten thousand of them. From ``SEMANTIC_CACHE_ANN_MIN``
+entries the vectors are also clustered (spherical k-means), and a lookup
+only scans the ``SEMANTIC_CACHE_NPROBE`` clusters nearest the question.
+The cache holds at most ``SEMANTIC_CACHE_SIZE`` entries and evicts the
+least recently used. With ``SEMANTIC_CACHE_PATH`` it is saved to disk
+at most once a minute while entries are added, and at exit, and loaded at
+start-up.
+
+Configuration (environment variables):
+    SEMANTIC_CACHE_SIZE        entries kept; 0 (default) disables the semantic cache
+    SEMANTIC_CACHE_THRESHOLD   cosine similarity needed to reuse an answer (default 0.82)
+    SEMANTIC_CACHE_TTL         seconds an entry stays valid, 0 for no expiry (default 3600)
+    SEMANTIC_CACHE_PATH        .npz file the index is saved to and loaded from
+    SEMANTIC_CACHE_ANN_MIN     entries from which lookups scan only nearby clusters (default 100000)
+    SEMANTIC_CACHE_NPROBE      clusters scanned per lookup (default 16)
+"""
+import atexit
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import Counter, Histogram, registry
+from response_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = 256
+# Seconds between saves while entries are added; saving 100k entries takes a few seconds
+SAVE_INTERVAL = 60
+
+semantic_lookups = registry.register(Counter(
+    "chatbot_semantic_cache_lookups_total", "Semantic cache lookups by outcome.", ("outcome",)))
+semantic_lookup_seconds = registry.register(Histogram(
+    "chatbot_semantic_cache_lookup_seconds", "Time to embed a question and search the semantic cache.", ("index",)))
+
+_TOKEN = re.compile(r"[^\W_]+")
+_IRREGULAR_NEGATION = re.compile(r"\b(can|won|ain)['’]t\b")
+_EXPANSIONS = {"can": "can not", "won": "will not", "ain": "is not"}
+# "n't" is a negation; "'s" is dropped rather than guessed at ("what's", "user's")
+_CONTRACTION = re.compile(r"n['’]t\b|['’]s\b")
+# Words that change how a question is phrased, not what it asks. Present-tense auxiliaries
+# ("how do I", "what is") are among them; past and future ones are markers below. So are
+# words asking for a form of answer ("password reset steps", "explain photosynthesis").
+_STOPWORDS = frozenset(
+    "a an the i me my we our you your it its of in on for with and or as how what can could would should please "
+    "tell about this that there is are am be do does has have explain help steps step way ways instructions guide".split()
+)
+# Words that flip what a question asks while changing little else: negations and tense
+_MARKERS = frozenset("not no never nor none nothing cannot without was were did had been will".split())
+# Words whose object gives a question its direction, as in "USD to EUR"
+_DIRECTIONS = frozenset("to from into than vs versus".split())
+MARKER_WEIGHT = 2.0
+NUMBER_WEIGHT = 1.5
+DIRECTION_WEIGHT = 0.3
+TRIGRAM_WEIGHT = 0.7
+BIGRAM_WEIGHT = 0.7
+
+
+def _words(text: str) -> List[str]:
+    """A question's words with contractions expanded ("can't" -> "can not") and stopwords dropped."""
+    text = _IRREGULAR_NEGATION.sub(lambda m: _EXPANSIONS[m.group(1)], normalize_question(text))
+    text = _CONTRACTION.sub(lambda m: " not" if m.group(0).startswith("n") else "", text)
+    words = _TOKEN.findall(text)
+    return [word for word in words if word not in _STOPWORDS] or words
+
+
+def _features(words: List[str]) -> List[Tuple[str, float]]:
+    features = []
+    for word in words:
+        if word in _MARKERS:
+            features.append(("w:" + word, MARKER_WEIGHT))
+        elif word in _DIRECTIONS:
+            features.append(("w:" + word, DIRECTION_WEIGHT))
+        elif any(char.isdigit() for char in word):
+            # No trigrams, so "2023" and "2024" share nothing
+            features.append(("w:" + word, NUMBER_WEIGHT))
+        else:
+            features.append(("w:" + word, 1.0))
+            # Trigrams let "change"/"changing" and "work"/"works" overlap
+            padded = f"<{word}>"
+            grams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+            for gram in grams:
+                features.append(("c:" + gram, TRIGRAM_WEIGHT * len(grams) ** -0.5))
+    # "password reset" is "reset password", but bigrams with a direction word keep their order,
+    # so "usd to eur" and "eur to usd" differ
+    for pair in zip(words, words[1:]):
+        if pair[0] not in _DIRECTIONS and pair[1] not in _DIRECTIONS:
+            pair = tuple(sorted(pair))
+        features.append(("b:" + " ".join(pair), BIGRAM_WEIGHT))
+    return features
+
+
+def _markers(words: List[str]) -> Tuple[List[str], Dict[str, List[str]]]:
+    """The negations, tense words and numbers of a question, and what each direction word points at."""
+    markers = sorted(word for word in words if word in _MARKERS or any(char.isdigit() for char in word))
+    directions: Dict[str, List[str]] = {}
+    for word, target in zip(words, words[1:]):
+        if word in _DIRECTIONS:
+            directions.setdefault(word, []).append(target)
+    return markers, directions
+
+
+def same_markers(question: str, other: str) -> bool:
+    """
+    Whether two questions agree on negations, tense words, numbers and direction.
+
+    Direction words are only compared when both questions use them, so
+    "export my data to CSV" still matches "export data as CSV".
+    """
+    (markers, directions), (other_markers, other_directions) = _markers(_words(question)), _markers(_words(other))
+    if markers != other_markers:
+        return False
+    return all(directions[word] == other_directions[word] for word in directions.keys() & other_directions.keys())
+
+
+def embed(text: str, dimensions: int = DIMENSIONS) -> np.ndarray:
+    """
+    Hashed n-gram embedding of a question.
+
+    Args:
+        text (str): The question
+        dimensions (int): Length of the vector
+
+    Returns:
+        Unit float32 vector, or zeros if the text has no words. Hashes are
+        CRC32 rather than ``hash()``, so vectors are the same in every process.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, weight in _features(_words(text)):
+        hashed = zlib.crc32(feature.encode("utf-8"))
+        # The sign bit keeps colliding features from always adding up
+        vector[hashed % dimensions] += weight if hashed & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _cluster(sample: np.ndarray, clusters: int, iterations: int = 8, seed: int = 0) -> np.ndarray:
+    """Spherical k-means: unit centroids of ``sample``'s rows."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids).astype(np.float32)
+    return centroids
+
+
+class SemanticCache:
+    """
+    Answers of earlier questions, found again by the similarity of new ones.
+
+    Args:
+        max_entries (int): Entries kept before the least recently used is evicted
+        threshold (float): Cosine similarity at which an earlier answer is reused
+        ttl (float): Seconds an entry stays valid, 0 for no expiry
+        path (str, optional): .npz file the index is loaded from and saved to
+        ann_min_entries (int): Entries from which lookups scan only the nearest clusters
+        nprobe (int): Clusters scanned per lookup once clustered
+        dimensions (int): Embedding length
+    """
+
+    def __init__(self, max_entries: int = 10_000, threshold: float = 0.82, ttl: float = 3600, path: Optional[str] = None,
+                 ann_min_entries: int = 100_000, nprobe: int = 16, dimensions: int = DIMENSIONS):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.path = path
+        self.ann_min_entries = ann_min_entries
+        self.nprobe = nprobe
+        self.dimensions = dimensions
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._size = 0
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._scopes = np.zeros(0, dtype=np.int32)
+        self._stored_at = np.zeros(0, dtype=np.float64)
+        self._used_at = np.zeros(0, dtype=np.float64)
+        self._questions: List[str] = []
+        self._answers: List[str] = []
+        self._scope_ids: Dict[str, int] = {}
+        # Clusters, once there are ann_min_entries entries
+        self._centroids: Optional[np.ndarray] = None
+        self._clusters = np.zeros(0, dtype=np.int32)
+        self._clustered_at = 0
+        self._saved_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.saves = 0
+        if path and os.path.exists(path):
+            self._load(path)
+
+    def lookup(self, question: str, scope: str) -> Optional[str]:
+        """
+        Find the answer to a question similar enough to ``question``.
+
+        Args:
+            question (str): The new question
+            scope (str): What else the answer depends on (model, prompt template);
+                only entries added with the same scope match
+
+        Returns:
+            The earlier answer, or None.
+        """
+        start = time.perf_counter()
+        vector = embed(question, self.dimensions)
+        with self._lock:
+            index = "ann" if self._centroids is not None else "exact"
+            slot, similarity = self._nearest(vector, self._scope_ids.get(scope))
+            outcome, answer = "miss", None
+            if slot is not None and similarity >= self.threshold and not same_markers(question, self._questions[slot]):
+                outcome = "mismatch"
+            elif slot is not None and similarity >= self.threshold:
+                now = time.time()
+                if self.ttl and now - self._stored_at[slot] > self.ttl:
+                    self._forget(slot)
+                    self.expirations += 1
+                    outcome = "expired"
+                else:
+                    self._used_at[slot] = now
+                    outcome, answer = "hit", self._answers[slot]
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        semantic_lookups.inc(1, outcome)
+        semantic_lookup_seconds.observe(time.perf_counter() - start, index)
+        return answer
+
+    def add(self, question: str, scope: str, answer: str) -> None:
+        """Remember ``answer`` for ``question``; a question already in the cache has its answer replaced."""
+        vector = embed(question, self.dimensions)
+        if not vector.any():
+            return
+        with self._lock:
+            scope_id = self._scope_ids.setdefault(scope, len(self._scope_ids))
+            slot, similarity = self._nearest(vector, scope_id)
+            if slot is None or similarity < 0.999:
+                slot = self._free_slot()
+            now = time.time()
+            self._vectors[slot] = vector
+            self._scopes[slot] = scope_id
+            self._stored_at[slot] = self._used_at[slot] = now
+            self._questions[slot] = question
+            self._answers[slot] = answer
+            if self._centroids is not None:
+                self._clusters[slot] = int(np.argmax(self._centroids @ vector))
+            self._maybe_cluster()
+            due = self.path and time.monotonic() - self._saved_at >= SAVE_INTERVAL and not self._save_lock.locked()
+            if due:
+                self._saved_at = time.monotonic()
+        if due:
+            threading.Thread(target=self.save, name="semantic-cache-save", daemon=True).start()
+
+    def save(self) -> bool:
+        """Write the index to ``path`` (atomically); returns whether there was anything to write."""
+        if not self.path:
+            return False
+        with self._save_lock:
+            with self._lock:
+                size = self._size
+                arrays = {
+                    "vectors": self._vectors[:size].copy(),
+                    "scopes": self._scopes[:size].copy(),
+                    "stored_at": self._stored_at[:size].copy(),
+                    "used_at": self._used_at[:size].copy(),
+                }
+                meta = {"dimensions": self.dimensions, "scopes": sorted(self._scope_ids, key=self._scope_ids.get),
+                        "questions": self._questions[:size], "answers": self._answers[:size]}
+            arrays["meta"] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **arrays)
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(buffer.getvalue())
+            os.replace(temporary, self.path)
+            self.saves += 1
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            self._centroids = None
+            self._clustered_at = 0
+            self._scope_ids.clear()
+            del self._questions[:], self._answers[:]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": self._size,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "index": "ann" if self._centroids is not None else "exact",
+            "clusters": 0 if self._centroids is None else len(self._centroids),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "saves": self.saves,
+            "path": self.path,
+        }
+
+    def _nearest(self, vector: np.ndarray, scope_id: Optional[int]) -> Tuple[Optional[int], float]:
+        """The most similar entry in ``scope_id`` and its similarity; callers hold the lock."""
+        if scope_id is None or not self._size or not vector.any():
+            return None, 0.0
+        if self._centroids is None:
+            # Slices are views; indexing with every row would copy the whole matrix
+            scores = np.where(self._scopes[:self._size] == scope_id, self._vectors[:self._size] @ vector, -1.0)
+            best = int(np.argmax(scores))
+            return (best, float(scores[best])) if scores[best] >= 0 else (None, 0.0)
+        probes = min(self.nprobe, len(self._centroids))
+        nearest = np.argpartition(self._centroids @ vector, -probes)[-probes:]
+        rows = np.flatnonzero(np.isin(self._clusters[:self._size], nearest))
+        if not len(rows):
+            return None, 0.0
+        scores = np.where(self._scopes[rows] == scope_id, self._vectors[rows] @ vector, -1.0)
+        best = int(np.argmax(scores))
+        return (int(rows[best]), float(scores[best])) if scores[best] >= 0 else (None, 0.0)
+
+    def _free_slot(self) -> int:
+        """A slot for a new entry: the next unused one, or the least recently used once full."""
+        if self._size < self.max_entries:
+            if self._size == len(self._vectors):
+                self._grow(min(self.max_entries, max(64, 2 * len(self._vectors))))
+            self._questions.append("")
+            self._answers.append("")
+            self._size += 1
+            return self._size - 1
+        self.evictions += 1
+        return int(np.argmin(self._used_at[:self._size]))
+
+    def _grow(self, capacity: int) -> None:
+        extra = capacity - len(self._vectors)
+        self._vectors = np.concatenate([self._vectors, np.zeros((extra, self.dimensions), dtype=np.float32)])
+        self._scopes = np.concatenate([self._scopes, np.full(extra, -1, dtype=np.int32)])
+        self._stored_at = np.concatenate([self._stored_at, np.zeros(extra)])
+        self._used_at = np.concatenate([self._used_at, np.zeros(extra)])
+        self._clusters = np.concatenate([self._clusters, np.zeros(extra, dtype=np.int32)])
+
+    def _forget(self, slot: int) -> None:
+        """Make an expired entry unmatchable and the first to be evicted."""
+        self._scopes[slot] = -1
+        self._used_at[slot] = 0.0
+
+    def _maybe_cluster(self) -> None:
+        """Cluster the vectors on reaching ann_min_entries, and again each time the cache doubles since."""
+        if self._size < self.ann_min_entries or self._size < 2 * self._clustered_at:
+            return
+        start = time.perf_counter()
+        vectors = self._vectors[:self._size]
+        clusters = max(1, int(self._size ** 0.5))
+        rng = np.random.default_rng(self._size)
+        sample = vectors[rng.choice(self._size, min(self._size, 64 * clusters), replace=False)]
+        centroids = _cluster(sample, clusters)
+        for begin in range(0, self._size, 16_384):
+            end = min(begin + 16_384, self._size)
+            self._clusters[begin:end] = np.argmax(vectors[begin:end] @ centroids.T, axis=1)
+        self._centroids, self._clustered_at = centroids, self._size
+        logger.info("Clustered %d semantic cache entries into %d clusters in %.0f ms",
+                    self._size, clusters, (time.perf_counter() - start) * 1000)
+
+    def _load(self, path: str) -> None:
+        try:
+            with np.load(path) as data:
+                meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+                if meta["dimensions"] != self.dimensions:
+                    logger.warning("Ignoring semantic cache %s: built with %d dimensions, not %d",
+                                   path, meta["dimensions"], self.dimensions)
+                    return
+                vectors, scopes = data["vectors"], data["scopes"]
+                stored_at, used_at = data["stored_at"], data["used_at"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not load semantic cache %s: %s", path, e)
+            return
+        keep = scopes >= 0
+        if self.ttl:
+            keep &= time.time() - stored_at <= self.ttl
+        # Most recently used first, so a smaller max_entries keeps the useful ones
+        rows = np.flatnonzero(keep)
+        rows = rows[np.argsort(-used_at[rows], kind="stable")][:self.max_entries]
+        self._grow(max(64, len(rows)))
+        size = len(rows)
+        self._vectors[:size], self._scopes[:size] = vectors[rows], scopes[rows]
+        self._stored_at[:size], self._used_at[:size] = stored_at[rows], used_at[rows]
+        self._questions = [meta["questions"][row] for row in rows]
+        self._answers = [meta["answers"][row] for row in rows]
+        self._scope_ids = {scope: i for i, scope in enumerate(meta["scopes"])}
+        self._size = size
+        self._maybe_cluster()
+        logger.info("Loaded %d semantic cache entries from %s", size, path)
+
+
+def semantic_cache_from_env() -> Optional[SemanticCache]:
+    """Build the semantic cache from SEMANTIC_CACHE_* environment variables; None unless SEMANTIC_CACHE_SIZE is set."""
+    max_entries = int(os.getenv("SEMANTIC_CACHE_SIZE", "0"))
+    if max_entries <= 0:
+        return None
+    cache = SemanticCache(
+        max_entries=max_entries,
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.82")),
+        ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+        path=os.getenv("SEMANTIC_CACHE_PATH") or None,
+        ann_min_entries=int(os.getenv("SEMANTIC_CACHE_ANN_MIN", "100000")),
+        nprobe=int(os.getenv("SEMANTIC_CACHE_NPROBE", "16")),
+    )
+    if cache.path:
+        atexit.register(cache.save)
+    return cache
@@ -0,0 +1,378 @@
+"""
+Production launcher: pre-forked worker processes on one listening socket.
+
+``python api.py`` runs one development server process. ``serve.py``
+binds the port once and forks ``WORKERS`` processes that accept
+connections on it. Each worker then serves the Flask app (Werkzeug's
+threaded server) or the ASGI app (uvicorn). The master itself serves
+nothing. It imports the heavy third-party modules before forking, so the
+workers share those pages. It then watches the workers:
+
+- Each worker imports the app after the fork, so its model clients,
+  threads and sqlite connections are its own. It warms up
+  (``WARMUP=blocking``) before it reports ready, so it does not get
+  traffic while it is still cold.
+- A worker that dies is replaced. A worker that fails before it is ready
+  (the app does not import, say) stops the server instead, rather than
+  being forked again and again. When a new worker takes longer than
+  ``READY_TIMEOUT`` to become ready, it is stopped and replaced.
+- ``SIGTERM`` or ``SIGINT`` drains every worker. They stop accepting,
+  finish the requests in flight and exit; workers still busy after
+  ``GRACEFUL_TIMEOUT`` are killed.
+- ``SIGHUP`` reloads the workers one at a time. A new worker starts and
+  warms up, then the old one drains, so capacity never drops. The new
+  workers import the app code afresh, so a reload deploys code changes,
+  except to the preloaded third-party modules. If a new worker fails or
+  does not become ready in time, the reload stops and the old workers
+  keep serving. The master keeps replacing dead workers and killing ones
+  that drain too slowly while a reload is under way.
+
+Caches and sessions are per process unless ``SHARED_STATE`` is set, so
+serve.py sets it to sqlite when there is more than one worker (see
+shared_state.py). It also exports ``WORKERS``, and upstream.py divides
+the LLM rate limit between the workers. The semantic cache, in-flight
+request coalescing and ``/api/metrics`` stay per worker.
+
+Configuration (environment variables, or the matching flags):
+    WORKERS            worker processes (default: one per CPU)
+    SERVER             flask (default) or asgi
+    HOST               address to bind (default 127.0.0.1)
+    PORT               port to bind (default 4000)
+    GRACEFUL_TIMEOUT   seconds a draining worker may take before it is killed (default 30)
+    READY_TIMEOUT      seconds a new worker may take to warm up (default 120)
+    KEEPALIVE_TIMEOUT  seconds an idle keep-alive connection stays open, flask only (default 5)
+    LOG_LEVEL          level of the log on stderr (default INFO, which logs a line per model call)
+
+Usage:
+    python serve.py --workers 4 --server flask --port 4000
+    kill -HUP <master pid>    # rolling reload
+    kill -TERM <master pid>   # drain and stop
+"""
+import argparse
+import atexit
+import importlib
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger("serve")
+
+# Imported by the master so the workers share them; the app's own modules are imported by each worker
+PRELOAD = ("langchain_core.messages", "langchain_core.runnables", "langchain_google_genai", "numpy", "orjson")
+# Exit code of a worker that failed before it was ready; the master stops rather than respawn it forever
+BOOT_ERROR = 3
+
+
+def _flask_worker(master: "Master", ready: Callable[[], None]) -> None:
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from api import app
+
+    class Handler(WSGIRequestHandler):
+        # Idle keep-alive connections are closed after this, so draining does not wait on them
+        timeout = master.keepalive_timeout
+
+        def log_error(self, format, *args):
+            if not format.startswith("Request timed out"):
+                super().log_error(format, *args)
+
+    host, port = master.sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, request_handler=Handler, fd=master.sock.fileno())
+    # Request threads are joined by server_close(), so requests in flight finish before the worker exits
+    server.daemon_threads = False
+    server.block_on_close = True
+    # Every worker wakes up for a new connection but only one accepts it; the others must not block in accept(),
+    # where they would miss the shutdown
+    server.socket.setblocking(False)
+
+    def drain(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot run in the thread serving
+        threading.Thread(target=server.shutdown, name="drain").start()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+    ready()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _asgi_worker(master: "Master", ready: Callable[[], None]) -> None:
+    import uvicorn
+
+    from asgi_api import app
+
+    class Server(uvicorn.Server):
+        async def startup(self, sockets=None):
+            # Runs the lifespan, i.e. the warm-up, before it listens
+            await super().startup(sockets)
+            ready()
+
+    # uvicorn drains on SIGTERM and SIGINT itself
+    Server(uvicorn.Config(app, log_level="warning", timeout_graceful_shutdown=master.graceful_timeout)).run(sockets=[master.sock])
+
+
+# Serve the app in a forked worker: given the master and a callback to run once the app is ready for traffic
+SERVERS: Dict[str, Callable[["Master", Callable[[], None]], None]] = {"flask": _flask_worker, "asgi": _asgi_worker}
+
+
+class Master:
+    """
+    Forks the workers, keeps their number up and drains them on reload and stop.
+
+    Args:
+        sock (socket.socket): Listening socket the workers accept on
+        server (str): "flask" or "asgi", a key of ``SERVERS``
+        workers (int): Worker processes
+        graceful_timeout (float): Seconds a draining worker may take before it is killed
+        ready_timeout (float): Seconds a new worker may take to report ready
+        keepalive_timeout (float): Idle keep-alive timeout of the Flask workers
+        worker_init (Callable): Run in each worker after the fork, before the app is imported
+    """
+
+    def __init__(self, sock: socket.socket, server: str = "flask", workers: int = 1, graceful_timeout: float = 30,
+                 ready_timeout: float = 120, keepalive_timeout: float = 5, worker_init: Optional[Callable[[], None]] = None):
+        if server not in SERVERS:
+            raise ValueError(f"server must be one of {', '.join(SERVERS)}, not {server!r}")
+        self.sock = sock
+        self.server = server
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.ready_timeout = ready_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.worker_init = worker_init
+        # pid -> read end of the pipe the worker reports ready on
+        self.pids: Dict[int, int] = {}
+        # pid -> time by which a starting worker must be ready
+        self.starting: Dict[int, float] = {}
+        self.ready: Set[int] = set()
+        # pid -> time by which a draining worker is killed
+        self.draining: Dict[int, float] = {}
+        # Old workers a reload has yet to replace (None when no reload is under way), and the new worker starting for the first
+        self.to_replace: Optional[List[int]] = None
+        self.replacement: Optional[int] = None
+        self.stopping = False
+        self.reloading = False
+        # Set in a worker once it has reported ready
+        self.booted = False
+
+    def _worker(self, ready_fd: int) -> None:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+
+        def ready():
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
+            self.booted = True
+
+        try:
+            if self.worker_init is not None:
+                self.worker_init()
+            SERVERS[self.server](self, ready)
+        finally:
+            # Turns still queued for the audit log are written before the worker exits
+            audit_log = getattr(sys.modules.get("chatbot"), "audit_log", None)
+            if audit_log is not None:
+                audit_log.close()
+
+    def spawn(self) -> int:
+        """Fork a worker; returns its pid without waiting for it to be ready."""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 0
+            try:
+                self._worker(write_fd)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+                # Only a worker that never got ready is a boot error; one that crashes later is replaced
+                code = 1 if self.booted else BOOT_ERROR
+            finally:
+                # The worker's exit handlers (e.g. saving the semantic cache) run; the master's stack does not unwind
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(write_fd)
+        self.pids[pid] = read_fd
+        self.starting[pid] = time.monotonic() + self.ready_timeout
+        return pid
+
+    def _poll_ready(self, timeout: float) -> None:
+        """Wait up to ``timeout`` seconds for starting workers to report ready, and stop those that are too late."""
+        fds = {self.pids[pid]: pid for pid in self.starting}
+        if not fds:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(fds), [], [], timeout)
+        for fd in readable:
+            pid = fds[fd]
+            del self.starting[pid]
+            # An empty read means the worker exited before it was ready; _reap() deals with that
+            if os.read(fd, 1) == b"1":
+                self.ready.add(pid)
+                logger.info("Worker %d ready", pid)
+        now = time.monotonic()
+        for pid, deadline in list(self.starting.items()):
+            if now > deadline:
+                logger.error("Worker %d was not ready after %g s; stopping it", pid, self.ready_timeout)
+                self.drain(pid)
+
+    def drain(self, pid: int) -> None:
+        if pid in self.pids and pid not in self.draining:
+            self.starting.pop(pid, None)
+            self.draining[pid] = time.monotonic() + self.graceful_timeout
+            self._kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def _kill(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            read_fd = self.pids.pop(pid, None)
+            if read_fd is not None:
+                os.close(read_fd)
+            self.starting.pop(pid, None)
+            self.ready.discard(pid)
+            if self.draining.pop(pid, None) is None and not self.stopping:
+                code = os.waitstatus_to_exitcode(status)
+                if pid == self.replacement:
+                    # _step_reload() gives up on the reload; the old workers keep serving
+                    logger.error("New worker %d exited with %d", pid, code)
+                elif code == BOOT_ERROR:
+                    logger.error("Worker %d could not start the app; stopping", pid)
+                    self.stop()
+                else:
+                    logger.warning("Worker %d exited with %d; replacing it", pid, code)
+
+    def reload(self) -> None:
+        """Start replacing the workers one by one; ``run()`` drains each old worker once its replacement is ready."""
+        self.to_replace = [pid for pid in self.pids if pid not in self.draining and pid != self.replacement]
+        logger.info("Reloading %d workers", len(self.to_replace))
+
+    def _step_reload(self) -> None:
+        """Move a reload on: drain an old worker whose replacement is ready, then start the next replacement."""
+        if self.to_replace is None:
+            return
+        self.to_replace = [pid for pid in self.to_replace if pid in self.pids and pid not in self.draining]
+        new = self.replacement
+        if new is not None:
+            if new in self.ready:
+                self.replacement = None
+                # Without an old worker left (it died and was replaced meanwhile), the new one is one too many
+                self.drain(self.to_replace.pop(0) if self.to_replace else new)
+            elif new not in self.pids or new in self.draining:
+                logger.error("New worker %d did not become ready; keeping the old workers", new)
+                self.to_replace = self.replacement = None
+                return
+            else:
+                return
+        if self.to_replace:
+            self.replacement = self.spawn()
+        else:
+            logger.info("Reloaded %d workers", self.workers)
+            self.to_replace = None
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.to_replace = self.replacement = None
+        for pid in list(self.pids):
+            self.drain(pid)
+
+    def run(self) -> None:
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        def on_reload(signum, frame):
+            self.reloading = True
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+
+        logger.info("Starting %d %s workers on %s", self.workers, self.server, self.sock.getsockname())
+        for _ in range(self.workers):
+            self.spawn()
+        # Every step is short, so signals, dead workers and drain deadlines are seen to within 0.1 s, even mid-reload
+        while self.pids:
+            if self.stopping:
+                self.stop()
+            elif self.reloading:
+                self.reloading = False
+                self.reload()
+            self._poll_ready(0.1)
+            self._reap()
+            self._step_reload()
+            if not self.stopping:
+                for _ in range(self.workers - (len(self.pids) - len(self.draining))):
+                    self.spawn()
+            now = time.monotonic()
+            for pid, deadline in list(self.draining.items()):
+                if now > deadline:
+                    logger.warning("Worker %d did not drain in %g s; killing it", pid, self.graceful_timeout)
+                    self._kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+
+def preload(modules=PRELOAD) -> None:
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def bind(host: str, port: int) -> socket.socket:
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET, backlog=2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def main(worker_init: Optional[Callable[[], None]] = None, argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["flask", "asgi"], default=os.getenv("SERVER", "flask"))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "0")) or os.cpu_count() or 1)
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "4000")))
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("GRACEFUL_TIMEOUT", "30")))
+    parser.add_argument("--ready-timeout", type=float, default=float(os.getenv("READY_TIMEOUT", "120")))
+    parser.add_argument("--keepalive-timeout", type=float, default=float(os.getenv("KEEPALIVE_TIMEOUT", "5")))
+    parser.add_argument("--no-preload", action="store_true", help="import nothing before forking")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+    # Read by the workers after the fork: upstream.py splits the rate limit, shared_state.py picks the backend
+    # and names its default file after the port
+    os.environ["WORKERS"] = str(args.workers)
+    os.environ["PORT"] = str(args.port)
+    if args.workers > 1:
+        os.environ.setdefault("SHARED_STATE", "sqlite")
+    os.environ.setdefault("WARMUP", "blocking")
+    if not args.no_preload:
+        preload()
+    Master(bind(args.host, args.port), args.server, args.workers, args.graceful_timeout, args.ready_timeout,
+           args.keepalive_timeout, worker_init).run()
+
+
+if __name__ == "__main__":
+    main()
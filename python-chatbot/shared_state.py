@@ -0,0 +1,339 @@
+"""
+State shared between worker processes.
+
+Each worker process (see serve.py) has its own memory. Without a shared
+backend, things one worker stores are invisible to the others:
+
+- a cached answer;
+- a conversation's history, so a follow-up routed to another worker
+  loses its context;
+- a stored idempotent reply;
+- the audio of a spoken sentence.
+
+These components also write through a ``SharedStore`` when one is
+configured. It is a small key-value interface: bytes values in
+namespaces, with a TTL per entry. Each worker keeps its in-memory tier,
+so the shared store is only read on a local miss.
+
+Backends (``SHARED_STATE``):
+    sqlite     One sqlite file in WAL mode that every worker on the host opens.
+               It lives on ``/dev/shm`` by default, i.e. in shared memory. No
+               server is needed. The file is created readable by its owner
+               only (mode 0600), and one owned by another user is refused.
+    redis://…  A Redis server (``pip install redis``), for workers on several
+               hosts. ``RedisStore`` takes any client with Redis' ``get``,
+               ``set(px=…)``, ``delete`` and ``scan_iter``.
+    memory     A dictionary in this process, for tests and single-process use.
+
+Configuration (environment variables):
+    SHARED_STATE              off (default), sqlite, memory or a redis:// URL;
+                              serve.py uses sqlite when it runs more than one worker
+    SHARED_STATE_PATH         sqlite file (default: on /dev/shm, else in the temp directory, named after
+                              the user id, the app directory and PORT, so deployments do not share it)
+    SHARED_STATE_MAX_ENTRIES  sqlite entries kept per namespace before the oldest are pruned (default 100000)
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from json_codec import dumps, loads
+
+
+class SharedStore:
+    """
+    Interface of a shared key-value backend.
+
+    Values are bytes. A ``ttl`` of 0 means the entry does not expire; the
+    backend may still evict it to bound its size. Implementations must be
+    safe to use from several threads and several processes.
+    """
+
+    name = "abstract"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float = 0) -> None:
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> bool:
+        """Remove an entry; returns whether it existed."""
+        raise NotImplementedError
+
+    def count(self, namespace: str) -> int:
+        """Live entries in ``namespace``; may be slow, it is only used for stats."""
+        raise NotImplementedError
+
+    def clear(self, namespace: str) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        return {"backend": self.name}
+
+
+class MemoryStore(SharedStore):
+    """``SharedStore`` in this process's memory; shared between threads, not processes."""
+
+    name = "memory"
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], Tuple[float, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            if entry[0] and entry[0] < time.time():
+                del self._entries[(namespace, key)]
+                return None
+            return entry[1]
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float = 0) -> None:
+        with self._lock:
+            self._entries[(namespace, key)] = (time.time() + ttl if ttl else 0, value)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            return self._entries.pop((namespace, key), None) is not None
+
+    def count(self, namespace: str) -> int:
+        now = time.time()
+        with self._lock:
+            return sum(1 for (ns, _), (expires_at, _) in self._entries.items()
+                       if ns == namespace and not (expires_at and expires_at < now))
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            for entry in [entry for entry in self._entries if entry[0] == namespace]:
+                del self._entries[entry]
+
+
+def _create_private(path: str) -> None:
+    """
+    Create ``path`` readable and writable by this user only, before sqlite opens it.
+
+    sqlite gives the -wal and -shm files the database's permissions. A file
+    another user created first (the default path is in a world-writable
+    directory) is refused rather than written to.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    try:
+        info = os.fstat(fd)
+        if hasattr(os, "getuid") and info.st_uid != os.getuid():
+            raise PermissionError(f"Shared state file {path} belongs to another user")
+        if info.st_mode & 0o077:
+            os.fchmod(fd, 0o600)
+    finally:
+        os.close(fd)
+
+
+class SqliteStore(SharedStore):
+    """
+    ``SharedStore`` in a sqlite file that every worker process opens.
+
+    Each process opens its own connection, also after a fork. Expired
+    entries are pruned every 1000 writes, together with the oldest entries
+    of any namespace over ``max_entries``.
+
+    Args:
+        path (str): Database file, created with mode 0600 if missing; put it on ``/dev/shm`` to keep it in memory
+        max_entries (int): Entries kept per namespace
+
+    Raises:
+        PermissionError: If the file belongs to another user
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self.evictions = 0
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not cross a fork; the child opens its own
+        if self._pid != os.getpid():
+            _create_private(self.path)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last writes in a power cut is fine for caches and sessions
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+                "stored_at REAL NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS state_stored_at ON state (namespace, stored_at)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at = 0 OR expires_at > ?)",
+                (namespace, key, time.time())
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float = 0) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO state (namespace, key, value, stored_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                         (namespace, key, value, now, now + ttl if ttl else 0))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._prune(conn, now)
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM state WHERE expires_at != 0 AND expires_at < ?", (now,))
+        for namespace, count in conn.execute("SELECT namespace, COUNT(*) FROM state GROUP BY namespace").fetchall():
+            if count > self.max_entries:
+                self.evictions += conn.execute(
+                    "DELETE FROM state WHERE namespace = ? AND key IN "
+                    "(SELECT key FROM state WHERE namespace = ? ORDER BY stored_at LIMIT ?)",
+                    (namespace, namespace, count - self.max_entries)
+                ).rowcount
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            return self._connection().execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)).rowcount > 0
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM state WHERE namespace = ? AND (expires_at = 0 OR expires_at > ?)", (namespace, time.time())
+            ).fetchone()[0]
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+
+    def stats(self) -> Dict:
+        return {"backend": self.name, "path": self.path, "evictions": self.evictions}
+
+
+class RedisStore(SharedStore):
+    """
+    ``SharedStore`` on a Redis server, or anything that speaks its commands.
+
+    Entries live under ``<prefix><namespace>:<key>``. Redis expires them
+    itself, and its ``maxmemory-policy`` bounds their number.
+
+    Args:
+        client: A ``redis.Redis`` (or compatible) client
+        prefix (str): Prefix of every key, so one server can hold several deployments
+    """
+
+    name = "redis"
+
+    def __init__(self, client: Any, prefix: str = "chatbot:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self.client.get(self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float = 0) -> None:
+        self.client.set(self._key(namespace, key), value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return self.client.delete(self._key(namespace, key)) > 0
+
+    def count(self, namespace: str) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=self._key(namespace, "*"), count=1000))
+
+    def clear(self, namespace: str) -> None:
+        keys = list(self.client.scan_iter(match=self._key(namespace, "*"), count=1000))
+        for i in range(0, len(keys), 1000):
+            self.client.delete(*keys[i:i + 1000])
+
+    def stats(self) -> Dict:
+        return {"backend": self.name, "prefix": self.prefix}
+
+
+class SharedMapping:
+    """
+    One namespace of a ``SharedStore``, used like ``LRUCache`` (``get``, ``set``, ``clear``, ``len``).
+
+    Args:
+        store (SharedStore): Backend
+        namespace (str): Namespace of the entries
+        ttl (float): Seconds an entry stays valid, 0 for no expiry
+        encode, decode: Convert values to and from bytes; JSON by default, ``None`` for bytes values
+    """
+
+    def __init__(self, store: SharedStore, namespace: str, ttl: float = 0,
+                 encode: Optional[Callable[[Any], bytes]] = dumps, decode: Optional[Callable[[bytes], Any]] = loads):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self.path = getattr(store, "path", store.name)
+        # Kept for the stats of the tiers this replaces; the backend evicts on its own
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.store.get(self.namespace, key)
+        if value is None or self.decode is None:
+            return value
+        return self.decode(value)
+
+    def set(self, key: str, value: Any) -> None:
+        self.store.set(self.namespace, key, self.encode(value) if self.encode is not None else value, self.ttl)
+
+    def delete(self, key: str) -> bool:
+        return self.store.delete(self.namespace, key)
+
+    def clear(self) -> None:
+        self.store.clear(self.namespace)
+
+    def __len__(self) -> int:
+        return self.store.count(self.namespace)
+
+
+def default_path() -> str:
+    """
+    The sqlite file of this deployment: on ``/dev/shm`` if there is one, else in the temp directory.
+
+    The name holds the user id and a digest of the app directory and ``PORT``
+    (which serve.py exports), so two checkouts, two instances on different
+    ports or two users on one host each get their own file.
+    """
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    deployment = f"{os.path.dirname(os.path.abspath(__file__))}:{os.getenv('PORT', '')}"
+    digest = hashlib.sha256(deployment.encode("utf-8")).hexdigest()[:16]
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(directory, f"chatbot-state-{uid}-{digest}.db")
+
+
+def shared_store_from_env() -> Optional[SharedStore]:
+    """Build the shared store from SHARED_STATE* environment variables; None if ``SHARED_STATE`` is off."""
+    backend = os.getenv("SHARED_STATE", "off").strip()
+    if backend.lower() in ("", "off"):
+        return None
+    if backend.lower() == "memory":
+        return MemoryStore()
+    if backend.lower() == "sqlite":
+        return SqliteStore(os.getenv("SHARED_STATE_PATH") or default_path(),
+                           max_entries=int(os.getenv("SHARED_STATE_MAX_ENTRIES", "100000")))
+    if backend.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+
+        return RedisStore(redis.Redis.from_url(backend))
+    raise ValueError(f"Unknown SHARED_STATE {backend!r}; expected off, sqlite, memory or a redis:// URL")
@@ -0,0 +1,517 @@
+"""
+Server-side text-to-speech for voice replies.
+
+Until now the browser synthesized voice replies itself, after the whole
+answer had arrived. That is slow on low-end clients, and the same answer
+was synthesized again every time. With ``TTS_ENGINE`` set, answers are
+split into sentences as they stream and each sentence is synthesized by
+a local, offline engine on a small thread pool. The first sentence can
+play while the model is still writing the rest.
+
+Each sentence's WAV audio is cached by a hash of its text and the voice
+settings, so a repeated sentence (greetings, cached answers) is never
+synthesized twice. Clients get audio in one of these ways:
+
+- ``"speech": true`` on ``/api/chat`` adds an ``audio`` list of
+  ``{text, url}`` clips to the reply.
+- ``"speech": true`` on ``/api/chat/stream`` adds an ``event: audio``
+  frame per sentence.
+- ``/api/chat/speech`` takes the same body and streams one WAV file,
+  sentence by sentence, as it is synthesized.
+
+A clip's ``/api/audio/<key>`` URL waits for its synthesis if needed. The
+URL never changes meaning, so browsers may cache it indefinitely. With
+several worker processes, synthesized audio is also kept in the shared
+store for ``AUDIO_TTL`` seconds (see shared_state.py). A clip URL can
+therefore be served by a worker other than the one synthesizing it.
+
+Engines (``TTS_ENGINE``):
+    espeak   espeak-ng or espeak (``apt install espeak-ng``); fast, robotic
+    piper    Piper neural voices (``pip install piper-tts``); needs ``TTS_MODEL``
+
+Configuration (environment variables):
+    TTS_ENGINE       espeak, piper, or off (default)
+    TTS_VOICE        espeak voice (default en-us)
+    TTS_MODEL        Piper .onnx voice model; its .onnx.json config must sit next to it
+    TTS_RATE         speaking rate in words per minute (default 175)
+    TTS_CACHE_SIZE   synthesized sentences kept in memory (default 1024)
+    TTS_WORKERS      sentences synthesized at once (default 2)
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import Counter, Histogram, registry
+from response_cache import LRUCache
+from shared_state import SharedStore
+
+logger = logging.getLogger(__name__)
+
+# Fragments shorter than this are spoken together with the next sentence
+MIN_SENTENCE_CHARS = 12
+# A sentence without punctuation is cut at a comma or space once it gets this long
+MAX_SENTENCE_CHARS = 250
+# Seconds a request waits for one sentence's synthesis
+SYNTHESIS_TIMEOUT = 30
+DEFAULT_RATE = 175
+# Seconds synthesized audio stays in the shared store; clients fetch it right away, and cache it themselves
+AUDIO_TTL = 600
+
+tts_sentences = registry.register(Counter(
+    "chatbot_tts_sentences_total", "Sentences requested for speech, by whether their audio was cached.", ("outcome",)))
+tts_synthesis_seconds = registry.register(Histogram(
+    "chatbot_tts_synthesis_seconds", "Time to synthesize one sentence.", ("engine",)))
+
+
+_BOUNDARY = re.compile(r"[.!?…]+[\"'”’)\]]*(?=\s)|\n")
+_ABBREVIATION = re.compile(r"(?:\b(?:mr|mrs|ms|dr|prof|st|vs|etc|e\.g|i\.e)|\b[A-Z])\.$", re.IGNORECASE)
+_MARKUP = (
+    (re.compile(r"```.*?```", re.DOTALL), " "),
+    (re.compile(r"\[([^\]]*)\]\([^)]*\)"), r"\1"),
+    (re.compile(r"^\s*(?:[-+]|\d+\.)\s+", re.MULTILINE), ""),
+    (re.compile(r"[*_`#>|~]+"), " "),
+    (re.compile(r"\s+"), " "),
+)
+
+
+def speakable(text: str) -> str:
+    """``text`` without the Markdown the model writes (emphasis, code, links, list markers)."""
+    for pattern, replacement in _MARKUP:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+class SentenceSplitter:
+    """
+    Splits streamed text into speakable sentences as soon as each one ends.
+
+    A sentence ends at ``.``, ``!`` or ``?`` followed by whitespace, or at
+    a line break. Abbreviations such as "e.g." and "Dr.", lines inside a
+    code block and fragments shorter than ``min_chars`` do not end one.
+    A run of text longer than ``max_chars`` is cut at its last comma or
+    space.
+    """
+
+    def __init__(self, min_chars: int = MIN_SENTENCE_CHARS, max_chars: int = MAX_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """Add streamed text; returns the sentences it completed."""
+        self._buffer += text
+        sentences = []
+        position = 0
+        while True:
+            match = _BOUNDARY.search(self._buffer, position)
+            if match is None:
+                break
+            position = match.end()
+            candidate = self._buffer[:position]
+            if match.group() == "." and _ABBREVIATION.search(candidate):
+                continue
+            # Code blocks are skipped as a whole, not read out line by line
+            if candidate.count("```") % 2:
+                continue
+            sentence = speakable(candidate)
+            if len(sentence) < self.min_chars:
+                continue
+            sentences.append(sentence)
+            self._buffer = self._buffer[position:]
+            position = 0
+        while len(self._buffer) > self.max_chars:
+            head = self._buffer[:self.max_chars]
+            cut = max(head.rfind(", "), head.rfind("; "), head.rfind(": "))
+            if cut <= 0:
+                cut = head.rfind(" ")
+            cut = cut + 1 if cut > 0 else self.max_chars
+            sentence = speakable(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self) -> List[str]:
+        """The rest of the text, once the stream has ended."""
+        sentence = speakable(self._buffer)
+        self._buffer = ""
+        return [sentence] if sentence else []
+
+
+def split_sentences(text: str) -> List[str]:
+    """All speakable sentences of a complete answer."""
+    splitter = SentenceSplitter()
+    return splitter.feed(text) + splitter.flush()
+
+
+def wav_bytes(pcm: bytes, sample_rate: int, channels: int = 1, sample_width: int = 2) -> bytes:
+    """A WAV file holding ``pcm``."""
+    return _wav_header((channels, sample_rate, sample_width), len(pcm)) + pcm
+
+
+def _wav_header(audio_format: Tuple[int, int, int], data_size: int) -> bytes:
+    channels, sample_rate, sample_width = audio_format
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI", b"RIFF", min(data_size + 36, 0xFFFFFFFF), b"WAVE", b"fmt ", 16, 1, channels,
+        sample_rate, sample_rate * channels * sample_width, channels * sample_width, sample_width * 8, b"data", data_size)
+
+
+def wav_pcm(audio: bytes) -> Tuple[Tuple[int, int, int], memoryview]:
+    """
+    The (channels, sample rate, sample width) and samples of a PCM WAV file.
+
+    Engines that write to a pipe cannot go back and fill in the data size,
+    so a size that runs past the end of the file is read as "the rest".
+
+    Raises:
+        ValueError: ``audio`` is not a PCM WAV file
+    """
+    if audio[:4] != b"RIFF" or audio[8:12] != b"WAVE":
+        raise ValueError("not a WAV file")
+    view = memoryview(audio)
+    audio_format = None
+    offset = 12
+    while offset + 8 <= len(audio):
+        chunk, size = struct.unpack_from("<4sI", audio, offset)
+        offset += 8
+        if chunk == b"fmt ":
+            tag, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", audio, offset)
+            if tag != 1:
+                raise ValueError("only PCM WAV files are supported")
+            audio_format = (channels, sample_rate, bits // 8)
+        elif chunk == b"data" and audio_format is not None:
+            return audio_format, view[offset:offset + size]
+        offset += size + (size & 1)
+    raise ValueError("WAV file has no audio")
+
+
+class EspeakEngine:
+    """
+    Synthesizes with the espeak-ng (or espeak) command-line program.
+
+    Args:
+        voice (str): espeak voice, e.g. ``en-us`` or ``en-gb+f3``
+        rate (int): Words per minute
+        binary (str, optional): Program to run; found on ``PATH`` by default
+    """
+
+    name = "espeak"
+
+    def __init__(self, voice: str = "en-us", rate: int = DEFAULT_RATE, binary: Optional[str] = None):
+        self.binary = binary or shutil.which("espeak-ng") or shutil.which("espeak")
+        if self.binary is None:
+            raise RuntimeError("espeak-ng is not installed")
+        self.voice = voice
+        self.rate = rate
+
+    @property
+    def settings(self) -> Dict:
+        return {"engine": self.name, "voice": self.voice, "rate": self.rate}
+
+    def synthesize(self, text: str) -> bytes:
+        # The text goes through stdin, so text starting with "-" is not read as an option
+        result = subprocess.run([self.binary, "--stdout", "-b", "1", "-v", self.voice, "-s", str(self.rate)],
+                                input=text.encode("utf-8"), capture_output=True, timeout=SYNTHESIS_TIMEOUT, check=True)
+        return result.stdout
+
+
+class PiperEngine:
+    """
+    Synthesizes with the Piper command-line program and an .onnx voice.
+
+    Args:
+        model (str): Path of the voice model; its ``.onnx.json`` config gives the sample rate
+        rate (int): Words per minute; the voice's own pace is taken as 175
+        binary (str, optional): Program to run; found on ``PATH`` by default
+    """
+
+    name = "piper"
+
+    def __init__(self, model: str, rate: int = DEFAULT_RATE, binary: Optional[str] = None):
+        self.binary = binary or shutil.which("piper")
+        if self.binary is None:
+            raise RuntimeError("piper is not installed")
+        with open(model + ".json", encoding="utf-8") as f:
+            self.sample_rate = int(json.load(f)["audio"]["sample_rate"])
+        self.model = model
+        self.rate = rate
+
+    @property
+    def settings(self) -> Dict:
+        return {"engine": self.name, "model": os.path.basename(self.model), "rate": self.rate}
+
+    def synthesize(self, text: str) -> bytes:
+        # Piper reads one utterance per line and writes raw 16-bit mono samples
+        result = subprocess.run([self.binary, "--model", self.model, "--output-raw", "--length_scale", f"{DEFAULT_RATE / self.rate:.3f}"],
+                                input=text.replace("\n", " ").encode("utf-8") + b"\n", capture_output=True,
+                                timeout=SYNTHESIS_TIMEOUT, check=True)
+        return wav_bytes(result.stdout, self.sample_rate)
+
+
+def audio_url(key: str) -> str:
+    return f"/api/audio/{key}"
+
+
+class _WavJoiner:
+    """Joins sentence WAVs into one stream: the first one's header, then every sentence's samples."""
+
+    def __init__(self):
+        self.format: Optional[Tuple[int, int, int]] = None
+
+    def chunk(self, audio: bytes) -> bytes:
+        audio_format, pcm = wav_pcm(audio)
+        if self.format is None:
+            self.format = audio_format
+            # The length is not known yet; players read an all-ones size as "until the stream ends"
+            return _wav_header(audio_format, 0xFFFFFFFF) + pcm
+        if audio_format != self.format:
+            logger.warning("Skipping a sentence synthesized as %s in a %s stream", audio_format, self.format)
+            return b""
+        return pcm.tobytes()
+
+
+class Speech:
+    """
+    Synthesizes sentences on a thread pool and caches their audio.
+
+    Args:
+        engine: An engine such as ``EspeakEngine``, with ``name``, ``settings`` and ``synthesize(text) -> WAV bytes``
+        cache_size (int): Synthesized sentences kept in memory
+        workers (int): Sentences synthesized at once
+        shared (SharedStore, optional): Where other worker processes find synthesized audio
+    """
+
+    def __init__(self, engine, cache_size: int = 1024, workers: int = 2, shared: Optional[SharedStore] = None):
+        self.engine = engine
+        self.shared = shared
+        self.cache = LRUCache(max_entries=cache_size, ttl=0)
+        self._settings = json.dumps(engine.settings, sort_keys=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.synthesis_ms = 0.0
+
+    def key(self, text: str) -> str:
+        """Cache key of a sentence: what it says and how it is voiced."""
+        return hashlib.sha256(f"{self._settings}\n{text}".encode("utf-8")).hexdigest()
+
+    def _submit(self, text: str) -> Tuple[str, Future]:
+        key = self.key(text)
+        with self._lock:
+            # A sentence already being synthesized counts as a hit: it is not synthesized again
+            future = self._pending.get(key)
+            audio = self.cache.get(key) if future is None else None
+            if future is None and audio is None and self.shared is not None:
+                audio = self.shared.get("speech", key)
+            if future is not None or audio is not None:
+                self.hits += 1
+                tts_sentences.inc(1, "hit")
+                if future is None:
+                    future = Future()
+                    future.set_result(audio)
+                return key, future
+            self.misses += 1
+            tts_sentences.inc(1, "miss")
+            if self.shared is not None:
+                # Tells the other workers that this audio is on its way. It is set before the job
+                # starts, so a synthesis that fails at once removes it rather than racing it.
+                self.shared.set("speech-pending", key, b"", ttl=SYNTHESIS_TIMEOUT)
+            future = self._pending[key] = self._executor.submit(self._synthesize, key, text)
+        return key, future
+
+    def _synthesize(self, key: str, text: str) -> bytes:
+        start = time.perf_counter()
+        try:
+            audio = self.engine.synthesize(text)
+            self.cache.set(key, audio)
+            if self.shared is not None:
+                self.shared.set("speech", key, audio, ttl=AUDIO_TTL)
+            return audio
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            logger.exception("Speech synthesis failed")
+            if self.shared is not None:
+                self.shared.delete("speech-pending", key)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            tts_synthesis_seconds.observe(elapsed, self.engine.name)
+            with self._lock:
+                self.synthesis_ms += elapsed * 1000
+                self._pending.pop(key, None)
+
+    def submit(self, text: str) -> str:
+        """Start synthesizing a sentence unless its audio is cached or underway; returns its key."""
+        return self._submit(text)[0]
+
+    def clip(self, text: str) -> Dict:
+        """Submit a sentence and describe where its audio will be."""
+        return {"text": text, "url": audio_url(self.submit(text))}
+
+    def clips(self, text: str) -> List[Dict]:
+        """Submit every sentence of a complete answer."""
+        return [self.clip(sentence) for sentence in split_sentences(text)]
+
+    def audio(self, key: str, timeout: Optional[float] = SYNTHESIS_TIMEOUT) -> Optional[bytes]:
+        """
+        The WAV audio of a submitted sentence, waiting for its synthesis if needed.
+
+        Returns:
+            None if no sentence with this key was submitted, its synthesis failed, or its audio has been evicted
+        """
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            return future.result(timeout)
+        audio = self.cache.get(key)
+        if audio is not None or self.shared is None:
+            return audio
+        # Another worker may have synthesized it, or still be synthesizing it
+        deadline = time.monotonic() + (timeout if timeout is not None else SYNTHESIS_TIMEOUT)
+        while True:
+            audio = self.shared.get("speech", key)
+            if audio is not None:
+                self.cache.set(key, audio)
+                return audio
+            if self.shared.get("speech-pending", key) is None or time.monotonic() > deadline:
+                return None
+            time.sleep(0.05)
+
+    def synthesize(self, text: str) -> bytes:
+        """The WAV audio of a sentence, from cache or synthesized now."""
+        return self._submit(text)[1].result(SYNTHESIS_TIMEOUT)
+
+    def _stream_audio(self, future: Future) -> Optional[bytes]:
+        """A streamed sentence's audio, or None if its synthesis failed or timed out."""
+        try:
+            return future.result(SYNTHESIS_TIMEOUT)
+        except Exception:
+            logger.warning("Skipping a sentence of a speech stream: its synthesis failed or timed out")
+            return None
+
+    async def _astream_audio(self, future: Future) -> Optional[bytes]:
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), SYNTHESIS_TIMEOUT)
+        except Exception:
+            logger.warning("Skipping a sentence of a speech stream: its synthesis failed or timed out")
+            return None
+
+    def stream(self, sentences: Iterable[str]) -> Iterator[bytes]:
+        """
+        One WAV stream of ``sentences``, yielded as they are synthesized.
+
+        Later sentences are synthesized while earlier ones are sent. Until
+        the first sentence has been sent, the stream waits for it. After
+        that it does not hold up reading further sentences. A sentence that
+        cannot be synthesized is left out rather than ending the stream.
+        """
+        joiner = _WavJoiner()
+        queue = deque()
+        for sentence in sentences:
+            queue.append(self._submit(sentence)[1])
+            while queue and (joiner.format is None or queue[0].done()):
+                audio = self._stream_audio(queue.popleft())
+                if audio is not None:
+                    yield joiner.chunk(audio)
+        while queue:
+            audio = self._stream_audio(queue.popleft())
+            if audio is not None:
+                yield joiner.chunk(audio)
+
+    async def astream(self, sentences: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        """``stream`` for async sentences, awaiting synthesis and shared-store lookups instead of blocking."""
+        joiner = _WavJoiner()
+        queue = deque()
+        async for sentence in sentences:
+            queue.append((await asyncio.to_thread(self._submit, sentence))[1])
+            while queue and (joiner.format is None or queue[0].done()):
+                audio = await self._astream_audio(queue.popleft())
+                if audio is not None:
+                    yield joiner.chunk(audio)
+        while queue:
+            audio = await self._astream_audio(queue.popleft())
+            if audio is not None:
+                yield joiner.chunk(audio)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            requested = self.hits + self.misses
+            return {
+                "engine": self.engine.settings,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requested if requested else 0.0,
+                "failures": self.failures,
+                "pending": len(self._pending),
+                "entries": len(self.cache),
+                "synthesis_ms_total": round(self.synthesis_ms, 3),
+            }
+
+
+def sentences(tokens: Iterable[str]) -> Iterator[str]:
+    """The sentences of a token stream, each as soon as it ends."""
+    splitter = SentenceSplitter()
+    for token in tokens:
+        yield from splitter.feed(token)
+    yield from splitter.flush()
+
+
+async def asentences(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """``sentences`` for an async token stream."""
+    splitter = SentenceSplitter()
+    async for token in tokens:
+        for sentence in splitter.feed(token):
+            yield sentence
+    for sentence in splitter.flush():
+        yield sentence
+
+
+def reply_audio(speech: Optional[Speech], text: str, requested) -> Dict:
+    """The ``audio`` field of a reply for which the client asked for speech: its clips, or None if speech is off."""
+    if not requested:
+        return {}
+    return {"audio": speech.clips(text) if speech is not None else None}
+
+
+def engine_from_env():
+    """The engine ``TTS_ENGINE`` names, or None if it is off."""
+    name = os.getenv("TTS_ENGINE", "off").lower()
+    rate = int(os.getenv("TTS_RATE", str(DEFAULT_RATE)))
+    if name in ("", "off"):
+        return None
+    if name == "espeak":
+        return EspeakEngine(voice=os.getenv("TTS_VOICE", "en-us"), rate=rate)
+    if name == "piper":
+        model = os.getenv("TTS_MODEL")
+        if not model:
+            raise ValueError("TTS_ENGINE=piper needs TTS_MODEL")
+        return PiperEngine(model, rate=rate)
+    raise ValueError(f"Unknown TTS_ENGINE {name!r}; expected espeak, piper or off")
+
+
+def speech_from_env(shared: Optional[SharedStore] = None) -> Optional[Speech]:
+    """Build server-side speech from TTS_* environment variables; None if ``TTS_ENGINE`` is off or not installed."""
+    try:
+        engine = engine_from_env()
+    except (RuntimeError, OSError) as e:
+        logger.warning("Server-side speech is off: %s", e)
+        return None
+    if engine is None:
+        return None
+    return Speech(engine, cache_size=int(os.getenv("TTS_CACHE_SIZE", "1024")), workers=int(os.getenv("TTS_WORKERS", "2")),
+                  shared=shared)
@@ -0,0 +1,98 @@
+"""
+Tests for the attachment worker pool
+"""
+import asyncio
+import threading
+
+import pytest
+
+from attachment_pool import AttachmentPool, AttachmentTimeout
+from benchmarks.sample_documents import make_pdf
+from concurrency import Overloaded
+from document_extraction import DocumentExtractor
+
+
+def test_tasks_run_on_a_worker_thread_and_results_are_not_copied():
+    pool = AttachmentPool(workers=2)
+    result = {"data": b"x" * 1024}
+    ran_on = []
+
+    def task():
+        ran_on.append(threading.current_thread().name)
+        return result
+
+    assert pool.run(task, task="decode") is result
+    assert asyncio.run(pool.arun(task, task="decode")) is result
+    assert all(name.startswith("attachment") for name in ran_on)
+    assert pool.stats()["completed"] == 2 and pool.stats()["pending"] == 0
+
+    # Without workers the task runs on the calling thread
+    inline = AttachmentPool(workers=0)
+    assert inline.run(threading.current_thread) is threading.current_thread()
+
+
+def test_full_queue_is_refused():
+    pool = AttachmentPool(workers=1, max_queue=1)
+    release = threading.Event()
+    busy = [threading.Thread(target=pool.run, args=(release.wait,)) for _ in range(2)]
+    for thread in busy:
+        thread.start()
+    while pool.stats()["pending"] < 2:
+        pass
+    try:
+        with pytest.raises(Overloaded):
+            pool.run(lambda: None)
+        assert pool.stats()["rejected"] == 1
+    finally:
+        release.set()
+        for thread in busy:
+            thread.join()
+
+
+def test_timed_out_task_keeps_running():
+    pool = AttachmentPool(workers=1, timeout=0.05)
+    release, finished = threading.Event(), threading.Event()
+
+    def slow():
+        release.wait()
+        finished.set()
+
+    with pytest.raises(AttachmentTimeout) as excinfo:
+        pool.run(slow)
+    assert excinfo.value.retry_after == 1
+    release.set()
+    assert finished.wait(5)
+    assert pool.stats()["timed_out"] == 1
+
+
+def test_task_timed_out_while_queued_still_runs():
+    pool = AttachmentPool(workers=1, timeout=0.05)
+    release = threading.Event()
+    ran = []
+    blocker = threading.Thread(target=lambda: pytest.raises(AttachmentTimeout, pool.run, release.wait))
+    blocker.start()
+    while pool.stats()["pending"] < 1:
+        pass
+
+    # Both wait behind the blocked worker until their requests give up
+    with pytest.raises(AttachmentTimeout):
+        pool.run(ran.append, "sync")
+    with pytest.raises(AttachmentTimeout):
+        asyncio.run(pool.arun(ran.append, "async"))
+    release.set()
+    blocker.join()
+    while pool.stats()["pending"]:
+        pass
+    assert sorted(ran) == ["async", "sync"]
+    assert pool.stats()["timed_out"] == 3 and pool.stats()["failed"] == 0
+
+
+def test_documents_can_be_parsed_in_a_worker_process():
+    pool = AttachmentPool(workers=1, processes=1)
+    extractor = DocumentExtractor(runner=pool.in_process)
+    pdf = make_pdf(["Vacation policy: 25 days", "Remote work: 3 days a week"])
+
+    document = pool.run(extractor.extract, pdf, "application/pdf")
+    assert [chunk.page for chunk in document.chunks] == [1, 2]
+    # The cache stays in this process
+    assert pool.run(extractor.extract, pdf, "application/pdf") is document
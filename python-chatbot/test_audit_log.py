@@ -0,0 +1,135 @@
+"""
+Tests for the append-only audit log and its paged history
+"""
+import sqlite3
+
+import pytest
+
+from audit_log import AuditLog
+from metrics import end_request, start_request
+
+
+def test_turns_are_paged_newest_first(tmp_path):
+    log = AuditLog(str(tmp_path / "audit.db"))
+    for i in range(5):
+        log.record("s1", f"question {i}", f"answer {i}", model="gemini-2.5-flash")
+    log.record(None, "anonymous question", "answer")
+    assert log.flush(5)
+
+    page, cursor = log.turns("s1", limit=2)
+    assert [turn["message"] for turn in page] == ["question 4", "question 3"]
+    page, cursor = log.turns("s1", cursor=cursor, limit=2)
+    assert [turn["message"] for turn in page] == ["question 2", "question 1"]
+    # Turns appended meanwhile do not shift the next page
+    log.record("s1", "question 5", "answer 5")
+    log.flush(5)
+    page, cursor = log.turns("s1", cursor=cursor, limit=2)
+    assert [turn["message"] for turn in page] == ["question 0"] and cursor is None
+    assert log.stats()["written"] == 7
+
+    with pytest.raises(ValueError):
+        log.turns("s1", cursor="not-a-cursor")
+    log.close()
+
+
+def test_turn_details_are_kept_but_not_attachment_content(tmp_path):
+    log = AuditLog(str(tmp_path / "audit.db"))
+    trace, token = start_request("/api/chat", "POST")
+    try:
+        trace.add("llm_total", 0.25)
+        trace.prompt_tokens = 120
+        answer = "A long answer. " * 200
+        attachments = [{"type": "text", "filename": "notes.txt", "content": "secret notes", "size": 12}]
+        log.record("s1", "Summarize my notes", answer, "gemini-2.5-flash", attachments, trace, user="alice", cached=False)
+    finally:
+        end_request(token)
+    log.flush(5)
+
+    [turn], _ = log.turns("s1")
+    assert turn["response"] == answer
+    assert turn["user"] == "alice" and turn["model"] == "gemini-2.5-flash"
+    assert turn["timings_ms"]["llm_total"] == 250.0 and turn["prompt_tokens"] == 120
+    assert turn["attachments"][0]["filename"] == "notes.txt"
+    assert len(turn["attachments"][0]["digest"]) == 64
+    assert "secret notes" not in str(turn)
+    log.close()
+
+
+def test_sessions_are_listed_by_last_activity_and_survive_restarts(tmp_path):
+    path = str(tmp_path / "audit.db")
+    log = AuditLog(path)
+    for session_id in ("a", "b", "c"):
+        log.record(session_id, f"Hello from {session_id}", "Hi!")
+        log.flush(5)
+    log.record("a", "Me again", "Welcome back")
+    log.close()
+
+    log = AuditLog(path)
+    page, cursor = log.sessions(limit=2)
+    assert [(s["session_id"], s["turns"]) for s in page] == [("a", 2), ("c", 1)]
+    assert page[0]["title"] == "Hello from a"
+    page, cursor = log.sessions(cursor=cursor, limit=2)
+    assert [s["session_id"] for s in page] == ["b"] and cursor is None
+
+    assert log.delete("a")
+    assert not log.delete("a")
+    assert log.turns("a") == ([], None)
+    assert [s["session_id"] for s in log.sessions()[0]] == ["c", "b"]
+    log.close()
+
+
+def test_turns_are_written_in_batches(tmp_path):
+    log = AuditLog(str(tmp_path / "audit.db"), batch_size=4, flush_interval=10)
+    for i in range(10):
+        log.record("s1", f"question {i}", "answer")
+    log.flush(5)
+    assert log.stats()["written"] == 10
+    assert log.stats()["batches"] == 3
+    log.close()
+
+
+def test_history_is_scoped_to_the_owner_who_started_it(tmp_path):
+    log = AuditLog(str(tmp_path / "audit.db"))
+    log.record("a-session", "Alice's question", "answer", user="bob", owner="alice")
+    log.record("a-session", "Bob's follow-up", "answer", user="bob", owner="bob")
+    log.record("b-session", "Bob's question", "answer", user="alice", owner="bob")
+    log.record("x-session", "Anonymous question", "answer", user="alice")
+    log.flush(5)
+
+    assert [s["session_id"] for s in log.sessions(owner="bob")[0]] == ["b-session"]
+    assert [s["session_id"] for s in log.sessions(owner="alice")[0]] == ["a-session"]
+    with pytest.raises(LookupError):
+        log.turns("a-session", owner="bob")
+    with pytest.raises(LookupError):
+        log.turns("no-such-session", owner="bob")
+    assert not log.delete("a-session", owner="bob")
+    assert not log.delete("x-session", owner="alice")
+
+    turns, _ = log.turns("a-session", owner="alice")
+    assert [turn["message"] for turn in turns] == ["Bob's follow-up", "Alice's question"]
+    assert log.delete("a-session", owner="alice")
+    log.close()
+
+
+def test_sessions_logged_before_owners_belong_to_nobody(tmp_path):
+    path = str(tmp_path / "audit.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TABLE turns (id INTEGER PRIMARY KEY, session_id TEXT, created_at REAL NOT NULL, user TEXT, model TEXT,"
+        " cached INTEGER NOT NULL, message BLOB NOT NULL, response BLOB NOT NULL, attachments TEXT, timings TEXT,"
+        " prompt_tokens INTEGER, response_tokens INTEGER);"
+        "CREATE TABLE sessions (session_id TEXT PRIMARY KEY, title TEXT NOT NULL, started_at REAL NOT NULL,"
+        " last_active REAL NOT NULL, turns INTEGER NOT NULL);"
+        "INSERT INTO turns VALUES (1, 's1', 1.0, 'alice', NULL, 0, 'hi', 'hello', NULL, NULL, NULL, NULL);"
+        "INSERT INTO sessions VALUES ('s1', 'hi', 1.0, 1.0, 1);"
+    )
+    conn.close()
+
+    log = AuditLog(path)
+    # The user column was never authenticated, so it does not make alice the owner
+    assert log.sessions(owner="alice") == ([], None)
+    assert [s["session_id"] for s in log.sessions()[0]] == ["s1"]
+    log.record("s2", "hi again", "hello", owner="alice")
+    log.flush(5)
+    assert [s["session_id"] for s in log.sessions(owner="alice")[0]] == ["s2"]
+    log.close()
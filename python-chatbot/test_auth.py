@@ -0,0 +1,81 @@
+"""
+Tests for signed bearer tokens and the history routes that require them
+"""
+import pytest
+from starlette.testclient import TestClient
+
+import api
+import asgi_api
+from audit_log import AuditLog
+from auth import TokenAuthenticator
+
+SECRET = "a-test-secret-of-enough-length"
+
+
+def _json(response):
+    return response.get_json() if hasattr(response, "get_json") else response.json()
+
+
+def test_issued_tokens_verify_until_they_expire():
+    authenticator = TokenAuthenticator(SECRET)
+    token = authenticator.issue("alice")
+    assert authenticator.verify(token) == "alice"
+    assert authenticator.principal(f"Bearer {token}") == "alice"
+    assert authenticator.verify(authenticator.issue("alice", ttl=-1)) is None
+
+    with pytest.raises(ValueError):
+        TokenAuthenticator("short")
+
+
+def test_forged_and_malformed_tokens_are_rejected():
+    authenticator = TokenAuthenticator(SECRET)
+    payload, signature = authenticator.issue("alice").split(".")
+    bob_payload = authenticator.issue("bob").split(".")[0]
+    assert authenticator.verify(f"{bob_payload}.{signature}") is None
+    assert authenticator.verify(TokenAuthenticator("another-secret-of-length").issue("alice")) is None
+    for value in [None, "", "Bearer", f"Basic {payload}.{signature}", "Bearer not-a-token", "Bearer ..."]:
+        assert authenticator.principal(value) is None
+
+
+@pytest.fixture(params=["flask", "asgi"])
+def history(request, tmp_path, monkeypatch):
+    """A client of one app with history enabled, and the log and authenticator behind it."""
+    log = AuditLog(str(tmp_path / "audit.db"))
+    authenticator = TokenAuthenticator(SECRET)
+    module = api if request.param == "flask" else asgi_api
+    monkeypatch.setattr(module, "audit_log", log)
+    monkeypatch.setattr(module, "authenticator", authenticator)
+    client = api.app.test_client() if request.param == "flask" else TestClient(asgi_api.app)
+    yield client, log, authenticator
+    log.close()
+
+
+def test_history_needs_a_token_and_only_shows_its_owner_conversations(history):
+    client, log, authenticator = history
+    log.record("a-session", "Alice's question", "answer", user="alice", owner="alice")
+    log.record("b-session", "Bob's question", "answer", user="bob", owner="bob")
+    log.flush(5)
+
+    # Claiming to be alice with the fair-queuing header is not enough
+    response = client.get("/api/history", headers={"X-User-Id": "alice"})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+
+    bob = {"Authorization": f"Bearer {authenticator.issue('bob')}", "X-User-Id": "alice"}
+    response = client.get("/api/history", headers=bob)
+    assert [s["session_id"] for s in _json(response)["sessions"]] == ["b-session"]
+    assert client.get("/api/history/a-session", headers=bob).status_code == 404
+    assert client.delete("/api/history/a-session", headers=bob).status_code == 404
+
+    alice = {"Authorization": f"Bearer {authenticator.issue('alice')}"}
+    assert _json(client.get("/api/history/a-session", headers=alice))["turns"][0]["message"] == "Alice's question"
+    assert client.delete("/api/history/a-session", headers=alice).status_code == 200
+
+
+def test_history_is_disabled_without_an_auth_secret(history, monkeypatch):
+    client = history[0]
+    monkeypatch.setattr(api, "authenticator", None)
+    monkeypatch.setattr(asgi_api, "authenticator", None)
+    response = client.get("/api/history")
+    assert response.status_code == 404
+    assert "AUTH_SECRET" in _json(response)["error"]
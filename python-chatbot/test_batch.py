@@ -0,0 +1,108 @@
+"""
+Tests for concurrent batch execution
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from batch import arun_as_completed, batch_options, parse_items, run_as_completed
+
+
+def _answer(question):
+    if question == "fail":
+        raise RuntimeError("model error")
+    time.sleep(2.0 if question == "slow" else 0.05)
+    return question.upper()
+
+
+def test_failures_and_timeouts_stay_in_their_item():
+    model = RunnableLambda(_answer)
+    calls = [(model, "a"), (model, "fail"), (model, "slow"), (model, "b")]
+
+    start = time.perf_counter()
+    results = dict(run_as_completed(calls, max_concurrency=4, timeout=0.5))
+    elapsed = time.perf_counter() - start
+
+    assert results[0] == "A" and results[3] == "B"
+    assert isinstance(results[1], RuntimeError)
+    assert isinstance(results[2], TimeoutError)
+    # The slow item is reported at its timeout, not when it finally returns
+    assert elapsed < 1.5
+
+
+def test_concurrency_is_capped():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def tracked(question):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        return question
+
+    model = RunnableLambda(tracked)
+    results = sorted(run_as_completed([(model, str(i)) for i in range(20)], max_concurrency=3, timeout=5))
+    assert [result for _, result in results] == [str(i) for i in range(20)]
+    assert peak <= 3
+
+
+def test_timed_out_calls_still_count_against_the_cap():
+    running, peak, started = 0, 0, 0
+    lock = threading.Lock()
+
+    def slow_model(question):
+        nonlocal running, peak, started
+        with lock:
+            running += 1
+            started += 1
+            peak = max(peak, running)
+        time.sleep(0.3)
+        with lock:
+            running -= 1
+        return question
+
+    model = RunnableLambda(slow_model)
+    results = dict(run_as_completed([(model, str(i)) for i in range(8)], max_concurrency=2, timeout=0.05))
+    assert all(isinstance(result, TimeoutError) for result in results.values())
+    # Every item timed out, but the next one waited for an abandoned call to end before starting its own
+    assert started == 8 and peak <= 2
+
+
+def test_async_batch_cancels_timed_out_items():
+    cancelled = []
+
+    async def answer(question):
+        try:
+            await asyncio.sleep(1.0 if question == "slow" else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(question)
+            raise
+        return question
+
+    async def scenario():
+        model = RunnableLambda(answer)
+        return dict([pair async for pair in arun_as_completed([(model, "slow"), (model, "fast")], timeout=0.1)])
+
+    results = asyncio.run(scenario())
+    assert results[1] == "fast"
+    assert isinstance(results[0], TimeoutError)
+    assert cancelled == ["slow"]
+
+
+def test_request_validation():
+    assert parse_items([{"message": "hi", "attachments": []}]) == [{"message": "hi", "attachments": []}]
+    with pytest.raises(ValueError):
+        parse_items([])
+    with pytest.raises(ValueError):
+        parse_items([{"message": 3}])
+    assert batch_options(1000, 5)[1] == 5.0
+    assert batch_options(1000, 5)[0] <= 1000
+    with pytest.raises(ValueError):
+        batch_options(0, 5)
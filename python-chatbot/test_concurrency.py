@@ -0,0 +1,47 @@
+"""
+Tests for the upstream concurrency limiter
+"""
+import asyncio
+
+import pytest
+
+from concurrency import ConcurrencyLimiter, Overloaded
+
+
+def test_sheds_when_queue_is_full():
+    """Requests beyond in-flight + queue capacity are rejected immediately"""
+    async def scenario():
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_queue=1, queue_timeout=5)
+        release = asyncio.Event()
+
+        async def call():
+            async with limiter.slot():
+                await release.wait()
+
+        running = [asyncio.create_task(call()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        release.set()
+        await asyncio.gather(*running)
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["completed"] == 2
+    assert stats["rejected_queue_full"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_sheds_after_queue_timeout():
+    """A queued request gives up once queue_timeout has passed"""
+    async def scenario():
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_queue=4, queue_timeout=0.05)
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        limiter.release()
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["rejected_timeout"] == 1
+    assert stats["waiting"] == 0
@@ -0,0 +1,54 @@
+"""
+Tests for server-side conversation memory
+"""
+import time
+
+from conversation_memory import ConversationStore
+from token_budget import estimate_tokens
+
+
+def test_old_turns_roll_into_summary_within_budget():
+    store = ConversationStore(token_budget=60, summary_tokens=1000)
+    for i in range(10):
+        store.append("s1", f"Question {i}? " + "x" * 40, f"Answer {i}. " + "y" * 40)
+
+    messages = store.messages("s1")
+    summary, turns = messages[0], messages[1:]
+    assert summary.type == "system"
+    assert "User asked: Question 0?" in summary.content
+    assert turns[-1].content.startswith("Answer 9.")
+    assert sum(estimate_tokens(m.content) for m in turns) <= 60
+
+
+def test_summary_is_capped():
+    store = ConversationStore(token_budget=10, summary_tokens=30)
+    for i in range(50):
+        store.append("s1", f"Question {i}?", f"Answer {i}.")
+
+    summary = store.messages("s1")[0].content
+    assert "Question 0?" not in summary
+    assert "Answer 48." in summary
+
+
+def test_idle_and_capacity_eviction():
+    store = ConversationStore(idle_ttl=0.05, max_sessions=2)
+    store.append("a", "hi", "hello")
+    store.append("b", "hi", "hello")
+    store.append("c", "hi", "hello")
+    assert store.messages("a") == []
+    assert store.stats()["evicted_capacity"] == 1
+
+    time.sleep(0.06)
+    store.append("d", "hi", "hello")
+    assert store.stats()["sessions"] == 1
+    assert store.stats()["evicted_idle"] == 2
+
+
+def test_turn_appended_to_an_expired_session_is_kept():
+    store = ConversationStore(idle_ttl=0.05)
+    store.append("a", "What is the capital of France?", "Paris.")
+    time.sleep(0.06)
+    # The session expired while idle and is the oldest, so it is evicted during this append
+    store.append("a", "And of Italy?", "Rome.")
+    assert [m.content for m in store.messages("a")] == ["And of Italy?", "Rome."]
+    assert store.stats()["sessions"] == 1 and store.stats()["evicted_idle"] == 1
@@ -0,0 +1,44 @@
+"""
+Tests for PDF/DOCX text extraction
+"""
+import io
+
+from benchmarks.sample_documents import make_docx, make_pdf
+from document_extraction import DOCX_MIME_TYPE, DocumentExtractor, chunk_pages
+
+
+def test_pdf_pages_are_extracted_and_cached_by_content():
+    extractor = DocumentExtractor()
+    pdf = make_pdf(["Vacation policy: 25 days", "Remote work: 3 days a week"])
+
+    first = extractor.extract(pdf, "application/pdf")
+    assert [chunk.page for chunk in first.chunks] == [1, 2]
+    assert "Remote work" in first.text
+
+    # Same bytes from another upload are served from the cache
+    assert extractor.extract(io.BytesIO(pdf), "application/pdf") is first
+    assert extractor.stats()["misses"] == 1
+
+
+def test_docx_paragraphs_are_extracted():
+    document = DocumentExtractor().extract(make_docx(["Hello", "World & friends"]), DOCX_MIME_TYPE)
+    assert document.text == "Hello\nWorld & friends"
+
+
+def test_page_cap_truncates():
+    pdf = make_pdf([f"Page {i}" for i in range(10)])
+    document = DocumentExtractor(max_pages=3).extract(pdf, "application/pdf")
+    assert document.pages == 3
+    assert document.truncated
+
+
+def test_broken_documents_report_an_error():
+    document = DocumentExtractor().extract(b"PK\x03\x04 not really a zip", DOCX_MIME_TYPE)
+    assert document.chunks == []
+    assert document.error
+
+
+def test_chunks_overlap_and_stay_within_a_page():
+    chunks = chunk_pages(["a" * 250, "b" * 10], chunk_chars=100, overlap=20)
+    assert [len(chunk.text) for chunk in chunks] == [100, 100, 90, 10]
+    assert chunks[-1].page == 2
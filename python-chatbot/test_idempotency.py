@@ -0,0 +1,77 @@
+"""
+Tests for idempotency keys and single-flight coalescing
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from idempotency import IdempotencyConflict, RequestCoalescer, chat_fingerprint
+
+
+def test_concurrent_identical_requests_share_one_call():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    def slow_chat():
+        calls.append(threading.get_ident())
+        time.sleep(0.2)
+        return "Paris"
+
+    fingerprint = chat_fingerprint("Capital of France?")
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: coalescer.run(slow_chat, "/api/chat", fingerprint), range(4)))
+
+    assert results == ["Paris"] * 4
+    assert len(calls) == 1
+    assert coalescer.stats()["coalesced"] == 3
+    # Without a key nothing is stored once the call has finished
+    coalescer.run(slow_chat, "/api/chat", fingerprint)
+    assert len(calls) == 2
+
+
+def test_keyed_retries_are_replayed_and_conflicts_rejected():
+    coalescer = RequestCoalescer(ttl=60)
+    fingerprint = chat_fingerprint("hello", [{"type": "text", "content": "notes"}])
+    attempts = []
+
+    def failing_then_ok():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise TimeoutError("upstream timed out")
+        return "hi"
+
+    with pytest.raises(TimeoutError):
+        coalescer.run(failing_then_ok, "/api/chat", fingerprint, idempotency_key="k1")
+    # The failure was not stored, so the retry runs; later retries are replayed
+    assert coalescer.run(failing_then_ok, "/api/chat", fingerprint, idempotency_key="k1") == "hi"
+    assert coalescer.run(failing_then_ok, "/api/chat", fingerprint, idempotency_key="k1") == "hi"
+    assert len(attempts) == 2
+    assert coalescer.stats()["replayed"] == 1
+
+    with pytest.raises(IdempotencyConflict):
+        coalescer.run(failing_then_ok, "/api/chat", chat_fingerprint("something else"), idempotency_key="k1")
+
+
+def test_async_call_survives_the_client_that_started_it():
+    coalescer = RequestCoalescer(ttl=60)
+    calls = []
+
+    async def slow_chat():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "answer"
+
+    async def scenario():
+        first = asyncio.ensure_future(coalescer.arun(slow_chat, "/api/chat", "fp", idempotency_key="k"))
+        await asyncio.sleep(0.01)
+        first.cancel()  # the client timed out and disconnected
+        retry = await coalescer.arun(slow_chat, "/api/chat", "fp", idempotency_key="k")
+        late = await coalescer.arun(slow_chat, "/api/chat", "fp", idempotency_key="k")
+        return retry, late
+
+    assert asyncio.run(scenario()) == ("answer", "answer")
+    assert len(calls) == 1
+    assert coalescer.stats()["upstream_calls_saved"] == 2
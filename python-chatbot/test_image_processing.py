@@ -0,0 +1,48 @@
+"""
+Tests for image downscaling and recompression
+"""
+import io
+
+import pytest
+
+pytest.importorskip("PIL")
+
+from attachments import attachment_bytes, data_url_mime_type
+from benchmarks.sample_images import make_icon, make_photo, make_screenshot
+from image_processing import ImageProcessor
+from uploads import read_upload
+
+
+def test_photo_is_downscaled_recompressed_and_cached():
+    processor = ImageProcessor(max_dimension=800)
+    photo = make_photo(2000, 1500)
+
+    image = processor.process(photo, "image/jpeg")
+    assert (image.width, image.height) == (800, 600)
+    assert image.mime_type == "image/jpeg"
+    assert image.bytes_saved > 0
+
+    assert processor.process(io.BytesIO(photo), "image/jpeg") is image
+    assert processor.stats()["hits"] == 1
+
+
+def test_lossless_images_stay_lossless_and_bad_images_pass_through():
+    processor = ImageProcessor(max_dimension=1000)
+    assert processor.process(make_screenshot(), "image/png").mime_type == "image/png"
+    assert processor.process(make_icon(), "image/png").width == 64
+
+    broken = processor.process(b"\x89PNG\r\n\x1a\nnot an image", "image/png")
+    assert broken.error
+    assert broken.data == b"\x89PNG\r\n\x1a\nnot an image"
+
+
+def test_upload_sends_only_the_processed_image():
+    processor = ImageProcessor(max_dimension=500)
+    photo = make_photo(1200, 900)
+    attachment = read_upload(io.BytesIO(photo), "IMG_0001.JPG", image_processor=processor)
+
+    data, mime_type = attachment_bytes({'content': attachment['content']}), data_url_mime_type(attachment['content'])
+    assert attachment['image'].data == data
+    assert mime_type == "image/jpeg"
+    assert len(data) < len(photo)
+    assert attachment['size'] == len(photo)
@@ -0,0 +1,58 @@
+"""
+Tests for the JSON request fast path: the codec and typed attachments
+"""
+import base64
+import hashlib
+
+import numpy as np
+import pytest
+
+from attachments import Attachment, InvalidAttachment, attachment_bytes, data_url_mime_type, process_attachments
+from json_codec import dumps, loads
+from response_cache import attachment_digest
+
+
+def test_codec_round_trips_compact_utf8():
+    value = {"response": "Grüße 👋", "usage": None, "hit_rate": np.float64(0.5), "counts": {1: 2}}
+    encoded = dumps(value)
+    assert isinstance(encoded, bytes)
+    assert b" " not in encoded.replace("Grüße 👋".encode(), b"")
+    assert loads(encoded) == {"response": "Grüße 👋", "usage": None, "hit_rate": 0.5, "counts": {"1": 2}}
+    assert loads(memoryview(encoded))["usage"] is None
+    with pytest.raises(ValueError):
+        loads(b'{"message": ')
+
+
+def test_attachments_are_validated_into_typed_structs():
+    [text, image] = process_attachments([
+        {"filename": "notes.txt", "content": "aGk=", "mime_type": "text/plain"},
+        {"filename": "photo.png", "content": "", "mime_type": "image/png", "type": None},
+    ])
+    assert isinstance(text, Attachment) and text["type"] == "text" and text.get("encoding") == "base64"
+    assert image.type == "image"
+    assert "image" not in image and image.get("image") is None
+    image["image"] = "processed"
+    assert "image" in image and dict(image)["image"] == "processed"
+    with pytest.raises(KeyError):
+        image["__class__"] = None
+    assert process_attachments(None) == []
+
+    for bad in ("not a list", ["not an object"], [{"content": 42}], [{"filename": ["a"]}]):
+        with pytest.raises(InvalidAttachment):
+            process_attachments(bad)
+
+
+def test_payload_is_decoded_once_and_digested_like_uploads():
+    raw = b"\x89PNG" + bytes(range(256)) * 10
+    [attachment] = process_attachments([{"type": "image", "content": "data:image/png;base64," + base64.b64encode(raw).decode()}])
+    data = attachment_bytes(attachment)
+    assert data == raw and attachment_bytes(attachment) is data
+    assert attachment["digest"] == hashlib.sha256(raw).hexdigest()
+    assert attachment_digest(attachment).endswith(hashlib.sha256(raw).hexdigest())
+    assert data_url_mime_type(attachment.content, "image/jpeg") == "image/png"
+
+    # Plain dictionaries get the same treatment, and invalid base64 still gets a digest
+    plain = {"type": "text", "content": "plain words", "encoding": "text"}
+    assert attachment_digest(plain).endswith(hashlib.sha256(b"plain words").hexdigest()) and "data" not in plain
+    broken = {"type": "image", "content": "not base64!", "encoding": "base64"}
+    assert attachment_digest(broken).endswith(hashlib.sha256(b"not base64!").hexdigest())
@@ -0,0 +1,42 @@
+"""
+Tests for request tracing and the Prometheus metrics
+"""
+from metrics import Counter, Histogram, current_trace, end_request, record_tokens, span, stage_duration, start_request
+
+
+def test_histogram_renders_cumulative_buckets_and_estimates_quantiles():
+    histogram = Histogram("test_latency_seconds", "Test latency.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 2.0):
+        histogram.observe(value, "/a")
+
+    lines = histogram.render()
+    assert 'test_latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{route="/a",le="1.0"} 3' in lines
+    assert 'test_latency_seconds_bucket{route="/a",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count{route="/a"} 4' in lines
+    assert histogram.quantile(0.5, "/a") == 0.55
+    assert histogram.quantile(0.99, "/a") == 1.0
+
+
+def test_counter_renders_labels():
+    counter = Counter("test_total", "Test counter.", ("status",))
+    counter.inc(2, "200")
+    assert counter.render()[-1] == 'test_total{status="200"} 2'
+
+
+def test_spans_are_recorded_on_the_current_request_only():
+    with span("parse"):
+        pass  # no request, nothing recorded
+    assert current_trace() is None
+
+    trace, token = start_request("/test/spans", "POST")
+    with span("parse"):
+        pass
+    record_tokens(prompt=10, response=5)
+    trace.finish(200)
+    trace.finish(200)
+    end_request(token)
+
+    assert stage_duration.count("/test/spans", "parse") == 1
+    assert (trace.prompt_tokens, trace.response_tokens) == (10, 5)
+    assert current_trace() is None
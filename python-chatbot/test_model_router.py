@@ -0,0 +1,103 @@
+"""
+Tests for model tier routing and timeout fallback
+"""
+import asyncio
+import time
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from model_router import FAST, STRONG, ModelPool, ModelRouter
+from upstream import AdaptiveRateLimiter, GuardedModel, UpstreamUnavailable
+
+
+def _router(clients, **kwargs):
+    return ModelRouter(ModelPool(lambda name: clients[name]), fast_model="fast-model", strong_model="strong-model", **kwargs)
+
+
+def test_cheap_signals_pick_the_tier():
+    router = _router({})
+    assert router.route("hi!").tier == FAST
+    assert router.route("What is the capital of France?").tier == FAST
+
+    code = [{"type": "text", "filename": "server.py", "mime_type": "text/x-python"}]
+    decision = router.route("Please review this and find the bug", code)
+    assert decision.tier == STRONG
+    assert decision.model == "strong-model" and decision.fallback == "fast-model"
+    assert any("code attachment" in reason for reason in decision.reasons)
+
+    assert router.route("Summarize " + "lorem ipsum " * 200).tier == STRONG
+    assert router.route("What do these show?", [{"type": "image"}] * 3).tier == STRONG
+
+
+def test_timeouts_fall_back_to_the_other_model():
+    def slow(messages):
+        time.sleep(1.0)
+        return "slow answer"
+
+    clients = {"fast-model": RunnableLambda(slow), "strong-model": RunnableLambda(lambda messages: "fallback answer")}
+    router = _router(clients, timeouts={FAST: 0.1})
+    runnable = router.runnable(router.route("hello"))
+
+    start = time.perf_counter()
+    assert runnable.invoke("hello") == "fallback answer"
+    assert time.perf_counter() - start < 0.5
+    assert router.stats()["models"]["fast-model"]["timeout"] >= 1
+
+    async def aslow(messages):
+        await asyncio.sleep(1.0)
+        return "slow answer"
+
+    clients["fast-model"] = RunnableLambda(aslow)
+    router = _router(clients, timeouts={FAST: 0.1})
+    assert asyncio.run(router.runnable(router.route("hello")).ainvoke("hello")) == "fallback answer"
+
+
+def test_unavailable_model_falls_back_but_other_errors_do_not():
+    def unavailable(messages):
+        raise UpstreamUnavailable("circuit breaker open")
+
+    def broken(messages):
+        raise ValueError("bad request")
+
+    clients = {"fast-model": RunnableLambda(unavailable), "strong-model": RunnableLambda(lambda messages: "fallback answer")}
+    router = _router(clients)
+    assert list(router.runnable(router.route("hello")).stream("hello")) == ["fallback answer"]
+
+    clients["fast-model"] = RunnableLambda(broken)
+    router = _router(clients)
+    with pytest.raises(ValueError):
+        router.runnable(router.route("hello")).invoke("hello")
+
+
+def test_timed_out_primary_stops_calling_the_upstream():
+    calls = []
+
+    def flaky(messages):
+        calls.append(time.perf_counter())
+        time.sleep(0.15)
+        raise ConnectionError("connection reset")
+
+    primary = GuardedModel(RunnableLambda(flaky), AdaptiveRateLimiter(rate=100, burst=100), attempts=20, backoff_base=0.01)
+    clients = {"fast-model": primary, "strong-model": RunnableLambda(lambda messages: "fallback answer")}
+    router = _router(clients, timeouts={FAST: 0.25})
+    assert router.runnable(router.route("hello")).invoke("hello") == "fallback answer"
+    time.sleep(1.0)
+    # Two attempts fit in the deadline; without it all 20 would have been made in the background
+    assert len(calls) <= 2
+
+    closed = []
+
+    def slow_stream(messages):
+        try:
+            time.sleep(0.5)
+            yield "slow"
+            yield "more"
+        finally:
+            closed.append(True)
+
+    clients["fast-model"] = RunnableLambda(slow_stream)
+    router = _router(clients, timeouts={FAST: 0.1})
+    assert list(router.runnable(router.route("hello")).stream("hello")) == ["fallback answer"]
+    time.sleep(0.6)
+    assert closed == [True]
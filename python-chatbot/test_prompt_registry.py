@@ -0,0 +1,46 @@
+"""
+Tests for the compiled POML prompt registry
+"""
+import os
+
+from langchain_core.messages import AIMessage, HumanMessage
+from poml.integration.langchain import LangchainPomlTemplate
+
+from prompt_registry import PromptRegistry
+
+PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt.poml")
+
+
+def test_compiled_prompt_matches_poml():
+    """The compiled template renders the same system message as POML"""
+    registry = PromptRegistry()
+    compiled = registry.get(PROMPT_FILE).template.invoke({"question": "Hi {there}"})
+    original = LangchainPomlTemplate.from_file(PROMPT_FILE).format_prompt(question="Hi {there}", history="")
+
+    assert compiled.messages[0].content == original.messages[0].content
+    assert compiled.messages[-1].content == "Hi {there}"
+
+
+def test_history_expands_into_chat_messages():
+    """The history variable becomes a placeholder for earlier turns"""
+    history = [HumanMessage(content="Earlier question"), AIMessage(content="Earlier answer")]
+    messages = PromptRegistry().get(PROMPT_FILE).template.invoke({"question": "Follow-up", "history": history}).messages
+
+    assert [m.content for m in messages[1:]] == ["Earlier question", "Earlier answer", "Follow-up"]
+
+
+def test_reloads_only_when_content_changes(tmp_path):
+    """Touching a file keeps the compiled prompt, editing it recompiles"""
+    path = tmp_path / "prompt.poml"
+    path.write_text("<poml><system-msg>One</system-msg><human-msg>{{ question }}</human-msg></poml>")
+    registry = PromptRegistry(check_interval=0)
+
+    first = registry.get(str(path))
+    os.utime(path, ns=(first.mtime_ns + 10**9, first.mtime_ns + 10**9))
+    assert registry.get(str(path)) is first
+
+    path.write_text("<poml><system-msg>Two</system-msg><human-msg>{{ question }}</human-msg></poml>")
+    second = registry.get(str(path))
+    assert second is not first
+    assert second.template.invoke({"question": "q"}).messages[0].content == "Two"
+    assert registry.stats()[str(path)]["reloads"] == 1
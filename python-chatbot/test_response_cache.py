@@ -0,0 +1,52 @@
+"""
+Tests for the response cache
+"""
+import time
+
+from response_cache import LRUCache, ResponseCache, attachment_digest, cache_key, cache_requested
+
+
+def test_key_normalizes_question_and_hashes_attachments():
+    """Whitespace/case changes share a key, attachment payloads never appear in it"""
+    payload = "aGVsbG8gd29ybGQ=" * 100
+    digests = [attachment_digest({'type': 'text', 'content': payload, 'encoding': 'base64'})]
+
+    key = cache_key("What is  POML?", "model-a", "tmpl", digests)
+    assert key == cache_key(" what is poml? ", "model-a", "tmpl", digests)
+    assert key != cache_key("What is POML?", "model-b", "tmpl", digests)
+    assert key != cache_key("What is POML?", "model-a", "tmpl")
+    assert payload not in digests[0]
+
+
+def test_lru_evicts_least_recently_used_and_expires():
+    cache = LRUCache(max_entries=2, ttl=0.05)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.evictions == 1
+
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.expirations == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    db_path = str(tmp_path / "responses.sqlite")
+    ResponseCache(db_path=db_path).set("key", "cached answer")
+
+    restarted = ResponseCache(db_path=db_path)
+    assert restarted.get("key") == "cached answer"
+    assert restarted.get("missing") is None
+    stats = restarted.stats()
+    assert (stats["hits"], stats["misses"], stats["disk"]["hits"]) == (1, 1, 1)
+
+
+def test_cache_bypass_flags():
+    assert cache_requested()
+    assert not cache_requested(False)
+    assert not cache_requested("false")
+    assert not cache_requested(None, "no-cache")
@@ -0,0 +1,43 @@
+"""
+Tests for retrieval over long text attachments
+"""
+import io
+
+from retrieval import ChunkIndex, Retriever, split_lines
+from uploads import read_upload
+
+LOG = "".join(f"12:00:{i % 60:02d} INFO request {i} handled in 12 ms\n" for i in range(5000))
+LOG_WITH_ERROR = LOG.replace("request 4321 handled in 12 ms", "ERROR database connection refused on replica-3")
+
+
+def test_split_lines_keeps_line_numbers_and_cuts_long_lines():
+    chunks = split_lines("first\nsecond\n" + "x" * 25 + "\nlast\n", chunk_chars=10)
+    assert [(chunk.first_line, chunk.last_line) for chunk in chunks] == [(1, 1), (2, 2), (3, 3), (3, 3), (3, 3), (4, 4)]
+    assert "".join(chunk.text for chunk in chunks) == "first\nsecond\n" + "x" * 25 + "\nlast\n"
+
+
+def test_bm25_ranks_the_matching_chunk_first():
+    index = ChunkIndex(split_lines(LOG_WITH_ERROR, chunk_chars=1000))
+    best = index.chunks[index.search("why was the database connection refused?")[0]]
+    assert "replica-3" in best.text
+    assert best.first_line <= 4322 <= best.last_line
+
+
+def test_select_respects_token_budget_and_falls_back_to_leading_chunks():
+    index = ChunkIndex(split_lines(LOG, chunk_chars=1000))
+    selected = index.select("INFO request handled", token_budget=600, top_k=10)
+    assert 1 <= len(selected) <= 3
+    assert [chunk.first_line for chunk in selected] == sorted(chunk.first_line for chunk in selected)
+
+    assert index.select("no such words", top_k=2) == index.chunks[:2]
+
+
+def test_long_text_upload_is_indexed_once_per_content():
+    retriever = Retriever()
+    data = LOG_WITH_ERROR.encode()
+    first = read_upload(io.BytesIO(data), "server.log", "text/plain", retriever=retriever)
+    second = read_upload(io.BytesIO(data), "copy.log", "text/plain", retriever=retriever)
+
+    assert second['index'] is first['index']
+    assert retriever.stats()["misses"] == 1
+    assert any("replica-3" in chunk.text for chunk in retriever.select(first['index'], "database refused"))
@@ -0,0 +1,94 @@
+"""
+Tests for the semantic cache of paraphrased questions
+"""
+import time
+
+import numpy as np
+
+from semantic_cache import SemanticCache, embed, same_markers, semantic_lookups
+
+SCOPE = "gemini-2.5-flash:template"
+
+
+def test_paraphrases_hit_and_different_questions_miss():
+    cache = SemanticCache()
+    cache.add("How do I reset my password?", SCOPE, "Use the 'Forgot password' link.")
+    cache.add("What is the refund policy?", SCOPE, "Refunds within 30 days.")
+    hits = semantic_lookups.value("hit")
+
+    assert cache.lookup("reset my password", SCOPE) == "Use the 'Forgot password' link."
+    assert cache.lookup("what's your refund policy", SCOPE) == "Refunds within 30 days."
+    assert cache.lookup("How do I change my password?", SCOPE) is None
+    assert cache.lookup("What is the privacy policy?", SCOPE) is None
+    # Another model or prompt template does not share answers
+    assert cache.lookup("reset my password", "gemini-2.5-pro:template") is None
+    assert semantic_lookups.value("hit") == hits + 2
+    assert cache.stats()["hit_rate"] == 0.4
+    # Rewordings that reorder the words or add one about the form of the answer
+    assert cache.lookup("password reset steps", SCOPE) == "Use the 'Forgot password' link."
+    assert cache.lookup("steps to reset password", SCOPE) == "Use the 'Forgot password' link."
+
+
+def test_look_alike_questions_do_not_hit():
+    pairs = [
+        ("How do I enable 2FA?", "How do I disable 2FA?"),
+        ("Convert 100 USD to EUR", "Convert 100 EUR to USD"),
+        ("Who is the CEO of Twitter?", "Who was the CEO of Twitter?"),
+        ("Why does my password reset?", "Why does my password not reset?"),
+        ("Can I return an opened item?", "Can't I return an opened item?"),
+        ("Is it safe to mix bleach and ammonia?", "Is it safe to mix bleach and vinegar?"),
+        ("How many days are in 2023?", "How many days are in 2024?"),
+        ("What time does the store open?", "What time did the store open?"),
+    ]
+    for question, look_alike in pairs:
+        cache = SemanticCache()
+        cache.add(question, SCOPE, "answer")
+        assert cache.lookup(look_alike, SCOPE) is None, look_alike
+        assert cache.lookup(question, SCOPE) == "answer"
+    # Direction words are only compared when both questions have them
+    assert same_markers("How do I export my data to CSV?", "export data as csv")
+    assert not same_markers("convert usd to eur", "convert eur to usd")
+
+
+def test_embeddings_are_unit_vectors_and_stable():
+    vector = embed("How do I export my data to CSV?")
+    assert vector.dtype == np.float32 and abs(float(np.linalg.norm(vector)) - 1) < 1e-5
+    assert np.array_equal(vector, embed("how do I export my data to csv"))
+    assert not embed("?!").any()
+
+
+def test_least_recently_used_is_evicted_and_entries_expire():
+    cache = SemanticCache(max_entries=2, ttl=0.2)
+    cache.add("opening hours", SCOPE, "9 to 5")
+    cache.add("shipping costs", SCOPE, "Free over $50")
+    assert cache.lookup("what are your opening hours", SCOPE) == "9 to 5"
+    cache.add("cancel my subscription", SCOPE, "Settings > Billing")
+    assert len(cache) == 2 and cache.evictions == 1
+    assert cache.lookup("shipping costs", SCOPE) is None
+    assert cache.lookup("opening hours", SCOPE) == "9 to 5"
+
+    time.sleep(0.25)
+    assert cache.lookup("opening hours", SCOPE) is None
+    assert cache.expirations == 1
+
+
+def test_index_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / "semantic.npz")
+    cache = SemanticCache(path=path)
+    cache.add("How do I delete my account?", SCOPE, "Settings > Account > Delete")
+    cache.add("How do I delete my account?", SCOPE, "Settings > Privacy > Delete account")
+    assert len(cache) == 1
+    assert cache.save()
+
+    loaded = SemanticCache(path=path)
+    assert len(loaded) == 1
+    assert loaded.lookup("delete my account", SCOPE) == "Settings > Privacy > Delete account"
+    assert SemanticCache(path=path, dimensions=128).stats()["entries"] == 0
+
+
+def test_large_caches_search_only_nearby_clusters():
+    cache = SemanticCache(max_entries=5000, ann_min_entries=2000, nprobe=4)
+    for i in range(3000):
+        cache.add(f"question {i} about topic {i * 7919 % 1000} and item {i % 97}", SCOPE, f"answer {i}")
+    assert cache.stats()["index"] == "ann" and cache.stats()["clusters"] > 1
+    assert cache.lookup(f"question 2500 about topic {2500 * 7919 % 1000} and item {2500 % 97}", SCOPE) == "answer 2500"
@@ -0,0 +1,151 @@
+"""
+Tests for the pre-forked launcher: forking, readiness, draining, respawning and rolling reloads
+"""
+import os
+import select
+import signal
+import socket
+import time
+
+import pytest
+
+import serve
+
+# While this file exists, new workers wait before they report ready
+HOLD_READY = f"/tmp/test-serve-hold-{os.getpid()}"
+
+
+def _line_worker(master, ready):
+    """Answers each connection with its pid after a command: "pid", "slow" (half a second later) or "crash"."""
+    while os.path.exists(HOLD_READY):
+        time.sleep(0.05)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    ready()
+    master.sock.setblocking(False)
+    while not stopping:
+        if not select.select([master.sock], [], [], 0.05)[0]:
+            continue
+        try:
+            conn, _ = master.sock.accept()
+        except BlockingIOError:
+            continue
+        with conn:
+            conn.setblocking(True)
+            command = conn.recv(64).decode().strip()
+            if command == "crash":
+                raise RuntimeError("worker crashed while serving")
+            if command == "slow":
+                time.sleep(0.5)
+            conn.sendall(f"{os.getpid()}\n".encode())
+
+
+@pytest.fixture(autouse=True)
+def line_server(monkeypatch):
+    monkeypatch.setitem(serve.SERVERS, "line", _line_worker)
+    yield
+    if os.path.exists(HOLD_READY):
+        os.remove(HOLD_READY)
+
+
+def _start(workers=2, **kwargs):
+    """Fork a master serving ``_line_worker``; returns its pid and port."""
+    sock = serve.bind("127.0.0.1", 0)
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            serve.Master(sock, "line", workers, **kwargs).run()
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    port = sock.getsockname()[1]
+    sock.close()
+    return pid, port
+
+
+def _ask(port, command="pid"):
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+        conn.sendall(command.encode() + b"\n")
+        return conn.makefile().readline().strip()
+
+
+def _pids(port, expected, timeout=10):
+    """Ask until ``expected`` distinct workers have answered."""
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while len(seen) < expected and time.monotonic() < deadline:
+        seen.add(int(_ask(port)))
+    assert len(seen) == expected
+    return seen
+
+
+def _wait(pid, timeout=10):
+    """Exit code of the master, waiting at most ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return os.waitstatus_to_exitcode(status)
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    pytest.fail("master did not exit")
+
+
+def test_workers_that_crash_after_starting_are_replaced():
+    master, port = _start()
+    try:
+        workers = _pids(port, 2)
+        assert _ask(port, "crash") == ""
+        # The crashed worker is replaced, not treated as one that cannot start
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and int(_ask(port)) in workers:
+            pass
+        assert len(_pids(port, 2) - workers) == 1
+    finally:
+        os.kill(master, signal.SIGTERM)
+    assert _wait(master) == 0
+
+
+def test_sigterm_drains_requests_in_flight():
+    master, port = _start(graceful_timeout=5)
+    workers = _pids(port, 2)
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+        conn.sendall(b"slow\n")
+        time.sleep(0.1)
+        os.kill(master, signal.SIGTERM)
+        assert int(conn.makefile().readline()) in workers
+    assert _wait(master) == 0
+    with pytest.raises(OSError):
+        _ask(port)
+
+
+def test_worker_that_fails_before_it_is_ready_stops_the_master():
+    def broken():
+        raise ImportError("the app does not import")
+
+    master, _ = _start(worker_init=broken)
+    assert _wait(master) == 0
+
+
+def test_reload_replaces_workers_only_once_new_ones_are_ready():
+    master, port = _start(ready_timeout=1)
+    try:
+        old = _pids(port, 2)
+        # New workers never get ready: the reload is abandoned and the old workers keep serving
+        open(HOLD_READY, "w").close()
+        os.kill(master, signal.SIGHUP)
+        time.sleep(1.5)
+        assert _pids(port, 2) == old
+
+        os.remove(HOLD_READY)
+        os.kill(master, signal.SIGHUP)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and _pids(port, 2) & old:
+            time.sleep(0.1)
+        assert not _pids(port, 2) & old
+    finally:
+        os.kill(master, signal.SIGTERM)
+    assert _wait(master) == 0
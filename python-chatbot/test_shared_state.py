@@ -0,0 +1,201 @@
+"""
+Tests for state shared between worker processes: the stores and the components written through them
+"""
+import asyncio
+import multiprocessing
+import os
+import stat
+import struct
+import threading
+import time
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+import chatbot
+
+from conversation_memory import SharedConversationStore
+from idempotency import IdempotencyConflict, RequestCoalescer
+from response_cache import ResponseCache
+from shared_state import MemoryStore, SharedMapping, SqliteStore, default_path
+from speech import Speech, wav_bytes
+
+
+class CountingEngine:
+    name = "counting"
+    settings = {"engine": "counting"}
+
+    def __init__(self):
+        self.calls = []
+
+    def synthesize(self, text):
+        self.calls.append(text)
+        return wav_bytes(struct.pack(f"<{len(text)}h", *range(len(text))), 16000)
+
+
+def _write_from_child(path):
+    SqliteStore(path).set("ns", "from-child", b"hello")
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_stores_expire_delete_and_clear_per_namespace(backend, tmp_path):
+    store = MemoryStore() if backend == "memory" else SqliteStore(str(tmp_path / "state.db"))
+    store.set("a", "k", b"1")
+    store.set("a", "short", b"2", ttl=0.05)
+    store.set("b", "k", b"3")
+    assert store.get("a", "k") == b"1" and store.get("b", "k") == b"3"
+    assert store.count("a") == 2
+    time.sleep(0.1)
+    assert store.get("a", "short") is None and store.count("a") == 1
+
+    assert store.delete("a", "k") and not store.delete("a", "k")
+    store.clear("b")
+    assert store.get("b", "k") is None
+
+    mapping = SharedMapping(store, "json")
+    mapping.set("x", {"answer": [1, 2]})
+    assert mapping.get("x") == {"answer": [1, 2]} and len(mapping) == 1
+
+
+def test_sqlite_store_is_shared_with_forked_processes_and_bounded(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStore(path, max_entries=10)
+    store.get("ns", "opened-before-fork")
+    child = multiprocessing.get_context("fork").Process(target=_write_from_child, args=(path,))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    assert store.get("ns", "from-child") == b"hello"
+
+    # Pruning runs every 1000 writes and keeps the newest entries of each namespace
+    for i in range(1000):
+        store.set("bulk", str(i), b"x")
+    assert store.count("bulk") == 10 and store.evictions == 990
+    assert store.get("ns", "from-child") == b"hello"
+
+
+def test_sqlite_files_are_private_to_their_deployment(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.db")
+    store = SqliteStore(path)
+    store.set("ns", "k", b"secret")
+    for suffix in ("", "-wal", "-shm"):
+        assert stat.S_IMODE(os.stat(path + suffix).st_mode) == 0o600
+
+    # A file left readable by others is tightened when it is opened
+    os.chmod(path, 0o644)
+    SqliteStore(path).get("ns", "k")
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    monkeypatch.setenv("PORT", "4000")
+    first = default_path()
+    monkeypatch.setenv("PORT", "4001")
+    assert default_path() != first
+    assert f"-{os.getuid()}-" in os.path.basename(first)
+
+
+def test_conversations_continue_on_another_worker(tmp_path):
+    shared = SqliteStore(str(tmp_path / "state.db"))
+    first = SharedConversationStore(shared, token_budget=60, summary_tokens=200)
+    second = SharedConversationStore(shared, token_budget=60, summary_tokens=200)
+
+    first.append("s1", "What is the capital of France?", "Paris is the capital of France.")
+    history = second.messages("s1")
+    assert [m.content for m in history] == ["What is the capital of France?", "Paris is the capital of France."]
+
+    for i in range(5):
+        second.append("s1", f"And question {i} about the city and its long history?", f"Answer {i} with a few more words in it.")
+    history = first.messages("s1")
+    # Older turns were folded into the summary, and both workers see the same result
+    assert history[0].content.startswith("Summary of the earlier conversation:")
+    assert history[-1].content == "Answer 4 with a few more words in it."
+    assert [m.content for m in second.messages("s1")] == [m.content for m in history]
+    assert first.stats()["sessions"] == 1
+
+    assert second.clear("s1") and first.messages("s1") == [] and not first.clear("s1")
+
+
+def test_cached_answers_and_keyed_replies_are_seen_by_every_worker():
+    shared = MemoryStore()
+    first, second = ResponseCache(shared=shared), ResponseCache(shared=shared)
+    first.set("question", "answer")
+    assert second.get("question") == "answer"
+    assert second.stats()["disk"]["hits"] == 1 and second.stats()["disk"]["entries"] == 1
+    # Promoted to the second worker's memory tier
+    assert second.memory.get("question") == "answer"
+
+    calls = []
+
+    def chat():
+        calls.append(1)
+        return "Paris"
+
+    coalescers = RequestCoalescer(shared=shared), RequestCoalescer(shared=shared)
+    assert coalescers[0].run(chat, "/api/chat", "fingerprint", idempotency_key="retry-1") == "Paris"
+    assert coalescers[1].run(chat, "/api/chat", "fingerprint", idempotency_key="retry-1") == "Paris"
+    assert len(calls) == 1 and coalescers[1].stats()["replayed"] == 1
+    with pytest.raises(IdempotencyConflict):
+        coalescers[1].run(chat, "/api/chat", "other fingerprint", idempotency_key="retry-1")
+
+
+def test_speech_audio_is_synthesized_once_across_workers():
+    shared = MemoryStore()
+    engine = CountingEngine()
+    first, second = Speech(engine, shared=shared), Speech(engine, shared=shared)
+    clip = first.clip("Hello there, friend.")
+    key = clip["url"].rsplit("/", 1)[1]
+    assert second.audio(key, timeout=5) == first.audio(key)
+    assert second.synthesize("Hello there, friend.") == first.synthesize("Hello there, friend.")
+    assert engine.calls == ["Hello there, friend."]
+
+
+def test_failed_speech_synthesis_is_not_awaited_by_other_workers():
+    class SlowStore(MemoryStore):
+        """A store whose writes land late, as they may across processes."""
+
+        def set(self, namespace, key, value, ttl=0):
+            time.sleep(0.1)
+            super().set(namespace, key, value, ttl)
+
+    class FailingEngine(CountingEngine):
+        def synthesize(self, text):
+            raise RuntimeError("engine crashed")
+
+    shared = SlowStore()
+    first, second = Speech(FailingEngine(), shared=shared), Speech(FailingEngine(), shared=shared)
+    key = first.submit("Hello there, friend.")
+    start = time.monotonic()
+    assert second.audio(key, timeout=5) is None
+    assert time.monotonic() - start < 1
+
+
+def test_async_chats_use_the_shared_store_off_the_event_loop(monkeypatch):
+    threads = set()
+
+    class RecordingStore(MemoryStore):
+        def get(self, namespace, key):
+            threads.add(threading.get_ident())
+            return super().get(namespace, key)
+
+        def set(self, namespace, key, value, ttl=0):
+            threads.add(threading.get_ident())
+            super().set(namespace, key, value, ttl)
+
+    shared = RecordingStore()
+    monkeypatch.setattr(chatbot, "response_cache", ResponseCache(shared=shared))
+    monkeypatch.setattr(chatbot, "conversation_store", SharedConversationStore(shared))
+    chatbot.model_router.use_clients(lambda name: RunnableLambda(lambda prompt: "Paris."))
+
+    async def chat():
+        answers = [await chatbot.achatbot("Capital of France?", conversation_id="async-shared")]
+        answers.append(await chatbot.achatbot("Capital of France?", conversation_id="async-shared"))
+        answers.append("".join([chunk async for chunk in await chatbot.achatbot(
+            "And of Spain?", stream=True, use_cache=False, conversation_id="async-shared")]))
+        return threading.get_ident(), answers
+
+    try:
+        loop_thread, answers = asyncio.run(chat())
+    finally:
+        chatbot.model_router.use_clients(chatbot._client)
+    assert answers == ["Paris.", "Paris.", "Paris."]
+    assert threads and loop_thread not in threads
+    assert len(chatbot.conversation_store.messages("async-shared")) == 6
@@ -0,0 +1,133 @@
+"""
+Tests for server-side speech: sentence splitting, WAV joining and the audio cache
+"""
+import asyncio
+import struct
+
+import pytest
+
+from speech import SentenceSplitter, Speech, asentences, reply_audio, sentences, speakable, split_sentences, wav_bytes, wav_pcm
+
+
+class ToneEngine:
+    """Stands in for espeak: one 16-bit sample per character of the sentence."""
+
+    name = "tone"
+
+    def __init__(self, voice="a"):
+        self.voice = voice
+        self.calls = []
+
+    @property
+    def settings(self):
+        return {"engine": self.name, "voice": self.voice}
+
+    def synthesize(self, text):
+        if text == "fail":
+            raise RuntimeError("engine crashed")
+        self.calls.append(text)
+        return wav_bytes(struct.pack(f"<{len(text)}h", *range(len(text))), 16000)
+
+
+def test_streamed_text_is_split_into_speakable_sentences():
+    splitter = SentenceSplitter()
+    tokens = ["Sure! Here", " is what Dr. Smith", " said, e.g. rest", ". Then **drink** water", "!\n", "- Walk [daily](http://x.io).", " 3.5 km"]
+    completed = [splitter.feed(token) for token in tokens]
+    assert completed[:3] == [[], [], []]
+    assert completed[3] == ["Sure! Here is what Dr. Smith said, e.g. rest."]
+    assert completed[4] == ["Then drink water!"]
+    assert splitter.flush() == ["Walk daily. 3.5 km"]
+
+    assert split_sentences("Look:\n```python\nprint(1)\n\nx = 2\n```\nThat prints one.") == ["Look: That prints one."]
+    assert speakable("## Title\n1. `code` and __bold__") == "Title code and bold"
+    long = split_sentences("word, " * 100)
+    assert len(long) > 1 and all(len(sentence) <= 250 for sentence in long)
+
+
+def test_wav_helpers_read_pipe_written_sizes_and_reject_other_audio():
+    audio = wav_bytes(b"\x01\x00\x02\x00", 22050)
+    assert wav_pcm(audio)[0] == (1, 22050, 2) and bytes(wav_pcm(audio)[1]) == b"\x01\x00\x02\x00"
+    # espeak writing to a pipe leaves a placeholder data size
+    piped = audio[:40] + struct.pack("<I", 0x7FFFF000) + audio[44:]
+    assert bytes(wav_pcm(piped)[1]) == b"\x01\x00\x02\x00"
+    with pytest.raises(ValueError):
+        wav_pcm(b"ID3\x03 not a wav file")
+
+
+def test_sentences_are_synthesized_once_and_keyed_by_voice():
+    engine = ToneEngine()
+    speech = Speech(engine)
+    clips = speech.clips("Hello there, friend. How are you doing today?")
+    assert [clip["text"] for clip in clips] == ["Hello there, friend.", "How are you doing today?"]
+    key = clips[0]["url"].rsplit("/", 1)[1]
+    assert wav_pcm(speech.audio(key))[1].nbytes == 2 * len("Hello there, friend.")
+
+    assert speech.clip("Hello there, friend.") == clips[0]
+    assert speech.synthesize("How are you doing today?") is speech.audio(clips[1]["url"].rsplit("/", 1)[1])
+    assert engine.calls == ["Hello there, friend.", "How are you doing today?"]
+    assert speech.stats()["hits"] == 2 and speech.stats()["misses"] == 2
+
+    assert Speech(ToneEngine(voice="b")).key("Hello there, friend.") != key
+    assert speech.audio("0" * 64) is None
+    with pytest.raises(RuntimeError):
+        speech.synthesize("fail")
+    assert speech.stats()["failures"] == 1
+
+    assert reply_audio(speech, "Nothing requested.", False) == {}
+    assert reply_audio(None, "Speech is off here.", True) == {"audio": None}
+
+
+def test_wav_stream_starts_with_the_first_sentence_and_keeps_order():
+    engine = ToneEngine()
+    speech = Speech(engine, workers=4)
+    tokens = ["First sentence is here. ", "Second one follows now. ", "And the third one ends it."]
+    read = []
+
+    def model():
+        for token in tokens:
+            read.append(token)
+            yield token
+
+    stream = speech.stream(sentences(model()))
+    chunks = [next(stream)]
+    # The first sentence is sent before the model has written the rest
+    assert len(read) == 1
+    chunks += list(stream)
+    header = chunks[0][:44]
+    assert header[:4] == b"RIFF" and struct.unpack("<I", header[40:44])[0] == 0xFFFFFFFF
+    audio_format, pcm = wav_pcm(b"".join(chunks))
+    assert audio_format == (1, 16000, 2)
+    expected = b"".join(bytes(wav_pcm(speech.synthesize(s))[1]) for s in split_sentences("".join(tokens)))
+    assert bytes(pcm) == expected
+
+
+def test_async_wav_stream_matches_the_sync_one():
+    engine = ToneEngine()
+    speech = Speech(engine)
+
+    async def tokens():
+        for token in ["One short sentence here. ", "Another short sentence."]:
+            yield token
+
+    async def collect():
+        return [chunk async for chunk in speech.astream(asentences(tokens()))]
+
+    chunks = asyncio.run(collect())
+    assert b"".join(chunks) == b"".join(speech.stream(["One short sentence here.", "Another short sentence."]))
+    assert engine.calls == ["One short sentence here.", "Another short sentence."]
+
+
+def test_sentences_that_fail_to_synthesize_are_left_out_of_the_stream():
+    engine = ToneEngine()
+    speech = Speech(engine)
+    expected = b"".join(speech.stream(["First one is fine.", "Last one is fine too."]))
+    assert b"".join(speech.stream(["fail", "First one is fine.", "fail", "Last one is fine too."])) == expected
+
+    async def sentences():
+        for sentence in ["First one is fine.", "fail", "Last one is fine too."]:
+            yield sentence
+
+    async def collect():
+        return [chunk async for chunk in speech.astream(sentences())]
+
+    assert b"".join(asyncio.run(collect())) == expected
@@ -0,0 +1,97 @@
+"""
+Tests for streamed answers: SSE framing, completion and upstream cancellation
+"""
+import json
+
+import pytest
+from langchain_core.runnables import Runnable
+from starlette.testclient import TestClient
+
+import api
+import asgi_api
+import chatbot
+from chatbot import _stream_response
+
+
+class FakeStream(Runnable):
+    """Model that streams fixed chunks and counts how often its streams were closed."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        return "".join(self.chunks)
+
+    def stream(self, input, config=None, **kwargs):
+        try:
+            yield from self.chunks
+        finally:
+            self.closed += 1
+
+    async def astream(self, input, config=None, **kwargs):
+        try:
+            for chunk in self.chunks:
+                yield chunk
+        finally:
+            self.closed += 1
+
+
+@pytest.fixture
+def model():
+    fake = FakeStream(["Hello", " there", "."])
+    chatbot.model_router.use_clients(lambda name: fake)
+    yield fake
+    chatbot.model_router.use_clients(chatbot._client)
+
+
+def _frames(body):
+    frames = []
+    for frame in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        frames.append((lines.get("event"), json.loads(lines["data"])))
+    return frames
+
+
+def test_on_complete_runs_only_for_finished_streams():
+    completed = []
+    fake = FakeStream(["a", "", "b"])
+    assert list(_stream_response(fake, "question", completed.append)) == ["a", "b"]
+    assert completed == ["ab"] and fake.closed == 1
+
+    stream = _stream_response(fake, "question", completed.append)
+    assert next(stream) == "a"
+    stream.close()
+    assert completed == ["ab"] and fake.closed == 2
+
+
+@pytest.mark.parametrize("app", ["flask", "asgi"])
+def test_tokens_are_sent_as_sse_frames_then_done(app, model):
+    body = {"message": f"Say hello over {app}", "cache": False}
+    if app == "flask":
+        response = api.app.test_client().post("/api/chat/stream", json=body)
+        text = response.get_data(as_text=True)
+    else:
+        response = TestClient(asgi_api.app).post("/api/chat/stream", json=body)
+        text = response.text
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+
+    frames = _frames(text)
+    assert frames[:3] == [(None, {"token": "Hello"}), (None, {"token": " there"}), (None, {"token": "."})]
+    event, done = frames[-1]
+    assert event == "done" and done["attachments_processed"] == 0
+    assert done["usage"]["response_tokens"] > 0
+    assert model.closed == 1
+
+
+def test_closing_the_stream_cancels_the_model_call_and_forgets_the_turn(model):
+    tokens = chatbot.chatbot("Tell me a story", stream=True, use_cache=False, conversation_id="stream-closed")
+    assert next(tokens) == "Hello"
+    tokens.close()
+    assert model.closed == 1
+    assert chatbot.conversation_store.messages("stream-closed") == []
+
+    tokens = chatbot.chatbot("Tell me a story", stream=True, use_cache=False, conversation_id="stream-finished")
+    assert "".join(tokens) == "Hello there."
+    assert [m.content for m in chatbot.conversation_store.messages("stream-finished")][-1] == "Hello there."
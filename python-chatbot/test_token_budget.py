@@ -0,0 +1,98 @@
+"""
+Tests for token estimation and the prompt token budget
+"""
+import pytest
+
+from metrics import end_request, start_request
+from token_budget import PromptTooLarge, TokenBudget, estimate_tokens, fair_shares, image_tokens, record_estimate, usage
+
+PROSE = (
+    "The history of the city goes back more than two thousand years. It began as a small fishing village on the "
+    "northern bank of the river, where traders from the south stopped to exchange salt, wool and pottery for fish "
+    "and timber. Over the centuries the settlement grew into a market town, and by the twelfth century it had a "
+    "cathedral, a university and a population of roughly twenty thousand people. Could you summarize the main "
+    "economic drivers of the region, and explain why the population declined during the industrial revolution?"
+)
+CODE = '''def select(self, query: str, token_budget: int = TOKEN_BUDGET, top_k: int = TOP_K) -> List:
+    ranked = self.search(query, top_k) or range(min(top_k, len(self.chunks)))
+    selected = []
+    used = 0
+    for i in ranked:
+        tokens = estimate_tokens(self.chunks[i].text)
+        if used + tokens > token_budget and selected:
+            continue
+        selected.append(i)
+        used += tokens
+    return [self.chunks[i] for i in sorted(selected)]
+'''
+JSON = '{"results": [' + ", ".join(
+    f'{{"index": {i}, "response": "Answer number {i}", "error": null, "cached": false}}' for i in range(20)
+) + '], "succeeded": 20, "failed": 0}'
+
+
+@pytest.mark.parametrize("text, reference", [(PROSE, 101), (CODE, 116), (JSON, 516)])
+def test_estimate_is_within_ten_percent_of_a_subword_tokenizer(text, reference):
+    # Reference counts from a 200k-vocabulary BPE tokenizer
+    assert abs(estimate_tokens(text) - reference) <= reference * 0.1
+
+
+def test_fair_shares_and_image_tokens():
+    assert fair_shares([10, 500, 1000], 410) == [10, 200, 200]
+    assert fair_shares([10, 20], 100) == [10, 20]
+    assert fair_shares([10, 20], -5) == [0, 0]
+    assert image_tokens() == 258
+    assert image_tokens(300, 200) == 258
+    assert image_tokens(1024, 768) == 2 * 258
+
+
+def test_fit_drops_old_turns_then_narrows_the_largest_attachments():
+    budget = TokenBudget(total_tokens=1500, output_tokens=100)
+    narrowed = []
+
+    def narrow(i, tokens):
+        narrowed.append((i, tokens))
+        return "word " * tokens
+
+    attachments = [("small.txt", "word " * 50), ("big.log", "word " * 2000), ("huge.log", "word " * 5000)]
+    contents, estimate = budget.fit(400, [300, 200], attachments, narrow)
+    assert estimate.history_dropped == 0
+    assert contents[0] == attachments[0][1]
+    assert narrowed == [(1, 225), (2, 225)]
+    assert estimate.trimmed == ["big.log", "huge.log"] and estimate.omitted == []
+    assert estimate.prompt_tokens == budget.input_tokens
+
+    # Turns that do not fit next to the question go first, oldest first; a share too small to be useful is left out
+    _, estimate = budget.fit(400, [300, 200, 650], attachments, narrow)
+    assert estimate.history_dropped == 1
+    assert estimate.omitted == ["big.log", "huge.log"]
+    assert narrowed[-2:] == [(1, 0), (2, 0)]
+
+    with pytest.raises(PromptTooLarge):
+        budget.fit(1401, [], [], narrow)
+
+
+def test_narrowed_attachments_still_over_are_left_out_last_first():
+    budget = TokenBudget(total_tokens=1500, output_tokens=100)
+    attachments = [("small.txt", "word " * 50), ("big.log", "word " * 2000), ("huge.log", "word " * 5000)]
+    # Narrowing keeps whole sections, so it can come out larger than asked for
+    contents, estimate = budget.fit(400, [], attachments, lambda i, tokens: "word " * (tokens * 2) if tokens else "")
+    assert estimate.trimmed == ["big.log"] and estimate.omitted == ["huge.log"]
+    assert contents[2] == ""
+    assert estimate.prompt_tokens <= budget.input_tokens
+
+
+def test_estimate_is_reported_on_the_request():
+    budget = TokenBudget(total_tokens=1000, output_tokens=200)
+    trace, token = start_request("/api/chat", "POST")
+    try:
+        _, estimate = budget.fit(100, [50], [("notes.txt", "word " * 30)], lambda i, tokens: "")
+        record_estimate(estimate)
+        trace.response_tokens = 42
+    finally:
+        end_request(token)
+    assert trace.prompt_tokens == 180
+    assert usage(trace) == {
+        "prompt_tokens": 180, "input_budget": 800, "max_output_tokens": 200, "history_dropped": 0,
+        "attachments_trimmed": [], "attachments_omitted": [], "response_tokens": 42,
+    }
+    assert usage(None) is None
@@ -0,0 +1,55 @@
+"""
+Tests for the streaming upload pipeline
+"""
+import base64
+import io
+
+import pytest
+
+from uploads import LimitedSpooledFile, UploadTooLarge, read_upload, sniff_mime_type
+
+
+def test_sniff_prefers_magic_numbers_over_declared_type():
+    assert sniff_mime_type(b"\x89PNG\r\n\x1a\n....", "photo", "application/octet-stream") == "image/png"
+    assert sniff_mime_type(b"%PDF-1.7", "scan.txt", "text/plain") == "application/pdf"
+    assert sniff_mime_type(b"PK\x03\x04", "report.docx", None) == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    assert sniff_mime_type(b"PK\x03\x04", "archive.bin", None) == "application/zip"
+    assert sniff_mime_type(b"plain words", "README", "") == "text/plain"
+
+
+def test_text_upload_keeps_bounded_prefix_and_full_digest():
+    data = b"line of log output\n" * 10_000
+    attachment = read_upload(io.BytesIO(data), "server.log", "text/plain")
+
+    assert attachment['type'] == 'text'
+    assert attachment['encoding'] == 'text'
+    assert data.decode().startswith(attachment['content'])
+    assert len(attachment['content']) < len(data)
+    assert attachment['truncated']
+    assert attachment['size'] == len(data)
+
+
+def test_image_upload_is_encoded_once_as_data_url():
+    data = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 3000
+    attachment = read_upload(io.BytesIO(data), "photo.png")
+
+    prefix, encoded = attachment['content'].split(",", 1)
+    assert prefix == "data:image/png;base64"
+    assert base64.b64decode(encoded) == data
+
+
+def test_document_content_is_not_retained():
+    attachment = read_upload(io.BytesIO(b"%PDF-1.4" + b"0" * 1000), "handbook.pdf", "application/pdf")
+    assert attachment['type'] == 'document'
+    assert attachment['content'] == ''
+    assert attachment['digest']
+
+
+def test_size_limits():
+    with pytest.raises(UploadTooLarge):
+        read_upload(io.BytesIO(b"x" * 11), "big.txt", max_file_bytes=10)
+
+    spool = LimitedSpooledFile(limit=10)
+    spool.write(b"x" * 10)
+    with pytest.raises(UploadTooLarge):
+        spool.write(b"x")
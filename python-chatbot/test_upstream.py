@@ -0,0 +1,99 @@
+"""
+Tests for the rate limiter, retries and circuit breaker around the model
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.exceptions import ModelInvalidRequestError, ModelRateLimitError
+from langchain_core.runnables import RunnableLambda
+
+from upstream import AdaptiveRateLimiter, CircuitBreaker, GuardedModel, UpstreamUnavailable
+
+
+def _flaky(failures):
+    """Runnable failing with a 429 for the first ``failures`` calls."""
+    calls = []
+
+    def answer(question):
+        calls.append(question)
+        if len(calls) <= failures:
+            raise ModelRateLimitError("429 Resource has been exhausted")
+        return question.upper()
+
+    return RunnableLambda(answer), calls
+
+
+def test_rate_limits_are_retried_and_slow_the_limiter_down():
+    model, calls = _flaky(2)
+    limiter = AdaptiveRateLimiter(rate=100, burst=10)
+    guarded = GuardedModel(model, limiter, CircuitBreaker(failure_threshold=10), attempts=4, backoff_base=0.01)
+
+    assert guarded.invoke("hi") == "HI"
+    assert len(calls) == 3
+    assert guarded.stats()["retries"] == 2
+    assert limiter.rate < 100
+    assert asyncio.run(guarded.ainvoke("again")) == "AGAIN"
+
+
+def test_exhausted_retries_raise_upstream_unavailable_and_open_the_breaker():
+    clock = [0.0]
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=lambda: clock[0])
+    model, calls = _flaky(100)
+    guarded = GuardedModel(model, AdaptiveRateLimiter(rate=1000, burst=100), breaker, attempts=3, backoff_base=0.001)
+
+    with pytest.raises(UpstreamUnavailable):
+        guarded.invoke("hi")
+    assert breaker.state == "open"
+    # Further calls fail fast without reaching the model
+    with pytest.raises(UpstreamUnavailable) as error:
+        guarded.invoke("hi")
+    assert len(calls) == 3
+    assert error.value.retry_after == 30
+
+    # After the reset timeout one probe goes through and closes the breaker again
+    clock[0] = 31
+    calls.clear()
+    model.func = lambda question: "ok"
+    assert guarded.invoke("hi") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_invalid_requests_are_not_retried():
+    attempts = []
+
+    def reject(question):
+        attempts.append(question)
+        raise ModelInvalidRequestError("400 bad request")
+
+    guarded = GuardedModel(RunnableLambda(reject), breaker=CircuitBreaker(failure_threshold=1))
+    with pytest.raises(ModelInvalidRequestError):
+        guarded.invoke("hi")
+    assert len(attempts) == 1
+    assert guarded.breaker.state == "closed"
+
+
+def test_waiting_users_are_served_round_robin():
+    limiter = AdaptiveRateLimiter(rate=50, burst=1, max_wait=10)
+    limiter.acquire("warmup")
+    order = []
+    lock = threading.Lock()
+
+    def call(user):
+        limiter.acquire(user)
+        with lock:
+            order.append(user)
+
+    heavy = [threading.Thread(target=call, args=("heavy",)) for _ in range(8)]
+    for thread in heavy:
+        thread.start()
+    time.sleep(0.01)
+    light = threading.Thread(target=call, args=("light",))
+    light.start()
+    for thread in heavy + [light]:
+        thread.join()
+
+    # The light user queued behind eight heavy calls but is served within the first two
+    assert order.index("light") <= 1
+    assert limiter.stats()["granted"] == 10
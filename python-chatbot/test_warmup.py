@@ -0,0 +1,71 @@
+"""
+Tests for warm-up, readiness and the lazily imported dependencies
+"""
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from warmup import COLD, FAILED, READY, WARMING, WarmUp, warm_up_from_env
+
+
+def test_steps_run_once_and_the_process_is_ready():
+    calls = []
+    warmup = WarmUp([("a", lambda: calls.append("a")), ("b", lambda: calls.append("b"))])
+    assert warmup.state == COLD and warmup.ready
+
+    assert warmup.run()
+    assert warmup.run()
+    assert calls == ["a", "b"]
+    assert warmup.state == READY and warmup.ready
+    assert set(warmup.stats()["step_ms"]) == {"a", "b"}
+
+
+def test_a_failing_step_leaves_the_process_not_ready():
+    def broken():
+        raise RuntimeError("no credentials")
+
+    after = []
+    warmup = WarmUp([("model_clients", broken), ("pdf", lambda: after.append(1))])
+    assert not warmup.run()
+    assert warmup.state == FAILED and not warmup.ready
+    assert warmup.error == "model_clients: no credentials"
+    assert after == []
+
+
+def test_background_warm_up_is_not_ready_until_done():
+    release = threading.Event()
+    warmup = WarmUp([("slow", release.wait)])
+    thread = warmup.start()
+    assert warmup.state == WARMING and not warmup.ready
+    release.set()
+    thread.join(5)
+    assert warmup.state == READY and warmup.ready
+
+
+def test_warm_up_mode_comes_from_the_environment(monkeypatch):
+    calls = []
+    monkeypatch.setenv("WARMUP", "off")
+    warmup = WarmUp([("a", lambda: calls.append("a"))])
+    warm_up_from_env(warmup)
+    assert calls == [] and warmup.state == COLD
+
+    monkeypatch.setenv("WARMUP", "blocking")
+    warm_up_from_env(warmup)
+    assert calls == ["a"] and warmup.state == READY
+
+    monkeypatch.setenv("WARMUP", "eager")
+    with pytest.raises(ValueError):
+        warm_up_from_env(warmup)
+
+
+def test_importing_the_app_defers_the_heavy_dependencies():
+    code = ("import sys, chatbot; "
+            "print(sorted(m for m in ('langchain_google_genai', 'poml', 'pypdf') if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=120,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", "test-key")})
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
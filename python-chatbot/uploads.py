@@ -0,0 +1,215 @@
+"""
+Streaming pipeline for multipart file uploads.
+
+Uploaded files are spooled to temporary storage by the web framework and
+read back in fixed-size chunks. Each file is read once: the whole file is
+hashed for the response cache, its type is sniffed from the first bytes,
+and only what ``chatbot()`` actually uses is kept - a bounded text prefix
+(plus a retrieval index over the whole text when it is longer), the image
+as a base64 data URL encoded once (or downscaled first when an image
+processor is given), or extracted document text.
+
+Configuration (environment variables):
+    UPLOAD_MAX_FILE_BYTES      per-file limit (default 20 MB)
+    UPLOAD_MAX_REQUEST_BYTES   per-request limit (default 50 MB)
+    UPLOAD_TEXT_PREFIX_BYTES   bytes of a text file passed to the model (default 4096)
+"""
+import base64
+import hashlib
+import mimetypes
+import os
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Dict, Optional
+
+from attachments import DOCUMENT_MIME_TYPES, classify_attachment
+from document_extraction import DocumentExtractor
+from image_processing import ImageProcessor
+from retrieval import Retriever
+
+MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(50 * 1024 * 1024)))
+TEXT_PREFIX_BYTES = int(os.getenv("UPLOAD_TEXT_PREFIX_BYTES", "4096"))
+
+# Files larger than this are spooled to disk instead of memory while parsing
+SPOOL_MAX_MEMORY = 512 * 1024
+# Multiple of 3 so base64 chunks concatenate without padding in between
+CHUNK_SIZE = 3 * 64 * 1024
+SNIFF_BYTES = 512
+
+_MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"%PDF-", "application/pdf"),
+]
+_ZIP_MAGIC = b"PK\x03\x04"
+_OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+_GENERIC_MIME_TYPES = ("", "application/octet-stream")
+
+
+class UploadTooLarge(Exception):
+    """Raised when an uploaded file or request exceeds the configured size limits."""
+
+    def __init__(self, message: str, limit: int):
+        super().__init__(message)
+        self.limit = limit
+
+
+class LimitedSpooledFile(SpooledTemporaryFile):
+    """
+    Spooled temporary file that refuses to grow past ``limit`` bytes.
+
+    Used as the multipart parser's file container so an oversized file is
+    rejected while it is still being received, not after it is stored.
+    """
+
+    def __init__(self, limit: int = MAX_FILE_BYTES, max_size: int = SPOOL_MAX_MEMORY):
+        super().__init__(max_size=max_size, mode="w+b")
+        self.limit = limit
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        if self.written > self.limit:
+            raise UploadTooLarge(f"File exceeds the {self.limit} byte upload limit", self.limit)
+        return super().write(data)
+
+
+def looks_like_text(header: bytes) -> bool:
+    """Heuristic: no NUL bytes and valid UTF-8 apart from a possibly cut-off last character."""
+    if b"\x00" in header:
+        return False
+    try:
+        header.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        return e.start >= len(header) - 3
+
+
+def sniff_mime_type(header: bytes, filename: str, declared: Optional[str] = None) -> str:
+    """
+    Work out a file's MIME type from its first bytes.
+
+    Magic numbers win over the client's declared type, since browsers often
+    send ``application/octet-stream`` or guess from the extension. ZIP and
+    OLE containers are only trusted as Word documents when the name or the
+    declared type says so.
+    """
+    declared = (declared or "").split(";")[0].strip().lower()
+    guessed = mimetypes.guess_type(filename)[0] or ""
+
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith(_ZIP_MAGIC) or header.startswith(_OLE_MAGIC):
+        for candidate in (declared, guessed):
+            if candidate in DOCUMENT_MIME_TYPES:
+                return candidate
+        return "application/zip" if header.startswith(_ZIP_MAGIC) else "application/x-ole-storage"
+
+    if declared not in _GENERIC_MIME_TYPES:
+        return declared
+    if guessed:
+        return guessed
+    return "text/plain" if header and looks_like_text(header) else "application/octet-stream"
+
+
+def file_size(stream: BinaryIO) -> int:
+    """Size of a seekable stream, leaving the position at the start."""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def read_upload(stream: BinaryIO, filename: str, content_type: Optional[str] = None, max_file_bytes: int = MAX_FILE_BYTES,
+                extractor: Optional[DocumentExtractor] = None, retriever: Optional[Retriever] = None,
+                image_processor: Optional[ImageProcessor] = None) -> Dict:
+    """
+    Turn an uploaded file into an attachment dictionary in a single pass.
+
+    Args:
+        stream: Seekable binary file object, e.g. a spooled upload
+        filename (str): Original filename
+        content_type (str, optional): MIME type declared by the client
+        max_file_bytes (int): Reject files larger than this
+        extractor (DocumentExtractor, optional): Extracts PDF/DOCX text, reusing
+            earlier extractions of the same file content
+        retriever (Retriever, optional): Indexes text files longer than the
+            prefix, reusing the index of an earlier upload of the same content
+        image_processor (ImageProcessor, optional): Downscales images, reusing
+            the result for an earlier upload of the same content
+
+    Returns:
+        Dict: Attachment with ``type``, ``filename``, ``content``, ``mime_type``,
+        ``encoding``, ``size``, ``digest`` (SHA-256 of the full file) and, for
+        documents, ``extracted`` text, for long text files, an ``index`` or, for
+        processed images, the ``image``
+    """
+    size = file_size(stream)
+    if size > max_file_bytes:
+        raise UploadTooLarge(f"{filename} exceeds the {max_file_bytes} byte upload limit", max_file_bytes)
+
+    header = stream.read(SNIFF_BYTES)
+    mime_type = sniff_mime_type(header, filename, content_type)
+    attachment_type = classify_attachment(mime_type)
+
+    hasher = hashlib.sha256(header)
+    # Images are emitted as a ready-made data URL so chatbot() doesn't copy them again,
+    # unless they are about to be downscaled, in which case only the smaller copy is encoded
+    encode_image = attachment_type == 'image' and image_processor is None
+    encoded_parts = [f"data:{mime_type};base64,"]
+    text_prefix = bytearray(header[:TEXT_PREFIX_BYTES]) if attachment_type == 'text' else None
+    pending = header
+
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if chunk:
+            hasher.update(chunk)
+        if encode_image:
+            pending += chunk
+            # Encode whole 3-byte groups as they arrive; the remainder waits for the next chunk
+            cut = len(pending) if not chunk else len(pending) - len(pending) % 3
+            encoded_parts.append(base64.b64encode(pending[:cut]).decode('ascii'))
+            pending = pending[cut:]
+        elif text_prefix is not None and len(text_prefix) < TEXT_PREFIX_BYTES:
+            text_prefix += chunk[:TEXT_PREFIX_BYTES - len(text_prefix)]
+        if not chunk:
+            break
+
+    image = None
+    if encode_image:
+        content, encoding = "".join(encoded_parts), 'base64'
+    elif attachment_type == 'image':
+        # The original is read again only if this content has not been processed before
+        image = image_processor.process(stream, mime_type, digest=hasher.hexdigest())
+        content, encoding = image.data_url, 'base64'
+    elif text_prefix is not None:
+        content, encoding = bytes(text_prefix).decode('utf-8', errors='ignore'), 'text'
+    else:
+        # Documents and unknown types are only described to the model, not sent
+        content, encoding = '', 'none'
+
+    attachment = {
+        'type': attachment_type,
+        'filename': filename,
+        'content': content,
+        'mime_type': mime_type,
+        'encoding': encoding,
+        'size': size,
+        'digest': hasher.hexdigest(),
+        'truncated': text_prefix is not None and size > len(text_prefix),
+    }
+    if attachment_type == 'document' and extractor is not None:
+        stream.seek(0)
+        attachment['extracted'] = extractor.extract(stream, mime_type, digest=attachment['digest'])
+    elif attachment['truncated'] and retriever is not None:
+        # The file is read again only if this content has not been indexed before
+        attachment['index'] = retriever.index(stream, digest=attachment['digest'])
+    elif image is not None:
+        attachment['image'] = image
+    return attachment
@@ -0,0 +1,585 @@
+"""
+Adaptive rate limiting, retries and a circuit breaker around the model client.
+
+``GuardedModel`` wraps the chat model as a drop-in LangChain runnable. Each
+model call (each retry included) goes through three steps:
+
+* The circuit breaker fast-fails every call for ``LLM_BREAKER_RESET``
+  seconds after ``LLM_BREAKER_FAILURES`` consecutive upstream failures.
+  After that one probe call is let through, and its outcome closes or
+  reopens the breaker.
+* A token bucket paces calls. Waiting calls are queued per user (the
+  ``X-User-Id`` header, otherwise the client address) and tokens are
+  handed out round-robin across users, so one heavy user cannot starve
+  the others. The rate adapts (AIMD): every 429 halves it, answers slower
+  than ``LLM_TARGET_LATENCY`` cut it by 10%, and other successes raise it
+  slowly back towards ``LLM_RATE_MAX``.
+* Rate limits, 5xx errors, timeouts and connection errors are retried with
+  full-jitter exponential backoff. Streams are retried only until their
+  first chunk has been sent.
+
+When a call cannot be made (breaker open, rate-limit wait too long, retries
+exhausted) ``UpstreamUnavailable`` is raised. It is an ``Overloaded``, so
+the APIs answer 503 with ``Retry-After`` instead of a 500 that clients
+retry immediately.
+
+A call may carry a deadline (``set_deadline``; the model router sets one
+from its fallback timeout). The rate-limit wait and the retry backoff are
+cut short at the deadline, and no attempt is started after it, so a call
+that has been given up on stops making upstream requests.
+
+Configuration (environment variables):
+    LLM_RATE_LIMIT         initial calls per second (default 5)
+    LLM_RATE_MIN           lowest adapted rate (default 0.5)
+    LLM_RATE_MAX           highest adapted rate (default 50)
+    LLM_BURST              calls allowed back to back (default 10)
+    LLM_TARGET_LATENCY     seconds; slower answers lower the rate (default 15)
+    LLM_RATE_WAIT          seconds a call may wait for the rate limiter (default 30)
+    LLM_RATE_QUEUE         calls allowed to wait for the rate limiter (default 256)
+    LLM_RETRY_ATTEMPTS     attempts per call, including the first (default 4)
+    LLM_RETRY_BASE         backoff before the first retry, in seconds (default 0.5)
+    LLM_RETRY_MAX          longest backoff in seconds (default 8)
+    LLM_BREAKER_FAILURES   consecutive failures that open the breaker (default 5)
+    LLM_BREAKER_RESET      seconds the breaker stays open (default 30)
+
+The rate settings are for the whole deployment. With ``WORKERS`` worker
+processes (serve.py sets it) each process gets its share of the rate and
+the burst.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar, Token
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional
+
+from langchain_core.exceptions import ModelRateLimitError
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from concurrency import Overloaded
+from metrics import Counter, registry
+
+USER_HEADER = "X-User-Id"
+
+upstream_retries = registry.register(Counter(
+    "chatbot_upstream_retries_total", "Model calls retried after a retryable error.", ("reason",)))
+upstream_rejected = registry.register(Counter(
+    "chatbot_upstream_rejected_total", "Model calls not made because the upstream guard refused them.", ("reason",)))
+
+_user: ContextVar[str] = ContextVar("upstream_user", default="anonymous")
+_deadline: ContextVar[Optional[float]] = ContextVar("upstream_deadline", default=None)
+
+
+def set_user(user: Optional[str]) -> Token:
+    """Make ``user`` the owner of model calls in the current request; pass the token to ``reset_user``."""
+    return _user.set(user or "anonymous")
+
+
+def reset_user(token: Token) -> None:
+    _user.reset(token)
+
+
+def current_user() -> str:
+    return _user.get()
+
+
+def set_deadline(timeout: float) -> Token:
+    """Give model calls in the current context ``timeout`` seconds from now; pass the token to ``reset_deadline``."""
+    return _deadline.set(time.monotonic() + timeout)
+
+
+def reset_deadline(token: Token) -> None:
+    _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left before the current context's deadline, None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def request_user(user_header: Optional[str], client_address: Optional[str]) -> str:
+    """Fair-queuing identity of a request: the ``X-User-Id`` header, else the client address."""
+    return (user_header or "").strip()[:128] or client_address or "anonymous"
+
+
+class UpstreamUnavailable(Overloaded):
+    """Raised when a model call is refused or keeps failing; answered with 503 and ``Retry-After``."""
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """``"rate_limited"``, ``"retryable"`` or None for errors a retry cannot fix."""
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(error, ModelRateLimitError) or code == 429:
+        return "rate_limited"
+    if getattr(error, "is_retryable", False) or isinstance(error, (TimeoutError, ConnectionError)):
+        return "retryable"
+    if isinstance(code, int) and code >= 500:
+        return "retryable"
+    return None
+
+
+class _Waiter:
+    """A call queued for a rate-limit token."""
+
+    __slots__ = ("user", "granted", "event", "loop")
+
+    def __init__(self, user: str, event, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.user = user
+        self.granted = False
+        self.event = event
+        self.loop = loop
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket with an AIMD-adapted rate and per-user round-robin queuing.
+
+    Usable from threads (``acquire``) and event loops (``aacquire``) at the same time.
+
+    Args:
+        rate (float): Initial tokens per second
+        burst (int): Bucket size
+        min_rate (float): Lowest rate after decreases
+        max_rate (float): Highest rate after increases
+        target_latency (float): Calls slower than this lower the rate
+        max_wait (float): Seconds a call may wait for a token
+        max_queue (int): Calls allowed to wait at once
+        increase (float): Rate added per successful call
+    """
+
+    def __init__(self, rate: float = 5.0, burst: int = 10, min_rate: float = 0.5, max_rate: float = 50.0,
+                 target_latency: float = 15.0, max_wait: float = 30.0, max_queue: int = 256, increase: float = 0.1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.increase = increase
+        self._clock = clock
+        self.tokens = float(burst)
+        self._updated = clock()
+        self._last_decrease = float("-inf")
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _dispatch(self) -> list:
+        """Hand available tokens to waiters, one user at a time; returns the waiters to wake."""
+        self._refill()
+        woken = []
+        while self.tokens >= 1 and self._queues:
+            user, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                # The user goes to the back of the line behind everyone else waiting
+                self._queues[user] = queue
+            waiter.granted = True
+            self._waiting -= 1
+            self.tokens -= 1
+            self.granted += 1
+            woken.append(waiter)
+        return woken
+
+    def _next_token_in(self) -> float:
+        return max(0.001, (1 - self.tokens) / self.rate)
+
+    def _enqueue(self, user: str, event, loop=None) -> Optional[_Waiter]:
+        """Take a token straight away (returns None) or queue a waiter for one."""
+        with self._lock:
+            self._refill()
+            if not self._queues and self.tokens >= 1:
+                self.tokens -= 1
+                self.granted += 1
+                return None
+            if self._waiting >= self.max_queue:
+                self.rejected += 1
+                upstream_rejected.inc(1, "queue_full")
+                raise UpstreamUnavailable("rate limit queue full", retry_after=max(1, math.ceil(self._waiting / self.rate)))
+            waiter = _Waiter(user, event, loop)
+            self._queues.setdefault(user, deque()).append(waiter)
+            self._waiting += 1
+            self.queued += 1
+            return waiter
+
+    def _poll(self, waiter: _Waiter, deadline: float) -> float:
+        """Dispatch due tokens; returns how long ``waiter`` should sleep, 0 once it is granted."""
+        with self._lock:
+            woken = self._dispatch()
+            if not waiter.granted and self._clock() >= deadline:
+                self._queues[waiter.user].remove(waiter)
+                if not self._queues[waiter.user]:
+                    del self._queues[waiter.user]
+                self._waiting -= 1
+                self.rejected += 1
+                upstream_rejected.inc(1, "rate_limit_wait")
+                raise UpstreamUnavailable("timed out waiting for the upstream rate limit",
+                                          retry_after=max(1, math.ceil(self._waiting / self.rate)))
+            delay = 0.0 if waiter.granted else min(self._next_token_in(), deadline - self._clock())
+        for other in woken:
+            if other is not waiter:
+                other.wake()
+        return delay
+
+    def acquire(self, user: Optional[str] = None, timeout: Optional[float] = None) -> None:
+        """
+        Block until the calling thread may make a call.
+
+        Raises ``UpstreamUnavailable`` after ``max_wait`` seconds, or after ``timeout`` if that is shorter.
+        """
+        waiter = self._enqueue(user or current_user(), threading.Event())
+        if waiter is None:
+            return
+        deadline = self._clock() + (self.max_wait if timeout is None else min(self.max_wait, timeout))
+        while True:
+            delay = self._poll(waiter, deadline)
+            if not delay:
+                return
+            waiter.event.wait(delay)
+            waiter.event.clear()
+
+    async def aacquire(self, user: Optional[str] = None) -> None:
+        """Async counterpart of ``acquire()``."""
+        waiter = self._enqueue(user or current_user(), asyncio.Event(), asyncio.get_running_loop())
+        if waiter is None:
+            return
+        deadline = self._clock() + self.max_wait
+        try:
+            while True:
+                delay = self._poll(waiter, deadline)
+                if not delay:
+                    return
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                waiter.event.clear()
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        with self._lock:
+            queue = self._queues.get(waiter.user)
+            if queue and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.user]
+                self._waiting -= 1
+            elif waiter.granted:
+                # The token was handed over but will not be used
+                self.tokens = min(self.burst, self.tokens + 1)
+
+    def on_rate_limited(self) -> None:
+        """Halve the rate after a 429, at most once per refill interval, and drop saved-up tokens."""
+        with self._lock:
+            self.rate_limited += 1
+            now = self._clock()
+            if now - self._last_decrease >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._last_decrease = now
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    def on_success(self, latency: float) -> None:
+        """Lower the rate by 10% for a slow answer, otherwise raise it by ``increase``."""
+        with self._lock:
+            self._refill()
+            if latency > self.target_latency:
+                now = self._clock()
+                if now - self._last_decrease >= 1 / self.rate:
+                    self.rate = max(self.min_rate, self.rate * 0.9)
+                    self._last_decrease = now
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "tokens": round(self.tokens, 3),
+                "waiting": self._waiting,
+                "waiting_users": len(self._queues),
+                "granted": self.granted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "rate_limited": self.rate_limited,
+            }
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while the upstream keeps failing.
+
+    Args:
+        failure_threshold (int): Consecutive failures that open the breaker
+        reset_timeout (float): Seconds to stay open before letting one probe call through
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.fast_failed = 0
+
+    def before_call(self) -> None:
+        """Raise ``UpstreamUnavailable`` unless a call may be made now."""
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = self._opened_at + self.reset_timeout - self._clock()
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.fast_failed += 1
+        upstream_rejected.inc(1, "circuit_open")
+        raise UpstreamUnavailable("upstream model is failing, circuit breaker open", retry_after=max(1, math.ceil(remaining)))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def release(self) -> None:
+        """Give back the probe slot of a call that ended without reaching the upstream."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened += 1
+                self.state = "open"
+                self._opened_at = self._clock()
+                self._probing = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "opened": self.opened, "fast_failed": self.fast_failed}
+
+
+class GuardedModel(Runnable):
+    """
+    Runnable that sends calls to ``model`` through a rate limiter, retries and a circuit breaker.
+
+    Args:
+        model (Runnable): The chat model (or any runnable) to protect
+        limiter (AdaptiveRateLimiter): Paces calls and queues them fairly per user
+        breaker (CircuitBreaker): Fails fast while the upstream is down
+        attempts (int): Attempts per call, including the first
+        backoff_base (float): Backoff ceiling before the first retry, doubled per retry
+        backoff_max (float): Largest backoff ceiling
+    """
+
+    def __init__(self, model: Runnable, limiter: Optional[AdaptiveRateLimiter] = None, breaker: Optional[CircuitBreaker] = None,
+                 attempts: int = 4, backoff_base: float = 0.5, backoff_max: float = 8.0):
+        self.model = model
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.attempts = max(1, attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter backoff before retry number ``attempt + 1``."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Record a failed attempt; returns the backoff before retrying, or raises if the call is over."""
+        kind = classify_error(error)
+        if kind is None:
+            # The upstream answered, the request itself was bad
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if kind == "rate_limited":
+            self.limiter.on_rate_limited()
+        if attempt + 1 >= self.attempts:
+            self._count("failures")
+            raise UpstreamUnavailable(f"upstream model unavailable after {self.attempts} attempts: {error}",
+                                      retry_after=max(1, math.ceil(self.backoff_base * 2 ** attempt))) from error
+        self._count("retries")
+        upstream_retries.inc(1, kind)
+        delay = self.backoff(attempt)
+        remaining = remaining_time()
+        return delay if remaining is None else max(0.0, min(delay, remaining))
+
+    def _succeeded(self, latency: float) -> None:
+        self.breaker.record_success()
+        self.limiter.on_success(latency)
+
+    def _start(self) -> float:
+        """Wait for the breaker and the rate limiter; returns the attempt's start time."""
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            upstream_rejected.inc(1, "deadline")
+            raise TimeoutError("model call deadline passed")
+        self.breaker.before_call()
+        try:
+            self.limiter.acquire(timeout=remaining)
+        except BaseException:
+            self.breaker.release()
+            raise
+        return time.perf_counter()
+
+    async def _astart(self) -> float:
+        self.breaker.before_call()
+        try:
+            await self.limiter.aacquire()
+        except BaseException:
+            self.breaker.release()
+            raise
+        return time.perf_counter()
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        self._count("calls")
+        for attempt in range(self.attempts):
+            start = self._start()
+            try:
+                result = self.model.invoke(input, config, **kwargs)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self._succeeded(time.perf_counter() - start)
+            return result
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        self._count("calls")
+        for attempt in range(self.attempts):
+            start = await self._astart()
+            try:
+                result = await self.model.ainvoke(input, config, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self._succeeded(time.perf_counter() - start)
+            return result
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        """Stream from the model; the latency fed to the rate limiter is the time to the first chunk."""
+        self._count("calls")
+        for attempt in range(self.attempts):
+            start = self._start()
+            upstream = self.model.stream(input, config, **kwargs)
+            started = False
+            try:
+                for chunk in upstream:
+                    if not started:
+                        started = True
+                        self._succeeded(time.perf_counter() - start)
+                    yield chunk
+            except Exception as e:
+                if started:
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            finally:
+                upstream.close()
+            if not started:
+                self._succeeded(time.perf_counter() - start)
+            return
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        self._count("calls")
+        for attempt in range(self.attempts):
+            start = await self._astart()
+            upstream = self.model.astream(input, config, **kwargs)
+            started = False
+            try:
+                async for chunk in upstream:
+                    if not started:
+                        started = True
+                        self._succeeded(time.perf_counter() - start)
+                    yield chunk
+            except Exception as e:
+                if started:
+                    raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            finally:
+                await upstream.aclose()
+            if not started:
+                self._succeeded(time.perf_counter() - start)
+            return
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = {"calls": self.calls, "retries": self.retries, "failures": self.failures}
+        return {**counts, "rate_limiter": self.limiter.stats(), "circuit_breaker": self.breaker.stats()}
+
+
+def guard_from_env(model: Runnable) -> GuardedModel:
+    """Wrap ``model`` with limits from LLM_RATE_*, LLM_RETRY_* and LLM_BREAKER_* environment variables."""
+    # Every worker process has its own limiter, so each one gets its share of the deployment's rate
+    workers = max(1, int(os.getenv("WORKERS", "1")))
+    limiter = AdaptiveRateLimiter(
+        rate=float(os.getenv("LLM_RATE_LIMIT", "5")) / workers,
+        burst=max(1, int(os.getenv("LLM_BURST", "10")) // workers),
+        min_rate=float(os.getenv("LLM_RATE_MIN", "0.5")) / workers,
+        max_rate=float(os.getenv("LLM_RATE_MAX", "50")) / workers,
+        target_latency=float(os.getenv("LLM_TARGET_LATENCY", "15")),
+        max_wait=float(os.getenv("LLM_RATE_WAIT", "30")),
+        max_queue=int(os.getenv("LLM_RATE_QUEUE", "256")),
+    )
+    breaker = CircuitBreaker(
+        failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30")),
+    )
+    return GuardedModel(
+        model, limiter, breaker,
+        attempts=int(os.getenv("LLM_RETRY_ATTEMPTS", "4")),
+        backoff_base=float(os.getenv("LLM_RETRY_BASE", "0.5")),
+        backoff_max=float(os.getenv("LLM_RETRY_MAX", "8")),
+    )
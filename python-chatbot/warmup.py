@@ -0,0 +1,91 @@
+"""
+Warm-up and readiness of a serving process.
+
+Importing the app is kept cheap. The Gemini SDK, the POML compiler and
+pypdf are imported, the prompt compiled and the model clients built when
+the first request needs them. That first request then waits a few
+seconds. A production worker runs the warm-up instead, so this work is
+done before traffic arrives. ``/api/health`` doubles as a readiness
+probe: it answers 503 while warm-up runs or after it failed, and 200
+otherwise.
+
+Configuration (environment variables):
+    WARMUP   off (default): load everything on first use
+             background: warm up in a thread at start-up; not ready until it is done
+             blocking: warm up before the server starts accepting requests
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+COLD, WARMING, READY, FAILED = "cold", "warming", "ready", "failed"
+MODES = ("off", "background", "blocking")
+
+
+class WarmUp:
+    """
+    Runs a process's warm-up steps once and tracks whether they are done.
+
+    Args:
+        steps (Sequence[Tuple[str, Callable]]): (name, function) pairs run in order
+    """
+
+    def __init__(self, steps: Sequence[Tuple[str, Callable[[], Any]]]):
+        self.steps = list(steps)
+        self.state = COLD
+        self.error: Optional[str] = None
+        self.step_ms: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        """False while warm-up runs or after it failed; a process that never warms up is ready, just slower at first."""
+        return self.state in (COLD, READY)
+
+    def run(self) -> bool:
+        """Run the steps unless they already ran; callers arriving meanwhile wait for them. Returns whether they succeeded."""
+        with self._lock:
+            if self.state in (READY, FAILED):
+                return self.state == READY
+            self.state = WARMING
+            start = time.perf_counter()
+            for name, step in self.steps:
+                step_start = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    self.state, self.error = FAILED, f"{name}: {e}"
+                    logger.exception("Warm-up step %s failed", name)
+                    return False
+                self.step_ms[name] = round((time.perf_counter() - step_start) * 1000, 1)
+            self.state = READY
+            logger.info("Warmed up in %.0f ms: %s", (time.perf_counter() - start) * 1000, self.step_ms)
+            return True
+
+    def start(self) -> threading.Thread:
+        """Run the warm-up in a background thread; the process reports not ready until it is done."""
+        with self._lock:
+            if self.state == COLD:
+                # Set here rather than in the thread, so a probe right after start() already sees it
+                self.state = WARMING
+        thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> Dict:
+        return {"state": self.state, "ready": self.ready, "error": self.error, "step_ms": dict(self.step_ms)}
+
+
+def warm_up_from_env(warmup: WarmUp) -> None:
+    """Start, run or skip ``warmup`` as the ``WARMUP`` environment variable says."""
+    mode = os.getenv("WARMUP", "off").strip().lower()
+    if mode not in MODES:
+        raise ValueError(f"WARMUP must be one of {', '.join(MODES)}, not {mode!r}")
+    if mode == "background":
+        warmup.start()
+    elif mode == "blocking":
+        warmup.run()
@@ -162,7 +162,9 @@ export class ChatComponent implements OnInit, OnDestroy, AfterViewChecked {
 
     // Send message to API
     this.subscriptions.add(
-      this.chatbotService.sendMessageWithRetry(event.message, event.files).subscribe({
+      // Voice replies are synthesized on the server when it can, so slow clients do not have to
+      this.chatbotService.sendMessageWithRetry(event.message, event.files,
+        event.isVoiceInput && this.audioService.getSettings().voiceResponseEnabled).subscribe({
         next: (response: ChatResponse) => {
           // Stop loading music
           this.audioService.stopLoadingMusic();
@@ -204,22 +206,34 @@ export class ChatComponent implements OnInit, OnDestroy, AfterViewChecked {
     );
 
     // Play voice response if it was voice input and voice response is enabled
-    if (wasVoiceInput && this.voiceService.isSpeechSynthesisSupported()) {
-      const audioSettings = this.audioService.getSettings();
-      if (audioSettings.voiceResponseEnabled) {
-        // Use louder voice settings for voice responses
-        this.voiceService.speak(response.response, {
-          volume: audioSettings.voiceResponseVolume,
-          rate: 0.9,
-          pitch: 1.1
-        }).catch(error => {
-          console.error('Error playing voice response:', error);
-          this.snackBar.open('Could not play voice response', 'Close', { duration: 3000 });
+    if (wasVoiceInput && this.audioService.getSettings().voiceResponseEnabled) {
+      if (response.audio?.length) {
+        const urls = response.audio.map(clip => this.chatbotService.speechUrl(clip));
+        this.audioService.playSpeech(urls).catch(error => {
+          console.warn('Server speech failed, speaking in the browser instead:', error);
+          this.speakInBrowser(response.response);
         });
+      } else {
+        this.speakInBrowser(response.response);
       }
     }
   }
 
+  private speakInBrowser(text: string): void {
+    if (!this.voiceService.isSpeechSynthesisSupported()) {
+      return;
+    }
+    // Use louder voice settings for voice responses
+    this.voiceService.speak(text, {
+      volume: this.audioService.getSettings().voiceResponseVolume,
+      rate: 0.9,
+      pitch: 1.1
+    }).catch(error => {
+      console.error('Error playing voice response:', error);
+      this.snackBar.open('Could not play voice response', 'Close', { duration: 3000 });
+    });
+  }
+
   private handleError(error: any, loadingMessageId: string): void {
     // Remove loading message
     this.messages = this.messages.filter(m => m.id !== loadingMessageId);
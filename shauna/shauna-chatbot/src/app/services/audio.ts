@@ -140,6 +140,29 @@ export class AudioService {
     }
   }
 
+  /**
+   * Play server-synthesized sentences one after another.
+   *
+   * Every clip starts downloading right away, so later sentences are
+   * ready when earlier ones finish. Rejects if a clip cannot be played,
+   * and the caller can fall back to browser speech.
+   */
+  async playSpeech(urls: string[], volume: number = this.settingsSubject.value.voiceResponseVolume): Promise<void> {
+    const clips = urls.map(url => {
+      const clip = new Audio(url);
+      clip.preload = 'auto';
+      clip.volume = volume;
+      return clip;
+    });
+    for (const clip of clips) {
+      await new Promise<void>((resolve, reject) => {
+        clip.onended = () => resolve();
+        clip.onerror = () => reject(new Error(`Could not play ${clip.src}`));
+        clip.play().catch(reject);
+      });
+    }
+  }
+
   /**
    * Update audio settings
    */
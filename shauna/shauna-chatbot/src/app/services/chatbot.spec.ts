@@ -1,16 +1,58 @@
-import { TestBed } from '@angular/core/testing';
+import { TestBed, fakeAsync, tick } from '@angular/core/testing';
+import { provideHttpClient } from '@angular/common/http';
+import { HttpTestingController, provideHttpClientTesting } from '@angular/common/http/testing';
 
-import { Chatbot } from './chatbot';
+import { ChatbotService } from './chatbot';
+import { environment } from '../../environments/environment';
 
-describe('Chatbot', () => {
-  let service: Chatbot;
+describe('ChatbotService', () => {
+  const chatUrl = `${environment.apiUrl}/chat`;
+  let service: ChatbotService;
+  let http: HttpTestingController;
 
   beforeEach(() => {
-    TestBed.configureTestingModule({});
-    service = TestBed.inject(Chatbot);
+    TestBed.configureTestingModule({
+      providers: [provideHttpClient(), provideHttpClientTesting()]
+    });
+    service = TestBed.inject(ChatbotService);
+    http = TestBed.inject(HttpTestingController);
+  });
+
+  afterEach(() => {
+    http.verify();
   });
 
   it('should be created', () => {
     expect(service).toBeTruthy();
   });
+
+  it('sends a message rejected with 400 only once', fakeAsync(() => {
+    let error: Error | undefined;
+    service.sendMessageWithRetry('hello').subscribe({ error: e => error = e });
+
+    http.expectOne(chatUrl).flush({ error: 'bad request' }, { status: 400, statusText: 'Bad Request' });
+    tick(60000);
+
+    http.expectNone(chatUrl);
+    expect(error?.message).toContain('400');
+  }));
+
+  it('retries a 503 maxRetries times under one Idempotency-Key', fakeAsync(() => {
+    let error: Error | undefined;
+    service.sendMessageWithRetry('hello').subscribe({ error: e => error = e });
+
+    const keys = new Set<string | null>();
+    // The first attempt and 3 retries, each after at most the doubled backoff
+    for (let attempt = 0; attempt < 4; attempt++) {
+      const request = http.expectOne(chatUrl);
+      keys.add(request.request.headers.get('Idempotency-Key'));
+      request.flush({ error: 'busy' }, { status: 503, statusText: 'Service Unavailable' });
+      tick(1000 * 2 ** attempt);
+    }
+    tick(60000);
+
+    http.expectNone(chatUrl);
+    expect(keys.size).toBe(1);
+    expect(error?.message).toContain('Service unavailable');
+  }));
 });
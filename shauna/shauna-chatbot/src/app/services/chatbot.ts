@@ -1,7 +1,7 @@
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpHeaders, HttpErrorResponse } from '@angular/common/http';
 import { Observable, of, throwError, timer } from 'rxjs';
-import { retry, catchError, delay, switchMap, map, timeout } from 'rxjs/operators';
+import { retry, catchError, switchMap, map, timeout } from 'rxjs/operators';
 import { environment } from '../../environments/environment';
 
 export interface ChatMessage {
@@ -14,10 +14,18 @@ export interface ChatMessage {
   }>;
 }
 
+/** One sentence of a spoken reply and where the server keeps its audio. */
+export interface SpeechClip {
+  text: string;
+  url: string;
+}
+
 export interface ChatResponse {
   response: string;
   timestamp: string;
   status: string;
+  /** Present when speech was requested; null if the server does not synthesize speech. */
+  audio?: SpeechClip[] | null;
 }
 
 export interface HealthResponse {
@@ -37,40 +45,48 @@ export class ChatbotService {
   constructor(private http: HttpClient) { }
 
   /**
-   * Send a chat message to the API
+   * Send a chat message to the API.
+   *
+   * Every retry of one message carries the same Idempotency-Key, so the
+   * server answers retries from the original call instead of calling the
+   * model again.
+   *
+   * With `speech`, the server also synthesizes the reply sentence by
+   * sentence and returns the clips' URLs in `audio`.
    */
-  sendMessage(message: string, files?: File[]): Observable<ChatResponse> {
+  sendMessage(message: string, files?: File[], idempotencyKey: string = crypto.randomUUID(), speech: boolean = false): Observable<ChatResponse> {
     // Use different endpoints based on whether files are attached
     const hasFiles = files && files.length > 0;
     const url = hasFiles ? `${this.apiUrl}/chat/upload` : `${this.apiUrl}/chat`;
+    const headers = new HttpHeaders({
+      'Content-Type': 'application/json',
+      'Idempotency-Key': idempotencyKey
+    });
     
     if (hasFiles) {
-      // Convert files to attachments and send to upload endpoint
+      // Convert files to attachments once and send to upload endpoint; only the POST is retried
       return this.convertFilesToAttachments(files).pipe(
         switchMap(attachments => {
           const body = { 
             message: message,
-            attachments: attachments 
+            attachments: attachments,
+            speech: speech
           };
-          const headers = new HttpHeaders({
-            'Content-Type': 'application/json'
-          });
-          return this.http.post<ChatResponse>(url, body, { headers });
+          return this.http.post<ChatResponse>(url, body, { headers }).pipe(
+            retry({ count: this.maxRetries, delay: this.retryBackoff })
+          );
         }),
-        retry(this.maxRetries),
         catchError(this.handleError)
       );
     } else {
       // Send JSON for text-only messages to regular chat endpoint
       const body = { 
         message: message,
-        attachments: [] 
+        attachments: [],
+        speech: speech
       };
-      const headers = new HttpHeaders({
-        'Content-Type': 'application/json'
-      });
       return this.http.post<ChatResponse>(url, body, { headers }).pipe(
-        retry(this.maxRetries),
+        retry({ count: this.maxRetries, delay: this.retryBackoff }),
         catchError(this.handleError)
       );
     }
@@ -122,6 +138,13 @@ export class ChatbotService {
     });
   }
 
+  /**
+   * Absolute URL of a spoken sentence's audio
+   */
+  speechUrl(clip: SpeechClip): string {
+    return new URL(clip.url, this.apiUrl).toString();
+  }
+
   /**
    * Check API health status
    */
@@ -139,24 +162,34 @@ export class ChatbotService {
   }
 
   /**
-   * Send message with retry logic and rate limiting
+   * Send a message under a fresh Idempotency-Key.
+   *
+   * The retries happen in `sendMessage`, on the raw HttpErrorResponse, so
+   * the status and Retry-After decide them; errors are turned into
+   * messages only after the last attempt, and are not retried again here.
    */
-  sendMessageWithRetry(message: string, files?: File[]): Observable<ChatResponse> {
-    return timer(0).pipe(
-      switchMap(() => this.sendMessage(message, files)),
-      retry({
-        count: this.maxRetries,
-        delay: (error, retryCount) => {
-          if (retryCount <= this.maxRetries) {
-            return timer(this.retryDelay * retryCount);
-          }
-          return throwError(() => error);
-        }
-      }),
-      catchError(this.handleError)
-    );
+  sendMessageWithRetry(message: string, files?: File[], speech: boolean = false): Observable<ChatResponse> {
+    return this.sendMessage(message, files, crypto.randomUUID(), speech);
   }
 
+  /**
+   * Delay before retrying a failed request.
+   *
+   * Client errors other than 429 are not retried. When the server is
+   * overloaded (429/503) it says how long to wait in Retry-After; otherwise
+   * the wait doubles per attempt, with jitter so clients do not retry in step.
+   */
+  private retryBackoff = (error: HttpErrorResponse, retryCount: number): Observable<number> => {
+    if (error.status >= 400 && error.status < 500 && error.status !== 429) {
+      return throwError(() => error);
+    }
+    const retryAfter = Number(error.headers?.get('Retry-After'));
+    const backoff = retryAfter > 0
+      ? retryAfter * 1000
+      : this.retryDelay * 2 ** (retryCount - 1);
+    return timer(backoff / 2 + Math.random() * backoff / 2);
+  };
+
   /**
    * Handle HTTP errors
    */
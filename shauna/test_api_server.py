@@ -5,10 +5,11 @@ Implements the exact endpoints expected by the Angular frontend
 """
 
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import datetime
 import logging
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -76,6 +77,35 @@ def chat():
             "message": str(e)
         }), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming chat endpoint - sends the echo response word by word as Server-Sent Events"""
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message', '')
+    delay = float(request.args.get('delay', 0.05))
+    logger.info(f"Received streaming message: {user_message}")
+
+    response_text = f"Hello! You said: '{user_message}'. I'm Shauna, your AI assistant. How can I help you today?"
+
+    def generate():
+        sent = 0
+        try:
+            for i, word in enumerate(response_text.split(' ')):
+                time.sleep(delay)
+                token = word if i == 0 else ' ' + word
+                sent += 1
+                yield f"data: {json.dumps({'token': token})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'attachments_processed': len(data.get('attachments', []))})}\n\n"
+        except GeneratorExit:
+            logger.info(f"Client disconnected after {sent} tokens")
+            raise
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/', methods=['GET'])
 def api_info():
     """API information endpoint"""
@@ -84,7 +114,8 @@ def api_info():
         "version": "1.0.0",
         "endpoints": {
             "health": "/api/health",
-            "chat": "/api/chat"
+            "chat": "/api/chat",
+            "chat_stream": "/api/chat/stream"
         }
     })
 
@@ -101,6 +132,7 @@ if __name__ == '__main__':
     print("Endpoints:")
     print("  GET  /api/health - Health check")
     print("  POST /api/chat    - Send chat message")
+    print("  POST /api/chat/stream - Stream chat response (SSE)")
     print("  GET  /api/        - API information")
     print("\nServer will run on https://localhost:4000")
     print("CORS is enabled for all origins")